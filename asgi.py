@@ -0,0 +1,12 @@
+
+from kapricorn import create_app
+from kapricorn.asgi import create_asgi_app
+import os
+
+from dotenv import load_dotenv
+basedir = os.path.abspath(os.path.dirname(__file__))
+load_dotenv(os.path.join(basedir, '.env'))
+
+# ASGI entry point, e.g. `uvicorn asgi:app --host 0.0.0.0 --port 5000`
+# (run.py / gunicorn keep serving the plain WSGI app)
+app = create_asgi_app(create_app())
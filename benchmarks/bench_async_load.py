@@ -0,0 +1,117 @@
+# File: benchmarks/bench_async_load.py
+
+"""
+Concurrent chat load: thread-per-request WSGI vs the asyncio ASGI path.
+
+Both sides run in-process against the stub model with `--latency-ms` of
+injected generation latency:
+
+* wsgi  - `--threads` worker threads (a gunicorn worker's thread budget)
+          drive the Flask test client, so at most that many model calls
+          are in flight at once;
+* asgi  - all `--requests` are issued at once to kapricorn.asgi.AsgiApp
+          on one event loop, as an ASGI server would.
+
+    python benchmarks/bench_async_load.py --requests 400 --threads 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn import create_app
+from kapricorn.asgi import create_asgi_app
+from kapricorn.clients import ModelRegistry
+from kapricorn.stub_backend import stub_model_factory
+
+
+def make_app(latency):
+    app = create_app()
+    app.config.update(FREE_CHAT_MODEL_NAME='stub-chat', GOOGLE_API_KEY_FREE_CHAT='stub-key',
+                      PROMPT_CACHE_ENABLED=False, VISUALS_ASYNC=True)
+    app.extensions['prompt_cache'].enabled = False
+    app.extensions.pop('faq_cache', None) # The templated questions would be answered from it
+    app.extensions['scheduler'].enabled = False # Compare the serving models, not admission control
+    app.extensions['async_scheduler'].enabled = False
+    app.extensions['model_registry'] = ModelRegistry(model_factory=stub_model_factory(
+        reply='<r>Space cassava 1m x 1m.</r><cls>FI</cls>', latency=latency))
+    return app
+
+
+def body(index):
+    # Distinct messages so single-flight does not coalesce them
+    return {'message': f"Question {index}: when should I plant cassava?", 'history': []}
+
+
+def report(label, latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"{label:<6} {len(latencies) / elapsed:8.1f} req/s   p50 {p(0.50):8.1f} ms   "
+          f"p95 {p(0.95):8.1f} ms   p99 {p(0.99):8.1f} ms   errors {errors}")
+
+
+def run_wsgi(app, requests, threads):
+    client = app.test_client()
+
+    start = time.perf_counter()
+
+    def one(index):
+        # Latency counts from when all requests arrived, so queueing for a thread is included
+        status = client.post('/api/chat/', json=body(index)).status_code
+        return time.perf_counter() - start, status
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    report('wsgi', [r[0] for r in results], elapsed, sum(1 for r in results if r[1] != 200))
+
+
+async def asgi_request(asgi_app, payload):
+    data = json.dumps(payload).encode()
+    scope = {'type': 'http', 'method': 'POST', 'path': '/api/chat/', 'query_string': b'',
+             'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(data)).encode())],
+             'server': ('bench', 80), 'client': ('127.0.0.1', 0), 'scheme': 'http', 'http_version': '1.1'}
+    messages = [{'type': 'http.request', 'body': data, 'more_body': False}]
+    status = {}
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+
+    start = time.perf_counter()
+    await asgi_app(scope, receive, send)
+    return time.perf_counter() - start, status.get('code')
+
+
+async def run_asgi(app, requests):
+    asgi_app = create_asgi_app(app)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(asgi_request(asgi_app, body(i)) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    report('asgi', [r[0] for r in results], elapsed, sum(1 for r in results if r[1] != 200))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--latency-ms', type=float, default=500.0)
+    args = parser.parse_args()
+
+    app = make_app(args.latency_ms / 1000)
+    print(f"{args.requests} chat requests, {args.latency_ms:.0f} ms model latency")
+    run_wsgi(app, args.requests, args.threads)
+    asyncio.run(run_asgi(app, args.requests))
+
+
+if __name__ == '__main__':
+    main()
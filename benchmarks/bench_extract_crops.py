@@ -0,0 +1,109 @@
+# File: benchmarks/bench_extract_crops.py
+
+"""
+extractCropsInfo: the legacy multi-hop regex vs the streaming CropRecordParser.
+
+Well-formed inputs have `--crops` records in formatLocationInfo's tagged
+format. Adversarial inputs are the shapes that hurt the regex: many crop
+headers whose later fields never appear (the nested lazy hops retry every
+split of the remaining text, so keep `--adversarial-crops` small), and a
+batch where one record has a "60-70%" survivability (the legacy parser
+raises and loses every crop).
+
+    python benchmarks/bench_extract_crops.py --crops 200
+"""
+
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn.prompts import extractCropsInfo
+
+RECORD = """<crop>Crop {i}</crop>
+<description>Crop {i} is a staple that tolerates warm, humid lowland conditions and acidic soils.</description>
+<challenges>
+- Heavy rains in July and August waterlog poorly drained plots
+- Fall armyworm pressure during early vegetative stages
+</challenges>
+<survivability>{survivability}</survivability>
+<reasons>
+- Reliable bimodal rainfall supports two seasons
+- Volcanic soils are rich in organic matter
+</reasons>
+
+"""
+
+
+def legacy_extract_crops_info(tagged_response):
+    """The pre-streaming implementation (one VERBOSE/DOTALL regex, float() on survivability)."""
+    pattern = r"""
+    <crop>(.*?)</crop>
+    .*?<description>(.*?)</description>
+    .*?<challenges>(.*?)</challenges>
+    .*?<survivability>(.*?)</survivability>
+    .*?<reasons>(.*?)</reasons>
+    """
+    crops = {}
+    for match in re.findall(pattern, tagged_response, re.DOTALL | re.VERBOSE):
+        crops[match[0].strip()] = {
+            "description": match[1].strip(),
+            "challenges": [line.strip("- ").strip() for line in match[2].split("\n") if line.strip()],
+            "survivability": float(match[3].strip("%").strip()),
+            "reasons": [line.strip("- ").strip() for line in match[4].split("\n") if line.strip()],
+        }
+    return crops
+
+
+def well_formed(count):
+    return ''.join(RECORD.format(i=i, survivability=f"{40 + i % 50}%") for i in range(count))
+
+
+def truncated_fields(count):
+    # Every record stops after its description: each regex attempt runs to the end of the text
+    return ''.join(f"<crop>Crop {i}</crop>\n<description>Partial output {i}.</description>\n" for i in range(count))
+
+
+def one_bad_value(count):
+    return ''.join(RECORD.format(i=i, survivability="60-70%" if i == count // 2 else "55%") for i in range(count))
+
+
+def run(fn, text, repeat):
+    samples, outcome = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            outcome = f"{len(fn(text))} crops"
+        except ValueError as e:
+            outcome = f"raised ValueError ({e})"
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--crops', type=int, default=200)
+    parser.add_argument('--adversarial-crops', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [
+        ('well-formed', well_formed(args.crops)),
+        ('well-formed x10', well_formed(args.crops * 10)),
+        ('truncated fields', truncated_fields(args.adversarial_crops)),
+        ('truncated fields x2', truncated_fields(args.adversarial_crops * 2)),
+        ('one "60-70%" value', one_bad_value(args.crops)),
+    ]
+    for label, text in cases:
+        print(f"--- {label}: {len(text) / 1024:.0f} KB ---")
+        for name, fn in (('legacy regex', legacy_extract_crops_info), ('streaming parser', extractCropsInfo)):
+            median_ms, outcome = run(fn, text, args.repeat)
+            print(f"{name:<18} p50 {median_ms:9.2f} ms   {outcome}")
+
+
+if __name__ == '__main__':
+    main()
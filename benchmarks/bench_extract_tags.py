@@ -0,0 +1,93 @@
+# File: benchmarks/bench_extract_tags.py
+
+"""
+extract_tags: per-tag regex scans (legacy) vs the single-pass TagParser.
+
+Builds synthetic farmBot outputs of 2-20 KB (long <r> replies, a <gen>
+block, <gr>/<cls>, occasional repeated tags) and times both extractors on
+each, after checking they agree on every input.
+
+    python benchmarks/bench_extract_tags.py --iterations 2000
+"""
+
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn.prompts import extract_tags
+from kapricorn.tag_parser import TagParser
+
+TAGS = ['p', 'g', 'r', 'gr', 'cls', 'gen']
+SENTENCE = ("Apply well-rotted manure two weeks before planting and keep the ridges 75 cm apart; "
+            "watch for fall armyworm on the leaf whorls after rain. ")
+
+
+def legacy_extract_tags(response, tags=TAGS):
+    """The pre-TagParser implementation: one regex scan per tag."""
+    extracted_data = {}
+    for tag in tags:
+        pattern = r'<{0}>(.*?)</{0}>'.format(tag)
+        matches = re.findall(pattern, response, re.DOTALL)
+        extracted_data[tag] = matches[0].strip() if matches else None
+    return extracted_data
+
+
+def make_output(size, rng):
+    reply = []
+    while sum(len(s) for s in reply) < size:
+        reply.append(SENTENCE)
+    parts = [f"<r>{''.join(reply)}</r>", "<gr>Noted your maize farm.</gr>"]
+    if rng.random() < 0.5:
+        parts.append("<gen>Maize|timeline|Farm A|2024-06-01|N: 40, P: 20, K: 20</gen>")
+    if rng.random() < 0.3:
+        parts.append("<r>A repeated reply the parser must ignore.</r>")
+    parts.append("<cls>MF</cls>")
+    return '\n'.join(parts)
+
+
+def timed(fn, inputs, iterations):
+    samples = []
+    for i in range(iterations):
+        text = inputs[i % len(inputs)]
+        start = time.perf_counter()
+        fn(text)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(label, samples):
+    print(f"{label:<22} mean {statistics.mean(samples):9.1f} us   p50 {statistics.median(samples):9.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size_kb in (2, 5, 10, 20):
+        inputs = [make_output(size_kb * 1024, rng) for _ in range(20)]
+        for text in inputs:
+            assert extract_tags(text) == legacy_extract_tags(text), "extractors disagree"
+
+        print(f"--- {size_kb} KB outputs ---")
+        report("legacy (per-tag re)", timed(legacy_extract_tags, inputs, args.iterations))
+        report("single pass", timed(extract_tags, inputs, args.iterations))
+
+        def streamed(text, chunk=64):
+            tag_parser = TagParser(TAGS)
+            for i in range(0, len(text), chunk):
+                tag_parser.feed(text[i:i + chunk])
+            return tag_parser.result()
+        report("single pass, streamed", timed(streamed, inputs, max(1, args.iterations // 10)))
+
+
+if __name__ == '__main__':
+    main()
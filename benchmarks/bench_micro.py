@@ -0,0 +1,83 @@
+# File: benchmarks/bench_micro.py
+
+"""
+Micro-benchmarks for the CPU-bound steps of a request, on recorded model outputs.
+
+Times extract_tags on farmBot replies, extractCropsInfo on a formatted
+recommendation (and crops_from_json on its JSON-mode twin), string_to_dict
+(ast and json) and visuals_from_json on visualsBot <data> payloads and
+processChats on `--turns` long histories built from the
+recorded replies. Reports mean, p50 and p95 per call.
+
+    python benchmarks/bench_micro.py --iterations 5000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn.prompts import extract_tags, extractCropsInfo, processChats, string_to_dict
+from kapricorn.schemas import crops_from_json, visuals_from_json
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), 'recordings', 'gemini_outputs.json')
+
+
+def texts(recordings, kind):
+    return [record['text'] for record in recordings.get(kind, [])]
+
+
+def history(replies, turns):
+    chats = []
+    for index in range(turns):
+        chats.append({'role': 'user', 'parts': [f"Question {index} about my maize farm?"]})
+        chats.append({'role': 'model', 'parts': [replies[index % len(replies)]]})
+    chats.append({'role': 'user', 'parts': ["What should I do next?"]})
+    return chats
+
+
+def bench(label, fn, inputs, iterations):
+    timings = []
+    for index in range(iterations):
+        argument = inputs[index % len(inputs)]
+        start = time.perf_counter()
+        fn(argument)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    p = lambda q: timings[min(len(timings) - 1, int(q * len(timings)))] * 1e6
+    print(f"{label:<28} mean {statistics.fmean(timings) * 1e6:9.1f} us   "
+          f"p50 {p(0.50):9.1f} us   p95 {p(0.95):9.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--turns', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--recordings', default=RECORDINGS)
+    args = parser.parse_args()
+
+    with open(args.recordings, encoding='utf-8') as f:
+        recordings = json.load(f)
+    replies = texts(recordings, 'farmBot')
+    payloads = [extract_tags(text, ['data'])['data'] for text in texts(recordings, 'visualsBot')]
+
+    print(f"{args.iterations} iterations per benchmark, recordings from {os.path.basename(args.recordings)}\n")
+    bench('extract_tags', extract_tags, replies, args.iterations)
+    bench('extractCropsInfo', extractCropsInfo, texts(recordings, 'formatting'), args.iterations)
+    bench('string_to_dict (ast)', string_to_dict, payloads, args.iterations)
+    bench('string_to_dict (json)', lambda payload: string_to_dict(payload, method='json'), payloads, args.iterations)
+    bench('crops_from_json', crops_from_json, texts(recordings, 'formatting_json'), args.iterations)
+    bench('visuals_from_json', visuals_from_json, payloads, args.iterations)
+    for turns in args.turns:
+        chats = [history(replies, turns)]
+        bench(f'processChats ({turns} turns)',
+              lambda c: processChats(c, npk='N:40,P:20,K:20', location='Ibadan', date='2024-06-01'),
+              chats, args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# File: benchmarks/bench_process_chats.py
+
+"""
+Per-turn history preparation: deepcopy + full re-sanitization (legacy) vs the
+incremental processChats / _build_contents path.
+
+Builds 50- and 200-turn conversations where every `--image-every`th user
+turn carries a ~`--image-kb` KB base64 image, then measures CPU time and
+tracemalloc peak for preparing the next turn (processChats followed by
+the sanitization call_ai_model runs before sending).
+
+    python benchmarks/bench_process_chats.py --turns 50 200
+"""
+
+import argparse
+import base64
+import copy
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn.ai_service import _build_contents, _sanitize_part
+from kapricorn.prompts import processChats, startChats
+
+
+def legacy_process_chats(chats, npk=None, location=None, date=None):
+    """The pre-incremental processChats: deepcopy everything, edit the last user message."""
+    processed_chats = copy.deepcopy(chats)
+    for message in reversed(processed_chats):
+        if message.get('role') == 'user':
+            parts = message['parts']
+            for i, part in enumerate(parts):
+                if isinstance(part, str):
+                    parts[i] = f"<p>{part}</p><g>System Context: Location: {location}</g>"
+                    break
+            break
+    return startChats + processed_chats
+
+
+def legacy_build_contents(history):
+    """The pre-incremental sanitization loop: rebuild every message and part."""
+    contents = []
+    for message in history:
+        parts = [p for p in (_sanitize_part(part) for part in message['parts']) if p is not None]
+        if parts:
+            contents.append({'role': message['role'], 'parts': parts})
+    return contents
+
+
+def make_history(turns, image_every, image_kb):
+    image = base64.b64encode(os.urandom(image_kb * 768)).decode('ascii')
+    history = []
+    for turn in range(turns):
+        parts = [f"Question {turn}: how should I space my cassava rows on sloped land?"]
+        if image_every and turn % image_every == 0:
+            parts.append({'inline_data': {'mime_type': 'image/jpeg', 'data': image}})
+        history.append({'role': 'user', 'parts': parts})
+        history.append({'role': 'model', 'parts': [f"<r>Answer {turn}: plant along the contours.</r><cls>MF</cls>"]})
+    history.append({'role': 'user', 'parts': ["And what about fertilizer?"]})
+    return history
+
+
+def legacy_turn(history):
+    return legacy_build_contents(legacy_process_chats(history, location='Buea'))
+
+
+def incremental_turn(history):
+    contents, _ = _build_contents(processChats(history, location='Buea'))
+    return contents
+
+
+def measure(fn, history, repeat):
+    cpu = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn(history)
+        cpu.append((time.process_time() - start) * 1000)
+    tracemalloc.start()
+    fn(history)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(cpu), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--image-every', type=int, default=5)
+    parser.add_argument('--image-kb', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    for turns in args.turns:
+        history = make_history(turns, args.image_every, args.image_kb)
+        print(f"--- {turns} turns ({len(history)} messages) ---")
+        for label, fn in (('legacy', legacy_turn), ('incremental', incremental_turn)):
+            cpu_ms, peak_kb = measure(fn, history, args.repeat)
+            print(f"{label:<12} cpu p50 {cpu_ms:8.2f} ms   peak alloc {peak_kb:10.1f} KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# File: benchmarks/bench_rate_limiter.py
+
+"""
+Chat bursts against a quota-limited stub key, with and without the rate governor.
+
+The stub key admits `--quota-requests` calls per `--quota-window` seconds
+and `--quota-concurrency` at once, answering 429 (ResourceExhausted)
+beyond that, like the real API. The governor is deliberately configured
+above the quota (`--governor-rpm`, `--governor-concurrency`) so it has to
+learn the real limit from the 429s.
+
+    python benchmarks/bench_rate_limiter.py --requests 120 --threads 32
+"""
+
+import argparse
+import collections
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn import create_app
+from kapricorn.clients import ModelRegistry
+from kapricorn.ratelimit import RateGovernor
+from kapricorn.stub_backend import stub_model_factory
+
+
+def make_app(args, governed):
+    app = create_app()
+    app.config.update(FREE_CHAT_MODEL_NAME='stub-chat', GOOGLE_API_KEY_FREE_CHAT='stub-key',
+                      PROMPT_CACHE_ENABLED=False, VISUALS_ASYNC=True)
+    app.extensions['prompt_cache'].enabled = False
+    quota = dict(requests_per_minute=args.quota_requests, max_concurrency=args.quota_concurrency,
+                 window_seconds=args.quota_window)
+    app.extensions['model_registry'] = ModelRegistry(model_factory=stub_model_factory(
+        quota_per_key=quota, reply='<r>Space cassava 1m x 1m.</r><cls>FI</cls>', latency=args.latency_ms / 1000))
+    app.extensions['rate_governor'] = RateGovernor(
+        {'stub-key': (args.governor_rpm, args.governor_concurrency)},
+        enabled=governed, max_wait_seconds=args.max_wait)
+    return app
+
+
+def run(label, app, args):
+    client = app.test_client()
+    start = time.perf_counter()
+
+    def one(index):
+        response = client.post('/api/chat/', json={'message': f"Question {index} about cassava", 'history': []})
+        return response.status_code, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    statuses = collections.Counter(status for status, _ in results)
+    ok = sorted(latency for status, latency in results if status == 200)
+    p = lambda q: ok[min(len(ok) - 1, int(q * len(ok)))] * 1000 if ok else 0.0
+    print(f"{label:<10} ok {statuses.get(200, 0):4d}   429 {statuses.get(429, 0):4d}   "
+          f"500 {statuses.get(500, 0):4d}   {elapsed:6.2f} s   ok p50 {p(0.5):8.1f} ms   p95 {p(0.95):8.1f} ms")
+    if label == 'governed':
+        stats = app.extensions['rate_governor'].stats()
+        for fingerprint, key_stats in stats.items():
+            print(f"           key {fingerprint}: {key_stats}")
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=120)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--latency-ms', type=float, default=100)
+    parser.add_argument('--quota-requests', type=int, default=10, help="stub calls admitted per window")
+    parser.add_argument('--quota-window', type=float, default=1.0)
+    parser.add_argument('--quota-concurrency', type=int, default=4)
+    parser.add_argument('--governor-rpm', type=float, default=1200)
+    parser.add_argument('--governor-concurrency', type=int, default=8)
+    parser.add_argument('--max-wait', type=float, default=15.0)
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR) # Every rejected request logs; keep the report readable
+
+    print(f"{args.requests} requests, {args.threads} threads, stub quota {args.quota_requests}/"
+          f"{args.quota_window:g}s x{args.quota_concurrency}, {args.latency_ms:g} ms latency\n")
+    run('ungoverned', make_app(args, governed=False), args)
+    time.sleep(args.quota_window) # Let the stub window drain between runs
+    run('governed', make_app(args, governed=True), args)
+
+
+if __name__ == '__main__':
+    main()
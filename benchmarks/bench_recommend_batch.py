@@ -0,0 +1,146 @@
+# File: benchmarks/bench_recommend_batch.py
+
+"""
+A cooperative report for `--villages` locations: one /api/recommend/crops
+call per village, serially (as the dashboards do), vs one streamed
+/api/recommend/crops/batch call.
+
+Both run in-process on a fresh app against the recorded analysis /
+formatting outputs in benchmarks/recordings, with their latencies
+multiplied by `--latency-scale`. `--duplicates` of the villages are
+repeated with different spelling, as they are in real reports, and
+`--cached` of them were recommended before (warm cache). Replayed
+analyses repeat word for word, so identical formatting calls would be
+coalesced by single-flight; it is bypassed unless `--coalesce` is given,
+to count the calls real (distinct) analyses would make. The stub keys
+are rate governed with the default RATE_LIMITS for the keys they stand in
+for, so the run is paced as production would be.
+
+    python benchmarks/bench_recommend_batch.py --villages 200 --latency-scale 0.01
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn import create_app
+from kapricorn.cache import normalize_location
+from kapricorn.clients import ModelRegistry
+from kapricorn.ratelimit import RateGovernor, parse_rate_limits
+from kapricorn.stub_backend import ReplayBackend, stub_model_factory
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), 'recordings', 'gemini_outputs.json')
+
+
+class NoCoalescing:
+    """SingleFlight stand-in that runs every call."""
+
+    def do(self, key, fn):
+        return fn(), False
+
+    def stats(self):
+        return {}
+
+
+def make_app(args):
+    app = create_app()
+    app.config.update(
+        PAID_MODEL_NAME='stub-paid', GOOGLE_API_KEY_RECOMENDATIONS='stub-recommend-key',
+        FREE_ACCESSORY_MODEL_NAME='stub-accessory', GOOGLE_API_KEY_FREE_ACCESSORY='stub-accessory-key',
+    )
+    app.extensions['prompt_cache'].enabled = False
+    limits = parse_rate_limits(app.config.get('RATE_LIMITS'))
+    app.extensions['rate_governor'] = RateGovernor(
+        {'stub-recommend-key': limits['RECOMENDATIONS'], 'stub-accessory-key': limits['FREE_ACCESSORY']},
+        max_wait_seconds=app.config.get('RATE_LIMIT_MAX_WAIT_SECONDS', 10),
+        max_queue=app.config.get('RATE_LIMIT_MAX_QUEUE', 100),
+    )
+    replay = ReplayBackend.from_file(RECORDINGS, latency_scale=args.latency_scale)
+    app.extensions['model_registry'] = ModelRegistry(model_factory=stub_model_factory(reply=replay))
+    if not args.coalesce:
+        app.extensions['single_flight'] = NoCoalescing()
+    return app, replay
+
+
+def report_locations(args):
+    rng = random.Random(args.seed)
+    villages = [f"Village {index}, Oyo, Nigeria" for index in range(args.villages)]
+    repeats = [f"  village {index},  OYO, nigeria." for index in rng.sample(range(args.villages),
+                                                                          int(args.duplicates * args.villages))]
+    warm = rng.sample(villages, int(args.cached * args.villages))
+    return villages + repeats, warm
+
+
+def warm_cache(app, warm):
+    cache = app.extensions['recommendation_cache']
+    crops = {'Maize': {'description': 'Cereal.', 'survivability': 75.0, 'reasons': [], 'challenges': []}}
+    for location in warm:
+        cache.set(normalize_location(location), crops)
+
+
+def run_serial(args, locations, warm):
+    app, replay = make_app(args)
+    warm_cache(app, warm)
+    client = app.test_client()
+    start = time.perf_counter()
+    ok = 0
+    for location in locations:
+        response = client.post('/api/recommend/crops', json={'location': location})
+        ok += response.status_code == 200
+    return time.perf_counter() - start, ok, None, replay
+
+
+def run_batch(args, locations, warm):
+    app, replay = make_app(args)
+    warm_cache(app, warm)
+    client = app.test_client()
+    start = time.perf_counter()
+    first_line = None
+    ok = 0
+    response = client.post('/api/recommend/crops/batch', json={'locations': locations}, buffered=False)
+    summary = None
+    for raw in response.response:
+        for line in raw.decode('utf-8').splitlines():
+            if first_line is None:
+                first_line = time.perf_counter() - start
+            record = json.loads(line)
+            if 'summary' in record:
+                summary = record['summary']
+            elif 'recommendations' in record:
+                ok += 1
+    response.close()
+    return time.perf_counter() - start, ok, (first_line, summary), replay
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--villages', type=int, default=200)
+    parser.add_argument('--duplicates', type=float, default=0.1, help="share of villages listed twice")
+    parser.add_argument('--cached', type=float, default=0.2, help="share of villages already cached")
+    parser.add_argument('--latency-scale', type=float, default=0.01, help="multiplier on recorded latencies")
+    parser.add_argument('--coalesce', action='store_true', help="keep single-flight coalescing on")
+    parser.add_argument('--skip-serial', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    locations, warm = report_locations(args)
+    print(f"{len(locations)} locations ({args.villages} villages, {args.cached:.0%} cached), "
+          f"replay x{args.latency_scale:g} latency\n")
+    if not args.skip_serial:
+        elapsed, ok, _, replay = run_serial(args, locations, warm)
+        print(f"serial   {elapsed:8.2f} s   {ok} ok responses   model calls {dict(replay.served)}")
+    elapsed, ok, (first_line, summary), replay = run_batch(args, locations, warm)
+    print(f"batch    {elapsed:8.2f} s   {ok} ok lines (first after {first_line * 1000:.0f} ms)   "
+          f"model calls {dict(replay.served)}")
+    print(f"         summary {summary}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# File: benchmarks/bench_resilience.py
+
+"""
+Chat tail latency and error rate with and without retries and hedging.
+
+The stub model fails `--error-rate` of calls with ServiceUnavailable and
+makes `--slow-rate` of them take `--slow-ms` instead of `--latency-ms`.
+The baseline run allows a single attempt and no hedging; the resilient
+run uses the configured retry policy and hedges calls that outlast the
+model's recent p95 (within `--hedge-budget`). Rate governing is off so
+only the resilience layer is measured.
+
+    python benchmarks/bench_resilience.py --requests 400 --threads 8
+"""
+
+import argparse
+import collections
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn import create_app
+from kapricorn.clients import ModelRegistry
+from kapricorn.stub_backend import stub_model_factory
+
+
+def make_app(args, resilient):
+    app = create_app()
+    app.config.update(FREE_CHAT_MODEL_NAME='stub-chat', GOOGLE_API_KEY_FREE_CHAT='stub-key',
+                      PROMPT_CACHE_ENABLED=False, VISUALS_ASYNC=True)
+    app.extensions['prompt_cache'].enabled = False
+    app.extensions['rate_governor'].enabled = False
+    app.extensions['model_registry'] = ModelRegistry(model_factory=stub_model_factory(
+        reply='<r>Space cassava 1m x 1m.</r><cls>FI</cls>', latency=args.latency_ms / 1000,
+        error_rate=args.error_rate, slow_rate=args.slow_rate, slow_latency=args.slow_ms / 1000))
+    policy = app.extensions['resilience']
+    policy.base_delay = args.retry_base_ms / 1000
+    policy.hedge_budget = args.hedge_budget
+    if not resilient:
+        policy.max_attempts = 1
+        policy.hedge_enabled = False
+    return app
+
+
+def run(label, app, args):
+    client = app.test_client()
+
+    def one(index):
+        start = time.perf_counter()
+        status = client.post('/api/chat/', json={'message': f"Question {index} about maize", 'history': []}).status_code
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    statuses = collections.Counter(status for status, _ in results)
+    ok = sorted(latency for status, latency in results if status == 200)
+    p = lambda q: ok[min(len(ok) - 1, int(q * len(ok)))] * 1000 if ok else 0.0
+    print(f"{label:<10} ok {statuses.get(200, 0):4d}   failed {args.requests - statuses.get(200, 0):4d}   "
+          f"{elapsed:6.2f} s   p50 {p(0.5):7.1f} ms   p95 {p(0.95):7.1f} ms   p99 {p(0.99):7.1f} ms")
+    stats = app.extensions['resilience'].stats()
+    print(f"           attempts {stats['attempts']}  retries {stats['retries']}  "
+          f"hedges {stats['hedges']} (won {stats['hedge_wins']})  hedge delay {stats['hedge_delay_ms']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=40)
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--slow-rate', type=float, default=0.03)
+    parser.add_argument('--slow-ms', type=float, default=1000)
+    parser.add_argument('--retry-base-ms', type=float, default=20)
+    parser.add_argument('--hedge-budget', type=float, default=0.05)
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR) # Every simulated failure logs; keep the report readable
+
+    print(f"{args.requests} requests, {args.threads} threads, {args.latency_ms:g} ms latency, "
+          f"{args.error_rate:.0%} errors, {args.slow_rate:.0%} at {args.slow_ms:g} ms\n")
+    run('baseline', make_app(args, resilient=False), args)
+    run('resilient', make_app(args, resilient=True), args)
+
+
+if __name__ == '__main__':
+    main()
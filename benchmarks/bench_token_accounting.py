@@ -0,0 +1,79 @@
+# File: benchmarks/bench_token_accounting.py
+
+"""
+Per-chat-turn latency: count_tokens round-trips vs usage_metadata accounting.
+
+Runs against the stub backend, so no API quota is used. The stub charges
+`--generate-ms` per generation and `--count-ms` per count_tokens call,
+which stands in for the network round-trip the old path paid twice.
+
+    python benchmarks/bench_token_accounting.py --turns 50
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from kapricorn import create_app
+from kapricorn.ai_service import call_ai_model
+from kapricorn.clients import ModelRegistry
+from kapricorn.prompts import processChats
+from kapricorn.stub_backend import stub_model_factory
+
+MODEL = 'gemini-1.5-flash'
+REPLY = "<r>Plant cassava after the first rains, spacing 1m x 1m.</r><gr>Received.</gr><cls>FI</cls>" * 4
+
+
+def legacy_turn(model, contents):
+    """The pre-accounting flow: count input, generate, count output."""
+    input_tokens = model.count_tokens(contents).total_tokens
+    response = model.generate_content(contents)
+    output_tokens = model.count_tokens(response.text).total_tokens
+    return input_tokens, output_tokens
+
+
+def timed(fn, turns):
+    samples = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(label, samples):
+    print(f"{label:<22} mean {statistics.mean(samples):8.2f} ms   p50 {statistics.median(samples):8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=30)
+    parser.add_argument('--generate-ms', type=float, default=400.0)
+    parser.add_argument('--count-ms', type=float, default=120.0)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.extensions['prompt_cache'].enabled = False
+    app.extensions['model_registry'] = ModelRegistry(model_factory=stub_model_factory(
+        reply=REPLY, latency=args.generate_ms / 1000, count_latency=args.count_ms / 1000))
+
+    history = processChats([{'role': 'user', 'parts': ['When should I plant cassava?']}],
+                           location='Ibadan, Nigeria', npk='N:20,P:15,K:10', date='2025-04-02')
+
+    with app.app_context():
+        model = app.extensions['model_registry'].get_model('bench-key', MODEL)
+        legacy = timed(lambda: legacy_turn(model, history), args.turns)
+        current = timed(lambda: call_ai_model(history, MODEL, 'bench-key'), args.turns)
+
+    report('count_tokens x2', legacy)
+    report('usage_metadata', current)
+    saved = statistics.mean(legacy) - statistics.mean(current)
+    print(f"saved per turn: {saved:.2f} ms ({saved / statistics.mean(legacy):.0%})")
+
+
+if __name__ == '__main__':
+    main()
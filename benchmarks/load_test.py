@@ -0,0 +1,210 @@
+# File: benchmarks/load_test.py
+
+"""
+Multi-threaded load generator for /api/chat/ and /api/recommend/crops.
+
+By default the app runs in-process against a ReplayBackend serving the
+recorded farmBot / visualsBot / recommendation outputs in
+benchmarks/recordings, with their latencies multiplied by
+`--latency-scale` (0 measures the service's own CPU cost). With `--url`
+the same request mix is sent over HTTP to a running server instead
+(which then spends real quota unless it is itself stubbed).
+
+`--recommend-share` of the requests go to /api/recommend/crops, spread
+over `--locations` distinct locations (repeats hit the recommendation
+cache, as in production). Chat questions are reworded per farmer but
+repeat in meaning, so first turns are served by the semantic FAQ cache
+unless `--no-faq-cache` is given. `--paid-share` of the chat turns use
+the paid model (the scheduler's paid_chat class). Reports throughput,
+status counts, p50/p95/p99 latency and tokens per endpoint, plus the
+scheduler's per-class queue times and sheds (`--capacity` shrinks its
+slot count to provoke shedding). Per-key rate governing is off for the
+stub keys unless `--governor` is given.
+
+    python benchmarks/load_test.py --requests 400 --threads 32 --latency-scale 0.1
+    python benchmarks/load_test.py --requests 400 --threads 64 --recommend-share 0.5 --paid-share 0.3 --capacity 8
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --requests 50 --threads 4
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), 'recordings', 'gemini_outputs.json')
+
+QUESTIONS = [
+    "What should I plant this month?",
+    "My maize leaves are turning yellow at the bottom, what is wrong?",
+    "Can you show me a planting to harvest timeline for maize?",
+    "What are the key checkup dates for my tomatoes?",
+    "How do I improve my soil fertility?",
+    "How far apart should I plant cassava cuttings?",
+]
+TOWNS = ["Ibadan", "Kano", "Enugu", "Jos", "Ilorin", "Abeokuta", "Makurdi", "Kaduna", "Owerri", "Akure"]
+
+
+def chat_body(index, rng, paid=False):
+    # Distinct messages, as from distinct users, so single-flight does not coalesce them
+    return {'message': f"{rng.choice(QUESTIONS)} (farmer {index})", 'history': [],
+            'location': f"{rng.choice(TOWNS)}, Nigeria", 'npk': 'N:40,P:20,K:20', 'date': '2024-06-01',
+            'use_pro_model': paid}
+
+
+def recommend_body(rng, locations):
+    site = rng.randrange(locations)
+    return {'location': f"{TOWNS[site % len(TOWNS)]} district {site // len(TOWNS)}, Nigeria"}
+
+
+def make_app(args):
+    from kapricorn import create_app
+    from kapricorn.clients import ModelRegistry
+    from kapricorn.stub_backend import ReplayBackend, stub_model_factory
+
+    app = create_app()
+    app.config.update(
+        FREE_CHAT_MODEL_NAME='stub-chat', GOOGLE_API_KEY_FREE_CHAT='stub-chat-key',
+        PAID_MODEL_NAME='stub-paid', GOOGLE_API_KEY_PAID='stub-paid-key',
+        GOOGLE_API_KEY_RECOMENDATIONS='stub-recommend-key',
+        FREE_ACCESSORY_MODEL_NAME='stub-accessory', GOOGLE_API_KEY_FREE_ACCESSORY='stub-accessory-key',
+        PROMPT_CACHE_ENABLED=False,
+    )
+    app.extensions['prompt_cache'].enabled = False
+    app.extensions['rate_governor'].enabled = args.governor
+    if args.no_faq_cache:
+        app.extensions.pop('faq_cache', None)
+    if args.capacity:
+        app.extensions['scheduler'].capacity = args.capacity
+    replay = ReplayBackend.from_file(args.recordings, latency_scale=args.latency_scale)
+    app.extensions['model_registry'] = ModelRegistry(model_factory=stub_model_factory(reply=replay))
+    return app, replay
+
+
+class InProcessTarget:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, body):
+        response = self.client.post(path, json=body)
+        return response.status_code, response.get_json(silent=True) or {}
+
+
+class HttpTarget:
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def post(self, path, body):
+        request = urllib.request.Request(self.base_url + path, data=json.dumps(body).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            return e.code, {}
+        except (urllib.error.URLError, TimeoutError) as e:
+            return f"failed ({type(e).__name__})", {}
+
+
+def report(label, results, elapsed):
+    if not results:
+        return
+    statuses = collections.Counter(status for status, _, _ in results)
+    ok = sorted(latency for status, latency, _ in results if status == 200)
+    p = lambda q: ok[min(len(ok) - 1, int(q * len(ok)))] * 1000 if ok else 0.0
+    tokens_in = sum(payload.get('_input_tokens', 0) for _, _, payload in results)
+    tokens_out = sum(payload.get('_output_tokens', 0) for _, _, payload in results)
+    print(f"{label:<10} {len(results):5d} req   {len(results) / elapsed:7.1f} req/s   "
+          f"p50 {p(0.50):8.1f} ms   p95 {p(0.95):8.1f} ms   p99 {p(0.99):8.1f} ms")
+    print(f"{'':<10} status {dict(sorted(statuses.items(), key=str))}   "
+          f"tokens in {tokens_in} / out {tokens_out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--recommend-share', type=float, default=0.2)
+    parser.add_argument('--locations', type=int, default=40, help="distinct recommendation locations")
+    parser.add_argument('--latency-scale', type=float, default=0.1, help="multiplier on recorded latencies")
+    parser.add_argument('--recordings', default=RECORDINGS)
+    parser.add_argument('--governor', action='store_true', help="keep per-key rate governing on (stub keys)")
+    parser.add_argument('--no-faq-cache', action='store_true', help="send every chat turn to the model")
+    parser.add_argument('--paid-share', type=float, default=0.0, help="share of chat turns on the paid model")
+    parser.add_argument('--capacity', type=int, help="scheduler slots (default SCHEDULER_MAX_CONCURRENCY)")
+    parser.add_argument('--url', help="load a running server instead of an in-process app")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = replay = None
+    if args.url:
+        target = HttpTarget(args.url, args.timeout)
+    else:
+        logging.disable(logging.WARNING) # Every request logs at INFO; keep the report readable
+        app, replay = make_app(args)
+        target = InProcessTarget(app)
+
+    rng = random.Random(args.seed)
+    plan = []
+    for index in range(args.requests):
+        if rng.random() < args.recommend_share:
+            plan.append(('recommend', '/api/recommend/crops', recommend_body(rng, args.locations)))
+        else:
+            plan.append(('chat', '/api/chat/', chat_body(index, rng, paid=rng.random() < args.paid_share)))
+
+    results = collections.defaultdict(list)
+    lock = threading.Lock()
+
+    def one(item):
+        label, path, body = item
+        start = time.perf_counter()
+        status, payload = target.post(path, body)
+        latency = time.perf_counter() - start
+        with lock:
+            results[label].append((status, latency, payload))
+
+    print(f"{args.requests} requests ({args.recommend_share:.0%} recommendations), {args.threads} threads, "
+          f"target {args.url or f'in-process replay x{args.latency_scale:g} latency'}\n")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(one, plan))
+    elapsed = time.perf_counter() - start
+
+    print(f"{'total':<10} {args.requests:5d} req   {args.requests / elapsed:7.1f} req/s   {elapsed:.2f} s")
+    for label in ('chat', 'recommend'):
+        report(label, results[label], elapsed)
+    if app is not None:
+        # Chat replies with <gen> queue visuals jobs; let them finish before the interpreter exits
+        jobs = app.extensions['job_manager']
+        job_ids = [payload['visuals_job_id'] for _, _, payload in results['chat'] if payload.get('visuals_job_id')]
+        drain_start = time.perf_counter()
+        statuses = collections.Counter()
+        for job_id in job_ids:
+            job = jobs.get(job_id)
+            if job is not None and job.wait(args.timeout):
+                statuses[job.status] += 1
+        print(f"{'visuals':<10} {len(job_ids):5d} jobs  {dict(statuses)}   "
+              f"drained {time.perf_counter() - drain_start:.2f} s after the last response")
+        print(f"\nmodel calls by prompt kind: {dict(replay.served)}")
+        scheduler = app.extensions['scheduler'].stats()
+        print(f"\nscheduler (capacity {scheduler['capacity']}):")
+        for name, stats in scheduler['workloads'].items():
+            print(f"  {name:<16} admitted {stats['admitted']:4d}   shed {stats['shed']:4d}   "
+                  f"queue_full {stats['queue_full']:3d}   timed_out {stats['timed_out']:3d}   "
+                  f"queue p50 {stats['queue_p50_ms']:7.1f} ms   p95 {stats['queue_p95_ms']:7.1f} ms   "
+                  f"SLO {stats['slo_ms']} ms met {stats['slo_attainment']:.1%}")
+
+
+if __name__ == '__main__':
+    main()
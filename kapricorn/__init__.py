@@ -1,7 +1,8 @@
 # File: kapricorn/__init__.py
 
 import os
-from flask import Flask
+import time
+from flask import Flask, g, request
 import logging
 
 def create_app(config_class='kapricorn.config.Config'):
@@ -22,6 +23,191 @@ def create_app(config_class='kapricorn.config.Config'):
                         format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
     app.logger.info('Kapricorn Backend starting up...')
 
+    # Per-stage latency histograms and token counters, scraped at /metrics
+    from .telemetry import Telemetry
+    telemetry = app.extensions['telemetry'] = Telemetry(enabled=app.config.get('TELEMETRY_ENABLED', True))
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request_time(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            telemetry.record_request(request.endpoint, request.method, response.status_code,
+                                     time.perf_counter() - started)
+        return response
+
+    # Shared pool of AI clients, one per (api_key, model_name)
+    from .clients import ModelRegistry
+    app.extensions['model_registry'] = ModelRegistry()
+
+    # Per-class bounded queues, weighted fair admission and load shedding for chat/recommendations/visuals
+    from .scheduler import WorkloadScheduler
+    app.extensions['scheduler'] = WorkloadScheduler(
+        app.config.get('SCHEDULER_WORKLOADS'),
+        capacity=app.config.get('SCHEDULER_MAX_CONCURRENCY', 24),
+        max_wait_seconds=app.config.get('SCHEDULER_MAX_WAIT_SECONDS', 30),
+        enabled=app.config.get('SCHEDULER_ENABLED', True),
+        telemetry=telemetry,
+    )
+    # Separate admission for the native asyncio routes, which are not bound by the thread pool
+    app.extensions['async_scheduler'] = WorkloadScheduler(
+        app.config.get('SCHEDULER_ASYNC_WORKLOADS'),
+        capacity=app.config.get('SCHEDULER_ASYNC_MAX_CONCURRENCY', 384),
+        max_wait_seconds=app.config.get('SCHEDULER_MAX_WAIT_SECONDS', 30),
+        enabled=app.config.get('SCHEDULER_ENABLED', True),
+        telemetry=telemetry,
+    )
+
+    # Per-key token bucket + concurrency limit in front of every upstream call
+    from .ratelimit import RateGovernor, parse_rate_limits
+    key_limits = {}
+    for name, limit in parse_rate_limits(app.config.get('RATE_LIMITS')).items():
+        api_key = app.config.get(f'GOOGLE_API_KEY_{name}')
+        if api_key:
+            # Settings sharing one key share its quota; keep the tighter rate and concurrency
+            rpm, concurrency = key_limits.get(api_key, limit)
+            key_limits[api_key] = (min(rpm, limit[0]), min(concurrency, limit[1]))
+    app.extensions['rate_governor'] = RateGovernor(
+        key_limits,
+        enabled=app.config.get('RATE_LIMIT_ENABLED', True),
+        max_wait_seconds=app.config.get('RATE_LIMIT_MAX_WAIT_SECONDS', 10),
+        max_queue=app.config.get('RATE_LIMIT_MAX_QUEUE', 100),
+    )
+
+    # Fast-fail circuit breakers per (model, key) for degraded upstreams
+    from .breaker import BreakerBoard
+    app.extensions['circuit_breakers'] = BreakerBoard(
+        enabled=app.config.get('CIRCUIT_BREAKER_ENABLED', True),
+        failure_threshold=app.config.get('CIRCUIT_FAILURE_THRESHOLD', 0.5),
+        slow_call_seconds=app.config.get('CIRCUIT_SLOW_CALL_SECONDS', 30),
+        slow_call_threshold=app.config.get('CIRCUIT_SLOW_CALL_THRESHOLD', 0.8),
+        min_calls=app.config.get('CIRCUIT_MIN_CALLS', 10),
+        window_seconds=app.config.get('CIRCUIT_WINDOW_SECONDS', 60),
+        open_seconds=app.config.get('CIRCUIT_OPEN_SECONDS', 30),
+    )
+
+    # Retries, hedged requests and per-route model fallbacks for upstream calls
+    from concurrent.futures import ThreadPoolExecutor
+    from .resilience import ResiliencePolicy, parse_fallback_chains
+    hedge_workers = app.config.get('HEDGE_WORKERS', 16)
+    app.extensions['resilience'] = ResiliencePolicy(
+        executor=ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='kapricorn-hedge'),
+        executor_workers=hedge_workers,
+        max_attempts=app.config.get('RETRY_MAX_ATTEMPTS', 3),
+        base_delay=app.config.get('RETRY_BASE_DELAY_SECONDS', 0.5),
+        max_delay=app.config.get('RETRY_MAX_DELAY_SECONDS', 8),
+        hedge_enabled=app.config.get('HEDGE_ENABLED', True),
+        hedge_quantile=app.config.get('HEDGE_QUANTILE', 0.95),
+        hedge_min_samples=app.config.get('HEDGE_MIN_SAMPLES', 20),
+        hedge_budget=app.config.get('HEDGE_BUDGET_FRACTION', 0.05),
+    )
+    app.extensions['fallback_chains'] = parse_fallback_chains(app.config.get('FALLBACK_CHAINS'))
+
+    # Local token accounting (usage_metadata first, calibrated estimate otherwise)
+    from .tokens import TokenAccountant
+    app.extensions['token_accountant'] = TokenAccountant()
+
+    # Fixed bot preambles registered once as provider-side cached context
+    from .prompt_cache import GeminiCacheBackend, PromptPrefixCache
+    from .prompts import startChats, processVisualBotQuery
+    prompt_cache = PromptPrefixCache(
+        app.extensions['model_registry'],
+        GeminiCacheBackend(app.extensions['model_registry']),
+        ttl_seconds=app.config.get('PROMPT_CACHE_TTL_SECONDS', 3600),
+        refresh_margin_seconds=app.config.get('PROMPT_CACHE_REFRESH_MARGIN_SECONDS', 300),
+        min_tokens=app.config.get('PROMPT_CACHE_MIN_TOKENS', 1024),
+        enabled=app.config.get('PROMPT_CACHE_ENABLED', False),
+        models=(app.config.get('PROMPT_CACHE_MODELS') or '').split(','),
+    )
+    prompt_cache.register('farmBot', startChats)
+    prompt_cache.register('visualsBot', processVisualBotQuery('')[:2])
+    app.extensions['prompt_cache'] = prompt_cache
+
+    # Coalesces identical in-flight AI calls into one upstream request
+    from .singleflight import SingleFlight
+    app.extensions['single_flight'] = SingleFlight()
+
+    # Server-side chat transcripts keyed by conversation id
+    from .conversations import create_conversation_store
+    app.extensions['conversation_store'] = create_conversation_store(app.config)
+
+    # Background workers for slow follow-up generations (<gen> visuals)
+    from .jobs import JobManager
+    app.extensions['job_manager'] = JobManager(
+        app,
+        max_workers=app.config.get('VISUALS_WORKERS', 4),
+        ttl_seconds=app.config.get('VISUALS_JOB_TTL_SECONDS', 600),
+    )
+
+    # Parallel formatting of streamed recommendation analyses
+    app.extensions['recommendation_executor'] = ThreadPoolExecutor(
+        max_workers=app.config.get('RECOMMENDATION_FORMAT_WORKERS', 6),
+        thread_name_prefix='kapricorn-recommend',
+    )
+    # Concurrent packed analyses for /api/recommend/crops/batch
+    app.extensions['recommendation_batch_executor'] = ThreadPoolExecutor(
+        max_workers=app.config.get('RECOMMENDATION_BATCH_WORKERS', 8),
+        thread_name_prefix='kapricorn-recommend-batch',
+    )
+
+    # Crop recommendations cached per normalized location
+    from .cache import TieredCache
+    app.extensions['recommendation_cache'] = TieredCache(
+        max_entries=app.config.get('RECOMMENDATION_CACHE_MAX_ENTRIES', 2000),
+        ttl_seconds=app.config.get('RECOMMENDATION_CACHE_TTL_SECONDS', 7 * 86400),
+        database_url=app.config.get('RECOMMENDATION_CACHE_DATABASE_URL'),
+        table_name='recommendation_cache',
+    )
+
+    # Answers to first-turn, context-free chat questions, matched by meaning
+    if app.config.get('FAQ_CACHE_ENABLED', False):
+        from .faq_cache import SemanticFAQCache
+        app.extensions['faq_cache'] = SemanticFAQCache(
+            threshold=app.config.get('FAQ_CACHE_THRESHOLD', 0.75),
+            max_entries=app.config.get('FAQ_CACHE_MAX_ENTRIES', 2000),
+            ttl_seconds=app.config.get('FAQ_CACHE_TTL_SECONDS', 7 * 86400),
+            audit_rate=app.config.get('FAQ_CACHE_AUDIT_RATE', 0.02),
+            audit_min_similarity=app.config.get('FAQ_CACHE_AUDIT_MIN_SIMILARITY', 0.25),
+        )
+
+    # VisualsBot schedules shared across farmers with the same crop, area, season and NPK band
+    if app.config.get('SCHEDULE_CACHE_ENABLED', True):
+        from .schedule_cache import ScheduleCache
+        app.extensions['schedule_cache'] = ScheduleCache(
+            max_entries=app.config.get('SCHEDULE_CACHE_MAX_ENTRIES', 5000),
+            ttl_seconds=app.config.get('SCHEDULE_CACHE_TTL_SECONDS', 30 * 86400),
+            database_url=app.config.get('SCHEDULE_CACHE_DATABASE_URL'),
+            bucket_days=app.config.get('SCHEDULE_CACHE_SEASON_BUCKET_DAYS', 14),
+            npk_band_width=app.config.get('SCHEDULE_CACHE_NPK_BAND_WIDTH', 10),
+        )
+
+    # Token-budgeted chat history with a rolling summary of older turns
+    if app.config.get('CONTEXT_WINDOW_ENABLED', True):
+        from .context_window import ContextWindowManager, parse_token_budgets
+        app.extensions['context_window'] = ContextWindowManager(
+            app.extensions['token_accountant'],
+            budgets=parse_token_budgets(app.config.get('CONTEXT_TOKEN_BUDGETS')),
+            default_budget=app.config.get('CONTEXT_DEFAULT_TOKEN_BUDGET', 24000),
+            keep_recent_messages=app.config.get('CONTEXT_KEEP_RECENT_MESSAGES', 6),
+            ttl_seconds=app.config.get('CONVERSATION_TTL_SECONDS', 86400),
+            executor=ThreadPoolExecutor(max_workers=app.config.get('CONTEXT_SUMMARY_WORKERS', 4),
+                                        thread_name_prefix='kapricorn-summary'),
+            summary_timeout_seconds=app.config.get('CONTEXT_SUMMARY_TIMEOUT_SECONDS', 3.0),
+        )
+
+    # Uploaded chat images, referenced from chat turns by id
+    from .images import ImageStore
+    app.extensions['image_store'] = ImageStore(
+        app.config.get('IMAGE_STORE_PATH') or os.path.join(app.instance_path, 'images'),
+        max_dimension=app.config.get('IMAGE_MAX_DIMENSION', 768),
+        jpeg_quality=app.config.get('IMAGE_JPEG_QUALITY', 85),
+        allowed_extensions=app.config.get('ALLOWED_EXTENSIONS'),
+        max_upload_bytes=app.config.get('IMAGE_MAX_UPLOAD_BYTES', 10 * 1024 * 1024),
+    )
+
     # Register Blueprints
     from .routes import chat_bp
     app.register_blueprint(chat_bp)
@@ -29,6 +215,9 @@ def create_app(config_class='kapricorn.config.Config'):
     from .routes.recommendation_routes import recommend_bp
     app.register_blueprint(recommend_bp)
 
+    from .routes.health_routes import health_bp
+    app.register_blueprint(health_bp)
+
     # Add other initializations here (like database, mail, etc. if needed later)
     # For now, we only need the chat blueprint.
 
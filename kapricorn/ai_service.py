@@ -2,40 +2,41 @@
 
 from flask import current_app
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from concurrent.futures import as_completed
+import contextvars
+import copy
+import hashlib
+import json
 import logging
+import queue
+import threading
+from collections import OrderedDict, deque
 from .prompts import (
     extract_tags, string_to_dict, processVisualBotQuery,
-    formatLocationInfo, analyseLocation
+    formatLocationInfo, formatLocationInfoJson, formatLocationsInfo, formatLocationsInfoJson,
+    analyseLocation, analyseLocations, summarizeChatHistory, startChats,
+    repairStructuredOutput, personalizeFaqAnswer, systemContext
     
 ) # Add any other necessary imports from prompts.py
+from .schemas import (
+    CropRecommendations, PackedCropRecommendations, StructuredOutputError, VisualsData,
+    json_generation_config, visuals_from_json
+)
+from .tokens import usage_from_response
+from .cache import normalize_location
+from .schedule_cache import parse_gen_tag
+from .faq_cache import context_anchors, context_bucket
+from .clients import key_fingerprint
+from .recommendation_engine import CropSectionSplitter, LocationSectionSplitter
+from .images import is_image_id
+from .breaker import CircuitOpen
+from .ratelimit import RateLimited, is_quota_error, rate_limit_patience
+from .resilience import is_overload_error
 
 log = logging.getLogger(__name__)
 
 
-def estimate_tokens(content):
-    """Estimate token count. Prioritize text length."""
-    # Adjust ratio based on observation or model specifics if known
-    # Lower number = more tokens per char (safer estimate for limits)
-    # Higher number = fewer tokens per char
-    chars_per_token_estimate = 3.5 # General estimate
-    image_token_estimate = 258 # Rough estimate for typical image input cost (Gemini 1.5 Flash?) - ADJUST AS NEEDED
-
-    estimatedTotal = 0
-    if isinstance(content, str):
-        estimatedTotal = len(content) / chars_per_token_estimate
-    elif isinstance(content, list): # Estimate history
-        for message in content:
-            if isinstance(message, dict) and 'parts' in message and isinstance(message['parts'], list):
-                for part in message['parts']:
-                    if isinstance(part, str):
-                        estimatedTotal += len(part) / chars_per_token_estimate
-                    elif isinstance(part, dict) and 'inline_data' in part:
-                        # Add fixed estimate for images
-                        estimatedTotal += image_token_estimate
-            elif isinstance(message, str):
-                estimatedTotal += len(message) / chars_per_token_estimate
-    return round(estimatedTotal)
-
 def _sanitize_part(part):
     """Checks if a part is valid for Google AI content."""
     if isinstance(part, str):
@@ -47,6 +48,9 @@ def _sanitize_part(part):
             if 'mime_type' in inline_data and 'data' in inline_data:
                 # Return only the valid structure
                 return {'inline_data': {'mime_type': inline_data['mime_type'], 'data': inline_data['data']}}
+        # Reference to an uploaded image; the bytes are attached just before sending
+        if is_image_id(part.get('image_id')):
+            return {'image_id': part['image_id']}
         # Add checks for other valid Part types if needed (e.g., function calls)
     # If it's not a string or a valid known dictionary structure, it's invalid
     log.warning(f"Sanitizing invalid/unrecognized message part: {type(part)} Keys: {list(part.keys()) if isinstance(part, dict) else 'N/A'}")
@@ -54,134 +58,400 @@ def _sanitize_part(part):
 # --- End Helper Functions ---
 
 
-def call_ai_model(prompt, model_name, api_key, stream=False):
-    """Calls the Google AI model. Sanitizes history input including parts."""
+def _is_clean_message(message):
+    """True if a history message is already exactly what _sanitize_part would produce."""
+    if not isinstance(message, dict) or len(message) != 2 or 'role' not in message:
+        return False
+    parts = message.get('parts')
+    if not isinstance(parts, list) or not parts:
+        return False
+    for part in parts:
+        if isinstance(part, str):
+            continue
+        if not isinstance(part, dict) or len(part) != 1:
+            return False
+        if 'image_id' in part:
+            if not is_image_id(part['image_id']):
+                return False
+            continue
+        inline_data = part.get('inline_data')
+        if not isinstance(inline_data, dict) or len(inline_data) != 2 \
+                or 'mime_type' not in inline_data or 'data' not in inline_data:
+            return False
+    return True
+
+
+def _sanitize_message(message):
+    """Returns the sanitized copy of a history message, or None if nothing valid is left."""
+    sanitized_parts = []
+    if isinstance(message['parts'], list):
+        for part in message['parts']:
+            valid_part = _sanitize_part(part)
+            if valid_part is not None:
+                sanitized_parts.append(valid_part)
+    elif isinstance(message['parts'], str): # Allow simple string parts
+         sanitized_parts.append(message['parts'])
+    else:
+        log.warning(f"Message parts is not a list or string: {message['parts']}")
+        return None # Skip malformed message
+
+    if not sanitized_parts:
+        log.warning(f"Message skipped after part sanitization (no valid parts): Role={message.get('role','N/A')}")
+        return None
+    return {'role': message['role'], 'parts': sanitized_parts}
+
+
+class _RepairedMessageCache:
+    """
+    Remembers the sanitized form of messages that needed repair.
+
+    History messages are shared between turns (processChats only copies the
+    tail, and the conversation store hands out the same dicts), so a message
+    that had to be repaired once is looked up by identity instead of being
+    re-sanitized (and re-logged) on every later turn. Clean messages are
+    passed through without being cached.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # id(message) -> (message, parts, sanitized)
+
+    def get(self, message):
+        with self._lock:
+            entry = self._entries.get(id(message))
+            if entry is None or entry[0] is not message or entry[1] is not message.get('parts'):
+                return _MISSING
+            self._entries.move_to_end(id(message))
+            return entry[2]
+
+    def set(self, message, sanitized):
+        with self._lock:
+            self._entries[id(message)] = (message, message.get('parts'), sanitized)
+            self._entries.move_to_end(id(message))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_MISSING = object()
+_repaired_messages = _RepairedMessageCache()
+
+
+def _build_contents(prompt):
+    """
+    Converts a prompt string or history list into generate_content input.
+
+    Messages that are already well-formed are reused as-is (no copy of their
+    parts); only malformed ones are rebuilt. Returns (content_to_send, None)
+    or (None, error_dict).
+    """
+    content_to_send = []
+    if isinstance(prompt, str):
+        # Basic text prompt
+        content_to_send = [prompt] # Needs to be a list for generate_content
+    elif isinstance(prompt, list):
+        # Sanitize history list (assuming structure [{role:..., parts:...}])
+        for message in prompt:
+            if _is_clean_message(message):
+                content_to_send.append(message)
+            elif isinstance(message, dict) and 'role' in message and 'parts' in message:
+                sanitized = _repaired_messages.get(message)
+                if sanitized is _MISSING:
+                    sanitized = _sanitize_message(message)
+                    _repaired_messages.set(message, sanitized)
+                if sanitized is not None:
+                    content_to_send.append(sanitized)
+            else:
+                log.warning(f"Skipping invalid history item (structure error): {type(message)}")
+    else:
+        log.error(f"Invalid prompt format type: {type(prompt)}")
+        return None, {"error": "Invalid prompt format."}
+
+    if not content_to_send:
+        log.warning("No valid content to send to the AI model.")
+        return None, {"error": "No valid content to send."}
+    return content_to_send, None
+
+
+def _attach_images(contents):
+    """
+    Replaces {'image_id'} parts with the stored image bytes (inline_data).
+
+    Returns `contents` itself when it has no references, otherwise a copy in
+    which only the messages carrying references are rebuilt. Unknown or
+    expired ids are dropped with a warning.
+    """
+    if not isinstance(contents, list):
+        return contents
+    resolved = None
+    for index, message in enumerate(contents):
+        parts = message.get('parts') if isinstance(message, dict) else None
+        if not isinstance(parts, list) or not any(isinstance(p, dict) and 'image_id' in p for p in parts):
+            continue
+        store = current_app.extensions['image_store']
+        new_parts = []
+        for part in parts:
+            if isinstance(part, dict) and 'image_id' in part:
+                inline = store.inline_part(part['image_id'])
+                if inline is None:
+                    log.warning(f"Image {part['image_id'][:12]} is no longer stored; dropping it from the prompt.")
+                    continue
+                part = inline
+            new_parts.append(part)
+        if resolved is None:
+            resolved = list(contents)
+        resolved[index] = {'role': message['role'], 'parts': new_parts or ["[image unavailable]"]}
+    return contents if resolved is None else resolved
+
+
+def _request_fingerprint(model_name, api_key, content_to_send, generation_config=None):
+    """Stable hash identifying an upstream request, used to coalesce duplicates."""
+    digest = hashlib.sha256()
+    digest.update(f"{model_name}\0{key_fingerprint(api_key)}\0".encode('utf-8'))
+    digest.update(json.dumps(content_to_send, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    if generation_config:
+        digest.update(b"\0")
+        digest.update(json.dumps(generation_config, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _generate(model, model_name, content_to_send, request_contents=None, cached_prefix=None, labels=None,
+              generation_config=None):
+    """
+    Runs one non-streamed generation and returns the text/token dict (or an error dict).
+
+    `request_contents` is what is actually sent when part of the prompt is
+    served from a provider-side cache (`cached_prefix`); token accounting
+    still uses the full `content_to_send`. `labels` (Telemetry.call_labels)
+    attribute the call's latency and tokens in /metrics.
+    """
+    with current_app.extensions['telemetry'].model_call(labels):
+        response = model.generate_content(request_contents or content_to_send, generation_config=generation_config)
+    return _finish_generation(response, model_name, content_to_send, cached_prefix, labels)
+
+
+def _finish_generation(response, model_name, content_to_send, cached_prefix=None, labels=None):
+    """Extracts text from a non-streamed response and accounts its tokens (shared by the async path)."""
+    generated_text = ""
+    try:
+        # Attempt to access text directly for non-streamed object
+        # Handle potential blocks or errors in the response structure
+        if hasattr(response, 'text'):
+            generated_text = response.text
+        elif hasattr(response, 'parts'): # Check parts if text attribute isn't direct
+            generated_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
+        else:
+            log.warning(f"AI response for '{model_name}' has unexpected structure: {response}")
+            # Try resolving if it's a prompt feedback issue
+            if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
+                reason = response.prompt_feedback.block_reason
+                log.error(f"AI response blocked. Reason: {reason}")
+                return {"error": f"AI response blocked due to: {reason}"}
+
+        if not generated_text:
+             log.warning(f"AI response for '{model_name}' was empty or inaccessible.")
+             # Check candidate status if available
+             if hasattr(response, 'candidates') and response.candidates:
+                  finish_reason = response.candidates[0].finish_reason
+                  if finish_reason != 1: # 1 = STOP, other values indicate issues (SAFETY, RECITATION, etc.)
+                       log.error(f"AI generation finished abnormally. Reason: {finish_reason}")
+                       return {"error": f"AI generation issue: {finish_reason}"}
+             # If still no text, return generic empty error
+             return {"error": "AI response was empty."}
+
+
+    except Exception as resp_err:
+         log.error(f"Error processing non-streamed AI response for '{model_name}': {resp_err}", exc_info=True)
+         return {"error": "Error processing AI response."}
+
+    # Counts come from usage_metadata; no extra count_tokens round-trips
+    accountant = current_app.extensions['token_accountant']
+    telemetry = current_app.extensions['telemetry']
+    with telemetry.span('token_count'):
+        input_token_count, output_token_count = accountant.account(
+            model_name, content_to_send, response, generated_text)
+    telemetry.count_tokens(labels, input_token_count, output_token_count)
+    if cached_prefix:
+        cached_tokens = getattr(response.usage_metadata, 'cached_content_token_count', 0)
+        current_app.extensions['prompt_cache'].record_usage(cached_prefix, cached_tokens)
+        log.debug(f"Prompt prefix '{cached_prefix}' served {cached_tokens} tokens from cache.")
+    log.info(f"AI model '{model_name}' non-stream successful. Input: {input_token_count}, Output: {output_token_count}")
+    return {
+        'text': generated_text,
+        'input_tokens': input_token_count,
+        'output_tokens': output_token_count
+    }
+
+
+def _prepare_call(prompt, model_name, api_key):
+    """
+    Validates and builds one AI request.
+
+    Returns ((content_to_send, cached_content, request_contents, prefix_name), None)
+    or (None, error_dict). `request_contents` is what goes over the wire:
+    the prompt minus any cached prefix, with uploaded images attached.
+    """
     if not api_key:
         log.error(f"API Key is missing for model {model_name}.")
-        return {"error": "AI service API key not configured."}
+        return None, {"error": "AI service API key not configured."}
     if not model_name:
         log.error("AI Model name is missing.")
-        return {"error": "AI service model name not configured."}
+        return None, {"error": "AI service model name not configured."}
 
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name)
-        log.info(f"Calling AI model '{model_name}' (Stream: {stream})...")
-
-        content_to_send = []
-        if isinstance(prompt, str):
-            # Basic text prompt
-            content_to_send = [prompt] # Needs to be a list for generate_content
-        elif isinstance(prompt, list):
-            # Sanitize history list (assuming structure [{role:..., parts:...}])
-            for message in prompt:
-                if isinstance(message, dict) and 'role' in message and 'parts' in message:
-                    sanitized_parts = []
-                    if isinstance(message['parts'], list):
-                        for part in message['parts']:
-                            valid_part = _sanitize_part(part)
-                            if valid_part is not None:
-                                sanitized_parts.append(valid_part)
-                    elif isinstance(message['parts'], str): # Allow simple string parts
-                         sanitized_parts.append(message['parts'])
-                    else:
-                        log.warning(f"Message parts is not a list or string: {message['parts']}")
-                        continue # Skip malformed message
-
-                    if sanitized_parts:
-                        content_to_send.append({
-                            'role': message['role'],
-                            'parts': sanitized_parts
-                        })
-                    else:
-                        log.warning(f"Message skipped after part sanitization (no valid parts): Role={message.get('role','N/A')}")
-                else:
-                    log.warning(f"Skipping invalid history item (structure error): {type(message)}")
-        else:
-            log.error(f"Invalid prompt format type: {type(prompt)}")
-            return {"error": "Invalid prompt format."}
+    with current_app.extensions['telemetry'].span('sanitize'):
+        content_to_send, error = _build_contents(prompt)
+    if error:
+        return None, error
 
-        if not content_to_send:
-            log.warning("No valid content to send to the AI model.")
-            return {"error": "No valid content to send."}
+    # Send static bot preambles as provider-side cached context when available
+    prompt_cache = current_app.extensions['prompt_cache']
+    cached_content, request_contents, prefix_name = prompt_cache.bind(api_key, model_name, content_to_send)
+    # Uploaded images travel as ids until here (so hashing and caching never touch the bytes)
+    request_contents = _attach_images(request_contents)
+    return (content_to_send, cached_content, request_contents, prefix_name), None
+
+
+def call_ai_model(prompt, model_name, api_key, stream=False, route=None, generation_config=None):
+    """
+    Calls the Google AI model. Sanitizes history input including parts.
+
+    Identical non-streamed requests that are in flight at the same time are
+    coalesced: only one goes upstream and every caller gets its result.
+    Upstream calls wait for a slot from the per-key rate governor; if none
+    frees up in time, or the provider answers 429, the error dict carries
+    'retry_after' (seconds) so routes can answer 429 instead of 500.
+
+    Transient upstream errors are retried and slow calls hedged (see
+    ResiliencePolicy). If the model is overloaded and `route` has a
+    fallback chain (FALLBACK_CHAINS), the next model in the chain is tried;
+    a result served by a fallback carries 'fallback_model'.
+
+    `generation_config` is passed through to generate_content, e.g.
+    schemas.json_generation_config(...) for JSON-mode replies.
+    """
+    result = _call_model(prompt, model_name, api_key, stream, route, generation_config)
+    for fallback_model, fallback_key in _fallback_targets(route, model_name):
+        if not result.get('overloaded'):
+            break
+        log.warning(f"'{model_name}' overloaded for route '{route}'; falling back to '{fallback_model}'.")
+        result = _call_model(prompt, fallback_model, fallback_key, stream, route, generation_config)
+        current_app.extensions['resilience'].record_fallback(
+            route, model_name, fallback_model, succeeded='error' not in result)
+        if 'error' not in result:
+            result['fallback_model'] = fallback_model
+    return result
+
+
+def _fallback_targets(route, model_name):
+    """(model_name, api_key) pairs to try after `model_name` for `route`, from FALLBACK_CHAINS."""
+    if route is None:
+        return []
+    targets = []
+    for tier in current_app.extensions['fallback_chains'].get(route, ()):
+        fallback_model = current_app.config.get(f'{tier}_MODEL_NAME')
+        fallback_key = current_app.config.get(f'GOOGLE_API_KEY_{tier}')
+        if fallback_model and fallback_key and fallback_model != model_name:
+            targets.append((fallback_model, fallback_key))
+    return targets
 
-        # --- Estimate Input Tokens ---
-        input_token_count = 0
-        try:
-            # Use count_tokens if available and reliable, else estimate
-            # count_result = model.count_tokens(content_to_send)
-            # input_token_count = count_result.total_tokens
-            input_token_count = model.count_tokens(content_to_send).total_tokens # Fallback/primary estimator
-            log.debug(f"Estimated Input tokens for '{model_name}': {input_token_count}")
-        except Exception as count_err:
-             log.warning(f"Could not estimate input tokens for '{model_name}': {count_err}")
-        # --- End Estimate Input Tokens ---
 
-        response = model.generate_content(content_to_send, stream=stream)
+def _call_model(prompt, model_name, api_key, stream, route=None, generation_config=None):
+    """One model's share of call_ai_model: single-flight, retries, hedging and rate governing."""
+    prepared, error = _prepare_call(prompt, model_name, api_key)
+    if error:
+        return error
+    content_to_send, cached_content, request_contents, prefix_name = prepared
 
+    registry = current_app.extensions['model_registry']
+    governor = current_app.extensions['rate_governor']
+    breakers = current_app.extensions['circuit_breakers']
+    resilience = current_app.extensions['resilience']
+    telemetry = current_app.extensions['telemetry']
+    labels = telemetry.call_labels(route, model_name, api_key)
+    try:
         if stream:
-             # For streaming, return the iterator and input count
-             return {'stream': response, 'input_tokens': input_token_count}
-        else:
-            # For non-streaming, process the response fully
-            output_token_count = 0
-            generated_text = ""
-            try:
-                # Attempt to access text directly for non-streamed object
-                # Handle potential blocks or errors in the response structure
-                if hasattr(response, 'text'):
-                    generated_text = response.text
-                elif hasattr(response, 'parts'): # Check parts if text attribute isn't direct
-                    generated_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
-                else:
-                    log.warning(f"AI response for '{model_name}' has unexpected structure: {response}")
-                    # Try resolving if it's a prompt feedback issue
-                    if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
-                        reason = response.prompt_feedback.block_reason
-                        log.error(f"AI response blocked. Reason: {reason}")
-                        return {"error": f"AI response blocked due to: {reason}"}
-
-                # Estimate output tokens
-                if generated_text:
-                    output_token_count = model.count_tokens(generated_text).total_tokens
-                else:
-                     log.warning(f"AI response for '{model_name}' was empty or inaccessible.")
-                     # Check candidate status if available
-                     if hasattr(response, 'candidates') and response.candidates:
-                          finish_reason = response.candidates[0].finish_reason
-                          if finish_reason != 1: # 1 = STOP, other values indicate issues (SAFETY, RECITATION, etc.)
-                               log.error(f"AI generation finished abnormally. Reason: {finish_reason}")
-                               return {"error": f"AI generation issue: {finish_reason}"}
-                     # If still no text, return generic empty error
-                     return {"error": "AI response was empty."}
-
-
-            except Exception as resp_err:
-                 log.error(f"Error processing non-streamed AI response for '{model_name}': {resp_err}", exc_info=True)
-                 return {"error": "Error processing AI response."}
-
-            log.info(f"AI model '{model_name}' non-stream successful. Input Est: {input_token_count}, Output Est: {output_token_count}")
-            return {
-                'text': generated_text,
-                'input_tokens': input_token_count,
-                'output_tokens': output_token_count
-            }
+            def open_stream(sent):
+                # An open circuit fails fast, before waiting for a rate-limit slot
+                with breakers.call(model_name, api_key) as breaker_call, governor.acquire(api_key) as permit, \
+                        registry.lease(api_key, model_name, cached_content) as model:
+                    log.info(f"Calling AI model '{model_name}' (Stream: True, Cached prefix: {bool(cached_content)})...")
+                    breaker_call.started()
+                    sent()
+                    # The SDK fetches the first chunk here, so upstream errors surface (and retry) before any text
+                    with telemetry.model_call(labels, stream=True):
+                        response = model.generate_content(request_contents, stream=True,
+                                                          generation_config=generation_config)
+                    # The upstream slot stays taken until the stream is consumed
+                    return permit.guard_stream(response)
+
+            # For streaming, return the iterator and a local input estimate;
+            # exact usage only arrives with the final chunk.
+            response = resilience.run(model_name, open_stream, hedge=False)
+            accountant = current_app.extensions['token_accountant']
+            with telemetry.span('token_count'):
+                input_token_count = accountant.estimate(content_to_send, model_name)
+            # Tokens are counted under `labels` once the stream is consumed (_stream_outcome)
+            return {'stream': response, 'input_tokens': input_token_count, 'metric_labels': labels}
+
+        def attempt(sent):
+            with breakers.call(model_name, api_key) as breaker_call, governor.acquire(api_key), \
+                    registry.lease(api_key, model_name, cached_content) as model:
+                log.info(f"Calling AI model '{model_name}' (Stream: False, Cached prefix: {bool(cached_content)})...")
+                breaker_call.started()
+                sent()
+                return _generate(model, model_name, content_to_send, request_contents,
+                                 prefix_name if cached_content else None, labels, generation_config)
+
+        single_flight = current_app.extensions['single_flight']
+        fingerprint = _request_fingerprint(model_name, api_key, content_to_send, generation_config)
+        # Only the leader of a coalesced group goes upstream (and retries or hedges)
+        result, shared = single_flight.do(fingerprint, lambda: resilience.run(model_name, attempt))
+        if shared:
+            log.info(f"AI call to '{model_name}' coalesced with an identical in-flight request.")
+        return dict(result) # Callers may annotate their copy
 
     except genai.types.generation_types.BlockedPromptException as bpe:
          log.error(f"AI Model call blocked prompt ({model_name}): {bpe}", exc_info=True)
          return {"error": "AI request blocked by safety filters."}
     except Exception as e:
-        log.error(f"AI Model call error ({model_name}, Stream: {stream}): {e}", exc_info=True)
-        # More specific error check (e.g., API key validity) might be needed here
-        return {"error": "AI service encountered an unexpected error."}
+        return _call_error(e, model_name, api_key, stream)
 
 
-def get_chat_response(history, use_pro_model):
+def _call_error(e, model_name, api_key, stream):
     """
-    Gets a non-streaming chat response from the appropriate AI model.
+    Error dict for a failed AI call.
+
+    Rate limiting and quota errors carry 'retry_after'; those, open circuits
+    and provider overload errors are flagged 'overloaded' so a fallback model
+    may be tried. Open circuits are also flagged 'unavailable' (503).
     """
-    log.debug(f"Getting chat response. Pro Model Requested: {use_pro_model}")
+    if isinstance(e, CircuitOpen):
+        log.warning(f"AI model '{model_name}' (key {key_fingerprint(api_key)}) circuit open; failing fast.")
+        return {"error": "AI model is temporarily unavailable.", "retry_after": e.retry_after,
+                "overloaded": True, "unavailable": True}
+    if isinstance(e, RateLimited):
+        log.warning(f"AI call to '{model_name}' not admitted by the rate governor: {e}")
+        return {"error": "AI service is busy; please retry shortly.", "retry_after": e.retry_after,
+                "overloaded": True}
+    if is_quota_error(e):
+        log.warning(f"AI quota exhausted for '{model_name}' (key {key_fingerprint(api_key)}): {e}")
+        retry_after = current_app.extensions['rate_governor'].retry_after(api_key)
+        return {"error": "AI service quota exceeded; please retry shortly.", "retry_after": retry_after,
+                "overloaded": True}
+    if is_overload_error(e):
+        log.warning(f"AI model '{model_name}' unavailable: {e}")
+        return {"error": "AI model is temporarily unavailable.", "overloaded": True}
+    if isinstance(e, google_exceptions.InvalidArgument):
+        # e.g. a model without JSON mode given a response_schema; see _json_mode_rejected
+        log.warning(f"AI model '{model_name}' rejected the request as invalid: {e}")
+        return {"error": "AI service rejected the request.", "invalid_request": True}
+    log.error(f"AI Model call error ({model_name}, Stream: {stream}): {e}", exc_info=True)
+    # More specific error check (e.g., API key validity) might be needed here
+    return {"error": "AI service encountered an unexpected error."}
+
 
+def _chat_model_config(use_pro_model):
+    """Returns (model_name, api_key) for a chat request."""
     if use_pro_model:
         model_name = current_app.config.get('PAID_MODEL_NAME')
         api_key = current_app.config.get('GOOGLE_API_KEY_PAID')
@@ -190,30 +460,308 @@ def get_chat_response(history, use_pro_model):
         model_name = current_app.config.get('FREE_CHAT_MODEL_NAME')
         api_key = current_app.config.get('GOOGLE_API_KEY_FREE_CHAT')
         log.debug(f"Using FREE_CHAT model for chat: {model_name}")
+    return model_name, api_key
+
+
+def _chat_route(use_pro_model):
+    """Route name of a chat call, for its FALLBACK_CHAINS entry."""
+    return 'chat_pro' if use_pro_model else 'chat'
+
+
+def get_chat_response(history, use_pro_model):
+    """
+    Gets a non-streaming chat response from the appropriate AI model.
+    """
+    log.debug(f"Getting chat response. Pro Model Requested: {use_pro_model}")
+
+    model_name, api_key = _chat_model_config(use_pro_model)
 
     if not api_key or not model_name:
         log.error(f"Chat AI service config missing (Pro: {use_pro_model}). Key: {bool(api_key)}, Model: {bool(model_name)}")
         return {"error": "AI service not configured for this chat request."}
 
     # Use non-streaming for this specific function
-    ai_result = call_ai_model(prompt=history, model_name=model_name, api_key=api_key, stream=False)
+    ai_result = call_ai_model(prompt=history, model_name=model_name, api_key=api_key, stream=False,
+                              route=_chat_route(use_pro_model))
 
     return ai_result # Returns dict with 'text', 'input_tokens', 'output_tokens' or 'error'
 
 
+def faq_cached_reply(question, history, use_pro_model, context):
+    """
+    A cached reply to a first-turn question, as an ai_result dict with 'faq_hit', or None.
+
+    `context` holds the requester's 'location', 'npk' and 'date'. If the
+    cached answer refers to context that differs for this requester, its
+    <r> is adapted by the accessory model first (if that fails, None: the
+    question goes upstream as usual). A sample of hits is re-asked with
+    `history` in the background to audit for false hits.
+    """
+    cache = current_app.extensions.get('faq_cache')
+    if cache is None:
+        return None
+    with current_app.extensions['telemetry'].span('faq_lookup'):
+        entry, similarity = cache.lookup(question, _faq_namespace(use_pro_model, context))
+    if entry is None:
+        return None
+
+    text, input_tokens, output_tokens = entry.answer, 0, 0
+    personalized = entry.needs_personalization(context)
+    if personalized:
+        adapted = _personalize_faq_answer(question, entry, context)
+        if adapted is None:
+            return None
+        text, input_tokens, output_tokens = adapted
+        cache.record_personalized()
+    log.info(f"FAQ cache hit (entry {entry.id}, similarity {similarity:.3f}, personalized: {personalized}).")
+
+    if cache.should_audit():
+        try:
+            current_app.extensions['job_manager'].submit(
+                'faq_audit', _audit_faq_hit, entry, question, similarity, history, use_pro_model)
+        except RuntimeError as e:
+            # The worker pools refuse new work once the interpreter is shutting down
+            log.info(f"FAQ audit of entry {entry.id} skipped: {e}")
+    return {
+        'text': text,
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'faq_hit': {'entry_id': entry.id, 'similarity': round(similarity, 4), 'personalized': personalized},
+    }
+
+
+def _faq_namespace(use_pro_model, context):
+    """FAQ cache namespace: the chat tier plus the requester's coarse region and season."""
+    return f"{_chat_route(use_pro_model)}|{context_bucket(context.get('location'), context.get('date'))}"
+
+
+def _personalize_faq_answer(question, entry, context):
+    """(reply text, input tokens, output tokens) with the cached <r> adapted to `context`, or None."""
+    answer = extract_tags(entry.answer, ['r']).get('r')
+    model_name = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
+    api_key = current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
+    if not answer or not model_name or not api_key:
+        return None
+    ai_result = call_ai_model(prompt=personalizeFaqAnswer(question, answer.strip(), systemContext(**context)),
+                              model_name=model_name, api_key=api_key, route='faq')
+    if 'error' in ai_result or not ai_result.get('text'):
+        log.warning(f"Could not personalize FAQ entry {entry.id}: {ai_result.get('error', 'empty reply')}")
+        return None
+    text = entry.answer.replace(answer, ai_result['text'].strip(), 1)
+    return text, ai_result.get('input_tokens', 0), ai_result.get('output_tokens', 0)
+
+
+def _audit_faq_hit(entry, question, similarity, history, use_pro_model):
+    """Background job: re-asks a question served from the FAQ cache and records whether the hit held up."""
+    ai_result = get_chat_response(history, use_pro_model)
+    if 'error' in ai_result or not ai_result.get('text'):
+        log.info(f"FAQ audit of entry {entry.id} skipped: {ai_result.get('error', 'empty reply')}")
+        return None
+    fresh = extract_tags(ai_result['text'], ['r', 'cls'])
+    cached_reply = extract_tags(entry.answer, ['r']).get('r') or entry.answer
+    return current_app.extensions['faq_cache'].record_audit(
+        entry, question, similarity, cached_reply, fresh.get('r') or ai_result['text'],
+        (fresh.get('cls') or '').strip().upper())
+
+
+def remember_faq_answer(question, use_pro_model, context, reply_text):
+    """Caches a first-turn reply if the model classed it general (FI) and it requested no visuals."""
+    cache = current_app.extensions.get('faq_cache')
+    if cache is None or not reply_text:
+        return
+    extracted = extract_tags(reply_text, ['r', 'cls', 'gen'])
+    if (extracted.get('cls') or '').strip().upper() != 'FI' or extracted.get('gen') or not extracted.get('r'):
+        return
+    cache.add(question, reply_text, _faq_namespace(use_pro_model, context), context,
+              context_anchors(extracted['r'], **context))
+
+
+def summarize_history(previous_summary, messages):
+    """Folds `messages` into `previous_summary` with the accessory model. Returns the text or None."""
+    model_name = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
+    api_key = current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
+    if not api_key or not model_name:
+        log.error("Accessory AI service not configured; cannot summarize chat history.")
+        return None
+
+    lines = []
+    for message in messages:
+        parts = message.get('parts', [])
+        text = ' '.join(part if isinstance(part, str) else '[image]'
+                        for part in (parts if isinstance(parts, list) else [parts]))
+        lines.append(f"{'Farmer' if message.get('role') == 'user' else 'Oscar'}: {text}")
+
+    ai_result = call_ai_model(prompt=summarizeChatHistory(previous_summary, '\n'.join(lines)),
+                              model_name=model_name, api_key=api_key)
+    if 'error' in ai_result:
+        log.warning(f"Chat history summarization failed: {ai_result['error']}")
+        return None
+    return ai_result.get('text')
+
+
+def fit_chat_history(history, use_pro_model, conversation_key=None):
+    """
+    Fits a raw chat history into the chat model's context budget.
+
+    Returns (history, tokens_trimmed); older turns are replaced by a running
+    summary when the history is over budget (see ContextWindowManager).
+    """
+    window = current_app.extensions.get('context_window')
+    if window is None or not history:
+        return history, 0
+    model_name, _ = _chat_model_config(use_pro_model)
+    return window.fit(history, model_name, startChats, summarize_history, conversation_key=conversation_key)
+
+
+def stream_chat_response(history, use_pro_model):
+    """
+    Streams a chat response from the appropriate AI model.
+
+    Yields ('chunk', text) for each piece as it arrives, then exactly one of
+    ('done', {'text', 'input_tokens', 'output_tokens'}) or ('error', message).
+    """
+    log.debug(f"Streaming chat response. Pro Model Requested: {use_pro_model}")
+
+    model_name, api_key = _chat_model_config(use_pro_model)
+
+    if not api_key or not model_name:
+        log.error(f"Chat AI service config missing (Pro: {use_pro_model}). Key: {bool(api_key)}, Model: {bool(model_name)}")
+        yield 'error', "AI service not configured for this chat request."
+        return
+
+    ai_result = call_ai_model(prompt=history, model_name=model_name, api_key=api_key, stream=True,
+                              route=_chat_route(use_pro_model))
+    yield from iter_stream_events(ai_result, model_name)
+
+
+def iter_stream_events(ai_result, model_name):
+    """
+    Consumes a call_ai_model(stream=True) result.
+
+    Yields ('chunk', text) for each piece as it arrives, then exactly one of
+    ('done', {'text', 'input_tokens', 'output_tokens'}) or ('error', message).
+    """
+    if 'error' in ai_result:
+        yield 'error', ai_result['error']
+        return
+
+    pieces = []
+    usage = [None, None]
+    try:
+        for chunk in ai_result['stream']:
+            text = _stream_chunk(chunk, usage)
+            if text:
+                pieces.append(text)
+                yield 'chunk', text
+    except Exception as e:
+        log.error(f"AI stream error ({model_name}): {e}", exc_info=True)
+        yield 'error', "AI service encountered an unexpected error."
+        return
+
+    yield _stream_outcome(pieces, usage, ai_result, model_name)
+
+
+def _stream_chunk(chunk, usage):
+    """Returns a stream chunk's text and records its usage_metadata (if any) into usage[in, out]."""
+    try:
+        text = chunk.text
+    except ValueError: # Chunk without text parts (e.g. final safety/usage chunk)
+        text = ''
+    chunk_input, chunk_output = usage_from_response(chunk)
+    if chunk_input is not None:
+        usage[0], usage[1] = chunk_input, chunk_output
+    return text
+
+
+def _stream_outcome(pieces, usage, ai_result, model_name):
+    """The final ('done', result) or ('error', message) event of a consumed stream."""
+    generated_text = ''.join(pieces)
+    if not generated_text:
+        log.warning(f"AI stream for '{model_name}' produced no text.")
+        return 'error', "AI response was empty."
+
+    accountant = current_app.extensions['token_accountant']
+    telemetry = current_app.extensions['telemetry']
+    input_tokens, output_tokens = usage
+    if input_tokens is None:
+        input_tokens = ai_result.get('input_tokens', 0)
+    if output_tokens is None:
+        with telemetry.span('token_count'):
+            output_tokens = accountant.estimate(generated_text, model_name)
+    telemetry.count_tokens(ai_result.get('metric_labels'), input_tokens, output_tokens)
+    log.info(f"AI model '{model_name}' stream successful. Input: {input_tokens}, Output: {output_tokens}")
+    result = {'text': generated_text, 'input_tokens': input_tokens, 'output_tokens': output_tokens}
+    if ai_result.get('fallback_model'):
+        result['fallback_model'] = ai_result['fallback_model']
+    return 'done', result
+
+
 def generate_schedule_data(gen_tag_content):
-    """Calls the 'visualsBot' AI based on the parsed <gen> tag content."""
+    """
+    Calls the 'visualsBot' AI based on the parsed <gen> tag content.
+
+    Served from the cross-user schedule cache (date-shifted) when a farmer
+    with the same crop, area, season and NPK band asked recently.
+    """
+    cached = _cached_schedule(gen_tag_content)
+    if cached is not None:
+        return cached
+    request, error = _visuals_request(gen_tag_content)
+    if error:
+        return error
+    prompt_content, model_name, api_key = request
+    schema = _structured_schema(VisualsData, model_name)
+
+    # Call AI (non-streaming)
+    raw_response = call_ai_model(
+        prompt=prompt_content, # Use the constructed prompt list for visuals bot
+        model_name=model_name,
+        api_key=api_key,
+        stream=False,
+        route='visuals',
+        generation_config=_generation_config(schema)
+    )
+    if _json_mode_rejected(raw_response, schema):
+        schema = None # The prompt asks for a <data> tag when JSON mode is off
+        raw_response = call_ai_model(prompt=prompt_content, model_name=model_name, api_key=api_key,
+                                     stream=False, route='visuals')
+    schedule = _parse_visuals_response(raw_response, schema)
+    _store_schedule(gen_tag_content, schedule)
+    return schedule
+
+
+def _cached_schedule(gen_tag_content):
+    """A cached schedule adapted to this <gen> request (zero tokens, '_cache_hit'), or None."""
+    cache = current_app.extensions.get('schedule_cache')
+    if cache is None:
+        return None
+    try:
+        fields = parse_gen_tag(gen_tag_content)
+    except ValueError:
+        return None # _visuals_request reports it
+    schedule = cache.lookup(fields)
+    if schedule is not None:
+        schedule['_visuals_input_tokens'] = 0
+        schedule['_visuals_output_tokens'] = 0
+    return schedule
+
+
+def _store_schedule(gen_tag_content, schedule):
+    cache = current_app.extensions.get('schedule_cache')
+    if cache is not None and 'error' not in schedule:
+        cache.save(parse_gen_tag(gen_tag_content), schedule)
+
+
+def _visuals_request(gen_tag_content):
+    """Returns ((prompt, model_name, api_key), None) for a <gen> tag, or (None, error_dict)."""
     log.debug(f"Generating schedule data from <gen> tag: {gen_tag_content}")
 
     # Parse the pipe-delimited content from the <gen> tag
     try:
-        parts = gen_tag_content.split('|')
-        if len(parts) != 5:
-            raise ValueError(f"Expected 5 parts in <gen> tag, got {len(parts)}")
-        crop_name, generation_type, location, current_date, npk_string = [p.strip() for p in parts]
+        crop_name, generation_type, location, current_date, npk_string = parse_gen_tag(gen_tag_content)
     except Exception as e:
         log.error(f"Failed to parse <gen> tag content '{gen_tag_content}': {e}")
-        return {"error": "Internal error: Invalid format in AI's generation request."}
+        return None, {"error": "Internal error: Invalid format in AI's generation request."}
 
     # Model/Key for Visuals Bot (Using FREE_ACCESSORY as configured)
     model_name = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
@@ -221,7 +769,7 @@ def generate_schedule_data(gen_tag_content):
 
     if not api_key or not model_name:
          log.error("AI service config missing for schedule generation (VisualsBot).")
-         return {"error": "AI schedule generation service not configured."}
+         return None, {"error": "AI schedule generation service not configured."}
 
     # --- Build the prompt for VisualsBot ---
     # processVisualBotQuery expects a single string argument representing the user query part
@@ -229,15 +777,16 @@ def generate_schedule_data(gen_tag_content):
     visuals_bot_input_string = f"Crop Name: {crop_name}\nGeneration Type: {generation_type}\nLocation: {location}\nCurrent Date: {current_date}\nNPK Readings: {npk_string}"
     prompt_content = processVisualBotQuery(visuals_bot_input_string)
     # --- End Prompt Build ---
+    return (prompt_content, model_name, api_key), None
 
-    # Call AI (non-streaming)
-    raw_response = call_ai_model(
-        prompt=prompt_content, # Use the constructed prompt list for visuals bot
-        model_name=model_name,
-        api_key=api_key,
-        stream=False
-    )
 
+def _parse_visuals_response(raw_response, schema=None):
+    """
+    Turns a VisualsBot call result into the parsed schedule dict (or an error dict).
+
+    With `schema` (JSON mode) the reply is validated against it, repaired if
+    needed; otherwise the JSON inside its <data> tag is evaluated.
+    """
     if 'error' in raw_response:
         log.warning(f"VisualsBot AI call failed: {raw_response['error']}")
         return raw_response # Forward error
@@ -247,8 +796,20 @@ def generate_schedule_data(gen_tag_content):
         log.warning("VisualsBot AI returned empty text.")
         return {"error": "AI failed to generate schedule structure."}
 
+    if schema is not None:
+        try:
+            schedule_json, repair_tokens = _parse_structured(schema, visuals_text, visuals_from_json)
+        except StructuredOutputError as e:
+            log.error(f"VisualsBot JSON does not match its schema: {e}\nContent: {visuals_text[:300]}...")
+            return {"error": "AI response format error (invalid schedule JSON)."}
+        log.info("Successfully parsed schedule data from VisualsBot.")
+        schedule_json['_visuals_input_tokens'] = raw_response.get('input_tokens', 0) + repair_tokens[0]
+        schedule_json['_visuals_output_tokens'] = raw_response.get('output_tokens', 0) + repair_tokens[1]
+        return schedule_json
+
     # Extract content within <data> tag
-    data_tag_content = extract_tags(visuals_text, ['data']).get('data')
+    with current_app.extensions['telemetry'].span('extract_tags'):
+        data_tag_content = extract_tags(visuals_text, ['data']).get('data')
     if not data_tag_content:
         log.error(f"Could not find <data> tag in VisualsBot response: {visuals_text[:300]}...")
         return {"error": "AI response format error (missing <data> tag)."}
@@ -265,8 +826,75 @@ def generate_schedule_data(gen_tag_content):
     except Exception as e:
         log.error(f"Failed to parse JSON from <data> tag: {e}\nContent: {data_tag_content[:300]}...", exc_info=True)
         return {"error": "AI response format error (invalid JSON in <data> tag)."}
-    
-    
+
+
+def _structured_schema(schema, model_name):
+    """
+    `schema` when JSON-mode output is enabled (STRUCTURED_OUTPUT_ENABLED) and
+    `model_name` supports it (STRUCTURED_OUTPUT_MODELS prefixes), else None
+    (tagged text).
+    """
+    if not current_app.config.get('STRUCTURED_OUTPUT_ENABLED', True) or not model_name:
+        return None
+    prefixes = tuple(prefix.strip() for prefix in
+                     (current_app.config.get('STRUCTURED_OUTPUT_MODELS') or '').split(',') if prefix.strip())
+    return schema if prefixes and model_name.split('/')[-1].startswith(prefixes) else None
+
+
+def _generation_config(schema):
+    return json_generation_config(schema) if schema is not None else None
+
+
+def _json_mode_rejected(result, schema):
+    """True if a JSON-mode call came back as an invalid request; the caller retries once as tagged text."""
+    if schema is None or not result.get('invalid_request'):
+        return False
+    log.warning(f"{schema.__name__} request rejected in JSON mode; retrying once as tagged text.")
+    return True
+
+
+def _parse_structured(schema, text, parser):
+    """
+    Parses a JSON-mode reply with `parser` (a schemas.*_from_json function).
+
+    Replies that fail validation even after local repair are sent once to
+    the accessory model, in JSON mode, to be fixed. Returns (parsed,
+    (repair input tokens, repair output tokens)); raises
+    StructuredOutputError if the repaired reply does not parse either.
+    """
+    telemetry = current_app.extensions['telemetry']
+    outcome_labels = lambda outcome: (('schema', schema.__name__), ('outcome', outcome))
+    try:
+        with telemetry.span('parse_structured'):
+            parsed = parser(text)
+        telemetry.increment('kapricorn_structured_outputs_total', 1, outcome_labels('valid'))
+        return parsed, (0, 0)
+    except StructuredOutputError as e:
+        errors = str(e)
+
+    model_name = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
+    api_key = current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
+    log.warning(f"{schema.__name__} reply failed validation; asking '{model_name}' to repair it:\n{errors}")
+    # The prompt asks for bare JSON, so a model without JSON mode can still repair (fences are stripped locally)
+    repair_schema = _structured_schema(schema, model_name)
+    repair_result = call_ai_model(prompt=repairStructuredOutput(text, errors), model_name=model_name,
+                                  api_key=api_key, stream=False, route='repair',
+                                  generation_config=_generation_config(repair_schema))
+    if _json_mode_rejected(repair_result, repair_schema):
+        repair_result = call_ai_model(prompt=repairStructuredOutput(text, errors), model_name=model_name,
+                                      api_key=api_key, stream=False, route='repair')
+    if 'error' in repair_result:
+        telemetry.increment('kapricorn_structured_outputs_total', 1, outcome_labels('failed'))
+        raise StructuredOutputError(f"repair call failed: {repair_result['error']}")
+    try:
+        with telemetry.span('parse_structured'):
+            parsed = parser(repair_result.get('text') or '')
+    except StructuredOutputError:
+        telemetry.increment('kapricorn_structured_outputs_total', 1, outcome_labels('failed'))
+        raise
+    telemetry.increment('kapricorn_structured_outputs_total', 1, outcome_labels('repaired'))
+    return parsed, (repair_result.get('input_tokens', 0), repair_result.get('output_tokens', 0))
+
 
 def get_recommendations(location_description):
     """
@@ -282,23 +910,22 @@ def get_recommendations(location_description):
     """
     log.debug(f"Getting recommendations for location '{location_description}'")
 
-    # --- Determine Model/Key (Using FREE_ACCESSORY model for recommendations) ---
-    model_name = current_app.config.get('PAID_MODEL_NAME')
-    api_key = current_app.config.get('GOOGLE_API_KEY_RECOMENDATIONS')
-    log.debug(f"Using FREE_ACCESSORY model for recommendations: {model_name}")
+    # --- Serve from cache when this location was analysed recently ---
+    cache = current_app.extensions['recommendation_cache']
+    cache_key = normalize_location(location_description)
+    cached = _cached_recommendations(cache, cache_key)
+    if cached is not None:
+        return cached
 
-    if not api_key or not model_name:
-        log.error(f"AI service config missing for recommendations (FREE_ACCESSORY)")
-        return {"error": "AI recommendations service not configured."}
+    request, error = _recommendation_request(location_description)
+    if error:
+        return error
+    analysis_prompt, model_name, api_key = request
 
-    # --- Step 1: Initial Analysis Prompt ---
-    try:
-        # analyseLocation returns a tuple (prompt, parser_function), we only need the prompt here
-        analysis_prompt, _ = analyseLocation(location_description)
-        log.debug("Generated analysis prompt.")
-    except Exception as e:
-        log.error(f"Error building analysis prompt: {e}", exc_info=True)
-        return {"error": "Internal error preparing recommendation request (1)."}
+    if current_app.config.get('RECOMMENDATION_PIPELINE', True):
+        parsed_recommendations = _pipelined_recommendations(analysis_prompt, model_name, api_key)
+        _store_recommendations(cache, cache_key, parsed_recommendations)
+        return parsed_recommendations
 
     # --- Call AI for Analysis ---
     log.info(f"Calling AI for recommendation analysis (Model: {model_name})...")
@@ -306,7 +933,8 @@ def get_recommendations(location_description):
         prompt=analysis_prompt,
         model_name=model_name,
         api_key=api_key,
-        stream=False # Recommendations don't need streaming
+        stream=False, # Recommendations don't need streaming
+        route='recommendations'
     )
 
     if 'error' in analysis_result:
@@ -322,26 +950,17 @@ def get_recommendations(location_description):
          return {"error": "AI analysis failed to produce results."}
     log.debug("Received analysis text from AI.")
 
-    # --- Step 2: Formatting Prompt ---
-    try:
-        # formatLocationInfo returns a tuple (prompt, parser_function), we need both
-        formatting_prompt, response_parser = formatLocationInfo(analysis_text)
-        log.debug("Generated formatting prompt.")
-    except Exception as e:
-        log.error(f"Error building formatting prompt: {e}", exc_info=True)
-        return {"error": "Internal error preparing recommendation request (2)."}
-
-    # --- Call AI for Formatting ---
+    # --- Step 2: Formatting Prompt and Call ---
     # Using the same model for simplicity, though a cheaper one could be used.
     model_name= current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
     api_key= current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
     log.info(f"Calling AI for recommendation formatting (Model: {model_name})...")
-    formatting_result = call_ai_model(
-        prompt=formatting_prompt,
-        model_name=model_name,
-        api_key=api_key,
-        stream=False
-    )
+    try:
+        # (result, parser_function, schema); schema is None for the tagged-text format
+        formatting_result, response_parser, schema = _formatting_call(analysis_text, model_name, api_key)
+    except Exception as e:
+        log.error(f"Error building formatting prompt: {e}", exc_info=True)
+        return {"error": "Internal error preparing recommendation request (2)."}
 
     if 'error' in formatting_result:
         log.warning(f"AI formatting call failed for recommendations: {formatting_result['error']}")
@@ -358,12 +977,19 @@ def get_recommendations(location_description):
 
     # --- Step 3: Parse Formatted Text ---
     try:
-        # The response_parser here should be extractCropsInfo from formatLocationInfo
-        parsed_recommendations = response_parser(formatted_text)
+        if schema is not None:
+            parsed_recommendations, repair_tokens = _parse_structured(schema, formatted_text, response_parser)
+            input_tokens_step2 += repair_tokens[0]
+            output_tokens_step2 += repair_tokens[1]
+        else:
+            # The response_parser here should be extractCropsInfo from formatLocationInfo
+            with current_app.extensions['telemetry'].span('extract_crops_info'):
+                parsed_recommendations = response_parser(formatted_text)
         if not parsed_recommendations or not isinstance(parsed_recommendations, dict):
              # Add specific check if parser returns non-dict or empty
              raise ValueError(f"Parsing resulted in invalid data type or empty dict: {type(parsed_recommendations)}")
         log.info(f"Successfully generated and parsed {len(parsed_recommendations)} recommendations.")
+        cache.set(cache_key, copy.deepcopy(parsed_recommendations))
 
         # Add token usage info to the result for tracking/debugging
         parsed_recommendations['_total_input_tokens'] = input_tokens_step1 + input_tokens_step2
@@ -372,4 +998,417 @@ def get_recommendations(location_description):
         return parsed_recommendations # Return the structured dictionary
     except Exception as e:
         log.error(f"Error parsing formatted AI recommendations: {e}\nRaw Formatted Text:\n{formatted_text}", exc_info=True) # Log more text
-        return {"error": "Internal error processing AI recommendation results."}
\ No newline at end of file
+        return {"error": "Internal error processing AI recommendation results."}
+
+
+def _cached_recommendations(cache, cache_key):
+    """Returns a fresh copy of cached recommendations (zero tokens, '_cache_hit'), or None."""
+    cached = cache.get(cache_key)
+    if cached is None:
+        return None
+    log.info(f"Recommendation cache hit for '{cache_key}'.")
+    recommendations = copy.deepcopy(cached)
+    recommendations['_total_input_tokens'] = 0
+    recommendations['_total_output_tokens'] = 0
+    recommendations['_cache_hit'] = True
+    return recommendations
+
+
+def _store_recommendations(cache, cache_key, recommendations):
+    """Caches a complete pipelined result (crops only); errors and partial results are not cached."""
+    if 'error' not in recommendations and not recommendations.get('_partial'):
+        crops_only = {k: v for k, v in recommendations.items() if not k.startswith('_')}
+        cache.set(cache_key, copy.deepcopy(crops_only))
+
+
+def _recommendation_request(location_description):
+    """Returns ((analysis_prompt, model_name, api_key), None) or (None, error_dict)."""
+    # --- Determine Model/Key (Using PAID model on the RECOMENDATIONS key) ---
+    model_name = current_app.config.get('PAID_MODEL_NAME')
+    api_key = current_app.config.get('GOOGLE_API_KEY_RECOMENDATIONS')
+    log.debug(f"Using PAID model for recommendations (RECOMENDATIONS key): {model_name}")
+
+    if not api_key or not model_name:
+        log.error(
+            f"AI service config missing for recommendations "
+            f"(PAID_MODEL_NAME set: {bool(model_name)}, GOOGLE_API_KEY_RECOMENDATIONS set: {bool(api_key)})"
+        )
+        return None, {"error": "AI recommendations service not configured."}
+
+    # --- Step 1: Initial Analysis Prompt ---
+    try:
+        # analyseLocation returns a tuple (prompt, parser_function), we only need the prompt here
+        analysis_prompt, _ = analyseLocation(location_description)
+        log.debug("Generated analysis prompt.")
+    except Exception as e:
+        log.error(f"Error building analysis prompt: {e}", exc_info=True)
+        return None, {"error": "Internal error preparing recommendation request (1)."}
+    return (analysis_prompt, model_name, api_key), None
+
+
+def _formatting_request(analysis_text, model_name):
+    """
+    (prompt, parser, schema) formatting `analysis_text` for `model_name`;
+    schema is None for the tagged-text format (always used when `model_name`
+    is None).
+    """
+    schema = _structured_schema(CropRecommendations, model_name)
+    if schema is None:
+        formatting_prompt, response_parser = formatLocationInfo(analysis_text)
+    else:
+        formatting_prompt, response_parser = formatLocationInfoJson(analysis_text)
+    return formatting_prompt, response_parser, schema
+
+
+def _pack_formatting_request(sections, model_name):
+    """_formatting_request for a pack's (n, analysis) sections; the parser returns {n: crops}."""
+    schema = _structured_schema(PackedCropRecommendations, model_name)
+    if schema is None:
+        formatting_prompt, response_parser = formatLocationsInfo(sections)
+    else:
+        formatting_prompt, response_parser = formatLocationsInfoJson(sections)
+    return formatting_prompt, response_parser, schema
+
+
+def _formatting_call(analysis_text, model_name, api_key, request=_formatting_request):
+    """
+    (formatting result, parser, schema) for `request(analysis_text, model_name)`:
+    JSON mode where supported, tagged text if the model rejects it.
+    """
+    formatting_prompt, response_parser, schema = request(analysis_text, model_name)
+    formatting_result = call_ai_model(prompt=formatting_prompt, model_name=model_name, api_key=api_key,
+                                      stream=False, generation_config=_generation_config(schema))
+    if _json_mode_rejected(formatting_result, schema):
+        formatting_prompt, response_parser, schema = request(analysis_text, None)
+        formatting_result = call_ai_model(prompt=formatting_prompt, model_name=model_name, api_key=api_key,
+                                          stream=False)
+    return formatting_result, response_parser, schema
+
+
+def _format_sections(app, analysis_text, model_name, api_key):
+    """Formats and parses one slice of the analysis (runs on a worker thread)."""
+    with app.app_context():
+        formatting_result, response_parser, schema = _formatting_call(analysis_text, model_name, api_key)
+        return _parse_formatted_batch(formatting_result, response_parser, schema)
+
+
+def _parse_formatted_batch(formatting_result, response_parser, schema=None):
+    """{'crops', 'input_tokens', 'output_tokens'} for one formatting call, or its error dict."""
+    if 'error' in formatting_result:
+        return formatting_result
+    repair_tokens = (0, 0)
+    try:
+        if schema is not None:
+            crops, repair_tokens = _parse_structured(schema, formatting_result.get('text') or '', response_parser)
+        else:
+            with current_app.extensions['telemetry'].span('extract_crops_info'):
+                crops = response_parser(formatting_result.get('text') or '')
+    except Exception as e:
+        log.error(f"Error parsing formatted recommendation batch: {e}", exc_info=True)
+        return {"error": "Internal error processing AI recommendation results."}
+    return {
+        'crops': crops,
+        'input_tokens': formatting_result.get('input_tokens', 0) + repair_tokens[0],
+        'output_tokens': formatting_result.get('output_tokens', 0) + repair_tokens[1],
+    }
+
+
+def _pipelined_recommendations(analysis_prompt, analysis_model, analysis_key):
+    """
+    Streams the analysis and formats crops in parallel as their text completes.
+
+    Each crop section (batched RECOMMENDATION_FORMAT_BATCH_SIZE at a time) goes
+    to the formatting model as soon as the next crop header arrives, so
+    formatting overlaps the analysis and no call re-sends the full analysis.
+    A rate governed formatting key caps the calls (see _format_call_budget);
+    sections past the cap are formatted together once the analysis ends.
+    If no crop headers are recognised, the whole analysis is formatted in one
+    call, as the sequential path does.
+
+    Returns the merged crop dict with '_total_*_tokens' (and '_partial' if a
+    batch failed), or an error dict.
+    """
+    app = current_app._get_current_object()
+    executor = current_app.extensions['recommendation_executor']
+    batch_size = max(1, current_app.config.get('RECOMMENDATION_FORMAT_BATCH_SIZE', 2))
+    format_model = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
+    format_key = current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
+    max_calls = _format_call_budget(format_key)
+
+    futures = []
+    batch = []
+
+    def submit(sections):
+        # Run in a copy of this context so the worker's spans keep this request's endpoint
+        futures.append(executor.submit(contextvars.copy_context().run, _format_sections,
+                                       app, '\n\n'.join(sections), format_model, format_key))
+
+    log.info(f"Streaming recommendation analysis (Model: {analysis_model}), formatting in batches of {batch_size}...")
+    splitter = CropSectionSplitter()
+    analysis_result = call_ai_model(prompt=analysis_prompt, model_name=analysis_model, api_key=analysis_key,
+                                    stream=True, route='recommendations')
+    if 'error' in analysis_result:
+        log.warning(f"AI analysis call failed for recommendations: {analysis_result['error']}")
+        return analysis_result # Forward the error (and any retry_after)
+    analysis_done = None
+    for kind, value in iter_stream_events(analysis_result, analysis_model):
+        if kind == 'chunk':
+            for section in splitter.feed(value):
+                batch.append(section)
+                if len(batch) >= batch_size and len(futures) < max_calls - 1:
+                    submit(batch)
+                    batch = []
+        elif kind == 'error':
+            log.warning(f"AI analysis call failed for recommendations: {value}")
+            for future in futures:
+                future.cancel()
+            return {"error": value}
+        else:
+            analysis_done = value
+
+    batch.extend(splitter.finish())
+    if batch:
+        submit(batch)
+    if not futures:
+        log.warning("No crop sections recognised in analysis; formatting it in one call.")
+        submit([analysis_done['text']])
+
+    # Parse each batch as it lands; merge in analysis order
+    batch_results = {}
+    index_of = {future: index for index, future in enumerate(futures)}
+    for future in as_completed(futures):
+        batch_results[index_of[future]] = future.result()
+    return _merge_batches(analysis_done, [batch_results[index] for index in range(len(futures))])
+
+
+def _format_call_budget(format_key):
+    """
+    Most formatting calls one recommendation may make on `format_key`.
+
+    Unbounded unless the key is rate governed; then about one second's worth
+    of its rate (at least one call), so splitting the formatting does not
+    spend a low-quota key several times per request.
+    """
+    governor = current_app.extensions['rate_governor']
+    key_governor = governor.for_key(format_key) if governor.enabled else None
+    if key_governor is None:
+        return float('inf')
+    return max(1, int(key_governor.ceiling_rate))
+
+
+def _merge_batches(analysis_done, batch_results):
+    """
+    Merges per-batch crop dicts (in analysis order) and totals the tokens of every call.
+
+    Sets '_partial' if some batches failed. If all of them failed, returns an
+    error dict: a throttled batch's (with its retry_after) when there is one.
+    """
+    parsed_recommendations = {}
+    total_input = analysis_done.get('input_tokens', 0)
+    total_output = analysis_done.get('output_tokens', 0)
+    failed_batches = 0
+    throttled = None
+    for index, result in enumerate(batch_results):
+        if 'error' in result:
+            log.warning(f"Recommendation formatting batch {index} failed: {result['error']}")
+            failed_batches += 1
+            if result.get('retry_after') is not None:
+                throttled = result
+            continue
+        parsed_recommendations.update(result['crops'])
+        total_input += result['input_tokens']
+        total_output += result['output_tokens']
+
+    if not parsed_recommendations:
+        return dict(throttled) if throttled else {"error": "AI formatting failed to produce results."}
+    log.info(f"Pipelined recommendations: {len(parsed_recommendations)} crops from {len(batch_results)} batches ({failed_batches} failed).")
+
+    parsed_recommendations['_total_input_tokens'] = total_input
+    parsed_recommendations['_total_output_tokens'] = total_output
+    if failed_batches:
+        parsed_recommendations['_partial'] = True
+    return parsed_recommendations
+
+
+def get_batch_recommendations(locations):
+    """
+    Crop recommendations for many locations, yielded per location as each is ready.
+
+    Locations are deduplicated by normalize_location and cache hits are
+    yielded first. The misses are analysed RECOMMENDATION_BATCH_PACK_SIZE
+    at a time, one analyseLocations call per pack. Packs run concurrently
+    on the batch executor, paced to the analysis key: no more are in flight
+    than its rate governor admits at once, and their calls queue for the
+    governor for up to RECOMMENDATION_BATCH_MAX_WAIT_SECONDS rather than
+    failing after the interactive wait. Once a pack's analysis ends, all of
+    its locations are formatted in one call, and results are cached as
+    get_recommendations caches them. Locations a packed reply leaves out are
+    analysed on their own. Closing the generator early (the client went
+    away) stops further packs from starting.
+
+    Yields (location, requested_as, result): the first spelling given, every
+    spelling that normalized to it, and a get_recommendations result.
+    """
+    cache = current_app.extensions['recommendation_cache']
+    spellings = OrderedDict() # cache key -> locations as requested
+    for location in locations:
+        spellings.setdefault(normalize_location(location), []).append(location)
+
+    misses = []
+    for cache_key, requested_as in spellings.items():
+        cached = _cached_recommendations(cache, cache_key)
+        if cached is not None:
+            yield requested_as[0], requested_as, cached
+        else:
+            misses.append((cache_key, requested_as[0]))
+    if not misses:
+        return
+
+    model_name = current_app.config.get('PAID_MODEL_NAME')
+    api_key = current_app.config.get('GOOGLE_API_KEY_RECOMENDATIONS')
+    if not api_key or not model_name:
+        log.error("AI service config missing for batch recommendations")
+        for cache_key, location in misses:
+            yield location, spellings[cache_key], {"error": "AI recommendations service not configured."}
+        return
+
+    app = current_app._get_current_object()
+    executor = current_app.extensions['recommendation_batch_executor']
+    pack_size = max(1, current_app.config.get('RECOMMENDATION_BATCH_PACK_SIZE', 4))
+    packs = deque(misses[start:start + pack_size] for start in range(0, len(misses), pack_size))
+    # More packs in flight than the analysis key admits would only queue at the governor
+    governor = current_app.extensions['rate_governor']
+    key_governor = governor.for_key(api_key) if governor.enabled else None
+    in_flight = max(1, key_governor.max_concurrency) if key_governor is not None else len(packs)
+    finished = queue.Queue()
+    packs_lock = threading.Lock()
+
+    def submit_next(_done=None):
+        with packs_lock:
+            pack = packs.popleft() if packs else None
+        if pack is None:
+            return
+        try:
+            future = executor.submit(contextvars.copy_context().run, _recommend_pack, app,
+                                     pack, model_name, api_key, finished.put)
+        except RuntimeError: # Shutting down
+            for cache_key, _ in pack:
+                finished.put((cache_key, {"error": "An unexpected internal server error occurred."}))
+            return
+        future.add_done_callback(submit_next) # The next pack starts as this one ends
+
+    log.info(f"Batch recommendations: {len(spellings)} locations, {len(spellings) - len(misses)} cached, "
+             f"{len(misses)} to analyse in {len(packs)} packs of {pack_size}, {in_flight} at a time.")
+    for _ in range(min(in_flight, len(packs))):
+        submit_next()
+    try:
+        for _ in misses:
+            cache_key, result = finished.get()
+            yield spellings[cache_key][0], spellings[cache_key], result
+    finally:
+        with packs_lock:
+            abandoned = len(packs)
+            packs.clear() # Packs in flight finish (and are cached); the chain ends with them
+        if abandoned:
+            log.warning(f"Batch recommendations closed early; {abandoned} packs not started.")
+
+
+def _recommend_pack(app, pack, model_name, api_key, emit):
+    """
+    Recommendations for one pack of (cache_key, location) misses (runs on the batch executor).
+
+    Calls emit((cache_key, result)) once per location, whatever happens.
+    """
+    with app.app_context(), rate_limit_patience(app.config.get('RECOMMENDATION_BATCH_MAX_WAIT_SECONDS', 300)):
+        cache = current_app.extensions['recommendation_cache']
+        pending = dict(pack)
+
+        def finish(cache_key, result, store=False):
+            if pending.pop(cache_key, None) is not None:
+                if store:
+                    _store_recommendations(cache, cache_key, result)
+                emit((cache_key, result))
+
+        try:
+            error = _analyse_pack(pack, model_name, api_key,
+                                  lambda cache_key, result: finish(cache_key, result, store=True))
+            for cache_key, location in list(pending.items()):
+                if error is not None:
+                    finish(cache_key, dict(error))
+                else:
+                    log.warning(f"Packed analysis left out '{location}'; analysing it on its own.")
+                    finish(cache_key, get_recommendations(location))
+        except Exception as e:
+            log.exception(f"Batch recommendation pack failed: {e}")
+            for cache_key in list(pending):
+                finish(cache_key, {"error": "An unexpected internal server error occurred."})
+
+
+def _analyse_pack(pack, model_name, api_key, finish):
+    """
+    Streams one analyseLocations call for `pack`, then formats every
+    location's section in one formatLocationsInfo call and passes each
+    location's result to finish(). A location the formatted reply leaves
+    out is formatted on its own.
+
+    Returns None, or the error dict if the analysis failed (the sections
+    completed before it are still formatted and finished).
+    """
+    format_model = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
+    format_key = current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
+
+    log.info(f"Streaming packed recommendation analysis for {len(pack)} locations (Model: {model_name})...")
+    analysis_result = call_ai_model(prompt=analyseLocations([location for _, location in pack]),
+                                    model_name=model_name, api_key=api_key, stream=True, route='recommendations')
+    if 'error' in analysis_result:
+        log.warning(f"Packed analysis call failed for recommendations: {analysis_result['error']}")
+        return analysis_result
+    splitter = LocationSectionSplitter()
+    found = []
+    error = None
+    analysis_done = {}
+    for kind, value in iter_stream_events(analysis_result, model_name):
+        if kind == 'chunk':
+            found.extend(splitter.feed(value))
+        elif kind == 'error':
+            log.warning(f"Packed analysis call failed for recommendations: {value}")
+            error = {"error": value}
+        else:
+            analysis_done = value
+    if error is None:
+        found.extend(splitter.finish())
+    sections = {} # location number -> its analysis; the first section wins
+    for number, text in found:
+        if 1 <= number <= len(pack):
+            sections.setdefault(number, text)
+    if not sections:
+        return error
+
+    formatting_result, response_parser, schema = _formatting_call(list(sections.items()), format_model, format_key,
+                                                                  _pack_formatting_request)
+    formatted = _parse_formatted_batch(formatting_result, response_parser, schema)
+    packed = formatted.get('crops', {})
+    # Each call's tokens are split across the locations it served
+    analysis_shares = _token_shares(analysis_done, len(pack))
+    format_shares = dict(zip([number for number in sections if number in packed],
+                             _token_shares(formatted, sum(number in packed for number in sections))))
+    for index, (number, text) in enumerate(sections.items()):
+        if 'error' in formatted:
+            result = formatted
+        elif number in packed:
+            result = dict(format_shares[number], crops=packed[number])
+        else:
+            log.warning(f"Packed formatting left out location {number}; formatting it on its own.")
+            result = _parse_formatted_batch(*_formatting_call(text, format_model, format_key))
+        finish(pack[number - 1][0], _merge_batches(analysis_shares[index], [result]))
+    return error
+
+
+def _token_shares(result, parts):
+    """`result`'s input/output tokens split into `parts` shares; the first takes the remainder."""
+    shares = [{} for _ in range(parts)]
+    for field in ('input_tokens', 'output_tokens'):
+        share, extra = divmod(result.get(field, 0), parts) if parts else (0, 0)
+        for index, tokens in enumerate(shares):
+            tokens[field] = share + (extra if index == 0 else 0)
+    return shares
@@ -0,0 +1,275 @@
+# File: kapricorn/ai_service_async.py
+
+"""
+asyncio variants of the AI service functions.
+
+Same requests, parsing, caching and accounting as ai_service, but the
+Gemini calls go through `generate_content_async`, so one event loop can
+keep hundreds of model calls in flight instead of holding a worker thread
+for each. Must run inside a Flask app context (asgi.py pushes one per
+request).
+"""
+
+import asyncio
+import logging
+
+from flask import current_app
+import google.generativeai as genai
+
+from .ai_service import (
+    _prepare_call, _finish_generation, _call_error, _fallback_targets, _request_fingerprint,
+    _stream_chunk, _stream_outcome,
+    _chat_model_config, _chat_route, _visuals_request, _parse_visuals_response,
+    _cached_schedule, _store_schedule,
+    _cached_recommendations, _store_recommendations, _recommendation_request,
+    _formatting_request, _parse_formatted_batch, _merge_batches, _format_call_budget,
+    _structured_schema, _generation_config,
+    _json_mode_rejected,
+)
+from .cache import normalize_location
+from .schemas import VisualsData
+from .recommendation_engine import CropSectionSplitter
+
+log = logging.getLogger(__name__)
+
+
+async def call_ai_model_async(prompt, model_name, api_key, stream=False, route=None, generation_config=None):
+    """
+    Awaitable call_ai_model. For stream=True the result's 'stream' is an async iterator.
+
+    Request preparation may create a provider-side prompt cache on first use,
+    so it runs on a worker thread; the generation itself is awaited.
+    Retries, hedging and fallbacks behave as in call_ai_model.
+    """
+    result = await _call_model_async(prompt, model_name, api_key, stream, route, generation_config)
+    for fallback_model, fallback_key in _fallback_targets(route, model_name):
+        if not result.get('overloaded'):
+            break
+        log.warning(f"'{model_name}' overloaded for route '{route}'; falling back to '{fallback_model}'.")
+        result = await _call_model_async(prompt, fallback_model, fallback_key, stream, route, generation_config)
+        current_app.extensions['resilience'].record_fallback(
+            route, model_name, fallback_model, succeeded='error' not in result)
+        if 'error' not in result:
+            result['fallback_model'] = fallback_model
+    return result
+
+
+async def _call_model_async(prompt, model_name, api_key, stream, route=None, generation_config=None):
+    prepared, error = await asyncio.to_thread(_prepare_call, prompt, model_name, api_key)
+    if error:
+        return error
+    content_to_send, cached_content, request_contents, prefix_name = prepared
+
+    registry = current_app.extensions['model_registry']
+    governor = current_app.extensions['rate_governor']
+    breakers = current_app.extensions['circuit_breakers']
+    resilience = current_app.extensions['resilience']
+    telemetry = current_app.extensions['telemetry']
+    labels = telemetry.call_labels(route, model_name, api_key)
+    try:
+        if stream:
+            async def open_stream(sent):
+                with breakers.call(model_name, api_key) as breaker_call, \
+                        await governor.acquire_async(api_key) as permit, \
+                        registry.lease(api_key, model_name, cached_content) as model:
+                    registry.prepare_async(api_key, model)
+                    log.info(f"Calling AI model '{model_name}' async (Stream: True, Cached prefix: {bool(cached_content)})...")
+                    breaker_call.started()
+                    sent()
+                    with telemetry.model_call(labels, stream=True):
+                        response = await model.generate_content_async(request_contents, stream=True,
+                                                                      generation_config=generation_config)
+                    return permit.guard_async_stream(response)
+
+            response = await resilience.run_async(model_name, open_stream, hedge=False)
+            accountant = current_app.extensions['token_accountant']
+            with telemetry.span('token_count'):
+                input_token_count = accountant.estimate(content_to_send, model_name)
+            return {'stream': response, 'input_tokens': input_token_count, 'metric_labels': labels}
+
+        async def attempt(sent):
+            with breakers.call(model_name, api_key) as breaker_call, \
+                    await governor.acquire_async(api_key), \
+                    registry.lease(api_key, model_name, cached_content) as model:
+                registry.prepare_async(api_key, model)
+                log.info(f"Calling AI model '{model_name}' async (Stream: False, Cached prefix: {bool(cached_content)})...")
+                breaker_call.started()
+                sent()
+                with telemetry.model_call(labels):
+                    response = await model.generate_content_async(request_contents,
+                                                                  generation_config=generation_config)
+                return _finish_generation(response, model_name, content_to_send,
+                                          prefix_name if cached_content else None, labels)
+
+        single_flight = current_app.extensions['single_flight']
+        fingerprint = _request_fingerprint(model_name, api_key, content_to_send, generation_config)
+        result, shared = await single_flight.do_async(fingerprint, lambda: resilience.run_async(model_name, attempt))
+        if shared:
+            log.info(f"Async AI call to '{model_name}' coalesced with an identical in-flight request.")
+        return dict(result)
+
+    except genai.types.generation_types.BlockedPromptException as bpe:
+        log.error(f"AI Model call blocked prompt ({model_name}): {bpe}", exc_info=True)
+        return {"error": "AI request blocked by safety filters."}
+    except Exception as e:
+        return _call_error(e, model_name, api_key, stream)
+
+
+async def aiter_stream_events(ai_result, model_name):
+    """Async twin of ai_service.iter_stream_events."""
+    if 'error' in ai_result:
+        yield 'error', ai_result['error']
+        return
+
+    pieces = []
+    usage = [None, None]
+    try:
+        async for chunk in ai_result['stream']:
+            text = _stream_chunk(chunk, usage)
+            if text:
+                pieces.append(text)
+                yield 'chunk', text
+    except Exception as e:
+        log.error(f"AI stream error ({model_name}): {e}", exc_info=True)
+        yield 'error', "AI service encountered an unexpected error."
+        return
+
+    yield _stream_outcome(pieces, usage, ai_result, model_name)
+
+
+async def get_chat_response_async(history, use_pro_model):
+    """Awaitable get_chat_response."""
+    model_name, api_key = _chat_model_config(use_pro_model)
+    if not api_key or not model_name:
+        log.error(f"Chat AI service config missing (Pro: {use_pro_model}). Key: {bool(api_key)}, Model: {bool(model_name)}")
+        return {"error": "AI service not configured for this chat request."}
+    return await call_ai_model_async(prompt=history, model_name=model_name, api_key=api_key,
+                                     route=_chat_route(use_pro_model))
+
+
+async def generate_schedule_data_async(gen_tag_content):
+    """Awaitable generate_schedule_data."""
+    # The persistent cache tier may hit the database
+    cached = await asyncio.to_thread(_cached_schedule, gen_tag_content)
+    if cached is not None:
+        return cached
+    request, error = _visuals_request(gen_tag_content)
+    if error:
+        return error
+    prompt_content, model_name, api_key = request
+    schema = _structured_schema(VisualsData, model_name)
+    raw_response = await call_ai_model_async(prompt=prompt_content, model_name=model_name, api_key=api_key,
+                                             route='visuals', generation_config=_generation_config(schema))
+    if _json_mode_rejected(raw_response, schema):
+        schema = None
+        raw_response = await call_ai_model_async(prompt=prompt_content, model_name=model_name, api_key=api_key,
+                                                 route='visuals')
+    # A reply that fails validation gets one (blocking) repair call
+    schedule = await asyncio.to_thread(_parse_visuals_response, raw_response, schema)
+    await asyncio.to_thread(_store_schedule, gen_tag_content, schedule)
+    return schedule
+
+
+async def get_recommendations_async(location_description):
+    """
+    Awaitable get_recommendations.
+
+    With RECOMMENDATION_PIPELINE (the default) the analysis is streamed and
+    each batch of crop sections is formatted by its own task while the
+    analysis continues; otherwise the analysis and then its formatting are
+    one call each, as in get_recommendations.
+    """
+    cache = current_app.extensions['recommendation_cache']
+    cache_key = normalize_location(location_description)
+    # The persistent cache tier may hit the database
+    cached = await asyncio.to_thread(_cached_recommendations, cache, cache_key)
+    if cached is not None:
+        return cached
+
+    request, error = _recommendation_request(location_description)
+    if error:
+        return error
+    analysis_prompt, model_name, api_key = request
+
+    if current_app.config.get('RECOMMENDATION_PIPELINE', True):
+        recommendations = await _pipelined_recommendations_async(analysis_prompt, model_name, api_key)
+    else:
+        recommendations = await _sequential_recommendations_async(analysis_prompt, model_name, api_key)
+    await asyncio.to_thread(_store_recommendations, cache, cache_key, recommendations)
+    return recommendations
+
+
+async def _sequential_recommendations_async(analysis_prompt, analysis_model, analysis_key):
+    log.info(f"Calling AI for recommendation analysis (Model: {analysis_model})...")
+    analysis_result = await call_ai_model_async(analysis_prompt, analysis_model, analysis_key,
+                                                route='recommendations')
+    if 'error' in analysis_result:
+        log.warning(f"AI analysis call failed for recommendations: {analysis_result['error']}")
+        return analysis_result
+    if not analysis_result.get('text'):
+        log.warning("AI analysis for recommendations returned empty text.")
+        return {"error": "AI analysis failed to produce results."}
+
+    format_model = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
+    format_key = current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
+    log.info(f"Calling AI for recommendation formatting (Model: {format_model})...")
+    formatted = await _format_sections_async(analysis_result['text'], format_model, format_key)
+    return _merge_batches(analysis_result, [formatted])
+
+
+async def _format_sections_async(analysis_text, model_name, api_key):
+    formatting_prompt, response_parser, schema = _formatting_request(analysis_text, model_name)
+    formatting_result = await call_ai_model_async(prompt=formatting_prompt, model_name=model_name, api_key=api_key,
+                                                  generation_config=_generation_config(schema))
+    if _json_mode_rejected(formatting_result, schema):
+        formatting_prompt, response_parser, schema = _formatting_request(analysis_text, None)
+        formatting_result = await call_ai_model_async(prompt=formatting_prompt, model_name=model_name,
+                                                      api_key=api_key)
+    if schema is None:
+        return _parse_formatted_batch(formatting_result, response_parser)
+    return await asyncio.to_thread(_parse_formatted_batch, formatting_result, response_parser, schema)
+
+
+async def _pipelined_recommendations_async(analysis_prompt, analysis_model, analysis_key):
+    batch_size = max(1, current_app.config.get('RECOMMENDATION_FORMAT_BATCH_SIZE', 2))
+    format_model = current_app.config.get('FREE_ACCESSORY_MODEL_NAME')
+    format_key = current_app.config.get('GOOGLE_API_KEY_FREE_ACCESSORY')
+    max_calls = _format_call_budget(format_key)
+
+    tasks = []
+    batch = []
+
+    def submit(sections):
+        tasks.append(asyncio.ensure_future(
+            _format_sections_async('\n\n'.join(sections), format_model, format_key)))
+
+    splitter = CropSectionSplitter()
+    analysis_result = await call_ai_model_async(analysis_prompt, analysis_model, analysis_key, stream=True,
+                                                route='recommendations')
+    if 'error' in analysis_result:
+        log.warning(f"AI analysis call failed for recommendations: {analysis_result['error']}")
+        return analysis_result # Forward the error (and any retry_after)
+    analysis_done = None
+    async for kind, value in aiter_stream_events(analysis_result, analysis_model):
+        if kind == 'chunk':
+            for section in splitter.feed(value):
+                batch.append(section)
+                if len(batch) >= batch_size and len(tasks) < max_calls - 1:
+                    submit(batch)
+                    batch = []
+        elif kind == 'error':
+            log.warning(f"AI analysis call failed for recommendations: {value}")
+            for task in tasks:
+                task.cancel()
+            return {"error": value}
+        else:
+            analysis_done = value
+
+    batch.extend(splitter.finish())
+    if batch:
+        submit(batch)
+    if not tasks:
+        log.warning("No crop sections recognised in analysis; formatting it in one call.")
+        submit([analysis_done['text']])
+
+    return _merge_batches(analysis_done, await asyncio.gather(*tasks))
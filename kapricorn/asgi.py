@@ -0,0 +1,230 @@
+# File: kapricorn/asgi.py
+
+"""
+Minimal ASGI front for the Flask app.
+
+The endpoints that spend their time waiting on Gemini (chat, crop
+recommendations) are served by their asyncio handlers directly on the
+event loop, so in-flight model calls no longer pin a thread each. Every
+other route goes through the regular WSGI app on a small thread pool,
+with response bodies (e.g. the SSE stream) forwarded chunk by chunk; if
+the client disconnects, the WSGI response is closed at its next chunk, as
+a WSGI server would close it.
+
+requirements.txt pins uvicorn; run `uvicorn asgi:app` from the project
+root (any other ASGI server, e.g. `hypercorn asgi:app`, works too).
+"""
+
+import asyncio
+import io
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .routes.chat_routes import handle_chat_async
+from .routes.recommendation_routes import crop_recommendations_async
+
+log = logging.getLogger(__name__)
+
+ASYNC_ROUTES = {
+    ('POST', '/api/chat/'): handle_chat_async,
+    ('POST', '/api/recommend/crops'): crop_recommendations_async,
+}
+
+
+class _ClientGone(Exception):
+    """Raised in a WSGI worker once its client disconnected, to stop reading the response."""
+
+
+def _wsgi_environ(scope, body):
+    """Builds a PEP 3333 environ for an ASGI http scope."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """ASGI application wrapping a Flask app created by create_app()."""
+
+    def __init__(self, flask_app, wsgi_threads=None, max_body_bytes=None):
+        self.flask_app = flask_app
+        self.max_body_bytes = max_body_bytes or flask_app.config.get('ASGI_MAX_BODY_BYTES', 32 * 1024 * 1024)
+        self._executor = ThreadPoolExecutor(
+            max_workers=wsgi_threads or flask_app.config.get('ASGI_WSGI_THREADS', 32),
+            thread_name_prefix='kapricorn-wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return # No websocket routes
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if len(body) > self.max_body_bytes:
+                await self._send_simple(send, 413, b'{"error": "Request body too large."}')
+                return
+            if not message.get('more_body'):
+                break
+
+        environ = _wsgi_environ(scope, bytes(body))
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler is not None:
+            await self._serve_async(handler, environ, send)
+        else:
+            await self._serve_wsgi(environ, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _serve_async(self, handler, environ, send):
+        # A Flask request context gives the handler `request`, `current_app` and jsonify
+        with self.flask_app.request_context(environ) as context:
+            started = time.perf_counter()
+            try:
+                response = self.flask_app.make_response(await handler())
+            except Exception as e:
+                log.exception(f"Unhandled error in async route {environ['PATH_INFO']}: {e}")
+                response = self.flask_app.make_response(
+                    ({"error": "An unexpected internal server error occurred."}, 500))
+            # Flask's after_request hooks do not run for these handlers
+            self.flask_app.extensions['telemetry'].record_request(
+                context.request.endpoint, environ['REQUEST_METHOD'], response.status_code,
+                time.perf_counter() - started)
+            body = response.get_data()
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                            for k, v in response.headers.to_wsgi_list()],
+            })
+            await send({'type': 'http.response.body', 'body': body})
+
+    async def _serve_wsgi(self, environ, receive, send):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=16)
+        done = object()
+        closed = threading.Event() # Set once nothing more will be sent
+
+        def put(item):
+            if closed.is_set():
+                if item is done:
+                    return
+                raise _ClientGone()
+            # Blocks the worker (not the loop) when the client reads slowly
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put(('start', int(status.split(' ', 1)[0]),
+                 [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]))
+
+        def drive():
+            # One thread for the whole response: streamed Flask responses keep
+            # their request context in contextvars, which must not change threads
+            try:
+                result = self.flask_app.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            put(('body', chunk))
+                finally:
+                    close = getattr(result, 'close', None)
+                    if close is not None:
+                        close()
+            except _ClientGone:
+                log.info(f"Client disconnected from {environ['PATH_INFO']}; response closed.")
+            except Exception as e:
+                log.exception(f"WSGI fallback failed for {environ['PATH_INFO']}: {e}")
+                put(('error',))
+            finally:
+                put(done)
+
+        worker = loop.run_in_executor(self._executor, drive)
+        disconnect = asyncio.ensure_future(self._disconnected(receive))
+        finished = False
+        try:
+            started = False
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait({getter, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    return # The client went away
+                item = getter.result()
+                if item is done:
+                    break
+                if item[0] == 'start':
+                    await send({'type': 'http.response.start', 'status': item[1], 'headers': item[2]})
+                    started = True
+                elif item[0] == 'body':
+                    await send({'type': 'http.response.body', 'body': item[1], 'more_body': True})
+                elif not started:
+                    await self._send_simple(send, 500, b'{"error": "An unexpected internal server error occurred."}')
+                    started = None
+            if started:
+                await send({'type': 'http.response.body', 'body': b''})
+            finished = True
+        finally:
+            disconnect.cancel()
+            if not finished:
+                # Disconnected, or send failed: the worker stops at its next chunk (closing the
+                # response), and emptying the queue frees it if it is blocked putting one
+                closed.set()
+                while not queue.empty():
+                    queue.get_nowait()
+        await worker
+
+    @staticmethod
+    async def _disconnected(receive):
+        """Returns once the client disconnects (the request body has already been read)."""
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    async def _send_simple(send, status, body):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(flask_app):
+    return AsgiApp(flask_app)
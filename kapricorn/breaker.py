@@ -0,0 +1,225 @@
+# File: kapricorn/breaker.py
+
+import collections
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from google.api_core import exceptions as google_exceptions
+
+from .clients import key_fingerprint
+
+log = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# Failures that say the model/key itself is unhealthy. Quota errors are the
+# rate governor's business, and bad requests say nothing about the upstream.
+_FAILURE_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a model/key whose breaker is open."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _BreakerCall:
+    """Tracks one admitted call; `started()` marks when the upstream request is sent."""
+
+    __slots__ = ('started_at',)
+
+    def __init__(self):
+        self.started_at = None
+
+    def started(self):
+        self.started_at = time.monotonic()
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open breaker for one (model, key).
+
+    Outcomes of the last `window_size` calls (no older than
+    `window_seconds`) are kept. Once at least `min_calls` are on record and
+    the failure rate reaches `failure_threshold`, or the share of calls
+    slower than `slow_call_seconds` reaches `slow_call_threshold`, the
+    breaker opens and calls fail fast with CircuitOpen for
+    `open_seconds`. It then lets `half_open_calls` probes through: if they
+    all succeed it closes with a fresh window, and any failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=0.5, slow_call_seconds=30.0, slow_call_threshold=0.8,
+                 min_calls=10, window_size=50, window_seconds=60.0, open_seconds=30.0, half_open_calls=1):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_threshold = slow_call_threshold
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=window_size)  # (time, failed, slow)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._stats = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+        self.last_error = None
+
+    def _trim(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def retry_after(self):
+        with self._lock:
+            return self._retry_after_locked(time.monotonic())
+
+    def _retry_after_locked(self, now):
+        return max(1, math.ceil(self._opened_at + self.open_seconds - now))
+
+    def admit(self):
+        """Returns True for a half-open probe, False for a normal call; raises CircuitOpen when open."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now >= self._opened_at + self.open_seconds:
+                self.state = HALF_OPEN
+                self._probes_in_flight = 0
+                self._probe_successes = 0
+                log.info("Circuit half-open; sending a probe request.")
+            if self.state == CLOSED:
+                return False
+            if self.state == HALF_OPEN and self._probes_in_flight < self.half_open_calls:
+                self._probes_in_flight += 1
+                return True
+            self._stats['rejected'] += 1
+            raise CircuitOpen("AI model circuit is open.", self._retry_after_locked(now))
+
+    def record(self, probe, failed, latency, error=None):
+        """Records an admitted call's outcome; `latency` None means it never reached the model."""
+        now = time.monotonic()
+        with self._lock:
+            if probe:
+                self._probes_in_flight -= 1
+            if latency is None and not failed:
+                return # Neutral (e.g. rejected by the rate governor before sending)
+            slow = latency is not None and latency >= self.slow_call_seconds
+            self._stats['calls'] += 1
+            self._stats['failures'] += failed
+            self._stats['slow_calls'] += slow
+            if failed:
+                self.last_error = f"{type(error).__name__}: {error}" if error is not None else None
+
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._open(now, "probe failed")
+                elif probe:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self.state = CLOSED
+                        self._outcomes.clear()
+                        log.info("Circuit closed after successful probe.")
+                return
+            if self.state == OPEN:
+                return # A call admitted before the breaker opened
+
+            self._trim(now)
+            self._outcomes.append((now, failed, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for _, f, _ in self._outcomes if f)
+            slow_calls = sum(1 for _, _, s in self._outcomes if s)
+            if failures / calls >= self.failure_threshold:
+                self._open(now, f"{failures}/{calls} calls failed")
+            elif slow_calls / calls >= self.slow_call_threshold:
+                self._open(now, f"{slow_calls}/{calls} calls slower than {self.slow_call_seconds:g}s")
+
+    def _open(self, now, reason):
+        self.state = OPEN
+        self._opened_at = now
+        self._stats['opened'] += 1
+        log.warning(f"Circuit opened for {self.open_seconds:g}s: {reason}.")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            calls = len(self._outcomes)
+            stats = dict(self._stats)
+            stats.update(
+                state=self.state,
+                window_calls=calls,
+                window_failure_rate=round(sum(1 for _, f, _ in self._outcomes if f) / calls, 3) if calls else 0.0,
+                window_slow_rate=round(sum(1 for _, _, s in self._outcomes if s) / calls, 3) if calls else 0.0,
+                retry_after=self._retry_after_locked(now) if self.state == OPEN else None,
+                last_error=self.last_error,
+            )
+        return stats
+
+
+class BreakerBoard:
+    """
+    CircuitBreakers keyed by (model_name, api_key), created on first use.
+
+    Wrap each upstream attempt in `call(model_name, api_key)` and call
+    `started()` on the yielded object right before the request is sent, so
+    time spent waiting for a rate-limit slot is not counted as latency.
+    """
+
+    def __init__(self, enabled=True, **breaker_options):
+        self.enabled = enabled
+        self._breaker_options = breaker_options
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def breaker(self, model_name, api_key):
+        with self._lock:
+            breaker = self._breakers.get((model_name, api_key))
+            if breaker is None:
+                breaker = self._breakers[(model_name, api_key)] = CircuitBreaker(**self._breaker_options)
+            return breaker
+
+    @contextmanager
+    def call(self, model_name, api_key):
+        tracked = _BreakerCall()
+        if not self.enabled:
+            yield tracked
+            return
+        breaker = self.breaker(model_name, api_key)
+        probe = breaker.admit()
+        try:
+            yield tracked
+        except Exception as e:
+            failed = isinstance(e, _FAILURE_ERRORS)
+            latency = time.monotonic() - tracked.started_at if tracked.started_at is not None else None
+            breaker.record(probe, failed, latency if failed else None, e)
+            raise
+        except BaseException:
+            breaker.record(probe, False, None)
+            raise
+        else:
+            latency = time.monotonic() - tracked.started_at if tracked.started_at is not None else None
+            breaker.record(probe, False, latency)
+
+    def open_circuits(self):
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return [(model, key) for (model, key), breaker in breakers if breaker.state != CLOSED]
+
+    def stats(self):
+        """{'model@key-fingerprint': breaker stats}."""
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return {f"{model}@{key_fingerprint(key)}": breaker.stats() for (model, key), breaker in breakers}
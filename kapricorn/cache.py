@@ -0,0 +1,208 @@
+# File: kapricorn/cache.py
+
+import json
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from sqlalchemy import Column, Float, MetaData, String, Table, Text, create_engine, delete, select
+
+log = logging.getLogger(__name__)
+
+
+def normalize_location(location):
+    """
+    Canonical form of a free-text location for use as a cache key.
+
+    Case, accents, punctuation, extra whitespace and repeated components are
+    ignored, so "Ibadan,  Nigeria." and "ibadan, nigeria" share one key.
+    """
+    text = unicodedata.normalize('NFKD', location or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    components = []
+    for component in text.split(','):
+        component = re.sub(r'[^\w\s-]', ' ', component)
+        component = ' '.join(component.split())
+        if component and component not in components:
+            components.append(component)
+    return ', '.join(components)
+
+
+class TTLCache:
+    """Thread-safe in-memory cache with per-entry TTL and LRU eviction."""
+
+    def __init__(self, max_entries=1000, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_first(self, keys):
+        """(key, value) of the first live entry among `keys`, or None; counted as one lookup."""
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self._entries[key]
+                    self.expirations += 1
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key, entry[1]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl_seconds=None):
+        expires_at = time.monotonic() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class SQLCacheTier:
+    """
+    Persistent JSON cache tier (SQLite by default) so entries survive restarts.
+
+    Values must be JSON-serializable. Expiry uses wall-clock time.
+    """
+
+    def __init__(self, database_url, table_name='response_cache'):
+        self._engine = create_engine(database_url, future=True)
+        metadata = MetaData()
+        self._table = Table(
+            table_name, metadata,
+            Column('key', String(512), primary_key=True),
+            Column('value', Text, nullable=False),
+            Column('expires_at', Float, nullable=False, index=True),
+        )
+        metadata.create_all(self._engine)
+
+    def get(self, key):
+        """Returns (value, remaining_ttl_seconds) or (None, 0)."""
+        with self._engine.connect() as conn:
+            row = conn.execute(
+                select(self._table.c.value, self._table.c.expires_at).where(self._table.c.key == key)
+            ).first()
+        if row is None:
+            return None, 0
+        remaining = row.expires_at - time.time()
+        if remaining <= 0:
+            self.delete(key)
+            return None, 0
+        return json.loads(row.value), remaining
+
+    def set(self, key, value, ttl_seconds):
+        payload = json.dumps(value)
+        with self._engine.begin() as conn:
+            conn.execute(delete(self._table).where(self._table.c.key == key))
+            conn.execute(self._table.insert().values(key=key, value=payload, expires_at=time.time() + ttl_seconds))
+
+    def delete(self, key):
+        with self._engine.begin() as conn:
+            conn.execute(delete(self._table).where(self._table.c.key == key))
+
+    def purge_expired(self):
+        with self._engine.begin() as conn:
+            return conn.execute(delete(self._table).where(self._table.c.expires_at <= time.time())).rowcount
+
+
+class TieredCache:
+    """
+    Memory cache in front of an optional persistent tier.
+
+    Persistent hits are promoted into memory with their remaining TTL.
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=3600, database_url=None, table_name='response_cache'):
+        self.memory = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.persistent = SQLCacheTier(database_url, table_name) if database_url else None
+        self.ttl_seconds = ttl_seconds
+        self.persistent_hits = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.persistent is None:
+            return value
+        try:
+            value, remaining = self.persistent.get(key)
+        except Exception as e:
+            log.warning(f"Persistent cache read failed for '{key}': {e}")
+            return None
+        if value is not None:
+            self.persistent_hits += 1
+            self.memory.set(key, value, ttl_seconds=remaining)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, value, self.ttl_seconds)
+            except Exception as e:
+                log.warning(f"Persistent cache write failed for '{key}': {e}")
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.persistent is not None:
+            self.persistent.delete(key)
+
+    def stats(self):
+        stats = self.memory.stats()
+        # A persistent hit is first counted as a memory miss
+        hits = stats['hits'] + self.persistent_hits
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'memory_hits': stats['hits'],
+            'persistent_hits': self.persistent_hits,
+            'hits': hits,
+            'misses': lookups - hits,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'persistent': self.persistent is not None,
+        })
+        return stats
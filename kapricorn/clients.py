@@ -0,0 +1,124 @@
+# File: kapricorn/clients.py
+
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+
+log = logging.getLogger(__name__)
+
+
+def key_fingerprint(api_key):
+    """Short, non-reversible label for an API key (safe for logs and stats)."""
+    if not api_key:
+        return 'none'
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:8]
+
+
+def _default_model_factory(model_name, client_manager, cached_content=None):
+    """Builds a GenerativeModel bound to a per-key client instead of the global one."""
+    model = genai.GenerativeModel(model_name)
+    # GenerativeModel lazily falls back to the process-global client when these are
+    # None; pinning them here keeps each key on its own long-lived gRPC channel.
+    model._client = client_manager.get_default_client('generative')
+    if cached_content:
+        # Same attribute GenerativeModel.from_cached_content sets, without its global-client lookup
+        model._cached_content = cached_content
+    return model
+
+
+class ModelRegistry:
+    """
+    Thread-safe pool of long-lived Gemini models keyed by (api_key, model_name).
+
+    Each API key gets its own client manager (and so its own connection), so
+    concurrent requests using different keys never touch `genai.configure`'s
+    process-global state. Models are created once and shared by all threads.
+    """
+
+    def __init__(self, model_factory=None):
+        self._model_factory = model_factory or _default_model_factory
+        self._lock = threading.Lock()
+        self._managers = {}   # api_key -> _ClientManager
+        self._models = {}     # (api_key, model_name, cached_content) -> model
+        self._created = 0
+        self._reuse_hits = 0
+        self._in_flight = {}  # key fingerprint -> active calls
+
+    def client_manager(self, api_key):
+        """Returns the per-key client manager, creating it on first use."""
+        with self._lock:
+            return self._client_manager_locked(api_key)
+
+    def _client_manager_locked(self, api_key):
+        manager = self._managers.get(api_key)
+        if manager is None:
+            manager = genai_client._ClientManager()
+            manager.configure(api_key=api_key)
+            self._managers[api_key] = manager
+        return manager
+
+    def get_model(self, api_key, model_name, cached_content=None):
+        """Returns the shared model for (api_key, model_name), optionally bound to a cached content."""
+        cache_key = (api_key, model_name, cached_content)
+        with self._lock:
+            model = self._models.get(cache_key)
+            if model is not None:
+                self._reuse_hits += 1
+                return model
+            manager = self._client_manager_locked(api_key)
+            if cached_content:
+                model = self._model_factory(model_name, manager, cached_content=cached_content)
+            else:
+                model = self._model_factory(model_name, manager)
+            self._models[cache_key] = model
+            self._created += 1
+        log.info(f"Created pooled AI model '{model_name}' for key {key_fingerprint(api_key)}.")
+        return model
+
+    def prepare_async(self, api_key, model):
+        """
+        Pins the per-key asyncio client on a pooled model before generate_content_async.
+
+        Like `_client`, GenerativeModel would otherwise fall back to the global
+        async client. grpc.aio channels belong to the event loop they are
+        created on, so this runs lazily from the serving loop.
+        """
+        if getattr(model, '_async_client', False) is None:
+            with self._lock:
+                if model._async_client is None:
+                    model._async_client = self._client_manager_locked(api_key).get_default_client('generative_async')
+        return model
+
+    def discard_cached_content(self, cached_content):
+        """Drops models bound to a cached content that has been superseded."""
+        with self._lock:
+            for cache_key in [k for k in self._models if k[2] == cached_content]:
+                del self._models[cache_key]
+
+    @contextmanager
+    def lease(self, api_key, model_name, cached_content=None):
+        """Yields the shared model while tracking the call as in-flight for its key."""
+        model = self.get_model(api_key, model_name, cached_content)
+        fingerprint = key_fingerprint(api_key)
+        with self._lock:
+            self._in_flight[fingerprint] = self._in_flight.get(fingerprint, 0) + 1
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._in_flight[fingerprint] -= 1
+
+    def stats(self):
+        """Snapshot of pool usage. API keys are reported by fingerprint only."""
+        with self._lock:
+            return {
+                'clients_created': self._created,
+                'api_key_clients': len(self._managers),
+                'reuse_hits': self._reuse_hits,
+                'models': sorted(f"{key_fingerprint(k)}:{m}" + (f"@{c}" if c else '') for k, m, c in self._models),
+                'in_flight': dict(self._in_flight),
+            }
@@ -19,6 +19,135 @@ class Config:
     FREE_ACCESSORY_MODEL_NAME = os.environ.get('FREE_ACCESSORY_MODEL_NAME', 'gemini-1.0-pro')
     PAID_MODEL_NAME = os.environ.get('PAID_MODEL_NAME', 'gemini-1.5-flash')
 
-   
+    # Provider-side caching of the fixed farmBot/visualsBot preambles, for the (versioned) models
+    # in PROMPT_CACHE_MODELS that support cached content; the default models above do not
+    PROMPT_CACHE_ENABLED = os.environ.get('PROMPT_CACHE_ENABLED', 'false').lower() == 'true'
+    PROMPT_CACHE_MODELS = os.environ.get(
+        'PROMPT_CACHE_MODELS', 'gemini-1.5-flash-001,gemini-1.5-flash-002,gemini-1.5-pro-001,gemini-1.5-pro-002')
+    PROMPT_CACHE_TTL_SECONDS = int(os.environ.get('PROMPT_CACHE_TTL_SECONDS', 3600))
+    PROMPT_CACHE_REFRESH_MARGIN_SECONDS = int(os.environ.get('PROMPT_CACHE_REFRESH_MARGIN_SECONDS', 300))
+    # Provider minimum cacheable size varies by model; smaller prefixes are sent inline
+    PROMPT_CACHE_MIN_TOKENS = int(os.environ.get('PROMPT_CACHE_MIN_TOKENS', 1024))
+
+    # Server-side conversation store ('memory' or 'sql')
+    CONVERSATION_STORE = os.environ.get('CONVERSATION_STORE', 'memory')
+    CONVERSATION_DATABASE_URL = os.environ.get(
+        'CONVERSATION_DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'instance', 'conversations.db'))
+    CONVERSATION_TTL_SECONDS = int(os.environ.get('CONVERSATION_TTL_SECONDS', 86400))
+    CONVERSATION_MAX_ACTIVE = int(os.environ.get('CONVERSATION_MAX_ACTIVE', 10000))
+
+    # <gen> schedule/timeline generation runs on a background worker pool
+    VISUALS_ASYNC = os.environ.get('VISUALS_ASYNC', 'true').lower() == 'true'
+    VISUALS_WORKERS = int(os.environ.get('VISUALS_WORKERS', 4))
+    VISUALS_JOB_TTL_SECONDS = int(os.environ.get('VISUALS_JOB_TTL_SECONDS', 600))
+
+    # Stream the recommendation analysis and format crops in parallel batches
+    # (fewer, larger ones when the FREE_ACCESSORY key is rate governed)
+    RECOMMENDATION_PIPELINE = os.environ.get('RECOMMENDATION_PIPELINE', 'true').lower() == 'true'
+    RECOMMENDATION_FORMAT_BATCH_SIZE = int(os.environ.get('RECOMMENDATION_FORMAT_BATCH_SIZE', 2))
+    RECOMMENDATION_FORMAT_WORKERS = int(os.environ.get('RECOMMENDATION_FORMAT_WORKERS', 6))
+    # /api/recommend/crops/batch: cache misses analysed PACK_SIZE locations per call, BATCH_WORKERS calls at once
+    RECOMMENDATION_BATCH_MAX_LOCATIONS = int(os.environ.get('RECOMMENDATION_BATCH_MAX_LOCATIONS', 500))
+    RECOMMENDATION_BATCH_PACK_SIZE = int(os.environ.get('RECOMMENDATION_BATCH_PACK_SIZE', 4))
+    RECOMMENDATION_BATCH_WORKERS = int(os.environ.get('RECOMMENDATION_BATCH_WORKERS', 8))
+    # Batch calls queue for the rate governor this long (instead of RATE_LIMIT_MAX_WAIT_SECONDS)
+    RECOMMENDATION_BATCH_MAX_WAIT_SECONDS = float(os.environ.get('RECOMMENDATION_BATCH_MAX_WAIT_SECONDS', 300))
+
+    # JSON mode (response_schema) for VisualsBot and recommendation formatting; false = tagged text.
+    # Only models whose name starts with a STRUCTURED_OUTPUT_MODELS prefix are asked for JSON
+    # (gemini-1.0-pro rejects response_schema); the others, and any model that rejects it, get tagged text
+    STRUCTURED_OUTPUT_ENABLED = os.environ.get('STRUCTURED_OUTPUT_ENABLED', 'true').lower() == 'true'
+    STRUCTURED_OUTPUT_MODELS = os.environ.get('STRUCTURED_OUTPUT_MODELS', 'gemini-1.5-,gemini-2.')
+
+    # Crop recommendation cache, keyed on the normalized location
+    RECOMMENDATION_CACHE_TTL_SECONDS = int(os.environ.get('RECOMMENDATION_CACHE_TTL_SECONDS', 7 * 86400))
+    RECOMMENDATION_CACHE_MAX_ENTRIES = int(os.environ.get('RECOMMENDATION_CACHE_MAX_ENTRIES', 2000))
+    # Optional persistent tier, e.g. sqlite:///instance/recommendations.db (empty = memory only)
+    RECOMMENDATION_CACHE_DATABASE_URL = os.environ.get('RECOMMENDATION_CACHE_DATABASE_URL')
+
+    # Semantic cache of first-turn FI answers (hashed n-gram cosine >= threshold, same crops/inputs/numbers).
+    # Off by default: a false hit can hand a farmer another question's dose
+    FAQ_CACHE_ENABLED = os.environ.get('FAQ_CACHE_ENABLED', 'false').lower() == 'true'
+    FAQ_CACHE_THRESHOLD = float(os.environ.get('FAQ_CACHE_THRESHOLD', 0.75))
+    FAQ_CACHE_MAX_ENTRIES = int(os.environ.get('FAQ_CACHE_MAX_ENTRIES', 2000))
+    FAQ_CACHE_TTL_SECONDS = int(os.environ.get('FAQ_CACHE_TTL_SECONDS', 7 * 86400))
+    # Share of hits re-asked upstream to detect false hits (evicted when the answers diverge)
+    FAQ_CACHE_AUDIT_RATE = float(os.environ.get('FAQ_CACHE_AUDIT_RATE', 0.02))
+    FAQ_CACHE_AUDIT_MIN_SIMILARITY = float(os.environ.get('FAQ_CACHE_AUDIT_MIN_SIMILARITY', 0.25))
+
+    # Cross-user VisualsBot schedule cache: crop, generation type, location, season bucket, NPK band
+    SCHEDULE_CACHE_ENABLED = os.environ.get('SCHEDULE_CACHE_ENABLED', 'true').lower() == 'true'
+    SCHEDULE_CACHE_TTL_SECONDS = int(os.environ.get('SCHEDULE_CACHE_TTL_SECONDS', 30 * 86400))
+    SCHEDULE_CACHE_MAX_ENTRIES = int(os.environ.get('SCHEDULE_CACHE_MAX_ENTRIES', 5000))
+    SCHEDULE_CACHE_SEASON_BUCKET_DAYS = int(os.environ.get('SCHEDULE_CACHE_SEASON_BUCKET_DAYS', 14))
+    SCHEDULE_CACHE_NPK_BAND_WIDTH = int(os.environ.get('SCHEDULE_CACHE_NPK_BAND_WIDTH', 10))
+    # Optional persistent tier, e.g. sqlite:///instance/schedules.db (empty = memory only)
+    SCHEDULE_CACHE_DATABASE_URL = os.environ.get('SCHEDULE_CACHE_DATABASE_URL')
+
+    # Chat history is fitted into a per-model token budget; older turns are summarized
+    CONTEXT_WINDOW_ENABLED = os.environ.get('CONTEXT_WINDOW_ENABLED', 'true').lower() == 'true'
+    CONTEXT_DEFAULT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_DEFAULT_TOKEN_BUDGET', 24000))
+    # Per-model overrides, e.g. "gemini-1.5-flash=64000,gemini-1.0-pro=24000"
+    CONTEXT_TOKEN_BUDGETS = os.environ.get('CONTEXT_TOKEN_BUDGETS', '')
+    CONTEXT_KEEP_RECENT_MESSAGES = int(os.environ.get('CONTEXT_KEEP_RECENT_MESSAGES', 6))
+    # A turn waits this long for a history summary; a late one is kept for the next turn
+    CONTEXT_SUMMARY_TIMEOUT_SECONDS = float(os.environ.get('CONTEXT_SUMMARY_TIMEOUT_SECONDS', 3.0))
+    CONTEXT_SUMMARY_WORKERS = int(os.environ.get('CONTEXT_SUMMARY_WORKERS', 4))
+    # Uploaded chat images (content-addressed; default <instance>/images)
+    IMAGE_STORE_PATH = os.environ.get('IMAGE_STORE_PATH')
+    IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 768))
+    IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+    IMAGE_MAX_UPLOAD_BYTES = int(os.environ.get('IMAGE_MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+
+    # Per-key upstream throttling, adapted down on 429s: NAME=requests_per_minute:max_concurrency,
+    # where NAME matches a GOOGLE_API_KEY_<NAME> setting above
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMITS = os.environ.get('RATE_LIMITS', 'FREE_CHAT=15:4,FREE_ACCESSORY=15:4,PAID=1000:32,RECOMENDATIONS=15:4')
+    RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get('RATE_LIMIT_MAX_WAIT_SECONDS', 10))
+    RATE_LIMIT_MAX_QUEUE = int(os.environ.get('RATE_LIMIT_MAX_QUEUE', 100))
+
+    # Workload classes admitted to the chat/recommendation routes and visuals jobs:
+    # name=weight:max_active:max_queue:queue_slo_seconds, highest priority first (the last is shed first)
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+    SCHEDULER_WORKLOADS = os.environ.get(
+        'SCHEDULER_WORKLOADS', 'paid_chat=8:16:64:1,free_chat=4:12:64:3,visuals=2:4:32:20,recommendations=1:4:16:10')
+    SCHEDULER_MAX_CONCURRENCY = int(os.environ.get('SCHEDULER_MAX_CONCURRENCY', 24))
+    SCHEDULER_MAX_WAIT_SECONDS = float(os.environ.get('SCHEDULER_MAX_WAIT_SECONDS', 30))
+    # The native asyncio routes (asgi.py) hold no worker thread while they wait, so they get their own limits
+    SCHEDULER_ASYNC_WORKLOADS = os.environ.get(
+        'SCHEDULER_ASYNC_WORKLOADS',
+        'paid_chat=8:256:1024:1,free_chat=4:192:1024:3,visuals=2:64:256:20,recommendations=1:64:256:10')
+    SCHEDULER_ASYNC_MAX_CONCURRENCY = int(os.environ.get('SCHEDULER_ASYNC_MAX_CONCURRENCY', 384))
+
+    # Retries (full-jitter exponential backoff) for transient upstream errors
+    RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 3))
+    RETRY_BASE_DELAY_SECONDS = float(os.environ.get('RETRY_BASE_DELAY_SECONDS', 0.5))
+    RETRY_MAX_DELAY_SECONDS = float(os.environ.get('RETRY_MAX_DELAY_SECONDS', 8))
+    # Hedged duplicate request once a call outlasts the model's recent p95; at most HEDGE_BUDGET_FRACTION of calls
+    HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'true').lower() == 'true'
+    HEDGE_QUANTILE = float(os.environ.get('HEDGE_QUANTILE', 0.95))
+    HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+    HEDGE_BUDGET_FRACTION = float(os.environ.get('HEDGE_BUDGET_FRACTION', 0.05))
+    HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', 16))
+    # Models to try when a route's model is overloaded: route=TIER>TIER, with TIER naming
+    # a <TIER>_MODEL_NAME / GOOGLE_API_KEY_<TIER> pair. Routes: chat, chat_pro, visuals, recommendations
+    FALLBACK_CHAINS = os.environ.get('FALLBACK_CHAINS', 'chat_pro=FREE_CHAT')
+
+    # Circuit breaker per (model, key): opens on error rate or slow-call rate over the
+    # recent window, fails fast (503 + Retry-After) while open, then probes half-open
+    CIRCUIT_BREAKER_ENABLED = os.environ.get('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+    CIRCUIT_FAILURE_THRESHOLD = float(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 0.5))
+    CIRCUIT_SLOW_CALL_SECONDS = float(os.environ.get('CIRCUIT_SLOW_CALL_SECONDS', 30))
+    CIRCUIT_SLOW_CALL_THRESHOLD = float(os.environ.get('CIRCUIT_SLOW_CALL_THRESHOLD', 0.8))
+    CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', 10))
+    CIRCUIT_WINDOW_SECONDS = float(os.environ.get('CIRCUIT_WINDOW_SECONDS', 60))
+    CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 30))
+
+    # Request-stage and model-call histograms plus token counters, exposed at /metrics
+    TELEMETRY_ENABLED = os.environ.get('TELEMETRY_ENABLED', 'true').lower() == 'true'
+
+    # asgi.py: threads for routes still served through WSGI, and the request body cap
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+    ASGI_MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 32 * 1024 * 1024))
 
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
\ No newline at end of file
@@ -0,0 +1,263 @@
+# File: kapricorn/context_window.py
+
+import contextvars
+import hashlib
+import logging
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from .cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+SUMMARY_ACK = "<gr>Noted, I will keep the earlier conversation in mind.</gr>"
+
+
+def _message_text(message):
+    parts = message.get('parts', []) if isinstance(message, dict) else []
+    if isinstance(parts, str):
+        return parts
+    return ' '.join(part if isinstance(part, str) else '[image]' for part in parts)
+
+
+def _prefix_digest(messages):
+    """Identity of a run of history messages (roles and text; image bytes are not hashed)."""
+    digest = hashlib.sha256()
+    for message in messages:
+        role = message.get('role') if isinstance(message, dict) else None
+        digest.update(f"{role}\0{_message_text(message)}\0".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _prefix_digests(messages):
+    """_prefix_digest(messages[:n]) for n = 1..len(messages), in one pass."""
+    digest = hashlib.sha256()
+    digests = []
+    for message in messages:
+        role = message.get('role') if isinstance(message, dict) else None
+        digest.update(f"{role}\0{_message_text(message)}\0".encode('utf-8'))
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def parse_token_budgets(value):
+    """Parses 'model=tokens,model=tokens' (or a dict) into {model: tokens}."""
+    if isinstance(value, dict):
+        return {model: int(tokens) for model, tokens in value.items()}
+    budgets = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            model, tokens = item.split('=', 1)
+            budgets[model.strip()] = int(tokens)
+    return budgets
+
+
+class _SummaryState:
+    __slots__ = ('folded', 'digest', 'summary', 'tokens')
+
+    def __init__(self, folded, digest, summary, tokens):
+        self.folded = folded # Number of leading history messages the summary covers
+        self.digest = digest # _prefix_digest of those messages
+        self.summary = summary
+        self.tokens = tokens
+
+
+class ContextWindowManager:
+    """
+    Fits a chat history into a per-model token budget.
+
+    The bot preamble (startChats) is added later by processChats and is
+    always sent, so its size is reserved up front. Recent messages are kept
+    verbatim, and so is the latest system `<g>` notice; everything older is
+    folded into a running summary that is sent as a `<g>` message pair in
+    front of the kept turns.
+
+    Summaries are cached per conversation and only extended: when the window
+    overflows again, just the messages that newly fall out of it are passed
+    to `summarize(previous_summary, messages)` together with the previous
+    summary. Stateless histories (no conversation key) are keyed by the
+    digest of the whole folded prefix, so only an identical prefix reuses a
+    summary. Folding goes down to `low_watermark` of the budget so this
+    happens every few turns rather than on every turn.
+
+    With an `executor`, summaries are made on it and a turn waits at most
+    `summary_timeout_seconds` for one: past that the older turns are
+    dropped for this turn (as when summarizing fails), and the summary is
+    stored when it lands, for the next turn. One summary per conversation
+    is made at a time.
+    """
+
+    def __init__(self, accountant, budgets=None, default_budget=24000, keep_recent_messages=6,
+                 low_watermark=0.75, reserve_tokens=256, ttl_seconds=86400, max_conversations=10000,
+                 executor=None, summary_timeout_seconds=3.0):
+        self.accountant = accountant
+        self.budgets = dict(budgets or {})
+        self.default_budget = default_budget
+        self.keep_recent_messages = keep_recent_messages
+        self.low_watermark = low_watermark
+        self.reserve_tokens = reserve_tokens # Per-turn <g> context and classification tags
+        self._summaries = TTLCache(max_entries=max_conversations, ttl_seconds=ttl_seconds)
+        self.executor = executor
+        self.summary_timeout_seconds = summary_timeout_seconds
+        self._lock = threading.Lock()
+        self._pending = set() # Conversations (or stateless prefix digests) with a summary being made
+        self._stats = {'requests': 0, 'windowed_requests': 0, 'tokens_trimmed': 0,
+                       'max_tokens_trimmed': 0, 'summaries_generated': 0, 'summary_failures': 0,
+                       'summary_timeouts': 0}
+
+    def budget_for(self, model_name):
+        return self.budgets.get(model_name, self.default_budget)
+
+    def fit(self, history, model_name, preamble, summarize, conversation_key=None):
+        """
+        Returns (history_to_send, tokens_trimmed).
+
+        `preamble` is the fixed prefix the request will carry (startChats);
+        `summarize(previous_summary, messages)` returns the updated summary
+        text, or None if it could not be produced.
+        """
+        key = conversation_key
+        budget = self.budget_for(model_name)
+        available = budget - self.accountant.estimate(preamble, model_name) - self.reserve_tokens
+
+        state = self._state_for(key, history)
+        start = state.folded if state else 0
+        sizes = [self.accountant.estimate([message], model_name) for message in history[start:]]
+        summary_tokens = state.tokens if state else 0
+
+        if summary_tokens + sum(sizes) > available:
+            split = self._split_point(history, start, sizes, int(available * self.low_watermark) - summary_tokens)
+            if split > start:
+                state = self._extend_summary(key, history, state, split, summarize)
+                start = split
+
+        if start == 0:
+            self._record(0)
+            return history, 0
+
+        carried = []
+        if state:
+            carried += [{'role': 'user', 'parts': [f"<g>Summary of the earlier conversation: {state.summary}</g>"]},
+                        {'role': 'model', 'parts': [SUMMARY_ACK]}]
+        carried += self._latest_notice(history, start)
+        trimmed = max(0, self.accountant.estimate(history[:start], model_name)
+                      - self.accountant.estimate(carried, model_name))
+        self._record(trimmed)
+        return carried + history[start:], trimmed
+
+    def _state_for(self, key, history):
+        if key is None:
+            return self._stateless_state(history)
+        state = self._summaries.get(key)
+        # The transcript may have been edited or truncated since; start over if so
+        if state and (state.folded >= len(history)
+                      or _prefix_digest(history[:state.folded]) != state.digest):
+            self._summaries.delete(key)
+            return None
+        return state
+
+    def _stateless_state(self, history):
+        """The summary of the longest folded prefix of `history` seen before, if any."""
+        digests = _prefix_digests(history[:-1])
+        # Folds end right before a user message (see _split_point), so only those prefixes are looked up
+        candidates = [digests[folded - 1] for folded in range(len(digests), 0, -1)
+                      if folded == len(digests) or history[folded].get('role') == 'user']
+        found = self._summaries.get_first(candidates)
+        if found is None:
+            return None
+        digest, state = found
+        return state if state.digest == digest else None
+
+    def _split_point(self, history, start, sizes, target):
+        """First index to keep so the kept tail fits `target` tokens (always keeps the recent turns)."""
+        keep_from = len(history)
+        used = 0
+        for index in range(len(history) - 1, start - 1, -1):
+            size = sizes[index - start]
+            if used + size > target and len(history) - index > self.keep_recent_messages:
+                break
+            used += size
+            keep_from = index
+        # Kept turns must start with a user message, right after the summary acknowledgement
+        while keep_from < len(history) - 1 and history[keep_from].get('role') != 'user':
+            keep_from += 1
+        return keep_from
+
+    def _extend_summary(self, key, history, state, split, summarize):
+        if self.executor is None:
+            return self._summarize(key, history, state, split, summarize)
+        pending = key if key is not None else _prefix_digest(history[:split])
+        with self._lock:
+            if pending in self._pending:
+                return state # Still summarizing for an earlier turn
+            self._pending.add(pending)
+
+        def run():
+            try:
+                return self._summarize(key, history[:split], state, split, summarize)
+            finally:
+                with self._lock:
+                    self._pending.discard(pending)
+
+        # A copy of this context, so the summarizer keeps the request's app context and spans
+        future = self.executor.submit(contextvars.copy_context().run, run)
+        try:
+            return future.result(timeout=self.summary_timeout_seconds)
+        except FutureTimeout:
+            log.warning(f"History summary not ready after {self.summary_timeout_seconds}s; "
+                        f"dropping older turns this time.")
+            with self._lock:
+                self._stats['summary_timeouts'] += 1
+            return state
+
+    def _summarize(self, key, history, state, split, summarize):
+        previous = state.summary if state else ''
+        start = state.folded if state else 0
+        try:
+            summary = summarize(previous, history[start:split])
+        except Exception as e:
+            log.error(f"History summarization failed: {e}", exc_info=True)
+            summary = None
+        if not summary:
+            # Older turns are still dropped so the request fits; the summary catches up next time
+            with self._lock:
+                self._stats['summary_failures'] += 1
+            return state
+        state = _SummaryState(split, _prefix_digest(history[:split]), summary.strip(),
+                              self.accountant.estimate(summary) + 24)
+        self._summaries.set(key if key is not None else state.digest, state)
+        with self._lock:
+            self._stats['summaries_generated'] += 1
+        return state
+
+    @staticmethod
+    def _latest_notice(history, start):
+        """
+        The most recent folded system notice (<g> from the user side) and its
+        reply, kept verbatim; nothing if that notice was not answered, so two
+        user turns never follow each other.
+        """
+        for index in range(start - 1, -1, -1):
+            message = history[index]
+            if message.get('role') == 'user' and '<g>' in _message_text(message):
+                if index + 1 < start and history[index + 1].get('role') == 'model':
+                    return history[index:index + 2]
+                return []
+        return []
+
+    def _record(self, trimmed):
+        with self._lock:
+            self._stats['requests'] += 1
+            if trimmed:
+                self._stats['windowed_requests'] += 1
+                self._stats['tokens_trimmed'] += trimmed
+                self._stats['max_tokens_trimmed'] = max(self._stats['max_tokens_trimmed'], trimmed)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        windowed = stats['windowed_requests']
+        stats['avg_tokens_trimmed'] = round(stats['tokens_trimmed'] / windowed, 1) if windowed else 0.0
+        stats['budgets'] = dict(self.budgets, default=self.default_budget)
+        stats['summaries'] = self._summaries.stats()
+        return stats
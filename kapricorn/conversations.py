@@ -0,0 +1,206 @@
+# File: kapricorn/conversations.py
+
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import (
+    Column, Float, ForeignKey, Integer, MetaData, String, Table, Text, create_engine, func, select
+)
+
+log = logging.getLogger(__name__)
+
+
+def new_conversation_id():
+    return uuid.uuid4().hex
+
+
+class _TurnGuard:
+    """
+    One in-flight turn per conversation (in this process).
+
+    Two turns sent at once would both read the same transcript and append
+    independently, leaving user, user, model, model in the store, which the
+    model API rejects on the next turn. `begin_turn` is non-blocking: a
+    second concurrent turn is refused rather than queued.
+    """
+
+    def begin_turn(self, conversation_id):
+        """Marks a turn as in flight; False if one already is."""
+        with self._turns_lock:
+            if conversation_id in self._turns:
+                return False
+            self._turns.add(conversation_id)
+            return True
+
+    def end_turn(self, conversation_id):
+        with self._turns_lock:
+            self._turns.discard(conversation_id)
+
+
+class MemoryConversationStore(_TurnGuard):
+    """
+    In-process transcript store with LRU eviction and idle TTL.
+
+    Transcripts are lists of {'role': ..., 'parts': [...]} messages. Reads
+    return a shallow copy of the list; the message dicts themselves are shared
+    and must be treated as immutable by callers.
+    """
+
+    def __init__(self, max_conversations=10000, ttl_seconds=86400):
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conversations = OrderedDict()  # id -> (last_used, messages)
+        self._turns_lock = threading.Lock()
+        self._turns = set()
+
+    def create(self):
+        conversation_id = new_conversation_id()
+        with self._lock:
+            self._conversations[conversation_id] = (time.monotonic(), [])
+            self._evict_locked()
+        return conversation_id
+
+    def get(self, conversation_id):
+        """Returns the transcript, or None if unknown or expired."""
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is None:
+                return None
+            last_used, messages = entry
+            if time.monotonic() - last_used > self.ttl_seconds:
+                del self._conversations[conversation_id]
+                return None
+            self._conversations.move_to_end(conversation_id)
+            return list(messages)
+
+    def append(self, conversation_id, messages):
+        """Appends messages to a transcript. Returns False if it no longer exists."""
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is None:
+                return False
+            stored = entry[1]
+            stored.extend(messages)
+            self._conversations[conversation_id] = (time.monotonic(), stored)
+            self._conversations.move_to_end(conversation_id)
+            return True
+
+    def delete(self, conversation_id):
+        with self._lock:
+            return self._conversations.pop(conversation_id, None) is not None
+
+    def _evict_locked(self):
+        while len(self._conversations) > self.max_conversations:
+            evicted, _ = self._conversations.popitem(last=False)
+            log.debug(f"Evicted conversation {evicted} (store full).")
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'conversations': len(self._conversations)}
+
+
+class SQLConversationStore(_TurnGuard):
+    """
+    SQLAlchemy-backed transcript store (SQLite by default).
+
+    Messages are stored one row each, so appending a turn is an insert rather
+    than a rewrite of the whole transcript. Conversations idle for longer than
+    `ttl_seconds` are treated as expired and purged lazily.
+    """
+
+    def __init__(self, database_url, ttl_seconds=86400):
+        self.ttl_seconds = ttl_seconds
+        self._turns_lock = threading.Lock()
+        self._turns = set()
+        self._engine = create_engine(database_url, future=True)
+        metadata = MetaData()
+        self._conversations = Table(
+            'conversations', metadata,
+            Column('id', String(32), primary_key=True),
+            Column('updated_at', Float, nullable=False, index=True),
+        )
+        self._messages = Table(
+            'conversation_messages', metadata,
+            Column('seq', Integer, primary_key=True, autoincrement=True),
+            Column('conversation_id', String(32), ForeignKey('conversations.id', ondelete='CASCADE'),
+                   nullable=False, index=True),
+            Column('content', Text, nullable=False),
+        )
+        metadata.create_all(self._engine)
+
+    def create(self):
+        conversation_id = new_conversation_id()
+        with self._engine.begin() as conn:
+            conn.execute(self._conversations.insert().values(id=conversation_id, updated_at=time.time()))
+        return conversation_id
+
+    def _is_live(self, conn, conversation_id):
+        updated_at = conn.execute(
+            select(self._conversations.c.updated_at).where(self._conversations.c.id == conversation_id)
+        ).scalar_one_or_none()
+        if updated_at is None:
+            return False
+        if time.time() - updated_at > self.ttl_seconds:
+            self._delete(conn, conversation_id)
+            return False
+        return True
+
+    def get(self, conversation_id):
+        with self._engine.begin() as conn:
+            if not self._is_live(conn, conversation_id):
+                return None
+            rows = conn.execute(
+                select(self._messages.c.content)
+                .where(self._messages.c.conversation_id == conversation_id)
+                .order_by(self._messages.c.seq)
+            ).scalars()
+            return [json.loads(row) for row in rows]
+
+    def append(self, conversation_id, messages):
+        with self._engine.begin() as conn:
+            if not self._is_live(conn, conversation_id):
+                return False
+            if messages:
+                conn.execute(self._messages.insert(), [
+                    {'conversation_id': conversation_id, 'content': json.dumps(message)}
+                    for message in messages
+                ])
+            conn.execute(
+                self._conversations.update()
+                .where(self._conversations.c.id == conversation_id)
+                .values(updated_at=time.time())
+            )
+            return True
+
+    def delete(self, conversation_id):
+        with self._engine.begin() as conn:
+            return self._delete(conn, conversation_id)
+
+    def _delete(self, conn, conversation_id):
+        conn.execute(self._messages.delete().where(self._messages.c.conversation_id == conversation_id))
+        result = conn.execute(self._conversations.delete().where(self._conversations.c.id == conversation_id))
+        return result.rowcount > 0
+
+    def stats(self):
+        with self._engine.connect() as conn:
+            count = conn.execute(select(func.count()).select_from(self._conversations)).scalar_one()
+        return {'backend': 'sql', 'conversations': count}
+
+
+def create_conversation_store(config):
+    """Builds the store selected by CONVERSATION_STORE ('memory' or 'sql')."""
+    backend = (config.get('CONVERSATION_STORE') or 'memory').lower()
+    ttl_seconds = config.get('CONVERSATION_TTL_SECONDS', 86400)
+    if backend == 'sql':
+        return SQLConversationStore(config.get('CONVERSATION_DATABASE_URL'), ttl_seconds=ttl_seconds)
+    if backend != 'memory':
+        log.warning(f"Unknown CONVERSATION_STORE '{backend}', falling back to memory.")
+    return MemoryConversationStore(
+        max_conversations=config.get('CONVERSATION_MAX_ACTIVE', 10000),
+        ttl_seconds=ttl_seconds,
+    )
@@ -0,0 +1,349 @@
+# File: kapricorn/faq_cache.py
+
+import collections
+import datetime
+import itertools
+import logging
+import math
+import random
+import re
+import threading
+import time
+import unicodedata
+import zlib
+
+from .cache import normalize_location
+
+log = logging.getLogger(__name__)
+
+# Function words carry no topic; dropping them keeps "how do I ..." phrasings from matching each other
+_STOP_WORDS = frozenset("""
+    a an the i me my we our you your is are was were be been do does did can could should would will
+    shall to of in on at for with and or how what when where which who why it this that these those
+    there their them they if so as by from about into some any please tell
+""".split())
+
+
+# Crops, farm inputs and units: questions that differ in one of these (or in a number) have different answers
+_KEY_TERMS = frozenset("""
+    maize corn cassava yam rice sorghum millet wheat cowpea bean soybean soya groundnut peanut sesame
+    tomato pepper onion okra cabbage lettuce carrot cucumber melon watermelon pumpkin egusi plantain banana
+    cocoa coffee cotton palm cashew mango orange citrus pineapple potato ginger garlic tea sugarcane
+    npk urea dap ssp tsp potash mop sop ammonium nitrate sulphate sulfate phosphate lime manure
+    compost poultry dung biochar mulch herbicide pesticide insecticide fungicide glyphosate atrazine
+    nitrogen phosphorus potassium zinc boron seed seedling
+    bag kg kilogram gram tonne ton liter litre ml hectare ha acre plot meter metre cm
+""".split())
+_KEY_TERM_ALIASES = {'corn': 'maize', 'peanut': 'groundnut', 'soya': 'soybean', 'sulfate': 'sulphate',
+                     'kilogram': 'kg', 'tonne': 'ton', 'litre': 'liter', 'ha': 'hectare', 'metre': 'meter',
+                     'tomatoe': 'tomato', 'potatoe': 'potato', 'mangoe': 'mango'} # _words strips only the 's'
+
+
+def key_terms(text):
+    """
+    The crops, inputs, units and numbers a question names (e.g. {'npk',
+    'bag', 'hectare', 'maize'}). Questions only share an answer when these
+    match exactly, however similar the rest of the wording is.
+    """
+    terms = (_KEY_TERM_ALIASES.get(word, word) for word in _words(text))
+    return frozenset(term for term in terms if term in _KEY_TERMS or term.isdigit())
+
+
+def _words(text):
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    words = []
+    for word in re.findall(r'[a-z0-9]+', text):
+        if word in _STOP_WORDS:
+            continue
+        if len(word) > 4 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+class HashedNgramVectorizer:
+    """
+    Local, dependency-free text embedding: word unigrams, word bigrams and
+    character 4-grams, hashed (crc32) into `dimensions` buckets, log-scaled
+    and L2-normalized. Vectors are sparse {bucket: weight} dicts, so cosine
+    similarity is a dot product over the shorter one.
+    """
+
+    def __init__(self, dimensions=1 << 20):
+        self.dimensions = dimensions
+
+    def embed(self, text):
+        counts = collections.Counter()
+        words = _words(text)
+        for word in words:
+            counts['w:' + word] += 2.0
+            padded = f' {word} '
+            for i in range(len(padded) - 3):
+                counts['c:' + padded[i:i + 4]] += 1.0
+        for first, second in zip(words, words[1:]):
+            counts[f'b:{first} {second}'] += 1.5
+
+        vector = {}
+        for feature, count in counts.items():
+            bucket = zlib.crc32(feature.encode('utf-8')) % self.dimensions
+            vector[bucket] = vector.get(bucket, 0.0) + 1.0 + math.log(count)
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {bucket: weight / norm for bucket, weight in vector.items()} if norm else {}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(bucket, 0.0) for bucket, weight in a.items())
+
+
+def context_anchors(answer, location=None, npk=None, date=None):
+    """
+    The context fields ('location', 'npk', 'date') an answer visibly refers
+    to: a location component, an NPK value, the ISO date or its month name.
+    """
+    text = ' '.join(_plain(answer).split())
+    anchors = []
+    components = [part for part in normalize_location(location or '').split(', ') if len(part) >= 3]
+    if any(re.search(rf'\b{re.escape(part)}\b', text) for part in components):
+        anchors.append('location')
+    if any(re.search(rf'\b{value}\b', text) for value in re.findall(r'\d{2,}', npk or '')):
+        anchors.append('npk')
+    if date:
+        month = None
+        try:
+            month = datetime.date.fromisoformat(date[:10]).strftime('%B').lower()
+        except ValueError:
+            pass
+        if date[:10] in text or (month and re.search(rf'\b{month}\b', text)):
+            anchors.append('date')
+    return tuple(anchors)
+
+
+def context_bucket(location=None, date=None):
+    """
+    Coarse region and season of a request, e.g. 'oyo, nigeria|m06': the last
+    two location components and the month. Context-free answers still differ
+    across regions and seasons, so they are only shared within one bucket.
+    """
+    components = [part for part in normalize_location(location or '').split(', ') if part]
+    region = ', '.join(components[-2:]) or '?'
+    try:
+        season = f"m{datetime.date.fromisoformat((date or '')[:10]).month:02d}"
+    except ValueError:
+        season = 'm?'
+    return f"{region}|{season}"
+
+
+def _plain(text):
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    return ''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+class FAQEntry:
+    __slots__ = ('id', 'namespace', 'question', 'answer', 'vector', 'key_terms', 'context', 'anchors',
+                 'expires_at', 'hits')
+
+    def __init__(self, entry_id, namespace, question, answer, vector, context, anchors, expires_at):
+        self.id = entry_id
+        self.namespace = namespace
+        self.question = question
+        self.answer = answer      # The model's full tagged reply
+        self.vector = vector
+        self.key_terms = key_terms(question)
+        self.context = context    # {'location', 'npk', 'date'} of the request that produced it
+        self.anchors = anchors    # Context fields the answer refers to (see context_anchors)
+        self.expires_at = expires_at
+        self.hits = 0
+
+    def needs_personalization(self, context):
+        """True if the answer mentions a context field whose value differs for this requester."""
+        return any(_plain(self.context.get(field)).strip() != _plain(context.get(field)).strip()
+                   for field in self.anchors)
+
+
+class SemanticFAQCache:
+    """
+    Answers to first-turn, context-free chat questions, matched by meaning.
+
+    Questions are embedded with a HashedNgramVectorizer and searched
+    through an inverted index (exact cosine over the entries sharing a
+    feature) within their `namespace` (the chat tier and context_bucket). A match at or above
+    `threshold` is a hit only if both questions name the same crops, inputs,
+    units and numbers (see key_terms): "bags of NPK per hectare of maize"
+    and the same question about urea are close in wording but not in
+    answer. Entries expire after `ttl_seconds` and the least
+    recently used are evicted beyond `max_entries`.
+
+    A random `audit_rate` share of hits should be re-asked upstream and
+    checked with `record_audit`: an answer that shares too little with the
+    cached one (below `audit_min_similarity`), or that the model no longer
+    classifies as general (FI), counts as a false hit and evicts the entry.
+    """
+
+    def __init__(self, threshold=0.75, max_entries=2000, ttl_seconds=7 * 86400, audit_rate=0.02,
+                 audit_min_similarity=0.25, vectorizer=None, audit_log_size=50):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.audit_rate = audit_rate
+        self.audit_min_similarity = audit_min_similarity
+        self.vectorizer = vectorizer or HashedNgramVectorizer()
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # id -> FAQEntry, least recently used first
+        self._postings = {}                        # bucket -> {entry id: weight}
+        self._ids = itertools.count(1)
+        self._audit_log = collections.deque(maxlen=audit_log_size)
+        self._random = random.Random()
+        self.lookups = 0
+        self.hits = 0
+        self.near_misses = 0
+        self.key_term_mismatches = 0
+        self.personalized = 0
+        self.stored = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.reported = 0
+        self.audits = 0
+        self.false_hits = 0
+
+    def embed(self, question):
+        return self.vectorizer.embed(question)
+
+    def lookup(self, question, namespace):
+        """
+        (entry, similarity) of the closest live question in `namespace` at or
+        above threshold with the same key terms, else (None, best).
+        """
+        query = self.embed(question)
+        terms = key_terms(question)
+        now = time.monotonic()
+        with self._lock:
+            self.lookups += 1
+            scores = collections.defaultdict(float)
+            for bucket, weight in query.items():
+                for entry_id, entry_weight in self._postings.get(bucket, {}).items():
+                    scores[entry_id] += weight * entry_weight
+            best, best_score = None, 0.0
+            mismatched = False
+            for entry_id, score in sorted(scores.items(), key=lambda item: -item[1]):
+                entry = self._entries[entry_id]
+                if entry.expires_at < now:
+                    self._remove_locked(entry_id)
+                    self.expirations += 1
+                    continue
+                if entry.namespace != namespace:
+                    continue
+                if entry.key_terms != terms:
+                    mismatched = mismatched or score >= self.threshold
+                    continue
+                best, best_score = entry, score
+                break
+            if mismatched:
+                self.key_term_mismatches += 1
+            if best is None or best_score < self.threshold:
+                if best_score >= self.threshold - 0.1:
+                    self.near_misses += 1
+                return None, best_score
+            self._entries.move_to_end(best.id)
+            best.hits += 1
+            self.hits += 1
+            return best, best_score
+
+    def add(self, question, answer, namespace, context, anchors=()):
+        vector = self.embed(question)
+        if not vector:
+            return None
+        with self._lock:
+            entry = FAQEntry(next(self._ids), namespace, question, answer, vector, dict(context),
+                             tuple(anchors), time.monotonic() + self.ttl_seconds)
+            self._entries[entry.id] = entry
+            for bucket, weight in vector.items():
+                self._postings.setdefault(bucket, {})[entry.id] = weight
+            self.stored += 1
+            while len(self._entries) > self.max_entries:
+                self._remove_locked(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def remove(self, entry_id, reported=False):
+        """Drops an entry (e.g. a false hit reported by a client). Returns False if unknown."""
+        with self._lock:
+            if entry_id not in self._entries:
+                return False
+            self._remove_locked(entry_id)
+            if reported:
+                self.reported += 1
+            return True
+
+    def _remove_locked(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        for bucket in entry.vector:
+            postings = self._postings.get(bucket)
+            if postings is not None:
+                postings.pop(entry_id, None)
+                if not postings:
+                    del self._postings[bucket]
+
+    def record_personalized(self):
+        with self._lock:
+            self.personalized += 1
+
+    def should_audit(self):
+        return self.audit_rate > 0 and self._random.random() < self.audit_rate
+
+    def record_audit(self, entry, question, similarity, cached_answer, fresh_answer, fresh_classification):
+        """Compares a fresh upstream answer with the cached one; evicts the entry on a false hit."""
+        answer_similarity = cosine(self.embed(cached_answer), self.embed(fresh_answer))
+        passed = answer_similarity >= self.audit_min_similarity and fresh_classification == 'FI'
+        audit = {
+            'entry_id': entry.id,
+            'cached_question': entry.question,
+            'question': question,
+            'similarity': round(similarity, 4),
+            'answer_similarity': round(answer_similarity, 4),
+            'classification': fresh_classification,
+            'passed': passed,
+            'at': time.time(),
+        }
+        with self._lock:
+            self.audits += 1
+            self._audit_log.append(audit)
+            if not passed:
+                self.false_hits += 1
+                if entry.id in self._entries:
+                    self._remove_locked(entry.id)
+        if not passed:
+            log.warning(f"FAQ cache false hit: '{question}' matched '{entry.question}' "
+                        f"(similarity {similarity:.3f}, answers {answer_similarity:.3f}); entry evicted.")
+        return audit
+
+    def audit_log(self):
+        with self._lock:
+            return list(self._audit_log)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                'near_misses': self.near_misses,
+                'key_term_mismatches': self.key_term_mismatches,
+                'personalized': self.personalized,
+                'stored': self.stored,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'reported_false_hits': self.reported,
+                'audits': self.audits,
+                'audit_false_hits': self.false_hits,
+                'audit_false_hit_rate': round(self.false_hits / self.audits, 4) if self.audits else 0.0,
+                'threshold': self.threshold,
+            }
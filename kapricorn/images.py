@@ -0,0 +1,176 @@
+# File: kapricorn/images.py
+
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+STORED_MIME_TYPE = 'image/jpeg'
+_IMAGE_ID = re.compile(r'^[0-9a-f]{64}$')
+# Pillow format names for the extensions in Config.ALLOWED_EXTENSIONS
+_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'gif': 'GIF', 'webp': 'WEBP'}
+_READ_CHUNK_BYTES = 64 * 1024
+
+
+class ImageRejected(ValueError):
+    """Raised when an upload is not a usable image."""
+
+
+class ImageTooLarge(ImageRejected):
+    """Raised when an upload is larger than the store accepts."""
+
+
+def is_image_id(value):
+    return isinstance(value, str) and bool(_IMAGE_ID.match(value))
+
+
+class ImageStore:
+    """
+    Content-addressed store for chat images.
+
+    Uploads are decoded once, downscaled so the longest side is at most
+    `max_dimension` (the model tiles anything larger anyway) and re-encoded
+    as JPEG. The image id is the sha256 of the stored bytes, so the same
+    picture uploaded twice is stored once; a digest of the raw upload is
+    remembered as well so an identical re-upload skips decoding entirely.
+    Files are sharded under `root` as ab/abcdef....jpg. Uploads are read
+    in chunks and hashed as they arrive; one over `max_upload_bytes` raises
+    ImageTooLarge without being buffered whole.
+    """
+
+    def __init__(self, root, max_dimension=768, jpeg_quality=85, allowed_extensions=None,
+                 memory_cache_entries=64, max_upload_bytes=None):
+        self.root = root
+        self.max_upload_bytes = max_upload_bytes
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+        self.allowed_formats = {_FORMATS[ext] for ext in (allowed_extensions or _FORMATS) if ext in _FORMATS}
+        self._lock = threading.Lock()
+        self._upload_digests = TTLCache(max_entries=10000, ttl_seconds=86400)  # sha256 of raw upload -> image id
+        self._bytes_cache = TTLCache(max_entries=memory_cache_entries, ttl_seconds=600)
+        self._stats = {'uploads': 0, 'deduplicated': 0, 'bytes_received': 0, 'bytes_stored': 0}
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, image_id):
+        return os.path.join(self.root, image_id[:2], image_id + '.jpg')
+
+    def save(self, stream):
+        """Stores an uploaded image (file-like or bytes); returns its metadata dict."""
+        raw, upload_digest = self._read(stream)
+        with self._lock:
+            self._stats['uploads'] += 1
+            self._stats['bytes_received'] += len(raw)
+        known_id = self._upload_digests.get(upload_digest)
+        if known_id and os.path.exists(self._path(known_id)):
+            with self._lock:
+                self._stats['deduplicated'] += 1
+            return self._describe(known_id, deduplicated=True)
+
+        data, size = self._normalize(raw)
+        image_id = hashlib.sha256(data).hexdigest()
+        path = self._path(image_id)
+        deduplicated = os.path.exists(path)
+        if not deduplicated:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path) # Atomic, so readers never see a partial file
+        self._upload_digests.set(upload_digest, image_id)
+        with self._lock:
+            if deduplicated:
+                self._stats['deduplicated'] += 1
+            else:
+                self._stats['bytes_stored'] += len(data)
+        log.info(f"Stored image {image_id[:12]} ({len(raw)} -> {len(data)} bytes, {size[0]}x{size[1]}).")
+        return self._describe(image_id, deduplicated=deduplicated, size=size, stored_bytes=len(data))
+
+    def _read(self, stream):
+        """(raw bytes, sha256 hex digest) of an upload; raises ImageTooLarge past max_upload_bytes."""
+        limit = self.max_upload_bytes
+        digest = hashlib.sha256()
+        if isinstance(stream, bytes):
+            if limit is not None and len(stream) > limit:
+                raise ImageTooLarge(f"Upload exceeds {limit} bytes.")
+            digest.update(stream)
+            return stream, digest.hexdigest()
+        buffer = io.BytesIO()
+        while True:
+            chunk = stream.read(_READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+            buffer.write(chunk)
+            if limit is not None and buffer.tell() > limit:
+                raise ImageTooLarge(f"Upload exceeds {limit} bytes.")
+        return buffer.getvalue(), digest.hexdigest()
+
+    def _normalize(self, raw):
+        try:
+            with Image.open(io.BytesIO(raw)) as image:
+                if image.format not in self.allowed_formats:
+                    raise ImageRejected(f"Unsupported image format: {image.format}.")
+                image = ImageOps.exif_transpose(image) # Phone photos carry rotation in EXIF
+                image.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+                if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+                    image = background
+                elif image.mode != 'RGB':
+                    image = image.convert('RGB')
+                out = io.BytesIO()
+                image.save(out, format='JPEG', quality=self.jpeg_quality, optimize=True)
+                return out.getvalue(), image.size
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+            raise ImageRejected(f"Could not read image: {e}") from e
+
+    def _describe(self, image_id, deduplicated, size=None, stored_bytes=None):
+        description = {'image_id': image_id, 'mime_type': STORED_MIME_TYPE, 'deduplicated': deduplicated}
+        if size:
+            description.update(width=size[0], height=size[1])
+        if stored_bytes is not None:
+            description['bytes'] = stored_bytes
+        return description
+
+    def exists(self, image_id):
+        return is_image_id(image_id) and os.path.exists(self._path(image_id))
+
+    def load(self, image_id):
+        """Returns the stored bytes, or None if the id is unknown."""
+        if not is_image_id(image_id):
+            return None
+        data = self._bytes_cache.get(image_id)
+        if data is not None:
+            return data
+        try:
+            with open(self._path(image_id), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._bytes_cache.set(image_id, data)
+        return data
+
+    def path(self, image_id):
+        """Filesystem path of a stored image (for send_file), or None."""
+        return self._path(image_id) if self.exists(image_id) else None
+
+    def inline_part(self, image_id):
+        """Resolves an {'image_id'} reference to the inline_data part the model expects."""
+        data = self.load(image_id)
+        if data is None:
+            return None
+        return {'inline_data': {'mime_type': STORED_MIME_TYPE, 'data': data}}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['memory_cache'] = self._bytes_cache.stats()
+        return stats
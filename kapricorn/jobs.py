@@ -0,0 +1,115 @@
+# File: kapricorn/jobs.py
+
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """State of one background job. `result` is set once status is DONE."""
+
+    def __init__(self, job_id, kind):
+        self.id = job_id
+        self.kind = kind
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._finished = threading.Event()
+
+    def wait(self, timeout=None):
+        """Blocks until the job finishes. Returns False on timeout."""
+        return self._finished.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """
+    Runs slow AI work (e.g. VisualsBot schedules) on a worker pool.
+
+    Jobs run inside an application context so service functions can read
+    `current_app.config`. Finished jobs are kept for `ttl_seconds` so clients
+    can poll for them, then dropped.
+    """
+
+    def __init__(self, app, max_workers=4, ttl_seconds=600):
+        self.app = app
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='kapricorn-job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, kind, fn, *args, on_complete=None):
+        """
+        Queues fn(*args) and returns the Job.
+
+        `on_complete(job)` runs in the worker (inside the app context) once
+        `job.result` or `job.error` is set and before the job is reported
+        finished, e.g. to reconcile stored conversation history.
+        """
+        job = Job(uuid.uuid4().hex, kind)
+        with self._lock:
+            self._purge_locked()
+            self._jobs[job.id] = job
+        try:
+            self._executor.submit(self._run, job, fn, args, on_complete)
+        except RuntimeError:
+            # Shutting down: the job would never run, so do not leave it pending
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args, on_complete):
+        job.status = RUNNING
+        with self.app.app_context():
+            try:
+                job.result = fn(*args)
+            except Exception as e:
+                log.error(f"Background job {job.id} ({job.kind}) failed: {e}", exc_info=True)
+                job.error = "Background job failed unexpectedly."
+            if on_complete is not None:
+                try:
+                    on_complete(job)
+                except Exception as e:
+                    log.error(f"Completion hook for job {job.id} failed: {e}", exc_info=True)
+        # Status flips only after the hook, so pollers never see a half-reconciled job
+        job.status = FAILED if job.error else DONE
+        job.finished_at = time.time()
+        job._finished.set()
+
+    def _purge_locked(self):
+        cutoff = time.time() - self.ttl_seconds
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {'jobs': counts}
@@ -0,0 +1,171 @@
+# File: kapricorn/prompt_cache.py
+
+import datetime
+import logging
+import threading
+import time
+
+from google.generativeai import caching as genai_caching
+
+from .clients import key_fingerprint
+from .tokens import estimate_tokens
+
+log = logging.getLogger(__name__)
+
+
+class GeminiCacheBackend:
+    """Creates/deletes provider-side cached contents using the per-key clients."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def create(self, api_key, model_name, contents, ttl_seconds):
+        """Returns (cached_content_name, expires_at_epoch)."""
+        client = self.registry.client_manager(api_key).get_default_client('cache')
+        request = genai_caching.CachedContent._prepare_create_request(
+            model=model_name, contents=contents, ttl=datetime.timedelta(seconds=ttl_seconds))
+        response = client.create_cached_content(request)
+        return response.name, time.time() + ttl_seconds
+
+
+class _CacheEntry:
+    __slots__ = ('name', 'expires_at', 'refreshing', 'failed_until')
+
+    def __init__(self):
+        self.name = None
+        self.expires_at = 0.0
+        self.refreshing = False
+        self.failed_until = 0.0
+
+
+class PromptPrefixCache:
+    """
+    Registers the fixed bot preambles (farmBot, visualsBot) as cached context.
+
+    `bind()` recognises a registered prefix at the start of a sanitized
+    prompt, makes sure a provider-side cached content exists for it on that
+    (api_key, model), and returns the cache name plus only the varying
+    suffix to send. Only `models` (versioned models that support cached
+    content) are cached; other models always get the prefix inline.
+
+    Caches are created and refreshed on a background thread, never on the
+    request path: turns sent before a cache exists go inline. The
+    superseded cache simply runs out its TTL. If creation fails (e.g. the
+    prefix is below the model's minimum cacheable size) creation is not
+    retried for `failure_backoff_seconds`.
+    """
+
+    def __init__(self, registry, backend, ttl_seconds=3600, refresh_margin_seconds=300,
+                 min_tokens=1024, failure_backoff_seconds=1800, enabled=True, models=()):
+        self.registry = registry
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.min_tokens = min_tokens
+        self.failure_backoff_seconds = failure_backoff_seconds
+        self.enabled = enabled
+        self.models = {model.strip() for model in models if model.strip()}
+        self._prefixes = {}  # name -> list of {'role', 'parts'} messages
+        self._lock = threading.Lock()
+        self._entries = {}   # (api_key, model_name, prefix_name) -> _CacheEntry
+        self._stats = {'cached_turns': 0, 'inline_turns': 0, 'cached_tokens': 0,
+                       'creations': 0, 'refreshes': 0, 'failures': 0}
+
+    def register(self, name, messages):
+        """Registers a static prefix (list of role/parts messages)."""
+        normalized = [{'role': m['role'], 'parts': list(m['parts'])} for m in messages]
+        if estimate_tokens(normalized) < self.min_tokens:
+            log.info(f"Prompt prefix '{name}' is below {self.min_tokens} tokens; it will not be cached.")
+            return
+        self._prefixes[name] = normalized
+
+    def supports(self, model_name):
+        return (model_name or '').split('/')[-1] in self.models
+
+    def _match(self, contents):
+        for name, prefix in self._prefixes.items():
+            if len(contents) > len(prefix) and contents[:len(prefix)] == prefix:
+                return name, prefix
+        return None, None
+
+    def bind(self, api_key, model_name, contents):
+        """
+        Returns (cached_content_name, contents_to_send, prefix_name).
+
+        cached_content_name is None when the prompt has no registered prefix
+        or no cache is available; contents_to_send is then the full prompt.
+        """
+        if not self.enabled or not isinstance(contents, list) or not contents or isinstance(contents[0], str):
+            return None, contents, None
+        if not self.supports(model_name):
+            return None, contents, None
+        name, prefix = self._match(contents)
+        if name is None:
+            return None, contents, None
+
+        cached_name = self._ensure(api_key, model_name, name, prefix)
+        if cached_name is None:
+            with self._lock:
+                self._stats['inline_turns'] += 1
+            return None, contents, name
+        return cached_name, contents[len(prefix):], name
+
+    def record_usage(self, prefix_name, cached_tokens):
+        """Counts tokens served from the cache for one turn (from usage_metadata)."""
+        with self._lock:
+            self._stats['cached_turns'] += 1
+            self._stats['cached_tokens'] += cached_tokens or 0
+
+    def _ensure(self, api_key, model_name, prefix_name, prefix):
+        cache_key = (api_key, model_name, prefix_name)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.setdefault(cache_key, _CacheEntry())
+            if entry.name and now < entry.expires_at - self.refresh_margin_seconds:
+                return entry.name
+            if now < entry.failed_until:
+                return None
+            live = entry.name if now < entry.expires_at else None
+            if not entry.refreshing:
+                # Create (or refresh) in the background; this turn uses the still-valid cache or goes inline
+                entry.refreshing = True
+                threading.Thread(target=self._create, args=(cache_key, prefix, live is not None),
+                                 name='kapricorn-prompt-cache', daemon=True).start()
+            return live
+
+    def _create(self, cache_key, prefix, is_refresh):
+        api_key, model_name, prefix_name = cache_key
+        try:
+            name, expires_at = self.backend.create(api_key, model_name, prefix, self.ttl_seconds)
+        except Exception as e:
+            log.warning(f"Could not cache prompt prefix '{prefix_name}' for '{model_name}' "
+                        f"(key {key_fingerprint(api_key)}): {e}")
+            with self._lock:
+                entry = self._entries[cache_key]
+                entry.refreshing = False
+                self._stats['failures'] += 1
+                if not is_refresh:
+                    entry.failed_until = time.time() + self.failure_backoff_seconds
+            return None
+
+        with self._lock:
+            entry = self._entries[cache_key]
+            old_name = entry.name
+            entry.name, entry.expires_at = name, expires_at
+            entry.refreshing = False
+            self._stats['refreshes' if is_refresh else 'creations'] += 1
+        log.info(f"Cached prompt prefix '{prefix_name}' for '{model_name}' as {name}.")
+        if old_name and old_name != name:
+            # The superseded cache is left to expire so in-flight calls using it still succeed
+            self.registry.discard_cached_content(old_name)
+        return name
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['prefixes'] = sorted(self._prefixes)
+            stats['active_caches'] = sum(1 for entry in self._entries.values()
+                                         if entry.name and entry.expires_at > time.time())
+            turns = stats['cached_turns']
+            stats['avg_cached_tokens_per_turn'] = round(stats['cached_tokens'] / turns, 1) if turns else 0.0
+            return stats
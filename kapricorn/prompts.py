@@ -1,7 +1,12 @@
 
-import re
 import ast
 import json
+import logging
+from .recommendation_engine import CropRecordParser, LocationSectionSplitter
+from .schemas import crops_from_json, packed_crops_from_json
+from .tag_parser import TagParser
+
+log = logging.getLogger(__name__)
 
 
 
@@ -67,7 +72,47 @@ def analyseLocation(location_details: str) -> str:
 
     Ensure the analysis is specific to {location_details} and provides actionable insights for improving crop survivability. Tie challenges and survivability reasons strictly to {location_details} natural conditions  without referencing human or infrastructural factors.
     """ , formatLocationInfo
-    
+
+
+def analyseLocations(locations: list) -> str:
+    """
+    analyseLocation for several locations in one call (batch recommendations).
+
+    Each location's analysis must start with its own '=== LOCATION n ===' line
+    (n = 1-based position in `locations`), which LocationSectionSplitter uses
+    to split the reply back into per-location analyses.
+    """
+    listing = '\n'.join(f"    {number}. {location}" for number, location in enumerate(locations, 1))
+    return f"""
+    Conduct a separate agricultural analysis for each of these {len(locations)} locations:
+{listing}
+
+    Start each location's analysis with a line containing only "=== LOCATION n ===", where n is the location's number above, and cover the locations in order. Do not mix locations within one analysis.
+
+    For each location:
+    - Identify at least 10 crops commonly grown there.
+    - For each crop, provide:
+        a. **Description**: A short concise description for someone unfamiliar with the crop.
+        b. **Challenges**: The top 3-5 challenges the crop faces in that location.
+        c. **Survivability Percentage**: A single estimated survivability percentage (0-100%), not a range.
+        d. **Reason for Survivability Value**: The key environmental and biological factors behind that percentage.
+
+    Format for each crop:
+    **Crop Name**: [Crop Name]
+    -Description: [Crop Description]
+    - Challenges:
+        - [Challenge 1]
+        - [Challenge 2]
+        - [Challenge 3]
+    - Survivability Percentage: [X%]
+    - Reason for Survivability Value:
+        - [Reason 1]
+        - [Reason 2]
+        - [Reason 3]
+
+    Tie challenges and survivability reasons strictly to each location's natural conditions (climate, soil type, water availability) without referencing human or infrastructural factors.
+    """
+
     
 def formatLocationInfo(previous_analysis: str) -> str:
     """
@@ -130,35 +175,139 @@ def formatLocationInfo(previous_analysis: str) -> str:
 def extractCropsInfo(tagged_response: str) -> dict:
     """
     Extracts structured crop data from XML-style tagged response.
-    Returns dict: {crop_name: {survivability, reasons, challenges}}
+    Returns dict: {crop_name: {description, survivability, reasons, challenges}}
+
+    Records that cannot be repaired (no name, no usable survivability) are
+    skipped rather than failing the whole set; see CropRecordParser.
     """
-    import re
-    
-    pattern = r"""
-    <crop>(.*?)</crop>                                 # Crop name
-    .*?<description>(.*?)</description>              # Description
-    .*?<challenges>(.*?)</challenges>                  # Challenges
-    .*?<survivability>(.*?)</survivability>            # Survivability
-    .*?<reasons>(.*?)</reasons>                        # Reasons
-    """ 
-    
-    crops = {}
-    for match in re.findall(pattern, tagged_response, re.DOTALL | re.VERBOSE): #move the flags to be the parameters of the re function
-        name = match[0].strip()
-        description = match[1].strip()
-        challenges = [line.strip("- ").strip() for line in match[2].split("\n") if line.strip()]
-        survivability = float(match[3].strip("%").strip())
-        reasons = [line.strip("- ").strip() for line in match[4].split("\n") if line.strip()]
-        
-        crops[name] = {
-            "description": description,
-            "survivability": survivability,
-            "reasons": reasons,
-            "challenges": challenges
-        }
-    
+    parser = CropRecordParser()
+    crops = dict(parser.feed(tagged_response or ''))
+    crops.update(parser.finish())
+    if parser.skipped:
+        log.warning(f"extractCropsInfo skipped {parser.skipped} malformed crop record(s).")
     return crops
 
+
+def formatLocationInfoJson(previous_analysis: str) -> str:
+    """
+    JSON-mode variant of formatLocationInfo: the reply is constrained by the
+    schemas.CropRecommendations response_schema instead of XML-style tags.
+    Returns both the prompt and a parser function as a tuple.
+    """
+    prompt = f"""
+    Convert this agricultural analysis into JSON matching the response schema:
+
+    {previous_analysis}
+
+    Requirements:
+    1. One entry in "crops" per crop in the analysis; include ALL of them
+    2. "crop": the full crop name, no markdown
+    3. "description": one or two sentences describing the crop
+    4. "challenges" and "reasons": one short point per list item, no '- ' prefix
+    5. "survivability": the survivability percentage as a number only (e.g. 65)
+    """
+
+    return prompt.strip() , crops_from_json
+
+
+def _location_analyses(sections):
+    return '\n\n'.join(f"=== LOCATION {number} ===\n{text}" for number, text in sections)
+
+
+def formatLocationsInfo(sections: list) -> str:
+    """
+    formatLocationInfo for several locations' analyses in one call (batch
+    recommendations). `sections` are the (n, analysis) pairs split from an
+    analyseLocations reply; the reply keeps each '=== LOCATION n ===' line
+    in front of that location's tagged crops.
+    Returns both the prompt and a parser function as a tuple.
+    """
+    prompt = f"""
+    Reformat these agricultural analyses of {len(sections)} locations. Copy each "=== LOCATION n ===" line exactly, on its own line, then give that location's crops using EXACTLY these XML-style tags:
+
+    {_location_analyses(sections)}
+
+    Reformatted Requirements:
+    1. For each crop, use these tags:
+       - <crop>Full crop name</crop>
+       - <description>Description of the crop</description>
+       - <challenges>List of challenges (one per line with '- ' prefix)</challenges>
+       - <survivability>Percentage without explanation</survivability>
+       - <reasons>List of reasons (one per line with '- ' prefix)</reasons>
+
+    2. Maintain this structure:
+    === LOCATION 1 ===
+    <crop>[CROP_NAME]</crop>
+    <description>[CROP_DESCRIPTION]</description>
+    <challenges>
+    - [Challenge 1]
+    </challenges>
+    <survivability>[X%]</survivability>
+    <reasons>
+    - [Reason 1]
+    </reasons>
+
+    3. Include ALL locations and ALL crops of each, and never move a crop to another location
+    4. Never use markdown - only the location lines and the specified tags
+    5. Put empty lines between crops
+    """
+
+    return prompt.strip() , extractLocationsCropsInfo
+
+
+def extractLocationsCropsInfo(tagged_response: str) -> dict:
+    """
+    Splits a formatLocationsInfo reply on its location lines and extracts each
+    location's crops: {n: {crop_name: {...}}}. Locations without a usable
+    crop are left out.
+    """
+    splitter = LocationSectionSplitter()
+    sections = splitter.feed(tagged_response or '') + splitter.finish()
+    packed = {}
+    for number, text in sections:
+        crops = extractCropsInfo(text)
+        if crops:
+            packed[number] = crops
+    return packed
+
+
+def formatLocationsInfoJson(sections: list) -> str:
+    """
+    JSON-mode variant of formatLocationsInfo: the reply is constrained by the
+    schemas.PackedCropRecommendations response_schema, one entry per
+    location number.
+    Returns both the prompt and a parser function as a tuple.
+    """
+    prompt = f"""
+    Convert these agricultural analyses into JSON matching the response schema, one entry per location ({len(sections)} locations):
+
+    {_location_analyses(sections)}
+
+    Requirements:
+    1. One entry in "locations" per "=== LOCATION n ===" analysis, with "location" set to its number n
+    2. One entry in that location's "crops" per crop in its analysis; include ALL of them and never move a crop to another location
+    3. "crop": the full crop name, no markdown
+    4. "description": one or two sentences describing the crop
+    5. "challenges" and "reasons": one short point per list item, no '- ' prefix
+    6. "survivability": the survivability percentage as a number only (e.g. 65)
+    """
+
+    return prompt.strip() , packed_crops_from_json
+
+
+def repairStructuredOutput(broken_output: str, errors: str) -> str:
+    """Builds the prompt asking the accessory model to fix a reply that failed schema validation."""
+    return f"""
+    The JSON below does not match its response schema. Return it corrected: keep all of its data,
+    fix the syntax and the listed problems, and output only the JSON.
+
+    Problems:
+    {errors}
+
+    JSON:
+    {broken_output}
+    """.strip()
+
 farmBot = """
 You are **Oscar**, an AI created by the **Kapricorn team** to provide **focused, concise, and practical farming guidance** to farmers. You are built in a system as the expert in it, the system is capable of providing you with some information like location (from the user's device. So if you need it , tell the user to turn it on or can as well give you the location) where the user is at(if any) , npk reading of the user farm (if any . This is gotten when the user connects the kapricorn soil sensor to the system he has to rent one(or buy) from Kapricorn head quaters if he has none or go to the `Manage Your Device` page and connect to any he got) and the current date at user's end. Your goal is to use the information provided by the System (like **location, date-time, and NPK readings**) to give **real-time, actionable advice** to user prompts in a way that is **easy to understand**. Always remember that your users are **local farmers**, so you should **speak as a farmer** and keep your responses **relevant and practical**.
 
@@ -367,17 +516,64 @@ def formatVisualBotResponse ( response ):
         bot = f'<gr>Ok. I will tell the user to reload if he doesn\'t see the vissuals, i will tell him to reload the page</gr>'
     return user , bot , response
 
-def processChats(chats, npk=None, location=None, date=None):
-    """Prepares chat history for AI, injecting context."""
-    l = len(chats)
-    if not l: return chats # Return empty if no history
+def summarizeChatHistory(previous_summary: str, transcript: str) -> str:
+    """
+    Builds the prompt that folds older chat turns into a running summary.
+
+    Args:
+        previous_summary (str): Summary of even older turns ('' if none yet)
+        transcript (str): The turns being folded, one "Role: text" line each
+
+    Returns:
+        str: Prompt for the accessory model
+    """
+    return f"""
+    You maintain the running memory of a conversation between a farmer and Oscar, a farming assistant.
+    Update the summary below with the new turns so Oscar can continue the conversation without them.
 
-    # Build the context string, omitting parts if None/empty
+    Keep: the farmer's crops, farm size and location, soil/NPK readings, dates and plans, problems
+    reported, advice already given, visuals (timelines/schedules) already generated, and open questions.
+    Drop greetings, repetition and the tag markup (<p>, <r>, <g>, ...).
+    Write plain, compact sentences, at most 200 words. Output only the updated summary.
+
+    Current summary:
+    {previous_summary or "(none yet)"}
+
+    New turns:
+    {transcript}
+    """.strip()
+
+def systemContext(npk=None, location=None, date=None):
+    """The system context sentence injected into <g> tags, omitting parts if None/empty."""
     context_parts = []
     if location: context_parts.append(f"Location: {location}")
     if npk: context_parts.append(f"NPK Reading: {npk}")
     if date: context_parts.append(f"Current Date: {date}")
-    context_string = ", ".join(context_parts) if context_parts else "No specific context provided."
+    return ", ".join(context_parts) if context_parts else "No specific context provided."
+
+
+def personalizeFaqAnswer(question: str, answer: str, context: str) -> str:
+    """
+    Builds the prompt adapting a cached FAQ answer (written for another
+    farmer's location/date/NPK) to the current farmer's context.
+    """
+    return f"""
+    A farmer asked: "{question}"
+    This answer was written for another farmer. Adapt it to this farmer's context: {context}
+    Change only the details that depend on location, date or NPK readings; keep everything else,
+    including the Markdown formatting. Output only the adapted answer.
+
+    Answer:
+    {answer}
+    """.strip()
+
+
+def processChats(chats, npk=None, location=None, date=None):
+    """Prepares chat history for AI, injecting context."""
+    l = len(chats)
+    if not l: return chats # Return empty if no history
+
+    context_string = systemContext(npk=npk, location=location, date=date)
 
     # Look for the last user message to append context to
     last_user_message_index = -1
@@ -386,13 +582,14 @@ def processChats(chats, npk=None, location=None, date=None):
             last_user_message_index = i
             break
 
-    # Deep copy to avoid modifying original list directly if needed elsewhere
-    import copy
-    processed_chats = copy.deepcopy(chats)
+    # Only the message that gets context injected is copied; every other
+    # message (and its possibly large inline_data parts) is shared as-is.
+    processed_chats = list(chats)
 
     if last_user_message_index != -1:
-        last_user_msg = processed_chats[last_user_message_index]
+        last_user_msg = dict(processed_chats[last_user_message_index])
         parts = last_user_msg.get('parts', [])
+        parts = list(parts) if isinstance(parts, list) else [parts]
         # Find the first text part to potentially modify
         text_part_index = -1
         for i, part in enumerate(parts):
@@ -423,23 +620,16 @@ def processChats(chats, npk=None, location=None, date=None):
 
         # Update the parts in the copied message
         last_user_msg['parts'] = parts
+        processed_chats[last_user_message_index] = last_user_msg
 
     # Prepend the initial bot instructions/role-play setup
     return startChats + processed_chats
 
 def extract_tags(response , tags = ['p', 'g', 'r', 'gr', 'cls', 'gen']):
-    # Initialize an empty dictionary to store the extracted content
-    extracted_data = {}
-    
-    # Loop through each tag and extract its content using regex
-    for tag in tags:
-        pattern = f'<{tag}>(.*?)</{tag}>'
-        matches = re.findall(pattern, response, re.DOTALL)
-        
-        # If matches are found, store them in the dictionary
-        if matches:
-            extracted_data[tag] = matches[0].strip()  # Store the first match and remove extra whitespace
-        else:
-            extracted_data[tag] = None  # If no match, store None
-    
-    return extracted_data
+    """
+    Extracts the first top-level content of each tag ({tag: content or None}).
+
+    Single pass over the response; see tag_parser.TagParser for how repeated,
+    nested and unclosed tags are handled.
+    """
+    return TagParser(tags).parse(response)
@@ -0,0 +1,357 @@
+# File: kapricorn/ratelimit.py
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import math
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+from .clients import key_fingerprint
+
+log = logging.getLogger(__name__)
+
+_SLOT_POLL_SECONDS = 0.05
+
+# Set by rate_limit_patience() for callers that pace themselves and would rather wait than fail
+_patience = contextvars.ContextVar('kapricorn_rate_limit_patience', default=None)
+
+
+@contextlib.contextmanager
+def rate_limit_patience(max_wait_seconds):
+    """Lets governed calls made in this context (and contexts copied from it) wait up to `max_wait_seconds`."""
+    token = _patience.set(max_wait_seconds)
+    try:
+        yield
+    finally:
+        _patience.reset(token)
+
+
+class RateLimited(Exception):
+    """Raised when a call could not get an upstream slot within the allowed wait."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_quota_error(error):
+    """True for the provider's 429 / RESOURCE_EXHAUSTED responses."""
+    # ResourceExhausted subclasses TooManyRequests; both are HTTP 429
+    return isinstance(error, google_exceptions.TooManyRequests)
+
+
+def parse_rate_limits(value):
+    """Parses 'NAME=rpm:concurrency,...' (or a dict) into {NAME: (rpm, concurrency)}."""
+    if isinstance(value, dict):
+        return {name: (float(rpm), int(concurrency)) for name, (rpm, concurrency) in value.items()}
+    limits = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, spec = item.split('=', 1)
+            rpm, _, concurrency = spec.partition(':')
+            limits[name.strip()] = (float(rpm), int(concurrency or 1))
+    return limits
+
+
+class Permit:
+    """
+    One granted upstream call. Use as a context manager around the call.
+
+    A quota error raised inside the block shrinks the key's limits; a
+    normal exit counts as a success. For streamed responses wrap the
+    iterator with `guard_stream` / `guard_async_stream`, which hands the
+    permit over to the stream so it is released when the stream ends.
+    A permit without a governor (rate limiting disabled) does nothing.
+    """
+
+    __slots__ = ('_governor', '_released', '_handed_off')
+
+    def __init__(self, governor):
+        self._governor = governor
+        self._released = False
+        self._handed_off = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._handed_off:
+            self.release(exc)
+        return False
+
+    def release(self, error=None):
+        if not self._released:
+            self._released = True
+            if self._governor is not None:
+                self._governor._release(error)
+
+    def __del__(self):
+        # A handed-off stream that is never iterated must not leak its slot
+        if not self._released:
+            self.release()
+
+    def guard_stream(self, stream):
+        self._handed_off = True
+
+        def iterate():
+            error = None
+            try:
+                yield from stream
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self.release(error)
+        return iterate()
+
+    def guard_async_stream(self, stream):
+        self._handed_off = True
+
+        async def iterate():
+            error = None
+            try:
+                async for chunk in stream:
+                    yield chunk
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self.release(error)
+        return iterate()
+
+
+class KeyGovernor:
+    """
+    Token bucket plus concurrency limit for one API key, adapted by AIMD.
+
+    Calls take a token (refilled at `rate_per_minute`) and a concurrency
+    slot. Every successful call raises the rate by `increase_fraction` of
+    the configured ceiling and the concurrency limit by 1/limit (about one
+    slot per round of calls); a 429/quota error multiplies both by
+    `decrease_factor`, empties the bucket and pauses the key for
+    `cooldown_seconds`. Decreases are applied at most once per cooldown, so
+    a burst of failures from the same overload counts once.
+
+    Callers wait up to `max_wait_seconds` (or the rate_limit_patience() in
+    effect; at most `max_queue` may wait) before RateLimited is raised.
+    """
+
+    def __init__(self, rate_per_minute, max_concurrency, max_wait_seconds=10.0, max_queue=100,
+                 min_rate_per_minute=1.0, decrease_factor=0.5, increase_fraction=0.02,
+                 cooldown_seconds=1.0):
+        self.ceiling_rate = rate_per_minute / 60.0
+        self.max_concurrency = max_concurrency
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queue = max_queue
+        self.min_rate = min_rate_per_minute / 60.0
+        self.decrease_factor = decrease_factor
+        self.increase_fraction = increase_fraction
+        self.cooldown_seconds = cooldown_seconds
+
+        self.rate = self.ceiling_rate
+        self.limit = float(max_concurrency)
+        self._burst = max(1.0, float(max_concurrency))
+        self._tokens = self._burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = float('-inf')
+        self._in_flight = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._stats = {'acquired': 0, 'waited': 0, 'rejected': 0, 'quota_errors': 0, 'decreases': 0,
+                       'max_queue_depth': 0, 'total_wait_ms': 0.0, 'max_wait_ms': 0.0}
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _try_take(self, now):
+        """Takes a slot if one is free. Returns None on success, else seconds until one may be."""
+        self._refill(now)
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._in_flight >= max(1, int(self.limit)):
+            return _SLOT_POLL_SECONDS # Threads are woken by the release; async waiters poll
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self.rate
+        self._tokens -= 1.0
+        self._in_flight += 1
+        return None
+
+    def retry_after(self):
+        """Rough seconds until a new caller would be admitted (for Retry-After)."""
+        with self._cond:
+            self._refill(time.monotonic())
+            return self._retry_after_locked()
+
+    def _enqueue(self):
+        if self._waiting >= self.max_queue:
+            self._stats['rejected'] += 1
+            raise RateLimited("Too many requests queued for this AI key.", self._retry_after_locked())
+        self._waiting += 1
+        self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self._waiting)
+
+    def _retry_after_locked(self):
+        now = time.monotonic()
+        backlog = self._waiting + max(0.0, 1.0 - self._tokens)
+        return max(1, math.ceil(max(self._paused_until - now, backlog / self.rate)))
+
+    def _record_wait(self, waited):
+        self._stats['acquired'] += 1
+        if waited > 0.001:
+            waited_ms = waited * 1000
+            self._stats['waited'] += 1
+            self._stats['total_wait_ms'] += waited_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], waited_ms)
+
+    def _max_wait(self):
+        patience = _patience.get()
+        return self.max_wait_seconds if patience is None else patience
+
+    def _reject(self):
+        self._stats['rejected'] += 1
+        return RateLimited("Timed out waiting for AI quota.", self._retry_after_locked())
+
+    def acquire(self):
+        """Blocks until a slot is granted; returns a Permit or raises RateLimited."""
+        start = time.monotonic()
+        deadline = start + self._max_wait()
+        with self._cond:
+            # Arrivals only skip the queue when nobody is waiting
+            if not self._waiting and self._try_take(start) is None:
+                self._record_wait(0)
+                return Permit(self)
+            self._enqueue()
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._try_take(now)
+                    if delay is None:
+                        break
+                    if now >= deadline:
+                        raise self._reject()
+                    self._cond.wait(min(delay, deadline - now))
+            finally:
+                self._waiting -= 1
+            self._record_wait(time.monotonic() - start)
+        return Permit(self)
+
+    async def acquire_async(self):
+        """Awaitable acquire: waits on the event loop instead of blocking a thread."""
+        start = time.monotonic()
+        deadline = start + self._max_wait()
+        with self._cond:
+            if not self._waiting and self._try_take(start) is None:
+                self._record_wait(0)
+                return Permit(self)
+            self._enqueue()
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    delay = self._try_take(now)
+                    if delay is None:
+                        self._record_wait(now - start)
+                        return Permit(self)
+                    if now >= deadline:
+                        raise self._reject()
+                await asyncio.sleep(min(delay, _SLOT_POLL_SECONDS, deadline - now))
+        finally:
+            with self._cond:
+                self._waiting -= 1
+
+    def _release(self, error):
+        with self._cond:
+            self._in_flight -= 1
+            if error is not None and is_quota_error(error):
+                self._on_quota_error()
+            elif error is None:
+                self.rate = min(self.ceiling_rate, self.rate + self.ceiling_rate * self.increase_fraction)
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / max(1.0, self.limit))
+            self._cond.notify_all()
+
+    def _on_quota_error(self):
+        now = time.monotonic()
+        self._stats['quota_errors'] += 1
+        if now - self._last_decrease < self.cooldown_seconds:
+            return
+        self._last_decrease = now
+        self._stats['decreases'] += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.limit = max(1.0, self.limit * self.decrease_factor)
+        self._tokens = 0.0
+        self._paused_until = now + self.cooldown_seconds
+        log.warning(f"Upstream quota hit; rate now {self.rate * 60:.1f}/min, concurrency {int(self.limit)}.")
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                rate_per_minute=round(self.rate * 60, 2),
+                ceiling_rate_per_minute=round(self.ceiling_rate * 60, 2),
+                concurrency_limit=max(1, int(self.limit)),
+                max_concurrency=self.max_concurrency,
+                in_flight=self._in_flight,
+                queue_depth=self._waiting,
+            )
+        total_wait_ms = stats.pop('total_wait_ms')
+        stats['avg_wait_ms'] = round(total_wait_ms / stats['waited'], 1) if stats['waited'] else 0.0
+        stats['max_wait_ms'] = round(stats['max_wait_ms'], 1)
+        return stats
+
+
+class RateGovernor:
+    """
+    Per-API-key KeyGovernors, created on first use.
+
+    `limits` maps api_key -> (requests_per_minute, max_concurrency); keys
+    without an entry get `default_limit`, and are not limited at all when
+    that is None (the default). Stats are reported by key fingerprint only.
+    When disabled, every call gets a no-op permit.
+    """
+
+    def __init__(self, limits=None, default_limit=None, enabled=True, **governor_options):
+        self.enabled = enabled
+        self._limits = dict(limits or {})
+        self._default_limit = default_limit
+        self._governor_options = governor_options
+        self._lock = threading.Lock()
+        self._governors = {}
+
+    def for_key(self, api_key):
+        """The key's KeyGovernor, or None if the key is not limited."""
+        with self._lock:
+            governor = self._governors.get(api_key)
+            if governor is None:
+                limit = self._limits.get(api_key, self._default_limit)
+                if limit is None:
+                    return None
+                rpm, concurrency = limit
+                governor = KeyGovernor(rpm, concurrency, **self._governor_options)
+                self._governors[api_key] = governor
+            return governor
+
+    def acquire(self, api_key):
+        governor = self.for_key(api_key) if self.enabled else None
+        if governor is None:
+            return Permit(None)
+        return governor.acquire()
+
+    async def acquire_async(self, api_key):
+        governor = self.for_key(api_key) if self.enabled else None
+        if governor is None:
+            return Permit(None)
+        return await governor.acquire_async()
+
+    def retry_after(self, api_key):
+        governor = self.for_key(api_key)
+        return governor.retry_after() if governor is not None else 1
+
+    def stats(self):
+        with self._lock:
+            governors = dict(self._governors)
+        return {key_fingerprint(api_key): governor.stats() for api_key, governor in governors.items()}
@@ -0,0 +1,253 @@
+# File: kapricorn/recommendation_engine.py
+
+import re
+
+# "**Crop Name**: Maize", "1. **Crop Name:** Maize", "### Crop Name: Maize", ...
+CROP_HEADER = re.compile(r'^[\s>#*\-\d.)]*crop name\W*:', re.IGNORECASE)
+# Headings that end the per-crop part of the analysis (e.g. "**2. Location-Specific Factors**")
+SECTION_BREAK = re.compile(r'^\s*#{1,6}\s|^[\s#*\d.)]*location[- ]specific', re.IGNORECASE)
+
+
+class CropSectionSplitter:
+    """
+    Splits a streamed analyseLocation reply into one text section per crop.
+
+    Feed it chunks as they arrive; a crop's section is returned as soon as
+    the next crop header (or a closing heading) shows up, so it can be
+    formatted while the rest of the analysis is still being generated.
+    Text before the first crop header and after a closing heading is dropped.
+    """
+
+    def __init__(self):
+        self._pending = ''   # Incomplete trailing line
+        self._current = None # Lines of the crop section being collected
+        self.sections_seen = 0
+
+    def feed(self, chunk):
+        """Consumes a chunk and returns the list of sections it completed."""
+        self._pending += chunk
+        *lines, self._pending = self._pending.split('\n')
+        completed = []
+        for line in lines:
+            self._consume_line(line, completed)
+        return completed
+
+    def finish(self):
+        """Flushes the final section once the stream has ended."""
+        completed = []
+        if self._pending:
+            self._consume_line(self._pending, completed)
+            self._pending = ''
+        self._close(completed)
+        return completed
+
+    def _consume_line(self, line, completed):
+        if CROP_HEADER.match(line):
+            self._close(completed)
+            self._current = [line]
+        elif SECTION_BREAK.match(line):
+            self._close(completed)
+        elif self._current is not None:
+            self._current.append(line)
+
+    def _close(self, completed):
+        if self._current:
+            section = '\n'.join(self._current).strip()
+            if section:
+                completed.append(section)
+                self.sections_seen += 1
+        self._current = None
+
+
+# "=== LOCATION 2 ===", "**=== Location 2: Kano ===**", ...
+LOCATION_HEADER = re.compile(r'^[\s>#*]*={2,}\s*location\s+(\d+)\b', re.IGNORECASE)
+
+
+class LocationSectionSplitter:
+    """
+    Splits a streamed analyseLocations reply into one analysis per location.
+
+    Like CropSectionSplitter, but on '=== LOCATION n ===' lines: feed it
+    chunks and it returns the (n, text) sections the next header completed.
+    Text before the first header is dropped; a repeated number keeps the
+    first section.
+    """
+
+    def __init__(self):
+        self._pending = ''
+        self._number = None
+        self._lines = []
+        self._seen = set()
+
+    def feed(self, chunk):
+        self._pending += chunk
+        *lines, self._pending = self._pending.split('\n')
+        completed = []
+        for line in lines:
+            match = LOCATION_HEADER.match(line)
+            if match:
+                self._close(completed)
+                self._number = int(match.group(1))
+            elif self._number is not None:
+                self._lines.append(line)
+        return completed
+
+    def finish(self):
+        completed = self.feed('\n') if self._pending else []
+        self._close(completed)
+        return completed
+
+    def _close(self, completed):
+        text = '\n'.join(self._lines).strip()
+        if self._number is not None and text and self._number not in self._seen:
+            self._seen.add(self._number)
+            completed.append((self._number, text))
+        self._number = None
+        self._lines = []
+
+
+CROP_FIELDS = ('crop', 'description', 'challenges', 'survivability', 'reasons')
+_CROP_MARKER = re.compile(r'<(/?)(' + '|'.join(CROP_FIELDS) + r')\s*>', re.IGNORECASE)
+_MAX_CROP_MARKER_LEN = max(len(field) for field in CROP_FIELDS) + 8  # "</survivability  >"
+_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+# "60-70", "60 % - 70", "60 to 70" (only at the first number)
+_RANGE = re.compile(r'(\d+(?:\.\d+)?)\s*%?\s*(?:-|\u2013|\u2014|to)\s*(\d+(?:\.\d+)?)', re.IGNORECASE)
+_LIST_BULLET = re.compile(r'^(?:[-*•]|\d+[.)])\s*')
+
+
+def parse_survivability(value):
+    """
+    Normalizes a survivability value to a 0-100 float, or None if unusable.
+
+    "65%" -> 65.0, "60-70%" or "60 to 70%" -> 65.0 (midpoint), "about 80
+    percent" -> 80.0, "0.7" -> 70.0 (a bare fraction), values above 100 are
+    clamped. Only the first number counts, so "85% (3-4 months)" -> 85.0.
+    """
+    first = _NUMBER.search(value or '')
+    if first is None:
+        return None
+    span = _RANGE.match(value, first.start())
+    if span:
+        survivability = (float(span.group(1)) + float(span.group(2))) / 2
+    else:
+        survivability = float(first.group())
+    if survivability <= 1 and '%' not in value and 'percent' not in value.lower():
+        survivability *= 100
+    return round(min(survivability, 100.0), 1)
+
+
+def _parse_list(value):
+    return [item for item in (_LIST_BULLET.sub('', line.strip()).strip() for line in (value or '').split('\n')) if item]
+
+
+def normalize_crop_record(fields):
+    """Validates raw tag contents of one crop; returns (name, data) or None if it cannot be repaired."""
+    name = (fields.get('crop') or '').strip().strip('*#').strip()
+    if not name:
+        return None
+    survivability = parse_survivability(fields.get('survivability'))
+    if survivability is None:
+        return None
+    return name, {
+        "description": (fields.get('description') or '').strip(),
+        "survivability": survivability,
+        "reasons": _parse_list(fields.get('reasons')),
+        "challenges": _parse_list(fields.get('challenges')),
+    }
+
+
+class CropRecordParser:
+    """
+    Linear-time, streaming parser for formatLocationInfo's tagged output.
+
+    Each `<crop>` starts a new record; the following field tags fill it in
+    until the next `<crop>` (or the end of the stream). Every marker is
+    visited once and consumed text is dropped, so malformed or huge inputs
+    cannot trigger regex backtracking. Records are validated one by one:
+    recoverable problems are repaired (ranges such as "60-70%", a field left
+    unclosed before the next tag), and records that cannot be repaired are
+    skipped and counted instead of failing the whole set.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._scan_pos = 0
+        self._record = None      # Field contents of the crop being parsed
+        self._open_field = None  # (field, content_start) of an unclosed tag
+        self.parsed = 0
+        self.skipped = 0
+
+    def feed(self, chunk):
+        """Consumes a chunk; returns the (name, data) records it completed."""
+        completed = []
+        if not chunk:
+            return completed
+        self._buffer += chunk
+        buffer = self._buffer
+        position = self._scan_pos
+        for match in _CROP_MARKER.finditer(buffer, position):
+            self._on_marker(match, completed)
+            position = match.end()
+        position = max(position, len(buffer) - _MAX_CROP_MARKER_LEN + 1)
+
+        # Drop text nothing can refer to any more
+        keep_from = self._open_field[1] if self._open_field else position
+        if keep_from > 0:
+            self._buffer = buffer[keep_from:]
+            position -= keep_from
+            if self._open_field:
+                self._open_field = (self._open_field[0], 0)
+        self._scan_pos = position
+        return completed
+
+    def finish(self):
+        """Flushes the last record once the stream has ended."""
+        completed = []
+        if self._open_field:
+            self._close_field(len(self._buffer))
+        self._emit(completed)
+        self._buffer, self._scan_pos = '', 0
+        return completed
+
+    def _on_marker(self, match, completed):
+        closing, field = match.groups()
+        field = field.lower()
+        if self._open_field:
+            if closing and field != self._open_field[0]:
+                return # Mismatched close inside a field: treat as text
+            self._close_field(match.start()) # Closes it, or repairs a missing close
+            if closing:
+                return
+        elif closing:
+            return # Stray close
+        if field == 'crop':
+            self._emit(completed)
+            self._record = {}
+        elif self._record is None:
+            return # Field before any <crop>: nothing to attach it to
+        self._open_field = (field, match.end())
+
+    def _close_field(self, end):
+        field, start = self._open_field
+        self._open_field = None
+        if self._record is not None:
+            self._record.setdefault(field, self._buffer[start:end])
+
+    def _emit(self, completed):
+        if self._record is None:
+            return
+        record = normalize_crop_record(self._record)
+        self._record = None
+        if record is None:
+            self.skipped += 1
+        else:
+            self.parsed += 1
+            completed.append(record)
+
+
+def iter_crops(chunks):
+    """Yields (name, data) per crop from a tagged response string or an iterable of chunks."""
+    parser = CropRecordParser()
+    for chunk in ([chunks] if isinstance(chunks, str) else chunks):
+        yield from parser.feed(chunk)
+    yield from parser.finish()
@@ -0,0 +1,330 @@
+# File: kapricorn/resilience.py
+
+import asyncio
+import collections
+import contextvars
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from google.api_core import exceptions as google_exceptions
+
+from .breaker import CircuitOpen
+from .ratelimit import RateLimited
+
+log = logging.getLogger(__name__)
+
+# Upstream failures worth another attempt (429s included: the governor slows the key down meanwhile)
+_TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+
+# Failures meaning "this model/key cannot take the call right now": try the next model in the chain
+_OVERLOAD_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    RateLimited,
+    CircuitOpen,
+)
+
+
+def is_transient_error(error):
+    return isinstance(error, _TRANSIENT_ERRORS) and not isinstance(error, RateLimited)
+
+
+def is_overload_error(error):
+    return isinstance(error, _OVERLOAD_ERRORS)
+
+
+def parse_fallback_chains(value):
+    """Parses 'route=TIER>TIER,route=TIER' (or a dict) into {route: [TIER, ...]}."""
+    if isinstance(value, dict):
+        return {route: list(tiers) for route, tiers in value.items()}
+    chains = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            route, tiers = item.split('=', 1)
+            chains[route.strip()] = [tier.strip() for tier in tiers.split('>') if tier.strip()]
+    return chains
+
+
+class _LatencyWindow:
+    """Recent successful-call latencies for one model, with a cached quantile."""
+
+    __slots__ = ('samples', 'quantile', '_cached', '_stale')
+
+    def __init__(self, size, quantile):
+        self.samples = collections.deque(maxlen=size)
+        self.quantile = quantile
+        self._cached = None
+        self._stale = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self._stale += 1
+
+    def value(self):
+        # Re-sorting a few hundred floats is cheap, but not worth doing on every call
+        if self._cached is None or self._stale >= 10:
+            ordered = sorted(self.samples)
+            self._cached = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))] if ordered else None
+            self._stale = 0
+        return self._cached
+
+
+class ResiliencePolicy:
+    """
+    Retries, hedges and counts upstream calls.
+
+    `run(model_name, attempt)` calls `attempt(sent)` (one complete upstream
+    call, which calls `sent()` right before the request goes out) and retries
+    transient failures up to `max_attempts` times with full-jitter
+    exponential backoff. Latency is measured from `sent()`, so time spent
+    waiting for a rate-limit slot or a client is not counted. Once a model
+    has `hedge_min_samples` latencies on record, an attempt still running
+    that model's `hedge_quantile` latency after it was sent gets one
+    duplicate request, and whichever finishes first wins; an attempt that
+    has not been sent yet (e.g. queued at the rate governor) is not hedged. Hedges are capped at `hedge_budget` of
+    all calls, since the losing request still spends its tokens. Blocking
+    calls need `executor` (with `executor_workers` threads) to hedge: a call
+    is handed to it only while it has idle workers to spare for the call and
+    a hedge, and otherwise runs unhedged on the caller's thread, so the pool
+    never queues requests or caps throughput. `run_async` hedges on
+    the event loop.
+
+    Fallbacks between models are decided by the caller (the chain is per
+    route) and only recorded here.
+    """
+
+    def __init__(self, executor=None, executor_workers=16, max_attempts=3, base_delay=0.5, max_delay=8.0,
+                 hedge_enabled=True, hedge_quantile=0.95, hedge_min_samples=20,
+                 hedge_min_delay=0.05, hedge_budget=0.05, latency_window=200):
+        self.executor = executor
+        self._idle_workers = executor_workers if executor is not None else 0
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_enabled = hedge_enabled
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_budget = hedge_budget
+        self.latency_window = latency_window
+        self._lock = threading.Lock()
+        self._latencies = {}  # model_name -> _LatencyWindow
+        self._stats = {'calls': 0, 'attempts': 0, 'retries': 0, 'retry_successes': 0,
+                       'hedges': 0, 'hedge_wins': 0, 'hedges_skipped_busy': 0,
+                       'fallbacks': 0, 'fallback_successes': 0}
+        self._fallback_routes = collections.Counter()
+
+    # --- Bookkeeping ---
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _record_latency(self, model_name, seconds):
+        with self._lock:
+            window = self._latencies.get(model_name)
+            if window is None:
+                window = self._latencies[model_name] = _LatencyWindow(self.latency_window, self.hedge_quantile)
+            window.add(seconds)
+
+    def hedge_delay(self, model_name):
+        """Seconds to wait before hedging a call to `model_name`, or None if it should not be hedged."""
+        if not self.hedge_enabled:
+            return None
+        with self._lock:
+            window = self._latencies.get(model_name)
+            if window is None or len(window.samples) < self.hedge_min_samples:
+                return None
+            if self._stats['hedges'] >= self.hedge_budget * self._stats['calls']:
+                return None
+            return max(self.hedge_min_delay, window.value())
+
+    def _reserve_worker(self, keep_free=0):
+        """Claims an idle pool worker, leaving `keep_free` idle; False if they are busy."""
+        with self._lock:
+            if self._idle_workers <= keep_free:
+                self._stats['hedges_skipped_busy'] += 1
+                return False
+            self._idle_workers -= 1
+            return True
+
+    def _release_worker(self, _future=None):
+        with self._lock:
+            self._idle_workers += 1
+
+    def record_fallback(self, route, from_model, to_model, succeeded):
+        with self._lock:
+            self._stats['fallbacks'] += 1
+            if succeeded:
+                self._stats['fallback_successes'] += 1
+            self._fallback_routes[f"{route}:{from_model}>{to_model}"] += 1
+
+    def backoff(self, retry_number):
+        """Full-jitter exponential backoff for the n-th retry (1-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (retry_number - 1))))
+
+    # --- Blocking calls ---
+
+    def run(self, model_name, attempt, hedge=True):
+        """
+        Runs `attempt()` with retries (and hedging unless `hedge` is False).
+
+        Returns the attempt's result or raises its last error. Streamed
+        calls pass hedge=False: a losing stream cannot be recalled, and its
+        time-to-first-chunk says nothing about full-call latency.
+        """
+        self._count('calls')
+        for number in range(1, self.max_attempts + 1):
+            try:
+                result = self._hedged(model_name, attempt) if hedge else self._timed(model_name, attempt, False)
+            except Exception as e:
+                if number == self.max_attempts or not is_transient_error(e):
+                    raise
+                delay = self.backoff(number)
+                log.warning(f"Transient AI error from '{model_name}' (attempt {number}): {e}; retrying in {delay:.2f}s.")
+                self._count('retries')
+                time.sleep(delay)
+                continue
+            if number > 1:
+                self._count('retry_successes')
+            return result
+
+    def _timed(self, model_name, attempt, record=True, on_sent=None):
+        self._count('attempts')
+        sent_at = []
+
+        def sent():
+            sent_at.append(time.monotonic())
+            if on_sent is not None:
+                on_sent()
+
+        result = attempt(sent)
+        if record and sent_at:
+            self._record_latency(model_name, time.monotonic() - sent_at[0])
+        return result
+
+    def _hedged(self, model_name, attempt):
+        delay = self.hedge_delay(model_name) if self.executor is not None else None
+        # A call only goes to the pool while a worker would still be idle for its hedge
+        if delay is None or not self._reserve_worker(keep_free=1):
+            return self._timed(model_name, attempt)
+
+        sent = threading.Event()
+        # Workers run in a copy of this context, so Flask's app context comes along
+        primary = self.executor.submit(contextvars.copy_context().run, self._timed, model_name, attempt,
+                                       True, sent.set)
+        primary.add_done_callback(self._release_worker)
+        primary.add_done_callback(lambda _: sent.set()) # Also wakes us if it fails before sending
+        sent.wait() # The hedge delay counts from when the call is actually sent
+        done, _ = wait([primary], timeout=delay)
+        if done or self.hedge_delay(model_name) is None or not self._reserve_worker():
+            return primary.result()
+
+        log.info(f"AI call to '{model_name}' slower than {delay * 1000:.0f} ms; sending a hedged request.")
+        self._count('hedges')
+        hedge = self.executor.submit(contextvars.copy_context().run, self._timed, model_name, attempt)
+        hedge.add_done_callback(self._release_worker)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count('hedge_wins')
+                    # The other request cannot be recalled; it finishes (and is accounted) on its own
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    # --- asyncio ---
+
+    async def run_async(self, model_name, attempt, hedge=True):
+        """Awaitable run(): `attempt` is a coroutine function; the losing hedge is cancelled."""
+        self._count('calls')
+        for number in range(1, self.max_attempts + 1):
+            try:
+                if hedge:
+                    result = await self._hedged_async(model_name, attempt)
+                else:
+                    result = await self._timed_async(model_name, attempt, False)
+            except Exception as e:
+                if number == self.max_attempts or not is_transient_error(e):
+                    raise
+                delay = self.backoff(number)
+                log.warning(f"Transient AI error from '{model_name}' (attempt {number}): {e}; retrying in {delay:.2f}s.")
+                self._count('retries')
+                await asyncio.sleep(delay)
+                continue
+            if number > 1:
+                self._count('retry_successes')
+            return result
+
+    async def _timed_async(self, model_name, attempt, record=True, on_sent=None):
+        self._count('attempts')
+        sent_at = []
+
+        def sent():
+            sent_at.append(time.monotonic())
+            if on_sent is not None:
+                on_sent()
+
+        result = await attempt(sent)
+        if record and sent_at:
+            self._record_latency(model_name, time.monotonic() - sent_at[0])
+        return result
+
+    async def _hedged_async(self, model_name, attempt):
+        delay = self.hedge_delay(model_name)
+        if delay is None:
+            return await self._timed_async(model_name, attempt)
+
+        sent = asyncio.Event()
+        primary = asyncio.ensure_future(self._timed_async(model_name, attempt, True, sent.set))
+        primary.add_done_callback(lambda _: sent.set())
+        pending = {primary}
+        error = None
+        # Cancelling the caller at any await below cancels whichever calls are still running
+        try:
+            await sent.wait()
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or self.hedge_delay(model_name) is None:
+                return await primary
+
+            self._count('hedges')
+            hedge = asyncio.ensure_future(self._timed_async(model_name, attempt))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['fallback_routes'] = dict(self._fallback_routes)
+            stats['hedge_delay_ms'] = {
+                model: round(window.value() * 1000, 1)
+                for model, window in self._latencies.items()
+                if len(window.samples) >= self.hedge_min_samples
+            }
+        return stats
@@ -1,5 +1,84 @@
-from flask import Blueprint
+import asyncio
+import functools
+
+from flask import Blueprint, current_app, jsonify, request
+
+from ..scheduler import LoadShed
 
 chat_bp = Blueprint('chat', __name__, url_prefix='/api/chat')
 
-from . import chat_routes
\ No newline at end of file
+
+def request_json(silent=False):
+    """The request's JSON body (as `request.json`, or None on errors if `silent`), timed as 'json_parse'."""
+    with current_app.extensions['telemetry'].span('json_parse'):
+        return request.get_json(silent=silent)
+
+
+def retry_later_response(result):
+    """
+    Response for an AI error dict that carries 'retry_after', else None.
+
+    503 when the model's circuit is open ('unavailable'), otherwise 429
+    (rate limited or out of quota); both with a Retry-After header.
+    """
+    retry_after = result.get('retry_after')
+    if retry_after is None:
+        return None
+    response = jsonify({"error": result['error'], "retry_after": retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503 if result.get('unavailable') else 429
+
+
+def chat_workload(data):
+    """Scheduler workload class of a chat request body."""
+    return 'paid_chat' if isinstance(data, dict) and data.get('use_pro_model') else 'free_chat'
+
+
+def scheduled(workload):
+    """
+    Runs a view in a WorkloadScheduler slot of class `workload` (a name, or
+    a function of the JSON body returning one); a rejected request gets 429
+    with Retry-After. Streamed responses hold the slot until they close.
+    Wraps both Flask views and the asyncio handlers served by asgi.py; the
+    latter are admitted by the separate 'async_scheduler', since they hold
+    no worker thread.
+    """
+    def workload_name():
+        return workload(request_json(silent=True)) if callable(workload) else workload
+
+    def shed_response(error):
+        return retry_later_response({'error': str(error), 'retry_after': error.retry_after})
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_view(*args, **kwargs):
+                try:
+                    slot = await current_app.extensions['async_scheduler'].acquire_async(workload_name())
+                except LoadShed as e:
+                    return shed_response(e)
+                with slot:
+                    return await view(*args, **kwargs)
+            return async_view
+
+        @functools.wraps(view)
+        def sync_view(*args, **kwargs):
+            try:
+                slot = current_app.extensions['scheduler'].acquire(workload_name())
+            except LoadShed as e:
+                return shed_response(e)
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                slot.release()
+                raise
+            if response.is_streamed:
+                response.call_on_close(slot.release)
+            else:
+                slot.release()
+            return response
+        return sync_view
+    return decorator
+
+
+from . import chat_routes, image_routes
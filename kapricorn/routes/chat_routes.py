@@ -1,19 +1,42 @@
 # File: kapricorn/routes/chat_routes.py
 
-from flask import request, jsonify, current_app
+from flask import jsonify, current_app, Response, stream_with_context
+import asyncio
+import contextlib
+import functools
+import json
 import logging
-from . import chat_bp  # Import the blueprint
-from ..ai_service import get_chat_response, generate_schedule_data
-from ..prompts import processChats, extract_tags, formatVisualBotResponse, startChats
+from . import chat_bp, request_json, retry_later_response, scheduled, chat_workload  # Import the blueprint
+from ..ai_service import (
+    get_chat_response, generate_schedule_data, stream_chat_response, fit_chat_history,
+    faq_cached_reply, remember_faq_answer,
+)
+from ..ai_service_async import get_chat_response_async
+from ..scheduler import LoadShed
+from ..prompts import processChats, extract_tags, formatVisualBotResponse
+from ..tag_parser import StreamingTagFilter
 
 log = logging.getLogger(__name__)
 
-@chat_bp.route('/', methods=['POST'])
-def handle_chat():
-    """Handles incoming chat messages."""
-    data = request.json
+def _prepare_turn(data):
+    """
+    Validates a chat request body and builds the AI-ready history.
+
+    If the body has a 'conversation_id' key, the history comes from the
+    server-side conversation store instead of the request (a null id starts a
+    new conversation), and any posted 'history' is ignored.
+
+    Returns (turn, None) on success, where turn holds 'history' (with the new
+    user message appended), 'processed_history' (fitted to the model's token
+    budget), 'use_pro_model', 'tokens_trimmed', the session fields and, for
+    a first-turn text-only question, 'faq_question' (else None) with its
+    'context'; or (None, (response, status)) on failure.
+
+    A server-side conversation allows one turn at a time (409 otherwise);
+    callers must call turn['release']() once the turn is saved or abandoned.
+    """
     if not data:
-        return jsonify({"error": "Invalid request: No JSON body found"}), 400
+        return None, (jsonify({"error": "Invalid request: No JSON body found"}), 400)
 
     user_message = data.get('message')
     history = data.get('history', []) # Expecting list of {'role': ..., 'parts': [...]}
@@ -21,41 +44,201 @@ def handle_chat():
     location = data.get('location') # Optional context
     npk = data.get('npk')           # Optional context
     current_date = data.get('date') # Optional context
+    image_ids = data.get('image_ids', []) # Optional, from POST /api/chat/images
 
     if not user_message:
-        return jsonify({"error": "Invalid request: 'message' field is required"}), 400
+        return None, (jsonify({"error": "Invalid request: 'message' field is required"}), 400)
+
+    if not isinstance(image_ids, list):
+        return None, (jsonify({"error": "Invalid request: 'image_ids' must be a list"}), 400)
+    image_store = current_app.extensions['image_store']
+    unknown = [image_id for image_id in image_ids if not image_store.exists(image_id)]
+    if unknown:
+        return None, (jsonify({"error": "Unknown image id(s); upload them first.", "image_ids": unknown}), 400)
+
+    conversation_id = None
+    stored_length = 0
+    release = lambda: None
+    if 'conversation_id' in data:
+        if data['conversation_id'] is not None and not isinstance(data['conversation_id'], str):
+            return None, (jsonify({"error": "Invalid request: 'conversation_id' must be a string or null"}), 400)
+        store = current_app.extensions['conversation_store']
+        conversation_id = data.get('conversation_id') or store.create()
+        if not store.begin_turn(conversation_id):
+            return None, (jsonify({"error": "Another message in this conversation is still being answered."}), 409)
+        release = functools.partial(store.end_turn, conversation_id)
+        history = store.get(conversation_id)
+        if history is None:
+            release()
+            return None, (jsonify({"error": "Conversation not found or expired."}), 404)
+        stored_length = len(history)
+
     if not isinstance(history, list):
-         return jsonify({"error": "Invalid request: 'history' must be a list"}), 400
+         return None, (jsonify({"error": "Invalid request: 'history' must be a list"}), 400)
 
     # Append the current user message to the history before processing
     # Ensure it follows the expected structure
     current_turn = {'role': 'user', 'parts': [user_message]} # Simple text part
+    current_turn['parts'].extend({'image_id': image_id} for image_id in image_ids)
     history.append(current_turn)
 
     # Prepare the history for the AI using processChats
     # processChats adds system context (<g>) and prepends initial bot setup (startChats)
     try:
-        processed_history = processChats(history, npk=npk, location=location, date=current_date)
+        # Older turns beyond the model's token budget are folded into a running summary
+        windowed_history, tokens_trimmed = fit_chat_history(history, use_pro_model, conversation_key=conversation_id)
+        with current_app.extensions['telemetry'].span('process_chats'):
+            processed_history = processChats(windowed_history, npk=npk, location=location, date=current_date)
     except Exception as e:
         log.error(f"Error processing chat history: {e}", exc_info=True)
-        return jsonify({"error": "Internal server error processing chat history"}), 500
+        release()
+        return None, (jsonify({"error": "Internal server error processing chat history"}), 500)
 
-    # Call the AI service to get the response
-    ai_result = get_chat_response(processed_history, use_pro_model)
+    return {
+        'history': history,
+        'processed_history': processed_history,
+        'use_pro_model': use_pro_model,
+        'conversation_id': conversation_id,
+        'stored_length': stored_length,
+        'tokens_trimmed': tokens_trimmed,
+        # Only first turns are free of earlier context, so only they can share answers
+        'faq_question': user_message if len(history) == 1 and not image_ids and isinstance(user_message, str) else None,
+        'context': {'location': location, 'npk': npk, 'date': current_date},
+        'release': release,
+    }, None
 
-    if 'error' in ai_result:
-        log.error(f"AI service returned error: {ai_result['error']}")
-        # Provide a generic error to the frontend, but log the specific one
-        return jsonify({"error": "Failed to get response from AI service."}), 500
 
+def _generate_visuals(gen_tag_content, admit=True):
+    """
+    Runs VisualsBot for a <gen> tag, in a 'visuals' scheduler slot if
+    `admit` (background jobs); inline visuals run in their chat turn's slot,
+    so a turn never waits for a second admission while holding the first.
+
+    Returns {'visuals_data', 'history_messages', 'error', token fields,
+    '_visuals_cached'}, where history_messages is the system notice +
+    acknowledgement pair to append after the model's turn (success or
+    failure).
+    """
+    try:
+        with current_app.extensions['scheduler'].slot('visuals') if admit else contextlib.nullcontext(), \
+                current_app.extensions['telemetry'].span('generate_schedule_data'):
+            schedule_result = generate_schedule_data(gen_tag_content)
+    except LoadShed as e:
+        schedule_result = {'error': str(e)}
+
+    if 'error' in schedule_result:
+        log.error(f"Failed to generate schedule data: {schedule_result['error']}")
+        # Inform the user the generation failed via a system message in history
+        system_error_msg = f"<g>System: Failed to generate the requested visual data. Error: {schedule_result['error']}. Please continue the conversation.</g>"
+        user_msg_part, bot_msg_part, _ = formatVisualBotResponse(system_error_msg) # Use formatVisualBotResponse to structure it
+        visuals_data = None
+        error = schedule_result['error']
+    else:
+        log.info("Successfully generated schedule data.")
+        visuals_data = schedule_result # This is the parsed JSON data
+        # Add system message indicating success to history
+        system_success_msg = f"<g>System: Visual data generated successfully. Displaying now. You can ask follow-up questions.</g>"
+        user_msg_part, bot_msg_part, _ = formatVisualBotResponse(system_success_msg) # Use formatter
+        error = None
+
+    result = {
+        "visuals_data": visuals_data,
+        "error": error,
+        "history_messages": [
+            {'role': 'user', 'parts': [user_msg_part]}, # System message framed as user input for next turn
+            {'role': 'model', 'parts': [bot_msg_part]}, # Oscar acknowledging the system message
+        ],
+    }
+    if visuals_data and isinstance(visuals_data, dict):
+         result["_visuals_input_tokens"] = visuals_data.pop('_visuals_input_tokens', 0)
+         result["_visuals_output_tokens"] = visuals_data.pop('_visuals_output_tokens', 0)
+         result["_visuals_cached"] = visuals_data.pop('_cache_hit', False) # Set by the schedule cache
+    return result
+
+
+def _start_visuals_job(gen_tag_content, conversation_id):
+    """
+    Queues VisualsBot generation in the background and returns the job id.
+
+    For server-side conversations the system messages are appended to the
+    stored transcript when the job finishes; otherwise the client appends the
+    'history_messages' it receives from the poll endpoint.
+    """
+    def reconcile_history(job):
+        if conversation_id is None or job.result is None:
+            return
+        store = current_app.extensions['conversation_store']
+        if not store.append(conversation_id, job.result['history_messages']):
+            log.warning(f"Conversation {conversation_id} expired before visuals job {job.id} finished.")
+
+    jobs = current_app.extensions['job_manager']
+    job = jobs.submit('visuals', _generate_visuals, gen_tag_content, on_complete=reconcile_history)
+    log.info(f"Queued visuals job {job.id} for <gen> request.")
+    return job.id
+
+
+def _finalize_payload(turn, payload):
+    """
+    Persists the turn for server-side conversations and starts deferred work.
+
+    In session mode the full history is not sent back; the client gets the
+    conversation id and only the messages added by this turn. A pending
+    <gen> request is queued only after the turn is saved, so its system
+    messages always land after the model's reply.
+    """
+    pending_gen = payload.pop('_pending_gen', None)
+    conversation_id = turn['conversation_id']
+    payload['_context_tokens_trimmed'] = turn['tokens_trimmed']
+
+    if conversation_id is not None:
+        new_messages = payload.pop('history')[turn['stored_length']:]
+        store = current_app.extensions['conversation_store']
+        if not store.append(conversation_id, new_messages):
+            log.warning(f"Conversation {conversation_id} expired before the turn could be saved.")
+        payload['conversation_id'] = conversation_id
+        payload['new_messages'] = new_messages
+
+    if pending_gen:
+        payload['visuals_job_id'] = _start_visuals_job(pending_gen, conversation_id)
+    return payload
+
+
+def _faq_reply(turn):
+    """A cached reply from the semantic FAQ cache for an eligible first turn, or None."""
+    if turn['faq_question'] is None:
+        return None
+    return faq_cached_reply(turn['faq_question'], turn['processed_history'], turn['use_pro_model'], turn['context'])
+
+
+def _answer_turn(turn, ai_result):
+    """
+    _complete_turn + _finalize_payload, caching eligible first-turn replies
+    in (or reporting hits from) the semantic FAQ cache.
+    """
+    payload = _complete_turn(turn['history'], ai_result)
+    if ai_result.get('faq_hit'):
+        payload['_faq_cache_hit'] = ai_result['faq_hit']
+    elif turn['faq_question'] is not None and 'error' not in payload:
+        remember_faq_answer(turn['faq_question'], turn['use_pro_model'], turn['context'], ai_result.get('text'))
+    return _finalize_payload(turn, payload)
+
+
+def _complete_turn(history, ai_result):
+    """
+    Parses the model's tagged reply, handles any <gen> request and updates history.
+
+    Returns the response payload dict (response, history, classification,
+    visuals_data and token fields). With VISUALS_ASYNC the <gen> request is
+    only recorded ('_pending_gen') for _finalize_payload to queue; otherwise
+    it runs inline. A tag parsing failure yields a payload carrying the raw
+    text and an 'error' flag.
+    """
     ai_raw_text = ai_result.get('text')
-    if not ai_raw_text:
-        log.error("AI service returned empty text response.")
-        return jsonify({"error": "AI service returned an empty response."}), 500
 
     # --- Parse AI response for tags ---
     try:
-        extracted = extract_tags(ai_raw_text) # Default tags: ['p', 'g', 'r', 'gr', 'cls', 'gen']
+        with current_app.extensions['telemetry'].span('extract_tags'):
+            extracted = extract_tags(ai_raw_text) # Default tags: ['p', 'g', 'r', 'gr', 'cls', 'gen']
         ai_response_text = extracted.get('r') # Get the primary response content
         gen_tag_content = extracted.get('gen')
         classification = extracted.get('cls')
@@ -66,61 +249,237 @@ def handle_chat():
         log.error(f"Error parsing AI response tags: {e}\nRaw Text: {ai_raw_text[:200]}...", exc_info=True)
         # Still try to return the raw text if parsing fails, but add it to history
         history.append({'role': 'model', 'parts': [f"[System Error: Could not parse AI tags] {ai_raw_text}"]})
-        return jsonify({
+        return {
             "response": ai_raw_text, # Send raw text back
             "history": history, # Include the errored response in history
             "classification": None,
             "error": "Error parsing AI response format." # Add an error flag
-            }), 200 # Return 200 but indicate parsing error
-
-
-    # --- Handle <gen> tag if present ---
-    visuals_data = None
-    if gen_tag_content:
-        log.info(f"Detected <gen> tag. Requesting schedule data: {gen_tag_content}")
-        schedule_result = generate_schedule_data(gen_tag_content)
-
-        if 'error' in schedule_result:
-            log.error(f"Failed to generate schedule data: {schedule_result['error']}")
-            # Inform the user the generation failed via a system message in history
-            system_error_msg = f"<g>System: Failed to generate the requested visual data. Error: {schedule_result['error']}. Please continue the conversation.</g>"
-            user_msg_part, bot_msg_part, _ = formatVisualBotResponse(system_error_msg) # Use formatVisualBotResponse to structure it
-
-            # Append original model response (acknowledgment) + system error message
-            history.append(model_full_response_part) # Oscar's original "<r> Generating..."
-            history.append({'role': 'user', 'parts': [user_msg_part]}) # System message framed as user input for next turn
-            history.append({'role': 'model', 'parts': [bot_msg_part]}) # Oscar acknowledging the system message
-            # Fall through to return the original AI response text ('<r>')
-        else:
-            log.info("Successfully generated schedule data.")
-            visuals_data = schedule_result # This is the parsed JSON data
-            # Add system message indicating success to history
-            system_success_msg = f"<g>System: Visual data generated successfully. Displaying now. You can ask follow-up questions.</g>"
-            user_msg_part, bot_msg_part, _ = formatVisualBotResponse(system_success_msg) # Use formatter
-
-            # Append original model response + system success message
-            history.append(model_full_response_part) # Oscar's original "<r> Generating..."
-            history.append({'role': 'user', 'parts': [user_msg_part]})
-            history.append({'role': 'model', 'parts': [bot_msg_part]})
-            # The visuals_data will be returned in the main JSON response
-    else:
-        # No <gen> tag, just append the normal AI response to history
-        history.append(model_full_response_part)
+            }
 
+    # Oscar's response (an acknowledgment like "<r> Generating..." when <gen> is used)
+    history.append(model_full_response_part)
 
     # --- Prepare final response ---
     response_payload = {
         "response": ai_response_text or "...", # Use <r> content, fallback if missing
         "history": history, # Return the updated history
         "classification": classification,
-        "visuals_data": visuals_data # Will be null if <gen> wasn't processed or failed gracefully
+        "visuals_data": None, # Set if <gen> was processed inline
+        "visuals_job_id": None # Set if <gen> was queued in the background
     }
 
     # Add token info for potential debugging/tracking on frontend if needed
     response_payload["_input_tokens"] = ai_result.get('input_tokens', 0)
     response_payload["_output_tokens"] = ai_result.get('output_tokens', 0)
-    if visuals_data and isinstance(visuals_data, dict):
-         response_payload["_visuals_input_tokens"] = visuals_data.pop('_visuals_input_tokens', 0)
-         response_payload["_visuals_output_tokens"] = visuals_data.pop('_visuals_output_tokens', 0)
+    if ai_result.get('fallback_model'):
+        response_payload["_fallback_model"] = ai_result['fallback_model'] # Primary model was overloaded
+
+    # --- Handle <gen> tag if present ---
+    if gen_tag_content:
+        log.info(f"Detected <gen> tag. Requesting schedule data: {gen_tag_content}")
+        if current_app.config.get('VISUALS_ASYNC', True):
+            # Chat latency no longer includes VisualsBot; the client polls for the result
+            response_payload['_pending_gen'] = gen_tag_content
+        else:
+            visuals = _generate_visuals(gen_tag_content, admit=False)
+            history.extend(visuals['history_messages'])
+            response_payload["visuals_data"] = visuals['visuals_data']
+            if visuals['visuals_data'] is not None:
+                response_payload["_visuals_input_tokens"] = visuals.get('_visuals_input_tokens', 0)
+                response_payload["_visuals_output_tokens"] = visuals.get('_visuals_output_tokens', 0)
+                response_payload["_visuals_cached"] = visuals.get('_visuals_cached', False)
+
+    return response_payload
+
+
+@chat_bp.route('/', methods=['POST'])
+@scheduled(chat_workload)
+def handle_chat():
+    """Handles incoming chat messages."""
+    turn, error_response = _prepare_turn(request_json())
+    if error_response:
+        return error_response
+    try:
+        return _chat_reply(turn)
+    finally:
+        turn['release']()
+
+
+def _chat_reply(turn):
+    # Call the AI service to get the response (unless a cached FAQ answer fits)
+    ai_result = _faq_reply(turn) or get_chat_response(turn['processed_history'], turn['use_pro_model'])
+
+    if 'error' in ai_result:
+        log.error(f"AI service returned error: {ai_result['error']}")
+        # Provide a generic error to the frontend, but log the specific one
+        return retry_later_response(ai_result) or (
+            jsonify({"error": "Failed to get response from AI service."}), 500)
+
+    if not ai_result.get('text'):
+        log.error("AI service returned empty text response.")
+        return jsonify({"error": "AI service returned an empty response."}), 500
+
+    payload = _answer_turn(turn, ai_result)
+    return jsonify(payload), 200
+
+
+@scheduled(chat_workload)
+async def handle_chat_async():
+    """
+    asyncio version of handle_chat, served natively by asgi.py.
+
+    Only the model call is awaited; turn preparation (which may summarize
+    history or hit the conversation database) and inline visuals run on
+    worker threads so the event loop is never blocked.
+    """
+    turn, error_response = await asyncio.to_thread(_prepare_turn, request_json(silent=True))
+    if error_response:
+        return error_response
+    try:
+        return await _chat_reply_async(turn)
+    finally:
+        turn['release']()
+
+
+async def _chat_reply_async(turn):
+    # A hit may need a personalization call, so the lookup runs on a worker thread
+    ai_result = (await asyncio.to_thread(_faq_reply, turn)
+                 or await get_chat_response_async(turn['processed_history'], turn['use_pro_model']))
+
+    if 'error' in ai_result:
+        log.error(f"AI service returned error: {ai_result['error']}")
+        return retry_later_response(ai_result) or (
+            jsonify({"error": "Failed to get response from AI service."}), 500)
+
+    if not ai_result.get('text'):
+        log.error("AI service returned empty text response.")
+        return jsonify({"error": "AI service returned an empty response."}), 500
+
+    # Transcript writes (and, without VISUALS_ASYNC, the visuals call) block; keep them off the event loop
+    payload = await asyncio.to_thread(_answer_turn, turn, ai_result)
+    return jsonify(payload), 200
+
+
+def _sse(event, payload):
+    """Formats one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@chat_bp.route('/stream', methods=['POST'])
+@scheduled(chat_workload)
+def handle_chat_stream():
+    """
+    Streams the chat reply as Server-Sent Events.
+
+    'chunk' events carry visible <r> text as it arrives; tags meant for the
+    system (<g>, <gr>, <cls>, <gen>) are hidden. A final 'done' event carries
+    the same payload as the blocking endpoint, or an 'error' event is sent
+    instead. The stream ends after 'done'; if the reply queued a visuals job,
+    the client polls /api/chat/visuals/<visuals_job_id> for it, so no worker
+    thread is held while VisualsBot runs.
+    """
+    turn, error_response = _prepare_turn(request_json())
+    if error_response:
+        return error_response
+
+    def generate():
+        tag_filter = StreamingTagFilter()
+        cached = _faq_reply(turn)
+        if cached is not None:
+            events = [('chunk', cached['text']), ('done', cached)]
+        else:
+            events = stream_chat_response(turn['processed_history'], turn['use_pro_model'])
+        for kind, value in events:
+            if kind == 'chunk':
+                visible = tag_filter.feed(value)
+                if visible:
+                    yield _sse('chunk', {'text': visible})
+            elif kind == 'error':
+                log.error(f"AI service returned error while streaming: {value}")
+                yield _sse('error', {'error': "Failed to get response from AI service."})
+                return
+            else:
+                visible = tag_filter.flush()
+                if visible:
+                    yield _sse('chunk', {'text': visible})
+                payload = _answer_turn(turn, value)
+                turn['release']()
+                yield _sse('done', payload)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+    response.call_on_close(turn['release']) # Errors and client disconnects end the turn too
+    return response
+
+
+@chat_bp.route('/conversations/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id):
+    """Returns a stored conversation transcript (e.g. after an app reload)."""
+    history = current_app.extensions['conversation_store'].get(conversation_id)
+    if history is None:
+        return jsonify({"error": "Conversation not found or expired."}), 404
+    return jsonify({"conversation_id": conversation_id, "history": history}), 200
+
+
+@chat_bp.route('/conversations/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    """Deletes a stored conversation."""
+    if not current_app.extensions['conversation_store'].delete(conversation_id):
+        return jsonify({"error": "Conversation not found or expired."}), 404
+    return jsonify({"deleted": conversation_id}), 200
+
+
+@chat_bp.route('/context/stats', methods=['GET'])
+def context_window_stats():
+    """Tokens trimmed from chat histories and rolling summary counters."""
+    window = current_app.extensions.get('context_window')
+    if window is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(window.stats(), enabled=True)), 200
+
+
+@chat_bp.route('/faq/stats', methods=['GET'])
+def faq_cache_stats():
+    """Semantic FAQ cache hit rate and eviction counters, plus the most recent false-hit audits."""
+    cache = current_app.extensions.get('faq_cache')
+    if cache is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(cache.stats(), enabled=True, audits=cache.audit_log())), 200
+
+
+@chat_bp.route('/faq/<int:entry_id>', methods=['DELETE'])
+def report_faq_false_hit(entry_id):
+    """Evicts a cached FAQ answer reported as a false hit (the '_faq_cache_hit' entry_id of a reply)."""
+    cache = current_app.extensions.get('faq_cache')
+    if cache is None or not cache.remove(entry_id, reported=True):
+        return jsonify({"error": "FAQ entry not found."}), 404
+    return jsonify({"deleted": entry_id}), 200
+
+
+@chat_bp.route('/ratelimit/stats', methods=['GET'])
+def rate_limit_stats():
+    """Per-key (by fingerprint) upstream rate, concurrency, queue depth and wait times."""
+    governor = current_app.extensions['rate_governor']
+    return jsonify({"enabled": governor.enabled, "keys": governor.stats()}), 200
+
+
+@chat_bp.route('/resilience/stats', methods=['GET'])
+def resilience_stats():
+    """Retry, hedge and model-fallback counters, and each model's current hedge delay."""
+    return jsonify(current_app.extensions['resilience'].stats()), 200
+
+
+@chat_bp.route('/visuals/<job_id>', methods=['GET'])
+def get_visuals(job_id):
+    """
+    Polls a background visuals job.
 
-    return jsonify(response_payload), 200
\ No newline at end of file
+    Returns 202 while it is still running. Once finished, 'result' holds
+    'visuals_data' (null on failure) and the 'history_messages' a client
+    holding its own history should append.
+    """
+    job = current_app.extensions['job_manager'].get(job_id)
+    if job is None:
+        return jsonify({"error": "Visuals job not found or expired."}), 404
+    status_code = 200 if job.wait(0) else 202
+    return jsonify(job.to_dict()), status_code
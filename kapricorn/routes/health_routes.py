@@ -0,0 +1,76 @@
+# File: kapricorn/routes/health_routes.py
+
+from flask import jsonify, Blueprint, current_app, Response
+import logging
+
+log = logging.getLogger(__name__)
+
+health_bp = Blueprint('health', __name__)
+
+# app.extensions entries whose stats() are reported alongside the breakers
+_COMPONENTS = (
+    ('scheduler', 'scheduler'),
+    ('async_scheduler', 'async_scheduler'),
+    ('rate_limits', 'rate_governor'),
+    ('resilience', 'resilience'),
+    ('model_registry', 'model_registry'),
+    ('single_flight', 'single_flight'),
+    ('prompt_cache', 'prompt_cache'),
+    ('tokens', 'token_accountant'),
+    ('jobs', 'job_manager'),
+    ('conversations', 'conversation_store'),
+    ('recommendation_cache', 'recommendation_cache'),
+    ('schedule_cache', 'schedule_cache'),
+    ('faq_cache', 'faq_cache'),
+    ('context_window', 'context_window'),
+    ('images', 'image_store'),
+    ('telemetry', 'telemetry'),
+)
+
+
+def _component_stats():
+    components = {}
+    for name, extension in _COMPONENTS:
+        component = current_app.extensions.get(extension)
+        if component is None:
+            continue
+        try:
+            components[name] = component.stats()
+        except Exception as e: # e.g. the conversation database is down
+            log.error(f"Health check could not read {name} stats: {e}", exc_info=True)
+            components[name] = {'error': str(e)}
+    return components
+
+
+@health_bp.route('/health', methods=['GET'])
+def health():
+    """
+    Service health for load balancers and dashboards.
+
+    'status' is 'ok' while every model/key circuit is closed, 'degraded' when
+    some are open or half-open, and 'unavailable' (HTTP 503) when all of the
+    circuits seen so far are open. 'circuits' has each breaker's state,
+    window error/slow rates and Retry-After; 'components' the internal
+    counters of the caches, pools and limiters.
+    """
+    breakers = current_app.extensions['circuit_breakers']
+    circuits = breakers.stats()
+    not_closed = [state for state in circuits.values() if state['state'] != 'closed']
+    if circuits and all(state['state'] == 'open' for state in circuits.values()):
+        status, status_code = 'unavailable', 503
+    elif not_closed:
+        status, status_code = 'degraded', 200
+    else:
+        status, status_code = 'ok', 200
+    return jsonify({
+        "status": status,
+        "circuits": circuits,
+        "components": _component_stats(),
+    }), status_code
+
+
+@health_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Request-stage and model-call latency histograms and token counters, in Prometheus text format."""
+    return Response(current_app.extensions['telemetry'].render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,61 @@
+# File: kapricorn/routes/image_routes.py
+
+from flask import request, jsonify, current_app, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
+import logging
+from . import chat_bp
+from ..images import ImageRejected, ImageTooLarge, STORED_MIME_TYPE
+
+log = logging.getLogger(__name__)
+
+
+def _allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config.get('ALLOWED_EXTENSIONS', set())
+
+
+@chat_bp.route('/images', methods=['POST'])
+def upload_images():
+    """
+    Stores one or more images sent as multipart/form-data field(s) 'image'.
+
+    Returns the stored image descriptions; chat turns then reference them
+    with 'image_ids' (or {'image_id': ...} parts in history) instead of
+    embedding base64 data, and the server attaches the bytes when calling
+    the model.
+    """
+    max_bytes = current_app.config.get('IMAGE_MAX_UPLOAD_BYTES', 10 * 1024 * 1024)
+    too_large = (jsonify({"error": f"Upload too large (max {max_bytes} bytes)."}), 413)
+    # Also bounds chunked uploads, which carry no Content-Length
+    request.max_content_length = max_bytes
+    try:
+        uploads = request.files.getlist('image')
+    except RequestEntityTooLarge:
+        return too_large
+    if not uploads:
+        return jsonify({"error": "Invalid request: no 'image' file in the form data"}), 400
+
+    store = current_app.extensions['image_store']
+    images = []
+    for upload in uploads:
+        if not upload.filename or not _allowed_file(upload.filename):
+            return jsonify({"error": f"File type not allowed: '{upload.filename}'"}), 400
+        try:
+            images.append(store.save(upload.stream))
+        except ImageTooLarge:
+            return too_large
+        except ImageRejected as e:
+            log.warning(f"Rejected image upload '{upload.filename}': {e}")
+            return jsonify({"error": f"Invalid image '{upload.filename}'."}), 400
+
+    return jsonify({"images": images}), 201
+
+
+@chat_bp.route('/images/<image_id>', methods=['GET'])
+def get_image(image_id):
+    """Returns the stored (downscaled) image, e.g. to redraw a conversation."""
+    path = current_app.extensions['image_store'].path(image_id)
+    if path is None:
+        return jsonify({"error": "Image not found."}), 404
+    response = send_file(path, mimetype=STORED_MIME_TYPE, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' # Content-addressed
+    return response
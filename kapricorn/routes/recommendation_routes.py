@@ -1,50 +1,163 @@
 # File: kapricorn/routes/recommendation_routes.py
 
-from flask import request, jsonify, Blueprint
+from flask import jsonify, Blueprint, current_app, Response, stream_with_context
+import collections
+import json
 import logging
-from ..ai_service import get_recommendations
+import time
+from ..ai_service import get_recommendations, get_batch_recommendations
+from ..ai_service_async import get_recommendations_async
+from . import request_json, retry_later_response, scheduled
 
 log = logging.getLogger(__name__)
 
 # Create a new Blueprint for recommendation routes
 recommend_bp = Blueprint('recommend', __name__, url_prefix='/api/recommend')
 
-@recommend_bp.route('/crops', methods=['POST'])
-def crop_recommendations():
-    """Endpoint to get crop recommendations based on location."""
-    data = request.json
+def _requested_location(data):
+    """Returns (location, None) or (None, error_response)."""
     if not data:
-        return jsonify({"error": "Invalid request: No JSON body found"}), 400
+        return None, (jsonify({"error": "Invalid request: No JSON body found"}), 400)
 
     location = data.get('location')
     if not location or not isinstance(location, str) or not location.strip():
-        return jsonify({"error": "Invalid request: 'location' field (string) is required"}), 400
+        return None, (jsonify({"error": "Invalid request: 'location' field (string) is required"}), 400)
 
     log.info(f"Received crop recommendation request for location: {location}")
+    return location.strip(), None
 
-    try:
-        result = get_recommendations(location.strip())
-
-        if 'error' in result:
-            log.error(f"Recommendation service returned error: {result['error']}")
-            # Determine status code based on error if possible, default 500
-            status_code = 500
-            if "not configured" in result['error']:
-                 status_code = 503 # Service Unavailable
-            return jsonify({"error": result['error']}), status_code
-        else:
-            # Extract token info before sending
-            input_tokens = result.pop('_total_input_tokens', 0)
-            output_tokens = result.pop('_total_output_tokens', 0)
-
-            log.info(f"Successfully generated recommendations. Input Tokens: {input_tokens}, Output Tokens: {output_tokens}")
-            # The result is already the dictionary of crops {crop: {details...}}
-            return jsonify({
-                "recommendations": result,
-                "_input_tokens": input_tokens,
-                "_output_tokens": output_tokens
-                }), 200
 
+def _requested_locations(data):
+    """Returns (locations, None) or (None, error_response) for a batch request body."""
+    locations = data.get('locations') if isinstance(data, dict) else None
+    if not isinstance(locations, list) or not locations:
+        return None, (jsonify({"error": "Invalid request: 'locations' field (non-empty list of strings) is required"}), 400)
+    if not all(isinstance(location, str) and location.strip() for location in locations):
+        return None, (jsonify({"error": "Invalid request: every location must be a non-empty string"}), 400)
+    limit = current_app.config.get('RECOMMENDATION_BATCH_MAX_LOCATIONS', 500)
+    if len(locations) > limit:
+        return None, (jsonify({"error": f"Invalid request: at most {limit} locations per batch"}), 400)
+
+    log.info(f"Received batch crop recommendation request for {len(locations)} locations")
+    return [location.strip() for location in locations], None
+
+
+def _recommendations_payload(result):
+    """
+    The JSON body fields for a successful get_recommendations result;
+    "_partial" is true when some crops could not be formatted.
+    """
+    input_tokens = result.pop('_total_input_tokens', 0)
+    output_tokens = result.pop('_total_output_tokens', 0)
+    cache_hit = result.pop('_cache_hit', False)
+    partial = result.pop('_partial', False)
+    return {
+        "recommendations": result,
+        "_input_tokens": input_tokens,
+        "_output_tokens": output_tokens,
+        "_cached": cache_hit,
+        "_partial": partial
+    }
+
+
+def _recommendations_response(result):
+    """Builds the endpoint response from a get_recommendations result."""
+    if 'error' in result:
+        log.error(f"Recommendation service returned error: {result['error']}")
+        throttled = retry_later_response(result)
+        if throttled:
+            return throttled
+        # Determine status code based on error if possible, default 500
+        status_code = 500
+        if "not configured" in result['error']:
+             status_code = 503 # Service Unavailable
+        return jsonify({"error": result['error']}), status_code
+
+    # The result is already the dictionary of crops {crop: {details...}}
+    payload = _recommendations_payload(result)
+    log.info(f"Successfully generated recommendations. Input Tokens: {payload['_input_tokens']}, Output Tokens: {payload['_output_tokens']}")
+    return jsonify(payload), 200
+
+
+@recommend_bp.route('/crops', methods=['POST'])
+@scheduled('recommendations')
+def crop_recommendations():
+    """Endpoint to get crop recommendations based on location."""
+    location, error_response = _requested_location(request_json())
+    if error_response:
+        return error_response
+
+    try:
+        return _recommendations_response(get_recommendations(location))
     except Exception as e:
         log.exception(f"Unexpected error during crop recommendation for location '{location}': {e}") # Log full traceback
-        return jsonify({"error": "An unexpected internal server error occurred."}), 500
\ No newline at end of file
+        return jsonify({"error": "An unexpected internal server error occurred."}), 500
+
+
+@scheduled('recommendations')
+async def crop_recommendations_async():
+    """asyncio version of crop_recommendations, served natively by asgi.py."""
+    location, error_response = _requested_location(request_json(silent=True))
+    if error_response:
+        return error_response
+
+    try:
+        return _recommendations_response(await get_recommendations_async(location))
+    except Exception as e:
+        log.exception(f"Unexpected error during crop recommendation for location '{location}': {e}")
+        return jsonify({"error": "An unexpected internal server error occurred."}), 500
+
+
+@recommend_bp.route('/crops/batch', methods=['POST'])
+@scheduled('recommendations')
+def crop_recommendations_batch():
+    """
+    Crop recommendations for many locations, streamed as NDJSON.
+
+    Body: {"locations": [...]}. Locations that normalize alike are answered
+    once. Each distinct location gets one line as soon as it is ready, cache
+    hits first: {"location", "requested_as", "recommendations", "_cached",
+    "_partial", "_input_tokens", "_output_tokens"}, or {"location",
+    "requested_as", "error"} (plus "retry_after" when throttled). A final
+    {"summary"} line counts the outcomes.
+    """
+    locations, error_response = _requested_locations(request_json())
+    if error_response:
+        return error_response
+
+    def generate():
+        started = time.perf_counter()
+        outcomes = collections.Counter()
+        results = get_batch_recommendations(locations)
+        try:
+            for location, requested_as, result in results:
+                line = {"location": location, "requested_as": requested_as}
+                if 'error' in result:
+                    log.warning(f"Batch recommendation for '{location}' failed: {result['error']}")
+                    line["error"] = result['error']
+                    if result.get('retry_after') is not None:
+                        line["retry_after"] = result['retry_after']
+                    outcomes['failed'] += 1
+                else:
+                    line.update(_recommendations_payload(result))
+                    outcomes['cached' if line['_cached'] else 'generated'] += 1
+                yield json.dumps(line) + '\n'
+        finally:
+            results.close() # On a disconnect, stops the packs not yet started
+        yield json.dumps({"summary": {
+            "requested": len(locations),
+            "unique": sum(outcomes.values()),
+            "cached": outcomes['cached'],
+            "generated": outcomes['generated'],
+            "failed": outcomes['failed'],
+            "elapsed_ms": round((time.perf_counter() - started) * 1000),
+        }}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@recommend_bp.route('/cache/stats', methods=['GET'])
+def recommendation_cache_stats():
+    """Hit/miss counters for the recommendation cache."""
+    return jsonify(current_app.extensions['recommendation_cache'].stats()), 200
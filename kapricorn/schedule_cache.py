@@ -0,0 +1,166 @@
+# File: kapricorn/schedule_cache.py
+
+import copy
+import datetime
+import logging
+import re
+import threading
+import unicodedata
+
+from .cache import TieredCache, normalize_location
+
+log = logging.getLogger(__name__)
+
+_ISO_DATE = re.compile(r'\b(\d{4})-(\d{2})-(\d{2})\b')
+_NPK_VALUE = re.compile(r'\b([NPK])\s*[:=]?\s*(\d+(?:\.\d+)?)', re.IGNORECASE)
+# A bare N-P-K triplet: '20-15-10', 'N-P-K: 20/15/10', '20, 15, 10'
+_NPK_TRIPLET = re.compile(r'(\d+(?:\.\d+)?)\s*[-/:,\s]\s*(\d+(?:\.\d+)?)\s*[-/:,\s]\s*(\d+(?:\.\d+)?)')
+# No reading at all: '', 'N/A', 'none', 'unknown', ...
+_NPK_MISSING = re.compile(r'^\W*(?:n/?a|none|nil|unknown|not available|no (?:npk )?readings?)?\W*$', re.IGNORECASE)
+
+
+def parse_gen_tag(gen_tag_content):
+    """(crop, generation_type, location, date, npk) from a <gen> tag's pipe-delimited content; raises ValueError."""
+    parts = (gen_tag_content or '').split('|')
+    if len(parts) != 5:
+        raise ValueError(f"Expected 5 parts in <gen> tag, got {len(parts)}")
+    return tuple(part.strip() for part in parts)
+
+
+def normalize_crop(crop):
+    """'Sweet Potatoes' / 'sweet potato.' -> 'sweet potato'."""
+    text = unicodedata.normalize('NFKD', crop or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    words = re.sub(r'[^\w\s-]', ' ', text).split()
+    if words:
+        last = words[-1]
+        if last.endswith('oes'):
+            words[-1] = last[:-2]
+        elif last.endswith('s') and not last.endswith('ss') and len(last) > 3:
+            words[-1] = last[:-1]
+    return ' '.join(words)
+
+
+def npk_band(npk, band_width):
+    """
+    Quantized NPK readings, e.g. 'N:42,P:18,K:20' or '42-18-20' -> 'n4-p1-k2'
+    for a band width of 10.
+
+    'npk-unknown' when there is no reading ('', 'N/A'); None when the text
+    holds readings in a form that cannot be read, so it is not cached.
+    """
+    npk = npk or ''
+    if _NPK_MISSING.match(npk):
+        return 'npk-unknown'
+    values = {}
+    for nutrient, value in _NPK_VALUE.findall(npk):
+        values.setdefault(nutrient.lower(), float(value))
+    if len(values) < 3:
+        # 'N-P-K: 20-15-10' carries its values unlabelled ('K: 20' alone would be misread)
+        triplet = _NPK_TRIPLET.search(npk)
+        if triplet:
+            values = dict(zip('npk', (float(value) for value in triplet.groups())))
+    if not values:
+        return None
+    return '-'.join(f"{nutrient}{int(values[nutrient] // band_width)}" if nutrient in values else f"{nutrient}?"
+                    for nutrient in 'npk')
+
+
+def shift_dates(value, days):
+    """Copy of a schedule with every ISO date (YYYY-MM-DD) in its strings moved by `days`."""
+    if isinstance(value, dict):
+        return {key: shift_dates(item, days) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shift_dates(item, days) for item in value]
+    if isinstance(value, str) and days:
+        return _ISO_DATE.sub(lambda match: _shift_match(match, days), value)
+    return value
+
+
+def _shift_match(match, days):
+    try:
+        date = datetime.date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    except ValueError:
+        return match.group(0)
+    return (date + datetime.timedelta(days=days)).isoformat()
+
+
+class ScheduleCache:
+    """
+    Cross-user cache of VisualsBot timelines and checkup schedules.
+
+    A "Maize|timeline|Ibadan|2025-04-03|N:20,P:15,K:10" request is nearly the
+    same for every farmer near Ibadan planting maize that fortnight, so
+    schedules are keyed on the normalized crop, generation type and
+    location, the request date's `bucket_days` season bucket (day of year)
+    and NPK readings quantized into `npk_band_width` bands. A cached
+    template is date-shifted by the days between its request date and the
+    requester's, and its query echo is rewritten to the requester's fields.
+    Descriptive dates ("mid-April") are left as written.
+
+    Entries live in a TieredCache (TTL + LRU eviction, optional persistent
+    tier). Requests whose date or NPK readings cannot be parsed are not
+    cached.
+    """
+
+    def __init__(self, max_entries=5000, ttl_seconds=30 * 86400, database_url=None,
+                 bucket_days=14, npk_band_width=10):
+        self.store = TieredCache(max_entries=max_entries, ttl_seconds=ttl_seconds,
+                                 database_url=database_url, table_name='schedule_cache')
+        self.bucket_days = max(1, bucket_days)
+        self.npk_band_width = max(1, npk_band_width)
+        self._lock = threading.Lock()
+        self.uncacheable = 0
+        self.stored = 0
+
+    def key_for(self, fields):
+        """(cache key, request date) for parsed <gen> fields, or (None, None) if the date or NPK is unusable."""
+        crop, generation_type, location, date_text, npk = fields
+        try:
+            date = datetime.date.fromisoformat(date_text[:10])
+        except ValueError:
+            return None, None
+        band = npk_band(npk, self.npk_band_width)
+        if band is None:
+            return None, None
+        season = (date.timetuple().tm_yday - 1) // self.bucket_days
+        kind = re.sub(r'[\s-]+', '_', generation_type.strip().lower())
+        key = '|'.join((normalize_crop(crop), kind, normalize_location(location), f"s{season}", band))
+        return key, date
+
+    def lookup(self, fields):
+        """The cached schedule adapted to `fields` (a fresh copy, with '_cache_hit'), or None."""
+        key, date = self.key_for(fields)
+        if key is None:
+            with self._lock:
+                self.uncacheable += 1
+            return None
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        days = (date - datetime.date.fromisoformat(entry['date'])).days
+        schedule = shift_dates(entry['schedule'], days)
+        query = schedule.get('query')
+        if isinstance(query, dict):
+            crop, _, location, date_text, npk = fields
+            query.update({'cropName': crop, 'location': location, 'requestDate': date_text, 'npkInput': npk})
+        log.info(f"Schedule cache hit for '{key}' (shifted {days:+d} days).")
+        schedule['_cache_hit'] = True
+        return schedule
+
+    def save(self, fields, schedule):
+        """Caches a successfully parsed schedule (its '_'-prefixed bookkeeping keys are dropped)."""
+        key, date = self.key_for(fields)
+        if key is None or 'error' in schedule:
+            return
+        template = {k: copy.deepcopy(v) for k, v in schedule.items() if not k.startswith('_')}
+        self.store.set(key, {'date': date.isoformat(), 'schedule': template})
+        with self._lock:
+            self.stored += 1
+
+    def stats(self):
+        stats = self.store.stats()
+        with self._lock:
+            stats.update({'stored': self.stored, 'uncacheable': self.uncacheable,
+                          'bucket_days': self.bucket_days, 'npk_band_width': self.npk_band_width})
+        return stats
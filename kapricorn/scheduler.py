@@ -0,0 +1,303 @@
+# File: kapricorn/scheduler.py
+
+import asyncio
+import collections
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# name=weight:max_active:max_queue:slo_seconds, highest priority first; the last class is shed first
+DEFAULT_WORKLOADS = 'paid_chat=8:16:64:1,free_chat=4:12:64:3,visuals=2:4:32:20,recommendations=1:4:16:10'
+
+
+def parse_workloads(value):
+    """Parses 'name=weight:max_active:max_queue:slo_seconds,...' (or a dict) into an ordered {name: tuple}."""
+    if isinstance(value, dict):
+        return {name: (float(w), int(a), int(q), float(s)) for name, (w, a, q, s) in value.items()}
+    workloads = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, spec = item.split('=', 1)
+            weight, max_active, max_queue, slo = (spec.split(':') + [''] * 3)[:4]
+            workloads[name.strip()] = (float(weight), int(max_active or 4), int(max_queue or 16), float(slo or 5))
+    return workloads
+
+
+class LoadShed(Exception):
+    """Raised when a request is not admitted: shed, its class queue is full, or it waited too long."""
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Slot:
+    """One admitted request. Release it (or use it as a context manager) when the work is done."""
+
+    __slots__ = ('_scheduler', '_workload', '_started', '_released')
+
+    def __init__(self, scheduler, workload):
+        self._scheduler = scheduler
+        self._workload = workload
+        self._started = time.monotonic()
+        self._released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            if self._scheduler is not None:
+                self._scheduler._release(self._workload, time.monotonic() - self._started)
+
+
+class _Waiter:
+    __slots__ = ('enqueued_at', 'state', 'event', 'loop', 'future')
+
+    def __init__(self, loop=None):
+        self.enqueued_at = time.monotonic()
+        self.state = 'queued' # -> 'granted' | 'shed'
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class _Workload:
+    def __init__(self, name, priority, weight, max_active, max_queue, slo_seconds):
+        self.name = name
+        self.priority = priority # 0 = highest
+        self.stride = 1.0 / max(weight, 0.001)
+        self.weight = weight
+        self.max_active = max(1, max_active)
+        self.max_queue = max_queue
+        self.slo_seconds = slo_seconds
+        self.queue = collections.deque()
+        self.active = 0
+        self.pass_value = 0.0
+        self.service_seconds = None # EWMA of slot hold time
+        self.queue_times = collections.deque(maxlen=512)
+        self.stats = collections.Counter()
+
+
+class WorkloadScheduler:
+    """
+    Admission control with a bounded queue and a concurrency cap per workload class.
+
+    At most `capacity` requests hold a slot at once, and at most each
+    class's `max_active`. When slots are contended, queued requests are
+    dispatched by stride scheduling (weighted fair queueing): each class
+    advances a virtual clock by 1/weight per dispatch and the backlogged
+    class with the lowest clock goes next, so under load paid chat gets 8
+    slots for every 4 of free chat, 2 of visuals and 1 of recommendations
+    (with the default weights), and no class starves.
+
+    The last (lowest-priority) class is shed under saturation: new
+    arrivals are rejected while every slot is taken and a higher class is
+    waiting, and its queued requests are dropped when a higher class has to
+    queue. Any class is rejected when its queue is full or after waiting
+    `max_wait_seconds`. Rejections raise LoadShed with a Retry-After
+    estimate from the class's backlog and average service time.
+
+    Queue times are tracked per class against its SLO (`slo_seconds`).
+    When disabled, every request gets a no-op slot.
+    """
+
+    def __init__(self, workloads=None, capacity=24, max_wait_seconds=30.0, enabled=True, telemetry=None):
+        self.enabled = enabled
+        self.capacity = max(1, capacity)
+        self.max_wait_seconds = max_wait_seconds
+        self.telemetry = telemetry
+        self._lock = threading.Lock()
+        self._workloads = {}
+        for priority, (name, (weight, max_active, max_queue, slo)) in enumerate(
+                parse_workloads(workloads or DEFAULT_WORKLOADS).items()):
+            self._workloads[name] = _Workload(name, priority, weight, max_active, max_queue, slo)
+        self._lowest = max(self._workloads.values(), key=lambda w: w.priority) if self._workloads else None
+        self._active = 0
+        self._virtual_time = 0.0
+
+    # --- Admission ---
+
+    def acquire(self, workload):
+        """Blocks until `workload` gets a slot; returns a Slot or raises LoadShed."""
+        if not self.enabled:
+            return Slot(None, None)
+        with self._lock:
+            w = self._workload(workload)
+            waiter = self._admit_locked(w)
+            if waiter is None:
+                return self._granted(w, 0.0)
+        waiter.event.wait(self.max_wait_seconds)
+        return self._settle(w, waiter)
+
+    async def acquire_async(self, workload):
+        """Awaitable acquire: waits on the event loop instead of blocking a thread."""
+        if not self.enabled:
+            return Slot(None, None)
+        with self._lock:
+            w = self._workload(workload)
+            waiter = self._admit_locked(w, loop=asyncio.get_running_loop())
+            if waiter is None:
+                return self._granted(w, 0.0)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.state == 'queued':
+                    w.queue.remove(waiter)
+                    waiter.state = 'cancelled'
+            if waiter.state == 'granted':
+                self._release(w.name, 0.0)
+            raise
+        return self._settle(w, waiter)
+
+    def slot(self, workload):
+        """Context-manager form of acquire (raises LoadShed on rejection)."""
+        return self.acquire(workload)
+
+    def _workload(self, name):
+        w = self._workloads.get(name)
+        if w is None:
+            raise KeyError(f"Unknown workload class '{name}'")
+        return w
+
+    def _admit_locked(self, w, loop=None):
+        """None if `w` may start now; else the queued _Waiter. Raises LoadShed."""
+        if not w.queue and self._has_room(w) and not self._higher_waiting(w):
+            self._take(w)
+            return None
+        if w is self._lowest and self._active >= self.capacity and self._higher_waiting(w):
+            raise self._reject(w, 'shed', "Server busy with higher-priority requests; please retry shortly.")
+        if len(w.queue) >= w.max_queue:
+            raise self._reject(w, 'queue_full', "Too many requests queued; please retry shortly.")
+        if w is not self._lowest:
+            self._shed_queued_locked()
+        if not w.queue:
+            # A class returning from idle does not bank credit for the time it was away
+            w.pass_value = max(w.pass_value, self._virtual_time)
+        waiter = _Waiter(loop)
+        w.queue.append(waiter)
+        w.stats['queued'] += 1
+        self._dispatch_locked()
+        return waiter
+
+    def _settle(self, w, waiter):
+        with self._lock:
+            if waiter.state == 'queued':
+                w.queue.remove(waiter)
+                waiter.state = 'timed_out'
+                raise self._reject(w, 'timeout', "Timed out waiting for a server slot; please retry shortly.")
+            if waiter.state == 'shed':
+                raise self._reject(w, 'shed', "Server busy with higher-priority requests; please retry shortly.")
+            return self._granted(w, time.monotonic() - waiter.enqueued_at)
+
+    def _granted(self, w, waited):
+        w.stats['admitted'] += 1
+        w.queue_times.append(waited)
+        if waited > w.slo_seconds:
+            w.stats['slo_missed'] += 1
+        if self.telemetry is not None:
+            self.telemetry.observe('kapricorn_scheduler_queue_seconds', waited, (('workload', w.name),))
+        return Slot(self, w.name)
+
+    def _reject(self, w, reason, message):
+        w.stats[reason] += 1
+        retry_after = self._retry_after_locked(w)
+        if self.telemetry is not None:
+            self.telemetry.increment('kapricorn_scheduler_rejections_total', 1,
+                                     (('workload', w.name), ('reason', reason)))
+        log.warning(f"Scheduler rejected a '{w.name}' request ({reason}); retry after {retry_after}s.")
+        return LoadShed(message, retry_after, reason)
+
+    def _retry_after_locked(self, w):
+        service = w.service_seconds or 1.0
+        return max(1, min(60, math.ceil(service * (len(w.queue) + 1) / w.max_active)))
+
+    # --- Dispatch ---
+
+    def _has_room(self, w):
+        return self._active < self.capacity and w.active < w.max_active
+
+    def _higher_waiting(self, w):
+        return any(other.queue for other in self._workloads.values() if other.priority < w.priority)
+
+    def _take(self, w):
+        w.active += 1
+        self._active += 1
+
+    def _dispatch_locked(self):
+        while self._active < self.capacity:
+            ready = [w for w in self._workloads.values() if w.queue and w.active < w.max_active]
+            if not ready:
+                return
+            w = min(ready, key=lambda candidate: (candidate.pass_value, candidate.priority))
+            self._virtual_time = w.pass_value
+            w.pass_value += w.stride
+            waiter = w.queue.popleft()
+            waiter.state = 'granted'
+            self._take(w)
+            waiter.wake()
+
+    def _shed_queued_locked(self):
+        """Drops the lowest class's queued requests while every slot is taken."""
+        lowest = self._lowest
+        if lowest is None or self._active < self.capacity:
+            return
+        while lowest.queue:
+            waiter = lowest.queue.popleft()
+            waiter.state = 'shed'
+            waiter.wake()
+
+    def _release(self, name, held_seconds):
+        with self._lock:
+            w = self._workloads[name]
+            w.active -= 1
+            self._active -= 1
+            w.service_seconds = held_seconds if w.service_seconds is None else \
+                0.8 * w.service_seconds + 0.2 * held_seconds
+            self._dispatch_locked()
+
+    # --- Stats ---
+
+    def stats(self):
+        with self._lock:
+            workloads = {}
+            for w in self._workloads.values():
+                times = sorted(w.queue_times)
+                p = lambda q: round(times[min(len(times) - 1, int(q * len(times)))] * 1000, 1) if times else 0.0
+                admitted = w.stats['admitted']
+                workloads[w.name] = {
+                    'weight': w.weight,
+                    'max_active': w.max_active,
+                    'max_queue': w.max_queue,
+                    'active': w.active,
+                    'queue_depth': len(w.queue),
+                    'admitted': admitted,
+                    'shed': w.stats['shed'],
+                    'queue_full': w.stats['queue_full'],
+                    'timed_out': w.stats['timeout'],
+                    'queue_p50_ms': p(0.50),
+                    'queue_p95_ms': p(0.95),
+                    'slo_ms': round(w.slo_seconds * 1000),
+                    'slo_attainment': round(1 - w.stats['slo_missed'] / admitted, 4) if admitted else 1.0,
+                    'avg_service_ms': round((w.service_seconds or 0.0) * 1000, 1),
+                }
+            return {'enabled': self.enabled, 'capacity': self.capacity, 'active': self._active,
+                    'workloads': workloads}
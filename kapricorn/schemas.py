@@ -0,0 +1,348 @@
+# File: kapricorn/schemas.py
+
+"""
+Schemas for the JSON-mode (structured output) model calls.
+
+VisualsBot timelines / checkup schedules and the crop recommendation
+formatter are requested with response_mime_type 'application/json' and a
+response_schema built from the pydantic models below, and their replies
+are validated with `model_validate_json`. Replies that still fail (a
+<data> wrapper, code fences, /* */ comments, trailing commas) are
+repaired locally before the caller falls back to a model repair pass.
+"""
+
+import functools
+import json
+import logging
+import re
+from typing import List, Optional
+
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+
+from .recommendation_engine import _parse_list, parse_survivability
+
+log = logging.getLogger(__name__)
+
+
+class StructuredOutputError(ValueError):
+    """A reply that does not match its schema, even after local repair."""
+
+
+# --- VisualsBot ---
+
+class VisualsQuery(BaseModel):
+    cropName: str
+    generationType: str = Field(description="'timeline' or 'checkup_schedule'")
+    location: str
+    requestDate: str = Field(description="YYYY-MM-DD")
+    npkInput: str
+
+
+class TimelineStage(BaseModel):
+    stageName: str
+    estimatedDateRange: str = Field(description="'YYYY-MM-DD to YYYY-MM-DD' or a descriptive window")
+    keyActivities: List[str] = []
+    warnings: List[str] = []
+
+
+class Timeline(BaseModel):
+    estimatedPlantingWindow: str
+    stages: List[TimelineStage]
+    estimatedHarvestWindow: str
+    notes: List[str] = []
+
+
+class Checkpoint(BaseModel):
+    checkName: str
+    estimatedCheckupDate: str = Field(description="YYYY-MM-DD")
+    keyChecks: List[str] = []
+    recommendedActions: List[str] = []
+    npkNotes: List[str] = []
+
+
+class CheckupSchedule(BaseModel):
+    estimatedPlantingWindow: str
+    estimatedPlantingDateForCalc: str = Field(description="YYYY-MM-DD")
+    checkpoints: List[Checkpoint]
+    notes: List[str] = []
+
+
+class VisualsData(BaseModel):
+    """VisualsBot output: the query echo plus a timeline or a checkup schedule."""
+
+    query: VisualsQuery
+    timeline: Optional[Timeline] = None
+    checkupSchedule: Optional[CheckupSchedule] = None
+
+    @model_validator(mode='after')
+    def _has_schedule(self):
+        if self.timeline is None and self.checkupSchedule is None:
+            raise ValueError("either 'timeline' or 'checkupSchedule' is required")
+        return self
+
+
+# --- Crop recommendations ---
+
+class CropRecommendation(BaseModel):
+    crop: str = Field(min_length=1, description="Full crop name")
+    description: str
+    challenges: List[str]
+    survivability: float = Field(description="Survivability percentage, 0-100, number only")
+    reasons: List[str]
+
+    @field_validator('crop')
+    @classmethod
+    def _clean_name(cls, value):
+        name = value.strip().strip('*#').strip()
+        if not name:
+            raise ValueError("empty crop name")
+        return name
+
+    @field_validator('survivability', mode='before')
+    @classmethod
+    def _parse_survivability(cls, value):
+        # Same normalization as the tagged format: "65%", "60-70%", 0.7 -> 0-100
+        survivability = parse_survivability(str(value)) if value is not None else None
+        if survivability is None:
+            raise ValueError(f"unusable survivability {value!r}")
+        return survivability
+
+    @field_validator('challenges', 'reasons', mode='before')
+    @classmethod
+    def _split_lists(cls, value):
+        return _parse_list(value) if isinstance(value, str) else value
+
+
+class CropRecommendations(BaseModel):
+    crops: List[CropRecommendation]
+
+
+class LocationCropRecommendations(BaseModel):
+    location: int = Field(description="The location's number from its '=== LOCATION n ===' line")
+    crops: List[CropRecommendation]
+
+
+class PackedCropRecommendations(BaseModel):
+    """Crop recommendations for several locations formatted in one call (batch recommendations)."""
+
+    locations: List[LocationCropRecommendations]
+
+
+# --- Gemini response_schema ---
+
+def _gemini_schema(node, defs):
+    """Converts one JSON-schema node to the OpenAPI subset Gemini accepts ($refs inlined)."""
+    if '$ref' in node:
+        node = defs[node['$ref'].rsplit('/', 1)[-1]]
+    if 'anyOf' in node: # Optional[X]
+        options = [option for option in node['anyOf'] if option.get('type') != 'null']
+        converted = _gemini_schema(options[0], defs)
+        converted['nullable'] = True
+        if 'description' in node:
+            converted['description'] = node['description']
+        return converted
+    schema = {key: node[key] for key in ('type', 'format', 'description', 'enum') if key in node}
+    if 'properties' in node:
+        schema['type'] = 'object'
+        schema['properties'] = {name: _gemini_schema(value, defs) for name, value in node['properties'].items()}
+        if node.get('required'):
+            schema['required'] = list(node['required'])
+    if 'items' in node:
+        schema['items'] = _gemini_schema(node['items'], defs)
+    return schema
+
+
+@functools.lru_cache(maxsize=None)
+def response_schema(model):
+    """The Gemini response_schema dict for a pydantic model (built once; do not mutate)."""
+    schema = model.model_json_schema()
+    return _gemini_schema(schema, schema.pop('$defs', {}))
+
+
+@functools.lru_cache(maxsize=None)
+def json_generation_config(model):
+    """generation_config for a JSON-mode call whose reply must match `model`."""
+    return {'response_mime_type': 'application/json', 'response_schema': response_schema(model)}
+
+
+# --- Parsing and local repair ---
+
+_DATA_TAG = re.compile(r'<data>(.*?)(?:</data>|$)', re.DOTALL)
+_CODE_FENCE = re.compile(r'```(?:json)?\s*(.*?)(?:```|$)', re.DOTALL)
+
+
+def repair_json(text):
+    """
+    Local fixes for almost-JSON replies: unwraps a <data> tag or code fence,
+    drops text around the outermost object, /* */ and // comments and
+    trailing commas. Strings are left untouched.
+    """
+    text = text or ''
+    for wrapper in (_DATA_TAG, _CODE_FENCE):
+        match = wrapper.search(text)
+        if match:
+            text = match.group(1)
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+
+    out = []
+    i, length = 0, len(text)
+    in_string = False
+    while i < length:
+        char = text[i]
+        if in_string:
+            out.append(char)
+            if char == '\\' and i + 1 < length:
+                out.append(text[i + 1])
+                i += 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            out.append(char)
+        elif text.startswith('/*', i):
+            close = text.find('*/', i + 2)
+            i = length if close == -1 else close + 2
+            continue
+        elif text.startswith('//', i):
+            newline = text.find('\n', i)
+            i = length if newline == -1 else newline
+            continue
+        elif char == ',':
+            following = _skip_blank(text, i + 1)
+            if following < length and text[following] in '}]':
+                i += 1
+                continue # Trailing comma
+            out.append(char)
+        else:
+            out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+def _skip_blank(text, i):
+    """Index of the next character after whitespace and comments."""
+    length = len(text)
+    while i < length:
+        if text[i] in ' \t\r\n':
+            i += 1
+        elif text.startswith('/*', i):
+            close = text.find('*/', i + 2)
+            i = length if close == -1 else close + 2
+        elif text.startswith('//', i):
+            newline = text.find('\n', i)
+            i = length if newline == -1 else newline
+        else:
+            break
+    return i
+
+
+def describe_errors(error, limit=8):
+    """Compact 'path: message' lines of a ValidationError, for logs and the model repair prompt."""
+    lines = [f"{'.'.join(str(part) for part in item['loc']) or '(root)'}: {item['msg']}"
+             for item in error.errors(include_url=False)[:limit]]
+    return '\n'.join(lines)
+
+
+def parse_structured(model, text):
+    """Validates a JSON-mode reply against `model`, repairing it locally if needed; raises StructuredOutputError."""
+    try:
+        return model.model_validate_json(text or '')
+    except ValidationError:
+        pass
+    try:
+        parsed = model.model_validate_json(repair_json(text))
+    except ValidationError as e:
+        raise StructuredOutputError(describe_errors(e)) from e
+    log.info(f"Repaired malformed {model.__name__} JSON locally.")
+    return parsed
+
+
+def visuals_from_json(text):
+    """VisualsBot JSON reply -> the schedule dict sent to clients."""
+    return parse_structured(VisualsData, text).model_dump(exclude_none=True)
+
+
+def crops_from_json(text):
+    """
+    Crop recommendation JSON reply -> {crop_name: {description, survivability, reasons, challenges}}.
+
+    As with extractCropsInfo, crops that fail validation are skipped rather
+    than failing the whole set; StructuredOutputError only if none is usable.
+    """
+    try:
+        crops = parse_structured(CropRecommendations, text).crops
+    except StructuredOutputError as error:
+        crops = _salvage_crops(text)
+        if not crops:
+            raise error
+    return _crop_dict(crops)
+
+
+def packed_crops_from_json(text):
+    """
+    Packed crop recommendation JSON reply -> {location number: {crop_name: {...}}}.
+
+    Malformed crops are skipped per location as in crops_from_json; a
+    location left with no usable crop is left out (the caller formats it on
+    its own). StructuredOutputError if the reply does not validate and no
+    location can be salvaged from it.
+    """
+    try:
+        locations = [(entry.location, entry.crops)
+                     for entry in parse_structured(PackedCropRecommendations, text).locations]
+    except StructuredOutputError as error:
+        locations = _salvage_locations(text)
+        if not locations:
+            raise error
+    packed = {}
+    for number, crops in locations:
+        if crops and number not in packed:
+            packed[number] = _crop_dict(crops)
+    return packed
+
+
+def _crop_dict(crops):
+    return {crop.crop: {
+        "description": crop.description.strip(),
+        "survivability": crop.survivability,
+        "reasons": crop.reasons,
+        "challenges": crop.challenges,
+    } for crop in crops}
+
+
+def _salvage_locations(text):
+    try:
+        entries = json.loads(repair_json(text)).get('locations')
+    except (ValueError, AttributeError):
+        return []
+    locations = []
+    for entry in entries if isinstance(entries, list) else []:
+        number = entry.get('location') if isinstance(entry, dict) else None
+        if isinstance(number, int) and not isinstance(number, bool):
+            crops = _salvage_items(entry.get('crops'))
+            if crops:
+                locations.append((number, crops))
+    return locations
+
+
+def _salvage_crops(text):
+    try:
+        items = json.loads(repair_json(text)).get('crops')
+    except (ValueError, AttributeError):
+        return []
+    return _salvage_items(items)
+
+
+def _salvage_items(items):
+    crops = []
+    for item in items if isinstance(items, list) else []:
+        try:
+            crops.append(CropRecommendation.model_validate(item))
+        except ValidationError:
+            continue
+    skipped = len(items) - len(crops) if isinstance(items, list) else 0
+    if crops and skipped:
+        log.warning(f"crops_from_json skipped {skipped} malformed crop record(s).")
+    return crops
@@ -0,0 +1,113 @@
+# File: kapricorn/singleflight.py
+
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _LeaderCancelled(Exception):
+    """Set on a coalesced coroutine call whose leader was cancelled; its followers retry."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key.
+
+    The first caller for a key runs the function; callers arriving while it
+    is still running block and receive the same result (or exception).
+    Nothing is cached once the call completes. `do_async` does the same for
+    coroutines on an event loop, sharing the counters; if its leader is
+    cancelled (its client went away), the waiting callers start the call
+    again among themselves rather than failing with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}  # key -> asyncio.Future (owned by the serving loop)
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Returns (result, shared) where shared is True for coalesced callers."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def do_async(self, key, coro_fn):
+        """Awaitable variant of `do`: coro_fn() is awaited once per key; returns (result, shared)."""
+        while True:
+            with self._lock:
+                future = self._async_calls.get(key)
+                if future is not None:
+                    self.coalesced += 1
+                    leader = False
+                else:
+                    future = asyncio.get_running_loop().create_future()
+                    self._async_calls[key] = future
+                    self.executions += 1
+                    leader = True
+            if leader:
+                break
+            try:
+                # shield: a cancelled follower must not cancel the leader's result
+                return await asyncio.shield(future), True
+            except _LeaderCancelled:
+                continue # The key is free again; the first follower back leads the retry
+
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # Mark retrieved so an unawaited failure is not logged
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._async_calls[key]
+        return result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executions': self.executions,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls) + len(self._async_calls),
+            }
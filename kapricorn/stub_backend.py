@@ -0,0 +1,350 @@
+# File: kapricorn/stub_backend.py
+
+"""
+Offline stand-in for google.generativeai models.
+
+StubModel mimics the parts of GenerativeModel the service uses
+(generate_content, generate_content_async, count_tokens) with configurable
+latency and canned replies, so the app can be exercised without spending
+real quota. StubQuota makes it answer 429 (ResourceExhausted) like the
+real API once a key goes over its requests-per-minute or concurrency.
+ReplayBackend answers each prompt kind (farmBot chat, visualsBot,
+recommendation analysis and formatting, history summaries) with recorded
+outputs, their latencies and token counts.
+Plug it in with `ModelRegistry(model_factory=stub_model_factory(...))`.
+"""
+
+import asyncio
+import collections
+import itertools
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core import exceptions as google_exceptions
+
+from .tokens import content_size
+
+STUB_CHARS_PER_TOKEN = 4.0
+
+# name -> token count of contents "cached" by StubCacheBackend
+_stub_cached_contents = {}
+
+
+def _stub_tokens(content):
+    chars, images = content_size(content)
+    return max(1, round(chars / STUB_CHARS_PER_TOKEN)) + images * 258
+
+
+class StubResponse:
+    """Looks like a non-streamed GenerateContentResponse."""
+
+    def __init__(self, text, prompt_tokens, cached_tokens=0, output_tokens=None):
+        output_tokens = output_tokens or _stub_tokens(text)
+        self.text = text
+        self.parts = [SimpleNamespace(text=text)]
+        self.candidates = [SimpleNamespace(finish_reason=1)]
+        self.prompt_feedback = SimpleNamespace(block_reason=None)
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens + cached_tokens,
+            cached_content_token_count=cached_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + cached_tokens + output_tokens,
+        )
+
+
+class StubReply:
+    """
+    One reply from a `reply` callable, with optional per-call overrides:
+    `latency` (seconds), `prompt_tokens` and `output_tokens` (otherwise
+    estimated from the text).
+    """
+
+    __slots__ = ('text', 'latency', 'prompt_tokens', 'output_tokens')
+
+    def __init__(self, text, latency=None, prompt_tokens=None, output_tokens=None):
+        self.text = text
+        self.latency = latency
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+
+
+# First words of the fixed prompts, to tell which bot a request is for
+_PROMPT_MARKERS = (
+    ('visualsBot', 'You are a specialized **Farming Data Generation AI**'),
+    ('analysis', 'Conduct a comprehensive agricultural analysis'),
+    ('analysis_batch', 'Conduct a separate agricultural analysis'),
+    ('formatting', 'Reformat this agricultural analysis'),
+    ('formatting_json', 'Convert this agricultural analysis into JSON'),
+    ('formatting_batch', 'Reformat these agricultural analyses'),
+    ('formatting_json_batch', 'Convert these agricultural analyses into JSON'),
+    ('repair', 'The JSON below does not match its response schema'),
+    ('summary', 'You maintain the running memory of a conversation'),
+    ('personalize', 'A farmer asked:'),
+)
+
+
+def _first_text(contents):
+    if isinstance(contents, str):
+        return contents
+    for item in contents if isinstance(contents, list) else []:
+        if isinstance(item, str):
+            return item
+        parts = item.get('parts') if isinstance(item, dict) else None
+        for part in parts if isinstance(parts, list) else [parts]:
+            if isinstance(part, str):
+                return part
+    return ''
+
+
+def classify_prompt(contents):
+    """The _PROMPT_MARKERS kind ('visualsBot', 'formatting_json', ...) or 'farmBot' (chat) of a request's contents."""
+    head = _first_text(contents).lstrip()[:200]
+    for kind, marker in _PROMPT_MARKERS:
+        if head.startswith(marker):
+            return kind
+    return 'farmBot'
+
+
+class ReplayBackend:
+    """
+    `reply` callable for StubModel that replays recorded outputs.
+
+    `recordings` maps a prompt kind (see classify_prompt) to a list of
+    {'text', 'latency_ms', 'output_tokens'} records, served round-robin per
+    kind so runs repeat. `latency_scale` multiplies the recorded latencies
+    (0 for CPU-only runs); `latency` overrides them per kind, in seconds.
+    Kinds without recordings get `default_text`.
+    """
+
+    def __init__(self, recordings, latency_scale=1.0, latency=None,
+                 default_text='<r>Stub reply.</r><cls>FI</cls>'):
+        self.recordings = {kind: list(records) for kind, records in recordings.items()
+                           if isinstance(records, list) and records}
+        self.latency_scale = latency_scale
+        self.latency = latency or {}
+        self.default_text = default_text
+        self._lock = threading.Lock()
+        self._next = collections.Counter()
+        self.served = collections.Counter()
+
+    @classmethod
+    def from_file(cls, path, **options):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f), **options)
+
+    def __call__(self, contents):
+        kind = classify_prompt(contents)
+        records = self.recordings.get(kind)
+        with self._lock:
+            self.served[kind] += 1
+            if not records:
+                return StubReply(self.default_text, latency=self.latency.get(kind))
+            record = records[self._next[kind] % len(records)]
+            self._next[kind] += 1
+        latency = self.latency.get(kind)
+        if latency is None:
+            latency = record.get('latency_ms', 0) / 1000 * self.latency_scale
+        return StubReply(record['text'], latency=latency, output_tokens=record.get('output_tokens'))
+
+
+class StubQuota:
+    """
+    Provider-side quota for one stub API key.
+
+    Calls beyond `requests_per_minute` in any sliding `window_seconds`, or
+    beyond `max_concurrency` at once, raise ResourceExhausted. Rejected
+    calls do not count against the window, as with the real API.
+    """
+
+    def __init__(self, requests_per_minute=None, max_concurrency=None, window_seconds=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrency = max_concurrency
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._admitted = collections.deque()
+        self._in_flight = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def enter(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._admitted and self._admitted[0] <= now - self.window_seconds:
+                self._admitted.popleft()
+            if ((self.requests_per_minute is not None and len(self._admitted) >= self.requests_per_minute)
+                    or (self.max_concurrency is not None and self._in_flight >= self.max_concurrency)):
+                self.rejected += 1
+                raise google_exceptions.ResourceExhausted("Resource has been exhausted (e.g. check quota). (stub)")
+            self._admitted.append(now)
+            self._in_flight += 1
+            self.accepted += 1
+
+    def exit(self):
+        with self._lock:
+            self._in_flight -= 1
+
+
+class StubModel:
+    """
+    Deterministic fake model.
+
+    `reply` is either a fixed string or a callable taking the contents list
+    and returning a string or a StubReply (e.g. a ReplayBackend).
+    `latency` is seconds per generate_content call; `count_latency` is seconds
+    per count_tokens call (the round-trip the service used to make twice).
+    `quota` is an optional StubQuota shared by the models of one key.
+    `error_rate` of calls fail with ServiceUnavailable and `slow_rate` of
+    calls take `slow_latency` instead (a slow tail), drawn from a generator
+    seeded with `seed` so runs repeat.
+    """
+
+    def __init__(self, model_name, reply='<r>Stub reply.</r><cls>FI</cls>', latency=0.0,
+                 count_latency=0.0, chunk_size=40, cached_content=None, quota=None,
+                 error_rate=0.0, slow_rate=0.0, slow_latency=0.0, seed=0):
+        self.model_name = model_name
+        self.quota = quota
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self._random = random.Random(seed)
+        self.cached_content = cached_content
+        self.reply = reply
+        self.latency = latency
+        self.count_latency = count_latency
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    def _reply_for(self, contents):
+        reply = self.reply(contents) if callable(self.reply) else self.reply
+        return reply if isinstance(reply, StubReply) else StubReply(reply)
+
+    def _call_latency(self, latency=None):
+        """Latency of this call; raises ServiceUnavailable for the simulated failures."""
+        draw = self._random.random()
+        if draw < self.error_rate:
+            raise google_exceptions.ServiceUnavailable("The model is overloaded. Please try again later. (stub)")
+        if draw < self.error_rate + self.slow_rate:
+            return self.slow_latency
+        return self.latency if latency is None else latency
+
+    def count_tokens(self, contents):
+        if self.count_latency:
+            time.sleep(self.count_latency)
+        return SimpleNamespace(total_tokens=_stub_tokens(contents))
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        self.calls += 1
+        reply = self._reply_for(contents)
+        prompt_tokens = reply.prompt_tokens or _stub_tokens(contents)
+        cached_tokens = _stub_cached_contents.get(self.cached_content, 0)
+        latency = self._call_latency(reply.latency)
+        if self.quota:
+            self.quota.enter()
+        if stream:
+            return self._stream(reply, prompt_tokens, latency)
+        try:
+            if latency:
+                time.sleep(latency)
+        finally:
+            if self.quota:
+                self.quota.exit()
+        return StubResponse(reply.text, prompt_tokens, cached_tokens, reply.output_tokens)
+
+    def _chunks(self, text):
+        return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or ['']
+
+    def _stream_response(self, reply, chunk, prompt_tokens, last):
+        response = StubResponse(chunk, prompt_tokens)
+        if not last:
+            response.usage_metadata = None
+        else:
+            response.usage_metadata.candidates_token_count = reply.output_tokens or _stub_tokens(reply.text)
+        return response
+
+    def _stream(self, reply, prompt_tokens, latency):
+        # Spread the latency over the chunks so time-to-first-chunk is realistic
+        chunks = self._chunks(reply.text)
+        per_chunk = latency / len(chunks) if latency else 0
+        try:
+            for index, chunk in enumerate(chunks):
+                if per_chunk:
+                    time.sleep(per_chunk)
+                yield self._stream_response(reply, chunk, prompt_tokens, index == len(chunks) - 1)
+        finally:
+            if self.quota:
+                self.quota.exit()
+
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        """asyncio twin of generate_content: latency is awaited, not slept."""
+        self.calls += 1
+        reply = self._reply_for(contents)
+        prompt_tokens = reply.prompt_tokens or _stub_tokens(contents)
+        cached_tokens = _stub_cached_contents.get(self.cached_content, 0)
+        latency = self._call_latency(reply.latency)
+        if self.quota:
+            self.quota.enter()
+        if stream:
+            return self._stream_async(reply, prompt_tokens, latency)
+        try:
+            if latency:
+                await asyncio.sleep(latency)
+        finally:
+            if self.quota:
+                self.quota.exit()
+        return StubResponse(reply.text, prompt_tokens, cached_tokens, reply.output_tokens)
+
+    async def _stream_async(self, reply, prompt_tokens, latency):
+        chunks = self._chunks(reply.text)
+        per_chunk = latency / len(chunks) if latency else 0
+        try:
+            for index, chunk in enumerate(chunks):
+                if per_chunk:
+                    await asyncio.sleep(per_chunk)
+                yield self._stream_response(reply, chunk, prompt_tokens, index == len(chunks) - 1)
+        finally:
+            if self.quota:
+                self.quota.exit()
+
+
+def stub_model_factory(quota_per_key=None, **stub_options):
+    """
+    Returns a ModelRegistry model_factory that builds StubModels.
+
+    `quota_per_key` (StubQuota keyword arguments) gives every API key its own
+    StubQuota; the registry keeps one client manager per key, so models of
+    the same key share it.
+    """
+    quotas = {}
+    lock = threading.Lock()
+
+    def factory(model_name, client_manager, cached_content=None):
+        quota = None
+        if quota_per_key is not None:
+            with lock:
+                quota = quotas.setdefault(id(client_manager), StubQuota(**quota_per_key))
+        return StubModel(model_name, cached_content=cached_content, quota=quota, **stub_options)
+    factory.quotas = quotas
+    return factory
+
+
+class StubCacheBackend:
+    """PromptPrefixCache backend that 'caches' contents locally and counts calls."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def create(self, api_key, model_name, contents, ttl_seconds):
+        if self.fail:
+            raise ValueError("Cached content is too small (stub).")
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/stub-{next(self._ids)}"
+        _stub_cached_contents[name] = _stub_tokens(contents)
+        return name, time.time() + ttl_seconds
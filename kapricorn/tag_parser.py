@@ -0,0 +1,179 @@
+# File: kapricorn/tag_parser.py
+
+import functools
+import re
+
+CHAT_TAGS = ('p', 'g', 'r', 'gr', 'cls', 'gen')
+
+# Longest tag marker we ever need to hold back while waiting for more text ("</cls>")
+_MAX_MARKER_LEN = max(len(tag) for tag in CHAT_TAGS) + 3
+
+
+@functools.lru_cache(maxsize=32)
+def marker_pattern(tags):
+    """Precompiled pattern matching <tag> and </tag> for any of `tags` (a tuple)."""
+    alternatives = '|'.join(re.escape(tag) for tag in sorted(set(tags), key=len, reverse=True))
+    return re.compile(r'<(/?)(' + alternatives + r')>')
+
+
+class TagParser:
+    """
+    Single-pass extractor for farmBot/VisualsBot tags.
+
+    One precompiled pattern finds every <tag>/</tag> marker and a small
+    stack machine pairs them, so the response is scanned once no matter how
+    many tags are requested. Semantics follow the farmBot tag rules:
+
+    * the first complete top-level element of each tag wins (repeats ignored);
+    * tags nested inside another element are part of its content (they are
+      queries, not separate answers), e.g. <p><r>x</r></p> yields only p;
+    * a stray closing marker is ignored, and a closing marker implicitly
+      closes any unclosed tags opened inside its element;
+    * an element that is never closed does not count, and elements inside
+      it are treated as top-level.
+
+    Use `parse(text)` for a whole response, or `feed(chunk)` repeatedly and
+    then `result()` when consuming a stream.
+    """
+
+    def __init__(self, tags=CHAT_TAGS):
+        self.tags = tuple(tags)
+        self._pattern = marker_pattern(self.tags)
+        self._max_marker_len = max(len(tag) for tag in self.tags) + 3
+        self._chunks = []    # Everything fed so far, joined only in result()
+        self._length = 0
+        self._tail = ''      # Unscanned text from `_scan_pos` (a possibly split marker)
+        self._scan_pos = 0
+        self._stack = []     # [tag, content_start, open_pos, nested_records]
+        self._records = []   # (open_pos, tag, content_start, content_end) of closed top-level elements
+
+    def parse(self, text):
+        """Parses a complete response and returns {tag: first content or None}."""
+        self.feed(text)
+        return self.result()
+
+    def feed(self, chunk):
+        """Consumes a chunk. Returns the tags whose first top-level element just completed."""
+        if not chunk:
+            return []
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        # Only the new chunk plus the held-back tail is scanned, so a stream is parsed in linear time
+        window = self._tail + chunk
+        offset = self._scan_pos
+        if '<' not in window:
+            self._tail = ''
+            self._scan_pos = offset + len(window)
+            return []
+        completed = []
+        position = 0
+        for match in self._pattern.finditer(window):
+            self._on_marker(match, offset, completed)
+            position = match.end()
+        # A marker split across chunks can only start in the last few characters
+        position = max(position, len(window) - self._max_marker_len + 1)
+        self._tail = window[position:]
+        self._scan_pos = offset + position
+        return completed
+
+    def _on_marker(self, match, offset, completed):
+        closing, tag = match.group(1), match.group(2)
+        start, end = offset + match.start(), offset + match.end()
+        stack = self._stack
+        if not closing:
+            stack.append([tag, end, start, []])
+            return
+        for depth in range(len(stack) - 1, -1, -1):
+            if stack[depth][0] == tag:
+                break
+        else:
+            return # Stray closing marker
+        frame = stack[depth]
+        del stack[depth:] # Also closes anything left open inside this element
+        record = (frame[2], tag, frame[1], start)
+        if stack:
+            stack[-1][3].append(record) # Nested: only matters if the parent never closes
+        else:
+            self._records.append(record)
+            completed.append(tag)
+
+    def result(self):
+        """Returns {tag: first top-level content (stripped) or None} for every requested tag."""
+        records = list(self._records)
+        for frame in self._stack:
+            # Unclosed elements do not count; whatever closed inside them does
+            records.extend(frame[3])
+        records.sort(key=lambda record: record[0])
+        text = ''.join(self._chunks)
+        extracted = dict.fromkeys(self.tags)
+        for _, tag, content_start, content_end in records:
+            if extracted[tag] is None:
+                extracted[tag] = text[content_start:content_end].strip()
+        return extracted
+
+
+class StreamingTagFilter:
+    """
+    Incremental filter for streamed farmBot output.
+
+    Feed it raw chunks as they arrive; it returns only the text that sits
+    inside `visible` tags (the `<r>` reply by default) and swallows
+    everything inside the other tags (`<g>`, `<gr>`, `<cls>`, `<gen>`, ...).
+    A partial marker split across chunks (e.g. "...</" + "r>") is held back
+    until the next chunk decides it.
+    """
+
+    def __init__(self, visible=('r',), tags=CHAT_TAGS):
+        self.visible = set(visible)
+        self._marker = marker_pattern(tuple(tags))
+        self._buffer = ''
+        self._open_tag = None
+        self.raw = []  # Every chunk fed, so the full text is available at the end
+
+    def feed(self, chunk):
+        """Consumes a chunk and returns the newly visible text (possibly '')."""
+        if not chunk:
+            return ''
+        self.raw.append(chunk)
+        self._buffer += chunk
+        visible = []
+        position = 0
+        buffer = self._buffer
+        while True:
+            match = self._marker.search(buffer, position)
+            if match is None:
+                break
+            self._emit(buffer[position:match.start()], visible)
+            closing, tag = match.group(1), match.group(2)
+            if closing:
+                if tag == self._open_tag:
+                    self._open_tag = None
+            elif self._open_tag is None:
+                self._open_tag = tag
+            position = match.end()
+
+        # Hold back a trailing '<...' that could still become a marker
+        tail = buffer[position:]
+        cut = tail.rfind('<')
+        if cut != -1 and len(tail) - cut < _MAX_MARKER_LEN and '>' not in tail[cut:]:
+            self._emit(tail[:cut], visible)
+            self._buffer = tail[cut:]
+        else:
+            self._emit(tail, visible)
+            self._buffer = ''
+        return ''.join(visible)
+
+    def flush(self):
+        """Returns any held-back visible text once the stream has ended."""
+        visible = []
+        self._emit(self._buffer, visible)
+        self._buffer = ''
+        return ''.join(visible)
+
+    def _emit(self, text, out):
+        if text and self._open_tag in self.visible:
+            out.append(text)
+
+    @property
+    def text(self):
+        return ''.join(self.raw)
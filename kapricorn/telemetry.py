@@ -0,0 +1,218 @@
+# File: kapricorn/telemetry.py
+
+import bisect
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+
+from .clients import key_fingerprint
+
+# Seconds; covers sub-millisecond parsing up to slow model calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name -> (type, help); exposition order follows this table
+_METRICS = {
+    'kapricorn_http_request_duration_seconds': (
+        'histogram', "Time to response headers by endpoint, method and status."),
+    'kapricorn_stage_duration_seconds': (
+        'histogram', "Time spent in each request-processing stage, by endpoint."),
+    'kapricorn_model_call_duration_seconds': (
+        'histogram', "Upstream generate_content latency by route, model and key (streams: time to first chunk)."),
+    'kapricorn_model_calls_total': (
+        'counter', "Upstream model calls by route, model, key and outcome."),
+    'kapricorn_tokens_total': (
+        'counter', "Tokens spent by route, model, key and direction."),
+    'kapricorn_structured_outputs_total': (
+        'counter', "JSON-mode replies by schema and outcome (valid, repaired by the model, failed)."),
+    'kapricorn_scheduler_queue_seconds': (
+        'histogram', "Time admitted requests waited for a scheduler slot, by workload class."),
+    'kapricorn_scheduler_rejections_total': (
+        'counter', "Requests turned away by the scheduler, by workload class and reason (shed, queue_full, timeout)."),
+}
+
+_STAGE = 'kapricorn_stage_duration_seconds'
+
+
+@functools.lru_cache(maxsize=64)
+def _fingerprint(api_key):
+    return key_fingerprint(api_key)
+
+
+def _endpoint():
+    """Flask endpoint of the current request; work on job/pool threads is 'background'."""
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'background'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+class _Histogram:
+    """Cumulative-on-export bucket counts, plus sum and count."""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class CallLabels:
+    """The (route, model, key fingerprint) labels of one upstream call."""
+
+    __slots__ = ('route', 'model', 'key')
+
+    def __init__(self, route, model, key):
+        self.route = route
+        self.model = model
+        self.key = key
+
+    def pairs(self):
+        return (('route', self.route), ('model', self.model), ('key', self.key))
+
+
+class Telemetry:
+    """
+    In-process latency histograms and token counters, exposed as Prometheus text.
+
+    `span(stage)` times one request-processing stage (labelled with the
+    Flask endpoint it ran under), `model_call(labels)` one upstream
+    request and `count_tokens(labels, ...)` what it spent. Recording is a
+    dict lookup and a bisect under one lock, so instrumenting the hot path
+    costs a few microseconds; everything heavier happens in `render()`,
+    at scrape time.
+    """
+
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, label pairs) -> _Histogram
+        self._counters = {}    # (name, label pairs) -> number
+
+    # --- Recording ---
+
+    def observe(self, name, seconds, labels):
+        """Adds one observation to histogram `name`; `labels` is a tuple of (name, value) pairs."""
+        if not self.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def increment(self, name, amount, labels):
+        if not self.enabled or not amount:
+            return
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    @contextmanager
+    def span(self, stage):
+        """Times the enclosed block as `stage` of the current endpoint (exceptions included)."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(_STAGE, time.perf_counter() - start, (('endpoint', _endpoint()), ('stage', stage)))
+
+    def call_labels(self, route, model_name, api_key):
+        return CallLabels(route or 'other', model_name, _fingerprint(api_key))
+
+    @contextmanager
+    def model_call(self, labels, stream=False):
+        """
+        Times one upstream request: its latency histogram, an outcome
+        counter ('ok' or the exception class) and the 'model_call' stage.
+        """
+        if not self.enabled or labels is None:
+            yield
+            return
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            pairs = labels.pairs()
+            if outcome == 'ok':
+                self.observe('kapricorn_model_call_duration_seconds', elapsed,
+                             pairs + (('stream', 'true' if stream else 'false'),))
+            self.increment('kapricorn_model_calls_total', 1, pairs + (('outcome', outcome),))
+            self.observe(_STAGE, elapsed, (('endpoint', _endpoint()), ('stage', 'model_call')))
+
+    def count_tokens(self, labels, input_tokens, output_tokens):
+        if labels is None:
+            return
+        pairs = labels.pairs()
+        self.increment('kapricorn_tokens_total', input_tokens or 0, pairs + (('direction', 'input'),))
+        self.increment('kapricorn_tokens_total', output_tokens or 0, pairs + (('direction', 'output'),))
+
+    def record_request(self, endpoint, method, status, seconds):
+        self.observe('kapricorn_http_request_duration_seconds', seconds,
+                     (('endpoint', endpoint or 'unmatched'), ('method', method), ('status', str(status))))
+
+    # --- Export ---
+
+    def render(self):
+        """All series in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            histograms = [(key, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()]
+            counters = list(self._counters.items())
+
+        by_name = {}
+        for (name, labels), counts, total, count in sorted(histograms, key=lambda item: item[0]):
+            lines = by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_value(float(bound))))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for (name, labels), value in sorted(counters, key=lambda item: item[0]):
+            by_name.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        output = []
+        for name, (metric_type, help_text) in _METRICS.items():
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(by_name.get(name, ()))
+        return '\n'.join(output) + '\n'
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.enabled, 'histogram_series': len(self._histograms),
+                    'counter_series': len(self._counters)}
@@ -0,0 +1,118 @@
+# File: kapricorn/tokens.py
+
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHARS_PER_TOKEN = 3.5 # General estimate
+IMAGE_TOKEN_ESTIMATE = 258 # Rough estimate for typical image input cost (Gemini 1.5 Flash?) - ADJUST AS NEEDED
+
+
+def content_size(content):
+    """Returns (text_chars, image_count) for a prompt string, history list or parts list."""
+    chars = 0
+    images = 0
+    if isinstance(content, str):
+        return len(content), 0
+    if isinstance(content, list): # Estimate history
+        for message in content:
+            if isinstance(message, dict) and 'parts' in message:
+                parts = message['parts']
+                if isinstance(parts, str):
+                    chars += len(parts)
+                    continue
+                for part in parts if isinstance(parts, list) else []:
+                    if isinstance(part, str):
+                        chars += len(part)
+                    elif isinstance(part, dict) and ('inline_data' in part or 'image_id' in part):
+                        images += 1
+            elif isinstance(message, str):
+                chars += len(message)
+    return chars, images
+
+
+def estimate_tokens(content, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    """Estimate token count. Prioritize text length."""
+    # Lower number = more tokens per char (safer estimate for limits)
+    # Higher number = fewer tokens per char
+    chars, images = content_size(content)
+    return round(chars / chars_per_token + images * IMAGE_TOKEN_ESTIMATE)
+
+
+def usage_from_response(response):
+    """Reads (prompt_tokens, output_tokens) from a response's usage_metadata, or (None, None)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return None, None
+    prompt_tokens = getattr(usage, 'prompt_token_count', 0) or None
+    output_tokens = getattr(usage, 'candidates_token_count', 0) or None
+    return prompt_tokens, output_tokens
+
+
+class TokenAccountant:
+    """
+    Token counts without extra network calls.
+
+    Exact counts come from the response's usage_metadata. When those are
+    missing (streams in progress, blocked responses) a local estimator is used,
+    with a chars-per-token ratio calibrated per model from observed responses.
+    """
+
+    def __init__(self, default_chars_per_token=DEFAULT_CHARS_PER_TOKEN, smoothing=0.2):
+        self.default_chars_per_token = default_chars_per_token
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._ratios = {}  # model_name -> calibrated chars per token
+        self._exact = 0
+        self._estimated = 0
+
+    def chars_per_token(self, model_name):
+        return self._ratios.get(model_name, self.default_chars_per_token)
+
+    def estimate(self, content, model_name=None):
+        return estimate_tokens(content, self.chars_per_token(model_name))
+
+    def observe(self, model_name, content, actual_tokens):
+        """Folds one (content, exact token count) observation into the model's ratio."""
+        chars, images = content_size(content)
+        text_tokens = actual_tokens - images * IMAGE_TOKEN_ESTIMATE
+        if chars < 200 or text_tokens <= 0:
+            return # Too small to say anything useful about the ratio
+        observed = chars / text_tokens
+        with self._lock:
+            current = self._ratios.get(model_name)
+            if current is None:
+                self._ratios[model_name] = observed
+            else:
+                self._ratios[model_name] = current + self.smoothing * (observed - current)
+
+    def account(self, model_name, content_sent, response, generated_text):
+        """Returns (input_tokens, output_tokens) for a completed generation."""
+        prompt_tokens, output_tokens = usage_from_response(response)
+        exact = prompt_tokens is not None and output_tokens is not None
+
+        if prompt_tokens is not None:
+            self.observe(model_name, content_sent, prompt_tokens)
+        else:
+            prompt_tokens = self.estimate(content_sent, model_name)
+
+        if output_tokens is not None:
+            self.observe(model_name, generated_text, output_tokens)
+        else:
+            output_tokens = self.estimate(generated_text, model_name)
+
+        with self._lock:
+            if exact:
+                self._exact += 1
+            else:
+                self._estimated += 1
+        return prompt_tokens, output_tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                'exact_counts': self._exact,
+                'estimated_counts': self._estimated,
+                'chars_per_token': {name: round(ratio, 3) for name, ratio in self._ratios.items()},
+            }
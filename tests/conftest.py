@@ -0,0 +1,43 @@
+# File: tests/conftest.py
+
+import os
+
+import pytest
+
+from kapricorn import create_app
+from kapricorn.clients import ModelRegistry
+from kapricorn.config import Config
+from kapricorn.stub_backend import ReplayBackend, stub_model_factory
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'recordings', 'gemini_outputs.json')
+
+
+@pytest.fixture
+def replay():
+    """The recorded Gemini outputs, replayed without their latencies."""
+    return ReplayBackend.from_file(RECORDINGS, latency_scale=0)
+
+
+@pytest.fixture
+def make_app():
+    """
+    make_app(reply=..., **config): an app configured with `config` over
+    Config, whose models are StubModels answering with `reply` (see
+    StubModel), on stub keys that are not rate governed unless
+    RATE_LIMIT_ENABLED is passed.
+    """
+    def factory(reply='<r>Stub reply.</r><cls>FI</cls>', **config):
+        settings = dict(
+            TESTING=True,
+            FREE_CHAT_MODEL_NAME='stub-chat', GOOGLE_API_KEY_FREE_CHAT='stub-key',
+            FREE_ACCESSORY_MODEL_NAME='stub-accessory', GOOGLE_API_KEY_FREE_ACCESSORY='stub-accessory-key',
+            PAID_MODEL_NAME='stub-paid', GOOGLE_API_KEY_RECOMENDATIONS='stub-recommend-key',
+            RATE_LIMIT_ENABLED=False, # Governed tests opt in
+        )
+        settings.update(config)
+        # A Config subclass, so settings read while the app is created (scheduler, governor) apply too
+        app = create_app(type('TestConfig', (Config,), settings))
+        app.extensions['prompt_cache'].enabled = False
+        app.extensions['model_registry'] = ModelRegistry(model_factory=stub_model_factory(reply=reply))
+        return app
+    return factory
@@ -0,0 +1,98 @@
+# File: tests/test_asgi.py
+
+import asyncio
+import itertools
+import threading
+
+import pytest
+from flask import Flask, Response
+
+from kapricorn.asgi import AsgiApp
+
+
+def _streaming_app():
+    """A Flask app whose /stream response never ends; `closed` is set once it is closed."""
+    app = Flask(__name__)
+    app.closed = threading.Event()
+
+    @app.route('/stream')
+    def stream():
+        def generate():
+            try:
+                for index in itertools.count():
+                    yield f"{index}\n"
+            finally:
+                app.closed.set()
+        return Response(generate(), mimetype='text/plain')
+
+    @app.route('/ping')
+    def ping():
+        return 'pong'
+
+    return app
+
+
+def _scope(path):
+    return {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+
+
+def _serve(asgi, path, send, disconnect_after=None):
+    """Runs one request; the client disconnects once `disconnect_after` body messages were sent."""
+    async def scenario():
+        sent = []
+        disconnected = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def record(message):
+            sent.append(message)
+            if disconnect_after is not None and len(sent) > disconnect_after:
+                disconnected.set()
+            await send(message)
+
+        await asyncio.wait_for(asgi(_scope(path), receive, record), 5)
+        return sent
+
+    return asyncio.run(scenario())
+
+
+async def _accept(message):
+    pass
+
+
+def test_wsgi_response_is_forwarded():
+    asgi = AsgiApp(_streaming_app(), wsgi_threads=2)
+    sent = _serve(asgi, '/ping', _accept)
+    assert sent[0]['status'] == 200
+    assert b''.join(message.get('body', b'') for message in sent[1:]) == b'pong'
+
+
+def test_disconnect_closes_the_wsgi_response():
+    app = _streaming_app()
+    asgi = AsgiApp(app, wsgi_threads=2)
+    sent = _serve(asgi, '/stream', _accept, disconnect_after=3)
+    assert sent[0]['type'] == 'http.response.start'
+    assert app.closed.wait(2)
+
+
+def test_send_error_closes_the_wsgi_response_and_frees_the_worker():
+    app = _streaming_app()
+    asgi = AsgiApp(app, wsgi_threads=1)
+    bodies = itertools.count()
+
+    async def failing_send(message):
+        if message['type'] == 'http.response.body' and next(bodies) == 2:
+            raise OSError('connection reset')
+
+    with pytest.raises(OSError):
+        _serve(asgi, '/stream', failing_send)
+    assert app.closed.wait(2)
+    # The only worker thread is free again
+    assert _serve(asgi, '/ping', _accept)[0]['status'] == 200
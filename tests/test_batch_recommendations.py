@@ -0,0 +1,49 @@
+# File: tests/test_batch_recommendations.py
+
+import json
+
+from kapricorn.stub_backend import classify_prompt
+
+
+def _post(client, locations):
+    response = client.post('/api/recommend/crops/batch', json={'locations': locations})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_batch_streams_one_line_per_location_then_a_summary(make_app, replay):
+    app = make_app(reply=replay, RECOMMENDATION_BATCH_PACK_SIZE=4)
+    app.extensions['recommendation_cache'].set('kano, nigeria', {'Sorghum': {'survivability': 80.0}})
+    locations = ['Ibadan, Oyo, Nigeria', 'Kano, Nigeria', 'ibadan, OYO, Nigeria.', 'Tamale, Ghana', 'Kisumu, Kenya']
+    lines = _post(app.test_client(), locations)
+
+    results, summary = lines[:-1], lines[-1]['summary']
+    assert results[0]['location'] == 'Kano, Nigeria' and results[0]['_cached'] # Cache hits first
+    assert results[0]['recommendations'] == {'Sorghum': {'survivability': 80.0}}
+    ibadan = next(line for line in results if line['location'] == 'Ibadan, Oyo, Nigeria')
+    assert ibadan['requested_as'] == ['Ibadan, Oyo, Nigeria', 'ibadan, OYO, Nigeria.']
+    assert sorted(line['location'] for line in results) == sorted(set(locations) - {'ibadan, OYO, Nigeria.'})
+    assert all(line['recommendations'] for line in results)
+    assert {key: summary[key] for key in ('requested', 'unique', 'cached', 'generated', 'failed')} == {
+        'requested': 5, 'unique': 4, 'cached': 1, 'generated': 3, 'failed': 0}
+    assert summary['elapsed_ms'] >= 0
+    # One pack: one analysis and one formatting call for the three misses
+    assert replay.served['analysis_batch'] == replay.served['formatting_batch'] == 1
+
+
+def test_batch_summary_counts_failures(make_app):
+    def reply(contents):
+        return '' if classify_prompt(contents) == 'analysis_batch' else '<r>unused</r>'
+
+    app = make_app(reply=reply)
+    lines = _post(app.test_client(), ['Tamale, Ghana', 'Kisumu, Kenya'])
+    assert all('error' in line for line in lines[:-1])
+    summary = lines[-1]['summary']
+    assert (summary['unique'], summary['generated'], summary['failed']) == (2, 0, 2)
+
+
+def test_batch_rejects_bad_bodies(make_app):
+    client = make_app(RECOMMENDATION_BATCH_MAX_LOCATIONS=2).test_client()
+    for body in ({}, {'locations': []}, {'locations': ['Kano', '  ']}, {'locations': ['a', 'b', 'c']}):
+        assert client.post('/api/recommend/crops/batch', json=body).status_code == 400
@@ -0,0 +1,116 @@
+# File: tests/test_breaker.py
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from kapricorn import breaker as breaker_module
+from kapricorn.ai_service import call_ai_model
+from kapricorn.breaker import CLOSED, HALF_OPEN, OPEN, BreakerBoard, CircuitBreaker, CircuitOpen
+
+
+class FakeClock:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(breaker_module.time, 'monotonic', lambda: self.now)
+
+
+def _fail(breaker, count=1):
+    for _ in range(count):
+        breaker.record(breaker.admit(), True, 0.1, google_exceptions.ServiceUnavailable('overloaded'))
+
+
+def _succeed(breaker, count=1, latency=0.1):
+    for _ in range(count):
+        breaker.record(breaker.admit(), False, latency)
+
+
+def test_opens_on_the_failure_rate_once_enough_calls_are_on_record(monkeypatch):
+    FakeClock(monkeypatch)
+    breaker = CircuitBreaker(min_calls=4, failure_threshold=0.5, open_seconds=30)
+    _fail(breaker, 3)
+    assert breaker.state == CLOSED # Below min_calls
+    _succeed(breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen) as rejected:
+        breaker.admit()
+    assert rejected.value.retry_after == 30
+    stats = breaker.stats()
+    assert (stats['rejected'], stats['opened'], stats['window_failure_rate']) == (1, 1, 0.75)
+    assert stats['last_error'].startswith('ServiceUnavailable')
+
+
+def test_opens_on_the_slow_call_rate(monkeypatch):
+    FakeClock(monkeypatch)
+    breaker = CircuitBreaker(min_calls=4, slow_call_seconds=5, slow_call_threshold=0.75)
+    _succeed(breaker, 3, latency=6)
+    _succeed(breaker, 1)
+    assert breaker.state == OPEN
+
+
+def test_old_outcomes_leave_the_window(monkeypatch):
+    clock = FakeClock(monkeypatch)
+    breaker = CircuitBreaker(min_calls=4, window_seconds=60)
+    _fail(breaker, 3)
+    clock.now += 61
+    _fail(breaker)
+    _succeed(breaker, 3)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_closes_or_reopens(monkeypatch):
+    clock = FakeClock(monkeypatch)
+    breaker = CircuitBreaker(min_calls=2, open_seconds=30)
+    _fail(breaker, 2)
+    clock.now += 30
+    probe = breaker.admit()
+    assert probe is True and breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.admit() # Only one probe at a time
+    breaker.record(probe, True, 0.1)
+    assert breaker.state == OPEN
+
+    clock.now += 30
+    breaker.record(breaker.admit(), False, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.stats()['window_calls'] == 0 # Closed with a fresh window
+
+
+def test_board_counts_only_upstream_health(monkeypatch):
+    FakeClock(monkeypatch)
+    board = BreakerBoard(min_calls=1)
+    with pytest.raises(google_exceptions.InvalidArgument):
+        with board.call('model', 'key') as call:
+            call.started()
+            raise google_exceptions.InvalidArgument('bad request')
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        with board.call('model', 'key') as call:
+            call.started()
+            raise google_exceptions.ResourceExhausted('quota')
+    assert board.open_circuits() == []
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        with board.call('model', 'key') as call:
+            call.started()
+            raise google_exceptions.ServiceUnavailable('overloaded')
+    assert board.open_circuits() == [('model', 'key')]
+
+    disabled = BreakerBoard(enabled=False, min_calls=1)
+    for _ in range(3):
+        with pytest.raises(google_exceptions.ServiceUnavailable):
+            with disabled.call('model', 'key'):
+                raise google_exceptions.ServiceUnavailable('overloaded')
+    assert disabled.stats() == {}
+
+
+def test_open_circuit_fails_fast_without_calling_the_model(make_app):
+    calls = []
+
+    def reply(contents):
+        calls.append(1)
+        raise google_exceptions.ServiceUnavailable('The model is overloaded. (stub)')
+
+    app = make_app(reply=reply, CIRCUIT_MIN_CALLS=2, RETRY_MAX_ATTEMPTS=1, HEDGE_ENABLED=False)
+    with app.app_context():
+        results = [call_ai_model('Hello', 'stub-chat', 'stub-key') for _ in range(3)]
+    assert len(calls) == 2
+    assert results[2]['unavailable'] is True and results[2]['retry_after'] >= 1
+    assert app.extensions['circuit_breakers'].open_circuits() == [('stub-chat', 'stub-key')]
@@ -0,0 +1,72 @@
+# File: tests/test_cache.py
+
+from kapricorn import cache as cache_module
+from kapricorn.ai_service import get_recommendations
+from kapricorn.cache import TieredCache, TTLCache, normalize_location
+
+
+def test_normalize_location_ignores_spelling_noise():
+    assert normalize_location("  Ibadan,  Oyo,NIGERIA. ") == "ibadan, oyo, nigeria"
+    assert normalize_location("Ségou, Mali, Mali") == "segou, mali"
+    assert normalize_location("Ibadan, Nigeria") != normalize_location("Nigeria, Ibadan")
+    assert normalize_location(None) == ""
+
+
+def test_ttl_cache_evicts_the_least_recently_used():
+    cache = TTLCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    cache = TTLCache(ttl_seconds=10)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl_seconds=100)
+    now = cache_module.time.monotonic()
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now + 50)
+    assert cache.get('a') is None
+    assert cache.get_first(['a', 'b']) == ('b', 2)
+    stats = cache.stats()
+    assert (stats['expirations'], stats['hits'], stats['misses']) == (1, 1, 1)
+
+
+def test_tiered_cache_survives_a_restart(tmp_path):
+    url = f"sqlite:///{tmp_path / 'cache.db'}"
+    TieredCache(database_url=url, ttl_seconds=600).set('ibadan, nigeria', {'Maize': {'survivability': 80.0}})
+
+    restarted = TieredCache(database_url=url, ttl_seconds=600)
+    assert restarted.get('ibadan, nigeria') == {'Maize': {'survivability': 80.0}}
+    assert restarted.get('ibadan, nigeria') is not None # Promoted to memory
+    stats = restarted.stats()
+    assert (stats['persistent_hits'], stats['memory_hits'], stats['misses']) == (1, 1, 0)
+    assert 0 < restarted.memory._entries['ibadan, nigeria'][0] - cache_module.time.monotonic() <= 600
+
+
+def test_recommendations_are_served_from_cache_for_the_same_place(make_app, replay):
+    calls = []
+
+    def reply(contents):
+        calls.append(1)
+        return replay(contents)
+
+    app = make_app(reply=reply)
+    with app.app_context():
+        first = get_recommendations('Ibadan, Oyo, Nigeria')
+        upstream_calls = len(calls)
+        second = get_recommendations('  ibadan, OYO, Nigeria.')
+    assert len(calls) == upstream_calls
+    assert second['_cache_hit'] is True
+    assert second['_total_input_tokens'] == second['_total_output_tokens'] == 0
+    crops = lambda result: {key: value for key, value in result.items() if not key.startswith('_')}
+    assert crops(second) == crops(first) and crops(first)
+
+
+def test_failed_recommendations_are_not_cached(make_app):
+    app = make_app(reply='')
+    with app.app_context():
+        assert 'error' in get_recommendations('Ibadan, Oyo, Nigeria')
+        assert app.extensions['recommendation_cache'].get('ibadan, oyo, nigeria') is None
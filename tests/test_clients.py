@@ -0,0 +1,76 @@
+# File: tests/test_clients.py
+
+import threading
+
+from kapricorn.clients import ModelRegistry, key_fingerprint
+
+
+def _registry():
+    """A registry whose factory records (model_name, client manager, cached_content) for each model built."""
+    built = []
+
+    def factory(model_name, client_manager, cached_content=None):
+        built.append((model_name, client_manager, cached_content))
+        return object()
+
+    return ModelRegistry(model_factory=factory), built
+
+
+def test_models_are_created_once_and_shared():
+    registry, built = _registry()
+    first = registry.get_model('key-a', 'gemini-flash')
+    assert registry.get_model('key-a', 'gemini-flash') is first
+    assert registry.get_model('key-a', 'gemini-pro') is not first
+    assert len(built) == 2
+    assert registry.stats()['reuse_hits'] == 1
+
+
+def test_each_key_gets_its_own_client_manager():
+    registry, built = _registry()
+    registry.get_model('key-a', 'gemini-flash')
+    registry.get_model('key-b', 'gemini-flash')
+    registry.get_model('key-a', 'gemini-pro')
+    managers = [manager for _, manager, _ in built]
+    assert managers[0] is managers[2] is registry.client_manager('key-a')
+    assert managers[1] is not managers[0]
+    assert registry.stats()['api_key_clients'] == 2
+
+
+def test_concurrent_first_use_builds_one_model():
+    registry, built = _registry()
+    start = threading.Barrier(8)
+    models = []
+
+    def worker():
+        start.wait()
+        models.append(registry.get_model('key-a', 'gemini-flash'))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(built) == 1
+    assert all(model is models[0] for model in models)
+
+
+def test_cached_content_models_are_separate_and_discardable():
+    registry, built = _registry()
+    plain = registry.get_model('key-a', 'gemini-flash')
+    cached = registry.get_model('key-a', 'gemini-flash', cached_content='cachedContents/1')
+    assert cached is not plain and built[1][2] == 'cachedContents/1'
+    registry.discard_cached_content('cachedContents/1')
+    assert registry.get_model('key-a', 'gemini-flash', cached_content='cachedContents/1') is not cached
+    assert registry.get_model('key-a', 'gemini-flash') is plain
+
+
+def test_lease_tracks_in_flight_calls_by_fingerprint():
+    registry, _ = _registry()
+    fingerprint = key_fingerprint('secret-key')
+    with registry.lease('secret-key', 'gemini-flash'):
+        with registry.lease('secret-key', 'gemini-flash'):
+            assert registry.stats()['in_flight'] == {fingerprint: 2}
+    stats = registry.stats()
+    assert stats['in_flight'] == {fingerprint: 0}
+    assert 'secret-key' not in repr(stats)
+    assert stats['models'] == [f"{fingerprint}:gemini-flash"]
@@ -0,0 +1,111 @@
+# File: tests/test_context_window.py
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from kapricorn.context_window import ContextWindowManager
+from kapricorn.tokens import TokenAccountant
+
+
+def turns(count):
+    history = []
+    for index in range(count):
+        history.append({'role': 'user', 'parts': [f"Question {index}: " + 'about maize ' * 20]})
+        history.append({'role': 'model', 'parts': [f"<r>Answer {index}: " + 'plant in rows ' * 20 + "</r>"]})
+    return history
+
+
+def summarizer(calls):
+    def summarize(previous, messages):
+        calls.append(len(messages))
+        return f"{previous} +{len(messages)}".strip()
+    return summarize
+
+
+def test_stateless_history_reuses_its_summary():
+    window = ContextWindowManager(TokenAccountant(), default_budget=700, keep_recent_messages=2,
+                                  reserve_tokens=0)
+    calls = []
+    history = turns(6) + [{'role': 'user', 'parts': ["Next question"]}]
+    first, trimmed = window.fit(list(history), 'model', '', summarizer(calls))
+    assert trimmed > 0 and len(calls) == 1
+    assert first[0]['parts'][0].startswith('<g>Summary of the earlier conversation')
+
+    # The client sends the same transcript plus the reply and a new question
+    history = history + [{'role': 'model', 'parts': ["<r>Short answer</r>"]},
+                         {'role': 'user', 'parts': ["Another question"]}]
+    second, _ = window.fit(history, 'model', '', summarizer(calls))
+    assert len(calls) == 1 # The stored summary still fits; nothing new is summarized
+    assert second[0] == first[0]
+
+    # One summary lookup per request, however long the history
+    summaries = window.stats()['summaries']
+    assert (summaries['hits'], summaries['misses']) == (1, 1)
+
+
+def test_edited_stateless_history_does_not_reuse_a_summary():
+    window = ContextWindowManager(TokenAccountant(), default_budget=700, keep_recent_messages=2,
+                                  reserve_tokens=0)
+    calls = []
+    history = turns(6) + [{'role': 'user', 'parts': ["Next question"]}]
+    window.fit(list(history), 'model', '', summarizer(calls))
+    edited = [{'role': 'user', 'parts': ["A different first question"]}] + history[1:]
+    window.fit(edited, 'model', '', summarizer(calls))
+    assert len(calls) == 2
+
+
+def test_slow_summary_is_used_from_the_next_turn():
+    window = ContextWindowManager(TokenAccountant(), default_budget=700, keep_recent_messages=2,
+                                  reserve_tokens=0, executor=ThreadPoolExecutor(max_workers=1),
+                                  summary_timeout_seconds=0.05)
+    release = threading.Event()
+    calls = []
+
+    def slow_summarize(previous, messages):
+        calls.append(len(messages))
+        release.wait(5)
+        return "Earlier: maize questions."
+
+    history = turns(6) + [{'role': 'user', 'parts': ["Next question"]}]
+    first, trimmed = window.fit(list(history), 'model', '', slow_summarize, conversation_key='c1')
+    # Not ready: the older turns are dropped, and the turn does not wait for the summary
+    assert trimmed > 0 and first[0]['role'] == 'user'
+    assert not any('Summary of the earlier conversation' in str(message['parts']) for message in first)
+    assert window.stats()['summary_timeouts'] == 1
+
+    # A turn arriving meanwhile does not start a second summary
+    window.fit(list(history), 'model', '', slow_summarize, conversation_key='c1')
+    assert len(calls) == 1
+
+    release.set()
+    window.executor.shutdown(wait=True)
+    later, _ = window.fit(list(history), 'model', '', slow_summarize, conversation_key='c1')
+    assert later[0]['parts'] == ["<g>Summary of the earlier conversation: Earlier: maize questions.</g>"]
+    assert len(calls) == 1
+
+
+def notice_history(answered):
+    history = turns(2)
+    history.append({'role': 'user', 'parts': ["<g>System: Visual data generated successfully.</g>"]})
+    if answered:
+        history.append({'role': 'model', 'parts': ["<gr>Ok.</gr>"]})
+    return history + turns(4)[2:] + [{'role': 'user', 'parts': ["Next question"]}]
+
+
+def test_folded_notice_is_carried_with_its_reply():
+    window = ContextWindowManager(TokenAccountant(), default_budget=700, keep_recent_messages=2,
+                                  reserve_tokens=0)
+    fitted, _ = window.fit(notice_history(answered=True), 'model', '', summarizer([]))
+    roles = [message['role'] for message in fitted]
+    assert fitted[2]['parts'][0].startswith('<g>System: Visual data')
+    assert fitted[3]['parts'] == ["<gr>Ok.</gr>"]
+    assert all(first != second for first, second in zip(roles, roles[1:]))
+
+
+def test_unanswered_folded_notice_is_skipped():
+    history = notice_history(answered=False)
+    notice = next(index for index, message in enumerate(history) if 'Visual data' in str(message['parts']))
+    # Folding right after the notice would put it next to the first kept (user) turn
+    assert ContextWindowManager._latest_notice(history, notice + 1) == []
+    answered = notice_history(answered=True)
+    assert ContextWindowManager._latest_notice(answered, notice + 2) == answered[notice:notice + 2]
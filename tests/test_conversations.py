@@ -0,0 +1,84 @@
+# File: tests/test_conversations.py
+
+import pytest
+
+from kapricorn import conversations
+from kapricorn.conversations import MemoryConversationStore, SQLConversationStore
+
+TURN = [{'role': 'user', 'parts': ['When do I plant maize?']},
+        {'role': 'model', 'parts': ['<r>In May.</r>']}]
+
+
+@pytest.fixture(params=['memory', 'sql'])
+def store(request):
+    if request.param == 'memory':
+        return MemoryConversationStore()
+    return SQLConversationStore('sqlite://')
+
+
+def test_transcript_round_trip(store):
+    conversation_id = store.create()
+    assert store.get(conversation_id) == []
+    assert store.append(conversation_id, TURN[:1])
+    assert store.append(conversation_id, TURN[1:])
+    assert store.get(conversation_id) == TURN
+    assert store.stats()['conversations'] == 1
+    assert store.delete(conversation_id)
+    assert store.get(conversation_id) is None
+    assert not store.append(conversation_id, TURN)
+
+
+def test_idle_conversations_expire(store, monkeypatch):
+    conversation_id = store.create()
+    later = conversations.time.time() + store.ttl_seconds + 1 # Past both clocks' expiry
+    monkeypatch.setattr(conversations.time, 'monotonic', lambda: later)
+    monkeypatch.setattr(conversations.time, 'time', lambda: later)
+    assert store.get(conversation_id) is None
+    assert not store.append(conversation_id, TURN)
+
+
+def test_one_turn_at_a_time(store):
+    conversation_id = store.create()
+    assert store.begin_turn(conversation_id)
+    assert not store.begin_turn(conversation_id)
+    assert store.begin_turn(store.create()) # Other conversations are not affected
+    store.end_turn(conversation_id)
+    assert store.begin_turn(conversation_id)
+
+
+def test_memory_store_evicts_the_least_recently_used():
+    store = MemoryConversationStore(max_conversations=2)
+    first, second = store.create(), store.create()
+    store.get(first)
+    third = store.create()
+    assert store.get(second) is None
+    assert store.get(first) == [] and store.get(third) == []
+
+
+def _body(**fields):
+    return dict({'message': 'When do I plant maize?', 'location': 'Kano, Nigeria',
+                 'npk': 'N/A', 'date': '2025-05-01'}, **fields)
+
+
+def test_chat_keeps_the_history_server_side(make_app):
+    app = make_app(reply='<r>In May.</r><cls>FI</cls>')
+    client = app.test_client()
+    first = client.post('/api/chat/', json=_body(conversation_id=None)).get_json()
+    conversation_id = first['conversation_id']
+    client.post('/api/chat/', json=_body(conversation_id=conversation_id, message='And cassava?'))
+
+    history = client.get(f'/api/chat/conversations/{conversation_id}').get_json()['history']
+    assert [message['role'] for message in history] == ['user', 'model', 'user', 'model']
+    assert history[2]['parts'] == ['And cassava?']
+
+
+def test_concurrent_turn_gets_409(make_app):
+    app = make_app()
+    store = app.extensions['conversation_store']
+    conversation_id = store.create()
+    store.begin_turn(conversation_id) # A turn is already being answered
+    response = app.test_client().post('/api/chat/', json=_body(conversation_id=conversation_id))
+    assert response.status_code == 409
+    assert store.get(conversation_id) == []
+    store.end_turn(conversation_id)
+    assert app.test_client().post('/api/chat/', json=_body(conversation_id=conversation_id)).status_code == 200
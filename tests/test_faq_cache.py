@@ -0,0 +1,52 @@
+# File: tests/test_faq_cache.py
+
+import pytest
+
+from kapricorn.faq_cache import SemanticFAQCache, key_terms
+
+NAMESPACE = 'free|oyo, nigeria|m06'
+CACHED = "How many bags of NPK per hectare of maize?"
+
+
+@pytest.fixture
+def cache():
+    cache = SemanticFAQCache(threshold=0.75, audit_rate=0)
+    cache.add(CACHED, "<r>Apply 4 bags of NPK 15-15-15 per hectare.</r>", NAMESPACE, {})
+    return cache
+
+
+@pytest.mark.parametrize('question', [
+    "How many bags of urea per hectare of maize?",
+    "How many bags of NPK per hectare of cassava?",
+    "How many bags of NPK per acre of maize?",
+    "How many bags of NPK per 2 hectares of maize?",
+])
+def test_near_misses_are_not_hits(cache, question):
+    entry, _ = cache.lookup(question, NAMESPACE)
+    assert entry is None
+
+
+def test_near_miss_above_threshold_is_counted(cache):
+    entry, similarity = cache.lookup("How many bags of urea per hectare of maize?", NAMESPACE)
+    assert entry is None and similarity == 0.0
+    assert cache.stats()['key_term_mismatches'] == 1
+
+
+@pytest.mark.parametrize('question', [
+    "How many bags of NPK should I apply per hectare of maize?",
+    "how many bags of npk per hectare of corn",
+])
+def test_paraphrases_are_hits(cache, question):
+    entry, similarity = cache.lookup(question, NAMESPACE)
+    assert entry is not None and entry.question == CACHED
+    assert similarity >= cache.threshold
+
+
+def test_other_namespace_is_a_miss(cache):
+    entry, _ = cache.lookup(CACHED, 'free|kano, nigeria|m06')
+    assert entry is None
+
+
+def test_key_terms_normalize_aliases_and_plurals():
+    assert key_terms("Tomatoes or corn on 2 ha?") == {'tomato', 'maize', 'hectare', '2'}
+    assert key_terms("When should I plant?") == frozenset()
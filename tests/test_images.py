@@ -0,0 +1,89 @@
+# File: tests/test_images.py
+
+import io
+
+import pytest
+from PIL import Image
+
+from kapricorn.images import ImageRejected, ImageStore, ImageTooLarge
+
+
+def _image_bytes(size=(1600, 1200), fmt='PNG', color=(30, 120, 40)):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, format=fmt)
+    return out.getvalue()
+
+
+class _UnsizedStream:
+    """A stream with no length, read chunk by chunk (as in a chunked upload)."""
+
+    def __init__(self, data):
+        self._buffer = io.BytesIO(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = self._buffer.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+def test_upload_is_downscaled_and_stored_as_jpeg(tmp_path):
+    store = ImageStore(str(tmp_path), max_dimension=768)
+    saved = store.save(io.BytesIO(_image_bytes()))
+    assert (saved['width'], saved['height'], saved['mime_type']) == (768, 576, 'image/jpeg')
+    assert not saved['deduplicated']
+    with Image.open(io.BytesIO(store.load(saved['image_id']))) as stored:
+        assert (stored.format, stored.size) == ('JPEG', (768, 576))
+    assert store.inline_part(saved['image_id'])['inline_data']['mime_type'] == 'image/jpeg'
+
+
+def test_same_picture_is_stored_once(tmp_path):
+    store = ImageStore(str(tmp_path))
+    first = store.save(_image_bytes())
+    again = store.save(_image_bytes()) # Identical upload: decoding is skipped
+    converted = store.save(_image_bytes(fmt='GIF')) # Same pixels, other encoding
+    assert again == {'image_id': first['image_id'], 'mime_type': 'image/jpeg', 'deduplicated': True}
+    assert converted['image_id'] == first['image_id'] and converted['deduplicated']
+    stats = store.stats()
+    assert (stats['uploads'], stats['deduplicated'], stats['bytes_stored']) == (3, 2, first['bytes'])
+
+
+def test_oversized_stream_is_rejected_without_reading_it_all(tmp_path):
+    store = ImageStore(str(tmp_path), max_upload_bytes=100 * 1024)
+    stream = _UnsizedStream(b'\0' * (1024 * 1024))
+    with pytest.raises(ImageTooLarge):
+        store.save(stream)
+    assert stream.bytes_read < 200 * 1024
+    with pytest.raises(ImageTooLarge):
+        store.save(b'\0' * (100 * 1024 + 1))
+
+
+def test_unreadable_and_disallowed_images_are_rejected(tmp_path):
+    store = ImageStore(str(tmp_path), allowed_extensions={'jpg', 'jpeg'})
+    with pytest.raises(ImageRejected):
+        store.save(b'not an image')
+    with pytest.raises(ImageRejected):
+        store.save(_image_bytes(fmt='PNG'))
+    assert store.load('../../etc/passwd') is None and not store.exists('ab' * 32)
+
+
+def _multipart(data, boundary='kapricorn-test'):
+    return (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="farm.png"\r\n'
+            f'Content-Type: image/png\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+
+
+def test_route_limits_uploads_without_content_length(make_app, tmp_path):
+    app = make_app(IMAGE_STORE_PATH=str(tmp_path), IMAGE_MAX_UPLOAD_BYTES=64 * 1024)
+    client = app.test_client()
+
+    def upload(data):
+        # No Content-Length: the body is read until the (chunked) input ends
+        return client.post('/api/chat/images', input_stream=io.BytesIO(_multipart(data)),
+                           content_type='multipart/form-data; boundary=kapricorn-test',
+                           environ_overrides={'wsgi.input_terminated': True})
+
+    assert upload(b'\0' * (256 * 1024)).status_code == 413
+    response = upload(_image_bytes(size=(64, 64)))
+    assert response.status_code == 201
+    image_id = response.get_json()['images'][0]['image_id']
+    assert client.get(f'/api/chat/images/{image_id}').status_code == 200
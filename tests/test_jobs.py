@@ -0,0 +1,90 @@
+# File: tests/test_jobs.py
+
+import threading
+
+from flask import Flask, current_app
+
+from kapricorn import jobs as jobs_module
+from kapricorn.jobs import DONE, FAILED, PENDING, RUNNING, JobManager
+from kapricorn.stub_backend import classify_prompt
+
+
+def _manager(**kwargs):
+    app = Flask(__name__)
+    app.config['GREETING'] = 'hello'
+    return JobManager(app, max_workers=1, **kwargs)
+
+
+def test_job_runs_in_the_app_context():
+    manager = _manager()
+    job = manager.submit('test', lambda name: f"{current_app.config['GREETING']} {name}", 'farmer')
+    assert job.wait(5)
+    assert manager.get(job.id).to_dict() == {
+        'job_id': job.id, 'kind': 'test', 'status': DONE, 'result': 'hello farmer', 'error': None}
+
+
+def test_failed_job_reports_a_generic_error():
+    def fail():
+        raise RuntimeError('secret upstream detail')
+
+    job = _manager().submit('test', fail)
+    assert job.wait(5)
+    assert job.status == FAILED
+    assert job.error == 'Background job failed unexpectedly.'
+
+
+def test_status_flips_only_after_the_completion_hook():
+    release = threading.Event()
+    seen = []
+
+    def hook(job):
+        seen.append((job.status, job.result))
+        release.wait(5)
+
+    job = _manager().submit('test', lambda: 42, on_complete=hook)
+    assert not job.wait(0.05) # Held in the hook
+    assert job.status == RUNNING
+    release.set()
+    assert job.wait(5)
+    assert seen == [(RUNNING, 42)]
+    assert job.status == DONE
+
+
+def test_queued_jobs_stay_pending_and_finished_jobs_expire(monkeypatch):
+    manager = _manager(ttl_seconds=60)
+    release = threading.Event()
+    first = manager.submit('test', release.wait, 5)
+    second = manager.submit('test', lambda: 'next')
+    assert second.status == PENDING # The only worker is busy
+    release.set()
+    assert first.wait(5) and second.wait(5)
+    assert manager.stats() == {'jobs': {DONE: 2}}
+
+    later = jobs_module.time.time() + 61
+    monkeypatch.setattr(jobs_module.time, 'time', lambda: later)
+    third = manager.submit('test', lambda: 'later')
+    assert manager.get(first.id) is None and manager.get(second.id) is None
+    assert manager.get(third.id) is third
+
+
+def test_chat_queues_visuals_and_the_poll_returns_them(make_app, replay):
+    def reply(contents):
+        if classify_prompt(contents) == 'farmBot':
+            return '<r>Here is your plan.</r><gen>Maize|timeline|Kano|2025-05-01|N:20,P:10,K:10</gen><cls>MF</cls>'
+        return replay(contents)
+
+    app = make_app(reply=reply, VISUALS_ASYNC=True)
+    client = app.test_client()
+    body = {'message': 'Plan my maize', 'history': [], 'location': 'Kano, Nigeria',
+            'npk': 'N:20,P:10,K:10', 'date': '2025-05-01'}
+    payload = client.post('/api/chat/', json=body).get_json()
+    assert payload['visuals_data'] is None
+    job_id = payload['visuals_job_id']
+
+    assert app.extensions['job_manager'].get(job_id).wait(5)
+    response = client.get(f'/api/chat/visuals/{job_id}')
+    assert response.status_code == 200
+    result = response.get_json()['result']
+    assert result['visuals_data']['timeline']['stages']
+    assert [message['role'] for message in result['history_messages']] == ['user', 'model']
+    assert client.get('/api/chat/visuals/unknown').status_code == 404
@@ -0,0 +1,101 @@
+# File: tests/test_prompt_cache.py
+
+import threading
+import time
+
+from kapricorn import prompt_cache as prompt_cache_module
+from kapricorn.clients import ModelRegistry
+from kapricorn.prompt_cache import PromptPrefixCache
+
+PREFIX = [{'role': 'user', 'parts': ['You are farmBot. ' * 40]},
+          {'role': 'model', 'parts': ['Understood.']}]
+TURN = [{'role': 'user', 'parts': ['When do I plant maize?']}]
+
+
+class FakeBackend:
+    """Records create calls; each one hands out the next cache name, or raises `error`."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+        self.created = threading.Event()
+
+    def create(self, api_key, model_name, contents, ttl_seconds):
+        self.calls.append((api_key, model_name, len(contents)))
+        try:
+            if self.error:
+                raise self.error
+            return f"cachedContents/{len(self.calls)}", prompt_cache_module.time.time() + ttl_seconds
+        finally:
+            self.created.set()
+
+
+def _cache(backend, **kwargs):
+    cache = PromptPrefixCache(ModelRegistry(model_factory=lambda *args, **kw: object()), backend,
+                              min_tokens=100, models=('gemini-1.5-flash-001',), **kwargs)
+    cache.register('farmBot', PREFIX)
+    return cache
+
+
+def _settle(cache, backend):
+    """Waits for the background creation started by the last bind to finish."""
+    assert backend.created.wait(5)
+    backend.created.clear()
+    for _ in range(500):
+        if not any(entry.refreshing for entry in cache._entries.values()):
+            return
+        time.sleep(0.01)
+
+
+def test_first_turn_goes_inline_while_the_cache_is_created():
+    backend = FakeBackend()
+    cache = _cache(backend)
+    assert cache.bind('key', 'models/gemini-1.5-flash-001', PREFIX + TURN) == (None, PREFIX + TURN, 'farmBot')
+    _settle(cache, backend)
+    assert cache.bind('key', 'models/gemini-1.5-flash-001', PREFIX + TURN) == ('cachedContents/1', TURN, 'farmBot')
+    assert backend.calls == [('key', 'models/gemini-1.5-flash-001', 2)]
+    stats = cache.stats()
+    assert (stats['creations'], stats['inline_turns'], stats['active_caches']) == (1, 1, 1)
+
+
+def test_unsupported_models_short_prefixes_and_other_prompts_go_inline():
+    backend = FakeBackend()
+    cache = _cache(backend)
+    cache.register('tiny', [{'role': 'user', 'parts': ['Too short to cache.']}])
+    assert cache.stats()['prefixes'] == ['farmBot']
+    assert cache.bind('key', 'gemini-1.0-pro', PREFIX + TURN) == (None, PREFIX + TURN, None)
+    assert cache.bind('key', 'gemini-1.5-flash-001', TURN) == (None, TURN, None)
+    assert cache.bind('key', 'gemini-1.5-flash-001', PREFIX) == (None, PREFIX, None) # Nothing after the prefix
+    assert backend.calls == []
+
+
+def test_failed_creation_backs_off():
+    backend = FakeBackend(error=RuntimeError('content too small'))
+    cache = _cache(backend, failure_backoff_seconds=60)
+    cache.bind('key', 'gemini-1.5-flash-001', PREFIX + TURN)
+    _settle(cache, backend)
+    assert cache.bind('key', 'gemini-1.5-flash-001', PREFIX + TURN)[0] is None
+    assert len(backend.calls) == 1
+    assert cache.stats()['failures'] == 1
+
+
+def test_cache_near_expiry_is_used_while_it_is_refreshed(monkeypatch):
+    backend = FakeBackend()
+    cache = _cache(backend, ttl_seconds=600, refresh_margin_seconds=300)
+    cache.bind('key', 'gemini-1.5-flash-001', PREFIX + TURN)
+    _settle(cache, backend)
+
+    later = prompt_cache_module.time.time() + 400 # Inside the refresh margin, not expired
+    monkeypatch.setattr(prompt_cache_module.time, 'time', lambda: later)
+    assert cache.bind('key', 'gemini-1.5-flash-001', PREFIX + TURN)[0] == 'cachedContents/1'
+    _settle(cache, backend)
+    assert cache.bind('key', 'gemini-1.5-flash-001', PREFIX + TURN)[0] == 'cachedContents/2'
+    assert cache.stats()['refreshes'] == 1
+
+
+def test_record_usage_averages_cached_tokens():
+    cache = _cache(FakeBackend())
+    cache.record_usage('farmBot', 1200)
+    cache.record_usage('farmBot', 800)
+    stats = cache.stats()
+    assert (stats['cached_turns'], stats['avg_cached_tokens_per_turn']) == (2, 1000.0)
@@ -0,0 +1,95 @@
+# File: tests/test_ratelimit.py
+
+import asyncio
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from kapricorn.clients import key_fingerprint
+from kapricorn.ratelimit import KeyGovernor, RateGovernor, RateLimited, parse_rate_limits, rate_limit_patience
+
+QUOTA_ERROR = google_exceptions.ResourceExhausted('Quota exceeded (stub)')
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits('FREE_CHAT=15:4, PAID=1000') == {'FREE_CHAT': (15.0, 4), 'PAID': (1000.0, 1)}
+    assert parse_rate_limits({'PAID': ('60', '8')}) == {'PAID': (60.0, 8)}
+    assert parse_rate_limits(None) == {}
+
+
+def test_quota_error_halves_the_limits_once_per_cooldown():
+    governor = KeyGovernor(60, 4, cooldown_seconds=60)
+    permits = [governor.acquire() for _ in range(2)]
+    permits[0].release(QUOTA_ERROR)
+    permits[1].release(QUOTA_ERROR) # Same overload: not counted twice
+    stats = governor.stats()
+    assert (stats['rate_per_minute'], stats['concurrency_limit']) == (30.0, 2)
+    assert (stats['quota_errors'], stats['decreases']) == (2, 1)
+    # The key is paused for the cooldown
+    with rate_limit_patience(0.05), pytest.raises(RateLimited) as limited:
+        governor.acquire()
+    assert limited.value.retry_after >= 59
+
+
+def test_successes_raise_the_limits_back_to_the_ceiling():
+    governor = KeyGovernor(600, 4, cooldown_seconds=0)
+    governor.acquire().release(QUOTA_ERROR)
+    assert (governor.stats()['rate_per_minute'], governor.stats()['concurrency_limit']) == (300.0, 2)
+    governor.acquire().release()
+    assert governor.stats()['rate_per_minute'] == 300.0 + 600 * 0.02 # Additive increase
+    for _ in range(200):
+        governor._tokens = governor._burst # Skip the token wait; only the AIMD matters here
+        with governor.acquire():
+            pass
+    stats = governor.stats()
+    assert (stats['rate_per_minute'], stats['concurrency_limit']) == (600.0, 4)
+
+
+def test_concurrency_limit_and_queue():
+    governor = KeyGovernor(6000, 2, max_wait_seconds=0.05, max_queue=1)
+    held = [governor.acquire(), governor.acquire()]
+    with pytest.raises(RateLimited):
+        governor.acquire() # Waits its turn, then times out
+
+    async def scenario():
+        waiting = asyncio.ensure_future(governor.acquire_async())
+        await asyncio.sleep(0.01)
+        with pytest.raises(RateLimited) as full:
+            await governor.acquire_async() # The one queue place is taken
+        held[0].release()
+        (await waiting).release()
+        return full.value
+
+    assert 'queued' in str(asyncio.run(scenario()))
+    held[1].release()
+    assert governor.stats()['in_flight'] == 0
+
+
+def test_token_bucket_paces_calls():
+    governor = KeyGovernor(60, 1, max_wait_seconds=0.05) # One call per second
+    governor.acquire().release()
+    with pytest.raises(RateLimited) as limited:
+        governor.acquire()
+    assert limited.value.retry_after >= 1
+
+
+def test_rate_governor_limits_only_configured_keys():
+    governor = RateGovernor({'limited': (60, 1)}, max_wait_seconds=0.05)
+    with governor.acquire('limited'):
+        with pytest.raises(RateLimited):
+            governor.acquire('limited')
+        with governor.acquire('other'), governor.acquire('other'):
+            pass
+    assert governor.for_key('other') is None
+    assert list(governor.stats()) == [key_fingerprint('limited')]
+    with RateGovernor({'limited': (60, 1)}, enabled=False).acquire('limited'):
+        pass
+
+
+def test_settings_sharing_a_key_get_the_tighter_limits(make_app):
+    app = make_app(RATE_LIMIT_ENABLED=True, RATE_LIMITS='FREE_CHAT=15:4,FREE_ACCESSORY=10:8,PAID=1000:32',
+                   GOOGLE_API_KEY_FREE_CHAT='shared-key', GOOGLE_API_KEY_FREE_ACCESSORY='shared-key')
+    governor = app.extensions['rate_governor'].for_key('shared-key')
+    stats = governor.stats()
+    assert (stats['ceiling_rate_per_minute'], stats['max_concurrency']) == (10.0, 4)
+    assert app.extensions['rate_governor'].for_key('stub-recommend-key') is None # No RECOMENDATIONS limit set
@@ -0,0 +1,116 @@
+# File: tests/test_recommendation_engine.py
+
+import pytest
+
+from kapricorn.recommendation_engine import CropRecordParser, iter_crops, parse_survivability
+
+
+@pytest.mark.parametrize('value, expected', [
+    ("65%", 65.0),
+    ("60-70%", 65.0),
+    ("60 to 70%", 65.0),
+    ("60% - 70%", 65.0),
+    ("60–70%", 65.0),
+    ("about 80 percent", 80.0),
+    ("0.7", 70.0),
+    ("0.6-0.8", 70.0),
+    ("120%", 100.0),
+    # Only the first number counts, unless it starts an explicit range
+    ("75% in year 1", 75.0),
+    ("85% (3-4 months)", 85.0),
+    ("about 70 percent, 2 seasons", 70.0),
+])
+def test_parse_survivability(value, expected):
+    assert parse_survivability(value) == expected
+
+
+@pytest.mark.parametrize('value', [None, '', 'unknown', 'high'])
+def test_parse_survivability_unusable(value):
+    assert parse_survivability(value) is None
+
+
+MAIZE = """<crop>Maize</crop>
+<description>A cereal grown for grain.</description>
+<challenges>
+- Fall armyworm
+- Striga weed
+</challenges>
+<survivability>75%</survivability>
+<reasons>
+- Two rainy seasons
+</reasons>
+"""
+
+CASSAVA = """<crop>**Cassava**</crop>
+<description>A hardy root crop.</description>
+<challenges>- Mosaic disease</challenges>
+<survivability>80-90%</survivability>
+<reasons>1. Tolerates poor soils</reasons>
+"""
+
+
+def parse(chunks):
+    parser = CropRecordParser()
+    crops = []
+    for chunk in chunks:
+        crops.extend(parser.feed(chunk))
+    crops.extend(parser.finish())
+    return dict(crops), parser
+
+
+def test_crop_record_parser_reads_every_field():
+    crops, parser = parse([MAIZE + '\n' + CASSAVA])
+    assert crops == {
+        'Maize': {
+            'description': 'A cereal grown for grain.',
+            'survivability': 75.0,
+            'reasons': ['Two rainy seasons'],
+            'challenges': ['Fall armyworm', 'Striga weed'],
+        },
+        'Cassava': {
+            'description': 'A hardy root crop.',
+            'survivability': 85.0,
+            'reasons': ['Tolerates poor soils'],
+            'challenges': ['Mosaic disease'],
+        },
+    }
+    assert (parser.parsed, parser.skipped) == (2, 0)
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 64])
+def test_crop_record_parser_streamed_matches_whole(size):
+    text = MAIZE + CASSAVA
+    streamed, _ = parse([text[i:i + size] for i in range(0, len(text), size)])
+    whole, _ = parse([text])
+    assert streamed == whole
+
+
+def test_crop_record_parser_completes_records_as_they_end():
+    parser = CropRecordParser()
+    assert parser.feed(MAIZE) == []
+    assert [name for name, _ in parser.feed(CASSAVA)] == ['Maize']
+    assert [name for name, _ in parser.finish()] == ['Cassava']
+
+
+def test_crop_record_parser_repairs_unclosed_field():
+    crops, _ = parse(["<crop>Yam<description>Tuber crop.<survivability>70%</survivability>"])
+    assert crops['Yam']['description'] == 'Tuber crop.'
+    assert crops['Yam']['survivability'] == 70.0
+
+
+def test_crop_record_parser_skips_unrepairable_records():
+    crops, parser = parse(["<crop></crop><survivability>50%</survivability>",
+                           "<crop>Sorghum</crop><survivability>n/a</survivability>",
+                           MAIZE])
+    assert list(crops) == ['Maize']
+    assert (parser.parsed, parser.skipped) == (1, 2)
+
+
+def test_crop_record_parser_ignores_stray_and_orphan_tags():
+    crops, _ = parse(["</reasons><survivability>10%</survivability>", MAIZE])
+    assert list(crops) == ['Maize']
+    assert crops['Maize']['survivability'] == 75.0
+
+
+def test_iter_crops_accepts_string_or_chunks():
+    assert dict(iter_crops(MAIZE)) == dict(iter_crops(iter([MAIZE[:20], MAIZE[20:]])))
@@ -0,0 +1,40 @@
+# File: tests/test_recommendations.py
+
+import asyncio
+import collections
+
+import pytest
+
+from kapricorn.ai_service import get_recommendations
+from kapricorn.ai_service_async import get_recommendations_async
+from kapricorn.stub_backend import classify_prompt
+
+
+@pytest.fixture
+def counted(replay):
+    """The replay backend, counting the calls per prompt kind."""
+    calls = collections.Counter()
+
+    def reply(contents):
+        calls[classify_prompt(contents)] += 1
+        return replay(contents)
+
+    reply.calls = calls
+    return reply
+
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_async_recommendations_follow_the_pipeline_setting(make_app, counted, pipeline):
+    app = make_app(reply=counted, RECOMMENDATION_PIPELINE=pipeline)
+    with app.app_context():
+        synchronous = get_recommendations('Ibadan, Oyo, Nigeria')
+        sync_calls = dict(counted.calls)
+        counted.calls.clear()
+        app.extensions['recommendation_cache'].delete('ibadan, oyo, nigeria')
+        asynchronous = asyncio.run(get_recommendations_async('Ibadan, Oyo, Nigeria'))
+
+    assert dict(counted.calls) == sync_calls
+    assert sync_calls['analysis'] == 1
+    assert (sync_calls['formatting'] > 1) is pipeline
+    crops = lambda result: sorted(key for key in result if not key.startswith('_'))
+    assert crops(asynchronous) == crops(synchronous) and crops(synchronous)
@@ -0,0 +1,109 @@
+# File: tests/test_resilience.py
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from kapricorn.resilience import ResiliencePolicy
+
+
+def make_policy():
+    return ResiliencePolicy(executor=ThreadPoolExecutor(max_workers=4), executor_workers=4,
+                            hedge_min_samples=3, hedge_min_delay=0.01, hedge_budget=1.0)
+
+
+def call(queued=0.0, upstream=0.0, result='ok'):
+    """An attempt that waits `queued` seconds (e.g. for a rate-limit slot) before sending."""
+    def attempt(sent):
+        time.sleep(queued)
+        sent()
+        time.sleep(upstream)
+        return result
+    return attempt
+
+
+def async_call(queued=0.0, upstream=0.0, result='ok'):
+    async def attempt(sent):
+        await asyncio.sleep(queued)
+        sent()
+        await asyncio.sleep(upstream)
+        return result
+    return attempt
+
+
+def test_latency_is_measured_from_send():
+    policy = make_policy()
+    policy.run('model', call(queued=0.2, upstream=0.01))
+    samples = policy._latencies['model'].samples
+    assert len(samples) == 1 and samples[0] < 0.1
+
+
+def test_queued_primary_is_not_hedged():
+    policy = make_policy()
+    for _ in range(3):
+        policy.run('model', call(upstream=0.01))
+    assert policy.run('model', call(queued=0.3, upstream=0.01)) == 'ok'
+    assert policy.stats()['hedges'] == 0
+
+
+def test_slow_upstream_call_is_hedged():
+    policy = make_policy()
+    for _ in range(3):
+        policy.run('model', call(upstream=0.01))
+    slow = iter([0.5, 0.01])
+    policy.run('model', lambda sent: call(upstream=next(slow))(sent))
+    stats = policy.stats()
+    assert (stats['hedges'], stats['hedge_wins']) == (1, 1)
+
+
+def test_primary_failing_before_send_is_not_hedged():
+    policy = make_policy()
+    for _ in range(3):
+        policy.run('model', call(upstream=0.01))
+
+    def rejected(sent):
+        raise ValueError("no slot")
+    with pytest.raises(ValueError):
+        policy.run('model', rejected)
+    assert policy.stats()['hedges'] == 0
+
+
+def test_async_queued_primary_is_not_hedged():
+    policy = make_policy()
+
+    async def scenario():
+        for _ in range(3):
+            await policy.run_async('model', async_call(upstream=0.01))
+        return await policy.run_async('model', async_call(queued=0.3, upstream=0.01))
+
+    assert asyncio.run(scenario()) == 'ok'
+    assert policy.stats()['hedges'] == 0
+    assert max(policy._latencies['model'].samples) < 0.1
+
+
+@pytest.mark.parametrize('queued, upstream', [(0.5, 0.01), (0.0, 0.5)])
+def test_async_cancelled_caller_cancels_the_primary(queued, upstream):
+    policy = make_policy()
+    cancelled = []
+
+    async def attempt(sent):
+        try:
+            await async_call(queued=queued, upstream=upstream)(sent)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        for _ in range(3):
+            await policy.run_async('model', async_call(upstream=0.2))
+        caller = asyncio.ensure_future(policy.run_async('model', attempt))
+        await asyncio.sleep(0.05) # Queued, or sent and waiting out the hedge delay
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0.01)
+        return list(cancelled) # Before asyncio.run cancels whatever is left
+
+    assert asyncio.run(scenario()) == [True]
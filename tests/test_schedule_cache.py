@@ -0,0 +1,80 @@
+# File: tests/test_schedule_cache.py
+
+import pytest
+
+from kapricorn.schedule_cache import ScheduleCache, npk_band, parse_gen_tag
+from kapricorn.stub_backend import classify_prompt
+
+
+@pytest.mark.parametrize('npk, expected', [
+    ('N:42,P:18,K:20', 'n4-p1-k2'),
+    ('n=42 p=18 k=20', 'n4-p1-k2'),
+    ('K: 20, N: 42, P: 18', 'n4-p1-k2'),
+    ('42-18-20', 'n4-p1-k2'),
+    ('N-P-K: 20/15/10', 'n2-p1-k1'),
+    ('20, 15, 10', 'n2-p1-k1'),
+    ('N:42.5,P:9.9,K:0', 'n4-p0-k0'),
+    ('N:42', 'n4-p?-k?'),
+])
+def test_npk_band(npk, expected):
+    assert npk_band(npk, 10) == expected
+
+
+def test_npk_band_width():
+    assert npk_band('N:42,P:18,K:20', 20) == 'n2-p0-k1'
+
+
+@pytest.mark.parametrize('npk', [None, '', 'N/A', 'none', 'unknown', 'no readings'])
+def test_npk_band_missing_reading(npk):
+    assert npk_band(npk, 10) == 'npk-unknown'
+
+
+@pytest.mark.parametrize('npk', ['high nitrogen', 'see soil report'])
+def test_npk_band_unreadable(npk):
+    assert npk_band(npk, 10) is None
+
+
+SCHEDULE = {
+    'query': {'cropName': 'Maize', 'location': 'Kano', 'requestDate': '2025-05-01', 'npkInput': 'N:20,P:10,K:10'},
+    'timeline': [{'stage': 'Planting', 'date': '2025-05-03'}, {'stage': 'Harvest', 'date': '2025-08-20'}],
+    '_visuals_input_tokens': 1500,
+}
+
+
+def test_schedule_cache_shifts_dates_for_a_later_request():
+    cache = ScheduleCache()
+    cache.save(parse_gen_tag('Maize|timeline|Kano|2025-05-01|N:20,P:10,K:10'), SCHEDULE)
+    schedule = cache.lookup(parse_gen_tag('maize|Timeline|kano|2025-05-06|N:24,P:12,K:15'))
+    assert schedule['_cache_hit'] is True
+    assert '_visuals_input_tokens' not in schedule
+    assert [stage['date'] for stage in schedule['timeline']] == ['2025-05-08', '2025-08-25']
+    assert schedule['query']['requestDate'] == '2025-05-06'
+
+
+@pytest.mark.parametrize('gen', [
+    'Maize|timeline|Kano|2025-07-01|N:20,P:10,K:10', # Another season bucket
+    'Maize|timeline|Kano|2025-05-01|N:40,P:10,K:10', # Another NPK band
+    'Maize|checkup|Kano|2025-05-01|N:20,P:10,K:10',
+    'Maize|timeline|Kano|early May|N:20,P:10,K:10',  # Unreadable date
+])
+def test_schedule_cache_misses(gen):
+    cache = ScheduleCache()
+    cache.save(parse_gen_tag('Maize|timeline|Kano|2025-05-01|N:20,P:10,K:10'), SCHEDULE)
+    assert cache.lookup(parse_gen_tag(gen)) is None
+
+
+def test_inline_visuals_report_cache_hits_outside_visuals_data(make_app, replay):
+    def reply(contents):
+        if classify_prompt(contents) == 'farmBot':
+            return '<r>Here is your plan.</r><gen>Maize|timeline|Kano|2025-05-01|N:20,P:10,K:10</gen><cls>MF</cls>'
+        return replay(contents)
+
+    client = make_app(reply=reply, VISUALS_ASYNC=False).test_client()
+    body = {'message': 'Plan my maize', 'history': [], 'location': 'Kano, Nigeria',
+            'npk': 'N:20,P:10,K:10', 'date': '2025-05-01'}
+    first = client.post('/api/chat/', json=body).get_json()
+    second = client.post('/api/chat/', json=body).get_json()
+    assert first['_visuals_cached'] is False and second['_visuals_cached'] is True
+    assert second['_visuals_input_tokens'] == 0
+    assert second['visuals_data']['timeline'] == first['visuals_data']['timeline']
+    assert not any(key.startswith('_') for key in second['visuals_data'])
@@ -0,0 +1,100 @@
+# File: tests/test_scheduler.py
+
+import asyncio
+
+import pytest
+
+from kapricorn.scheduler import LoadShed, WorkloadScheduler, parse_workloads
+from kapricorn.stub_backend import classify_prompt
+
+WORKLOADS = 'high=2:4:16:5,low=1:4:16:5,batch=1:4:1:5'
+
+
+def test_parse_workloads_defaults_missing_fields():
+    assert parse_workloads('a=8:16:64:1,b=2') == {'a': (8.0, 16, 64, 1.0), 'b': (2.0, 4, 16, 5.0)}
+
+
+def test_contended_slots_follow_the_weights():
+    async def scenario():
+        scheduler = WorkloadScheduler(WORKLOADS, capacity=1)
+        holder = await scheduler.acquire_async('high')
+        order = []
+
+        async def request(workload):
+            slot = await scheduler.acquire_async(workload)
+            order.append(workload)
+            slot.release()
+
+        tasks = [asyncio.ensure_future(request(workload)) for workload in ['low'] * 4 + ['high'] * 4]
+        await asyncio.sleep(0.01)
+        holder.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    # Stride scheduling: 'high' (weight 2) gets two slots for each of 'low' (weight 1)
+    assert asyncio.run(scenario()) == ['high', 'low', 'high', 'high', 'low', 'high', 'low', 'low']
+
+
+def test_lowest_class_is_shed_when_a_higher_class_queues():
+    async def scenario():
+        scheduler = WorkloadScheduler(WORKLOADS, capacity=1)
+        holder = await scheduler.acquire_async('high')
+        queued = asyncio.ensure_future(scheduler.acquire_async('batch'))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.ensure_future(scheduler.acquire_async('low'))
+        await asyncio.sleep(0.01)
+        with pytest.raises(LoadShed) as shed:
+            await queued
+        with pytest.raises(LoadShed) as rejected: # New arrivals too, while 'low' waits
+            await scheduler.acquire_async('batch')
+        holder.release()
+        (await waiting).release()
+        return shed.value, rejected.value, scheduler.stats()['workloads']['batch']
+
+    shed, rejected, stats = asyncio.run(scenario())
+    assert shed.reason == rejected.reason == 'shed'
+    assert shed.retry_after >= 1
+    assert stats['shed'] == 2
+
+
+def test_full_queue_and_long_waits_are_rejected():
+    scheduler = WorkloadScheduler(WORKLOADS, capacity=1, max_wait_seconds=0.05)
+    with scheduler.slot('high'):
+        with pytest.raises(LoadShed) as timed_out:
+            scheduler.acquire('batch')
+        assert timed_out.value.reason == 'timeout'
+
+    async def scenario():
+        holder = await scheduler.acquire_async('high')
+        queued = asyncio.ensure_future(scheduler.acquire_async('batch'))
+        await asyncio.sleep(0.01)
+        with pytest.raises(LoadShed) as full:
+            await scheduler.acquire_async('batch') # max_queue is 1
+        holder.release()
+        (await queued).release()
+        return full.value
+
+    assert asyncio.run(scenario()).reason == 'queue_full'
+
+
+def test_disabled_scheduler_admits_everything():
+    scheduler = WorkloadScheduler(WORKLOADS, capacity=1, enabled=False)
+    slots = [scheduler.acquire('batch') for _ in range(5)]
+    for slot in slots:
+        slot.release()
+    assert scheduler.stats()['active'] == 0
+
+
+def test_inline_visuals_run_in_the_chat_turns_slot(make_app, replay):
+    def reply(contents):
+        if classify_prompt(contents) == 'farmBot':
+            return '<r>Here is your plan.</r><gen>Maize|timeline|Kano|2025-05-01|N:20,P:10,K:10</gen><cls>MF</cls>'
+        return replay(contents)
+
+    # One slot in all: a second admission for the visuals would wait it out and fail
+    app = make_app(reply=reply, VISUALS_ASYNC=False, SCHEDULER_MAX_CONCURRENCY=1, SCHEDULER_MAX_WAIT_SECONDS=0.2)
+    body = {'message': 'Plan my maize', 'history': [], 'location': 'Kano, Nigeria',
+            'npk': 'N:20,P:10,K:10', 'date': '2025-05-01'}
+    payload = app.test_client().post('/api/chat/', json=body).get_json()
+    assert payload['visuals_data'] is not None
+    assert app.extensions['scheduler'].stats()['workloads']['visuals']['timed_out'] == 0
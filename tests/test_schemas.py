@@ -0,0 +1,100 @@
+# File: tests/test_schemas.py
+
+import json
+
+import pytest
+
+from kapricorn.schemas import (
+    CropRecommendations, StructuredOutputError, VisualsData, crops_from_json, json_generation_config,
+    packed_crops_from_json, repair_json, visuals_from_json,
+)
+
+
+def _crop(name, survivability=70):
+    return {"crop": name, "description": f"{name} description.", "challenges": ["Pests"],
+            "survivability": survivability, "reasons": ["Good rainfall"]}
+
+
+def _visuals(**schedule):
+    return {"query": {"cropName": "Maize", "generationType": "timeline", "location": "Kano",
+                      "requestDate": "2025-05-01", "npkInput": "N:20,P:10,K:10"}, **schedule}
+
+
+_TIMELINE = {"estimatedPlantingWindow": "May", "estimatedHarvestWindow": "August",
+             "stages": [{"stageName": "Planting", "estimatedDateRange": "2025-05-01 to 2025-05-10"}]}
+
+
+def test_visuals_from_json_drops_the_missing_schedule():
+    visuals = visuals_from_json(json.dumps(_visuals(timeline=_TIMELINE)))
+    assert "checkupSchedule" not in visuals
+    assert visuals["timeline"]["stages"][0]["keyActivities"] == []
+
+
+def test_visuals_from_json_requires_a_schedule():
+    with pytest.raises(StructuredOutputError):
+        visuals_from_json(json.dumps(_visuals()))
+
+
+def test_visuals_from_json_repairs_wrapped_replies_locally():
+    text = "<data>```json\n" + json.dumps(_visuals(timeline=_TIMELINE))[:-1] + ", /* done */}\n```</data>"
+    assert visuals_from_json(text)["timeline"]["estimatedHarvestWindow"] == "August"
+
+
+def test_repair_json_leaves_strings_alone():
+    assert json.loads(repair_json('{"note": "a, } // not a comment",}')) == {"note": "a, } // not a comment"}
+
+
+def test_crops_from_json_normalizes_like_the_tagged_format():
+    crops = crops_from_json(json.dumps({"crops": [
+        dict(_crop("Maize", "60-70%"), crop="**Maize**", challenges="- Pests\n- Drought"),
+    ]}))
+    assert crops == {"Maize": {"description": "Maize description.", "survivability": 65.0,
+                               "reasons": ["Good rainfall"], "challenges": ["Pests", "Drought"]}}
+
+
+def test_crops_from_json_skips_malformed_crops():
+    text = json.dumps({"crops": [_crop("Maize"), {"crop": "Broken"}, _crop("Yam", "unknown")]})
+    assert list(crops_from_json(text)) == ["Maize"]
+    with pytest.raises(StructuredOutputError):
+        crops_from_json(json.dumps({"crops": [{"crop": "Broken"}]}))
+
+
+def test_json_generation_config_inlines_the_schema():
+    config = json_generation_config(CropRecommendations)
+    assert config["response_mime_type"] == "application/json"
+    crop = config["response_schema"]["properties"]["crops"]["items"]
+    assert crop["required"] == ["crop", "description", "challenges", "survivability", "reasons"]
+    assert "$ref" not in json.dumps(config) and "$defs" not in json.dumps(config)
+    nullable = json_generation_config(VisualsData)["response_schema"]["properties"]["timeline"]
+    assert nullable["nullable"] is True and nullable["type"] == "object"
+
+
+def test_packed_crops_from_json_keys_by_location():
+    text = json.dumps({"locations": [
+        {"location": 1, "crops": [_crop("Maize"), _crop("Cassava", "85%")]},
+        {"location": 3, "crops": [_crop("Yam")]},
+    ]})
+    packed = packed_crops_from_json(text)
+    assert list(packed) == [1, 3]
+    assert list(packed[1]) == ["Maize", "Cassava"]
+    assert packed[1]["Cassava"]["survivability"] == 85.0
+
+
+def test_packed_crops_from_json_leaves_out_unusable_locations():
+    text = json.dumps({"locations": [
+        {"location": 1, "crops": [_crop("Maize")]},
+        {"location": 1, "crops": [_crop("Sorghum")]},
+        {"location": 2, "crops": []},
+        {"location": "three", "crops": [_crop("Yam")]},
+        {"location": 4, "crops": [_crop("Cowpea"), {"crop": "Broken"}]},
+    ]})
+    packed = packed_crops_from_json(text)
+    assert list(packed) == [1, 4]
+    assert list(packed[1]) == ["Maize"] # The first entry for a location wins
+    assert list(packed[4]) == ["Cowpea"]
+
+
+def test_packed_crops_from_json_without_usable_locations():
+    assert packed_crops_from_json('{"locations": [{"location": 1, "crops": []}]}') == {}
+    with pytest.raises(StructuredOutputError):
+        packed_crops_from_json('{"locations": [{"location": "one", "crops": []}]}')
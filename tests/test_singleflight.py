@@ -0,0 +1,135 @@
+# File: tests/test_singleflight.py
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from kapricorn.singleflight import SingleFlight
+
+
+def test_do_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'answer'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('k', fn)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('k', fn))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert calls == [1]
+    assert sorted(results) == [('answer', False)] + [('answer', True)] * 3
+    assert flight.stats() == {'executions': 1, 'coalesced': 3, 'in_flight': 0}
+
+
+def test_do_shares_the_leaders_exception():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError('upstream failed')
+
+    errors = []
+
+    def call():
+        try:
+            flight.do('k', fail)
+        except ValueError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert errors == ['upstream failed'] * 2
+
+
+def test_do_runs_again_once_the_call_completed():
+    flight = SingleFlight()
+    assert flight.do('k', lambda: 1) == (1, False)
+    assert flight.do('k', lambda: 2) == (2, False)
+
+
+def test_do_async_coalesces_concurrent_calls():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def coro_fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'answer'
+
+        results = await asyncio.gather(*(flight.do_async('k', coro_fn) for _ in range(4)))
+        return calls, results, flight.stats()
+
+    calls, results, stats = asyncio.run(scenario())
+    assert calls == [1]
+    assert sorted(results) == [('answer', False)] + [('answer', True)] * 3
+    assert stats == {'executions': 1, 'coalesced': 3, 'in_flight': 0}
+
+
+def test_do_async_followers_survive_a_cancelled_leader():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def coro_fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'answer'
+
+        leader = asyncio.create_task(flight.do_async('k', coro_fn))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(flight.do_async('k', coro_fn)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel() # Its client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, await asyncio.gather(*followers)
+
+    calls, results = asyncio.run(scenario())
+    assert calls == [1, 1] # One follower took over
+    assert sorted(results) == [('answer', False)] + [('answer', True)] * 2
+
+
+def test_do_async_cancelled_follower_leaves_the_leader_running():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def coro_fn():
+            await asyncio.sleep(0.05)
+            return 'answer'
+
+        leader = asyncio.create_task(flight.do_async('k', coro_fn))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flight.do_async('k', coro_fn))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        return await leader
+
+    assert asyncio.run(scenario()) == ('answer', False)
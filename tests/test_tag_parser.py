@@ -0,0 +1,91 @@
+# File: tests/test_tag_parser.py
+
+import pytest
+
+from kapricorn.prompts import extract_tags
+from kapricorn.tag_parser import StreamingTagFilter, TagParser
+
+
+def parse(text, tags=('p', 'g', 'r', 'gr', 'cls', 'gen')):
+    return TagParser(tags).parse(text)
+
+
+def test_extracts_each_tag_and_strips_content():
+    result = parse("<r> Plant in May. </r><cls>FI</cls>")
+    assert result == {'p': None, 'g': None, 'r': 'Plant in May.', 'gr': None, 'cls': 'FI', 'gen': None}
+
+
+def test_first_top_level_element_wins():
+    assert parse("<r>first</r><r>second</r>")['r'] == 'first'
+
+
+def test_nested_tags_belong_to_their_parent():
+    result = parse("<p><r>inner</r></p>")
+    assert result['p'] == '<r>inner</r>'
+    assert result['r'] is None
+
+
+def test_similar_tag_names_are_not_confused():
+    result = parse("<gr>greeting</gr><g>context</g><gen>Maize|timeline</gen>")
+    assert (result['gr'], result['g'], result['gen']) == ('greeting', 'context', 'Maize|timeline')
+
+
+def test_stray_closing_marker_is_ignored():
+    assert parse("</r><r>reply</r>")['r'] == 'reply'
+
+
+def test_closing_marker_closes_unclosed_inner_tags():
+    result = parse("<p><r>unclosed</p><r>reply</r>")
+    assert result['p'] == '<r>unclosed'
+    assert result['r'] == 'reply'
+
+
+def test_unclosed_element_does_not_count_but_its_children_do():
+    result = parse("<p><r>reply</r><cls>FI</cls>")
+    assert result['p'] is None
+    assert (result['r'], result['cls']) == ('reply', 'FI')
+
+
+def test_only_requested_tags_are_reported():
+    assert parse("<data>{}</data><r>x</r>", tags=('data',)) == {'data': '{}'}
+
+
+@pytest.mark.parametrize('size', [1, 2, 5, 100])
+def test_streamed_parse_matches_whole(size):
+    text = "<g>ctx</g><r>Space cassava 1m x 1m.</r><cls>FI</cls><gen>a|b|c|d|e</gen>"
+    parser = TagParser()
+    completed = []
+    for i in range(0, len(text), size):
+        completed.extend(parser.feed(text[i:i + size]))
+    assert parser.result() == parse(text)
+    assert completed == ['g', 'r', 'cls', 'gen']
+
+
+def test_streaming_filter_shows_only_reply_text():
+    chunks = ["<g>hidden</g><r>Hel", "lo</", "r><cls>FI</cls><r> again</r>"]
+    tag_filter = StreamingTagFilter()
+    visible = ''.join(tag_filter.feed(chunk) for chunk in chunks) + tag_filter.flush()
+    assert visible == "Hello again"
+    assert tag_filter.text == ''.join(chunks)
+
+
+def test_extract_tags_reads_multiline_replies():
+    response = "<gr>Hello!</gr>\n<r>\nStep 1: clear the land.\nStep 2: plant.\n</r>\n<cls>MF</cls>"
+    result = extract_tags(response)
+    assert result['r'] == "Step 1: clear the land.\nStep 2: plant."
+    assert (result['gr'], result['cls'], result['gen']) == ('Hello!', 'MF', None)
+
+
+def test_extract_tags_with_custom_tags():
+    assert extract_tags("<data>{\"a\": 1}</data>", tags=['data']) == {'data': '{"a": 1}'}
+
+
+def test_feed_keeps_only_a_short_tail_between_chunks():
+    parser = TagParser()
+    parser.feed("<r>")
+    for _ in range(2000):
+        parser.feed("word ")
+        # Only a possible split marker is held back, so each chunk is scanned once
+        assert len(parser._tail) < parser._max_marker_len
+    parser.feed("</r>")
+    assert parser.result()['r'] == ("word " * 2000).strip()
@@ -0,0 +1,80 @@
+# File: tests/test_telemetry.py
+
+import pytest
+
+from kapricorn.clients import key_fingerprint
+from kapricorn.telemetry import Telemetry
+
+
+def _lines(telemetry, prefix):
+    return [line for line in telemetry.render().splitlines() if line.startswith(prefix)]
+
+
+def test_histograms_are_cumulative_on_export():
+    telemetry = Telemetry(buckets=(0.1, 1.0))
+    labels = (('endpoint', 'chat.chat'), ('stage', 'parse'))
+    for seconds in (0.05, 0.5, 0.5, 5.0):
+        telemetry.observe('kapricorn_stage_duration_seconds', seconds, labels)
+    assert _lines(telemetry, 'kapricorn_stage_duration_seconds_') == [
+        'kapricorn_stage_duration_seconds_bucket{endpoint="chat.chat",stage="parse",le="0.1"} 1',
+        'kapricorn_stage_duration_seconds_bucket{endpoint="chat.chat",stage="parse",le="1.0"} 3',
+        'kapricorn_stage_duration_seconds_bucket{endpoint="chat.chat",stage="parse",le="+Inf"} 4',
+        'kapricorn_stage_duration_seconds_sum{endpoint="chat.chat",stage="parse"} 6.05',
+        'kapricorn_stage_duration_seconds_count{endpoint="chat.chat",stage="parse"} 4',
+    ]
+
+
+def test_model_call_records_latency_outcome_and_tokens():
+    telemetry = Telemetry()
+    labels = telemetry.call_labels(None, 'gemini-flash', 'secret-key')
+    with telemetry.model_call(labels):
+        pass
+    with pytest.raises(TimeoutError):
+        with telemetry.model_call(labels):
+            raise TimeoutError()
+    telemetry.count_tokens(labels, 120, 0)
+
+    key = key_fingerprint('secret-key')
+    series = f'route="other",model="gemini-flash",key="{key}"'
+    assert _lines(telemetry, 'kapricorn_model_calls_total') == [
+        f'kapricorn_model_calls_total{{{series},outcome="TimeoutError"}} 1',
+        f'kapricorn_model_calls_total{{{series},outcome="ok"}} 1',
+    ]
+    # Only successful calls feed the latency histogram; zero counts are not recorded
+    assert _lines(telemetry, 'kapricorn_model_call_duration_seconds_count') == [
+        f'kapricorn_model_call_duration_seconds_count{{{series},stream="false"}} 1']
+    assert _lines(telemetry, 'kapricorn_tokens_total') == [
+        f'kapricorn_tokens_total{{{series},direction="input"}} 120']
+    assert 'secret-key' not in telemetry.render()
+    # Outside a request, stages are labelled as background work
+    assert any('endpoint="background",stage="model_call"' in line
+               for line in _lines(telemetry, 'kapricorn_stage_duration_seconds_count'))
+
+
+def test_label_values_are_escaped():
+    telemetry = Telemetry()
+    telemetry.increment('kapricorn_model_calls_total', 1, (('model', 'a"b\\c\nd'),))
+    assert _lines(telemetry, 'kapricorn_model_calls_total') == [
+        'kapricorn_model_calls_total{model="a\\"b\\\\c\\nd"} 1']
+
+
+def test_disabled_telemetry_records_nothing():
+    telemetry = Telemetry(enabled=False)
+    with telemetry.span('parse'), telemetry.model_call(telemetry.call_labels('chat', 'm', 'k')):
+        pass
+    assert telemetry.stats() == {'enabled': False, 'histogram_series': 0, 'counter_series': 0}
+
+
+def test_metrics_endpoint_exposes_the_request_and_its_stages(make_app):
+    app = make_app()
+    client = app.test_client()
+    body = {'message': 'When do I plant maize?', 'history': [], 'location': 'Kano, Nigeria',
+            'npk': 'N/A', 'date': '2025-05-01'}
+    assert client.post('/api/chat/', json=body).status_code == 200
+    response = client.get('/metrics')
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    assert '# TYPE kapricorn_http_request_duration_seconds histogram' in text
+    assert 'kapricorn_http_request_duration_seconds_count{endpoint="chat.handle_chat",method="POST",status="200"} 1' in text
+    assert 'stage="model_call"' in text
+    assert 'kapricorn_tokens_total{route="chat",model="stub-chat"' in text
@@ -0,0 +1,73 @@
+# File: tests/test_tokens.py
+
+from types import SimpleNamespace
+
+import pytest
+
+from kapricorn.ai_service import call_ai_model
+from kapricorn.stub_backend import StubModel, StubReply
+from kapricorn.tokens import IMAGE_TOKEN_ESTIMATE, TokenAccountant, content_size, estimate_tokens
+
+
+def _response(prompt_tokens, output_tokens):
+    return SimpleNamespace(usage_metadata=SimpleNamespace(
+        prompt_token_count=prompt_tokens, candidates_token_count=output_tokens))
+
+
+def test_content_size_counts_history_text_and_images():
+    history = [
+        {'role': 'user', 'parts': ['Hello', {'inline_data': {'mime_type': 'image/jpeg', 'data': b''}}]},
+        {'role': 'model', 'parts': 'Hi there'},
+        {'role': 'user', 'parts': [{'image_id': 'abc'}]},
+    ]
+    assert content_size(history) == (13, 2)
+    assert content_size('abcd') == (4, 0)
+
+
+def test_estimate_tokens_adds_a_fixed_cost_per_image():
+    assert estimate_tokens('a' * 35) == 10
+    assert estimate_tokens([{'parts': [{'image_id': 'x'}]}]) == IMAGE_TOKEN_ESTIMATE
+
+
+def test_account_uses_usage_metadata_and_calibrates_the_ratio():
+    accountant = TokenAccountant()
+    prompt, reply = 'p' * 800, 'r' * 400
+    assert accountant.account('flash', prompt, _response(200, 100), reply) == (200, 100)
+    assert accountant.chars_per_token('flash') == pytest.approx(4.0)
+    assert accountant.chars_per_token('other') == 3.5
+    # Later estimates for the model use its observed ratio
+    assert accountant.estimate('x' * 400, 'flash') == 100
+    assert accountant.stats()['exact_counts'] == 1
+
+
+def test_account_estimates_what_usage_metadata_leaves_out():
+    accountant = TokenAccountant()
+    response = _response(0, 0) # e.g. a blocked response
+    assert accountant.account('flash', 'p' * 35, response, 'r' * 70) == (10, 20)
+    assert accountant.account('flash', 'p' * 35, SimpleNamespace(), '') == (10, 0)
+    stats = accountant.stats()
+    assert (stats['exact_counts'], stats['estimated_counts']) == (0, 2)
+    assert stats['chars_per_token'] == {}
+
+
+def test_small_or_image_only_samples_do_not_move_the_ratio():
+    accountant = TokenAccountant()
+    accountant.observe('flash', 'short', 50)
+    accountant.observe('flash', [{'parts': ['a' * 300, {'image_id': 'x'}]}], IMAGE_TOKEN_ESTIMATE)
+    assert accountant.chars_per_token('flash') == 3.5
+    accountant.observe('flash', 'a' * 400, 100)
+    accountant.observe('flash', 'a' * 400, 200)
+    assert accountant.chars_per_token('flash') == pytest.approx(4.0 + 0.2 * (2.0 - 4.0))
+
+
+def test_call_ai_model_reports_usage_without_counting_round_trips(make_app, monkeypatch):
+    def no_count_tokens(self, contents):
+        raise AssertionError('count_tokens called')
+
+    monkeypatch.setattr(StubModel, 'count_tokens', no_count_tokens)
+    app = make_app(reply=lambda contents: StubReply('<r>ok</r>', prompt_tokens=321, output_tokens=7))
+    with app.app_context():
+        result = call_ai_model('Hello', 'stub-chat', 'stub-key')
+        stats = app.extensions['token_accountant'].stats()
+    assert (result['input_tokens'], result['output_tokens']) == (321, 7)
+    assert stats['exact_counts'] == 1